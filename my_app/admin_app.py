@@ -1,69 +1,93 @@
 # my_app/admin_app.py
 import streamlit as st
-import requests
 import os
-from database import initialize_database, get_tasks_by_status, update_task_status, get_credentials
+from database import initialize_database, update_task_status, get_credentials
+from admin_data import TaskView
+from line_profiles import get_profiles
+from task_traces import load_trace
 from linebot import LineBotApi
 from linebot.models import TextSendMessage
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# จำนวนการ์ดต่อหน้า: สร้าง Widget เฉพาะหน้าที่เปิดอยู่ แม้จะมีงานรออนุมัติหลายพันงาน
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "50"))
+
 # --- Page Setup ---
 st.set_page_config(page_title="Admin Dashboard", layout="wide")
 st.title("🤖 Admin Dashboard: Review AI Responses")
 st.write("ตรวจสอบและแก้ไขคำตอบของ AI ก่อนส่งให้ลูกค้า")
 
 # --- Initialize Database ---
-db_uri = initialize_database()
+@st.cache_resource
+def init_db():
+    return initialize_database()
+
+db_uri = init_db()
 
 # --- Helper functions ---
-@st.cache_data
-def get_user_profile(user_id):
-    """Fetches user profile (name and picture) from LINE API."""
-    credentials_data = get_credentials(user_id)
-    if not credentials_data:
-        print(f"Credentials not found for user: {user_id}")
-        return user_id, None
-    
-    line_bot_api = LineBotApi(credentials_data['channel_access_token'])
-    try:
-        profile = line_bot_api.get_profile(user_id)
-        return profile.display_name, profile.picture_url
-    except Exception as e:
-        print(f"Error fetching user profile for {user_id}: {e}")
-        return user_id, None
+# เวลาที่ยอมรอ Profile ที่ยังไม่เคยดึง (ที่เหลือจะแสดงในการโหลดครั้งถัดไป)
+PROFILE_WAIT_SECONDS = float(os.getenv("ADMIN_PROFILE_WAIT_SECONDS", "3"))
 
-def send_line_message(user_id, message):
-    """Sends a message back to the user via LINE Push API using the correct token."""
-    credentials_data = get_credentials(user_id)
+def get_user_profiles(tasks):
+    """Returns {(store user_id, line_id): (name, picture_url)} for the tasks' customers from the line_profiles cache."""
+    line_ids_by_store = {}
+    for task in tasks:
+        line_ids_by_store.setdefault(task['user_id'], []).append(task['line_id'])
+    profiles = {}
+    for store_user_id, line_ids in line_ids_by_store.items():
+        for line_id, profile in get_profiles(store_user_id, line_ids, wait_seconds=PROFILE_WAIT_SECONDS).items():
+            profiles[(store_user_id, line_id)] = (profile['display_name'] or line_id, profile['picture_url'])
+    return profiles
+
+def send_line_message(store_user_id, line_id, message):
+    """Sends a message back to the customer via LINE Push API using the store's token."""
+    credentials_data = get_credentials(store_user_id)
     if not credentials_data:
-        st.error(f"ไม่พบข้อมูล Channel API สำหรับผู้ใช้: {user_id}")
+        st.error(f"ไม่พบข้อมูล Channel API สำหรับร้าน: {store_user_id}")
         return False
     
     line_bot_api = LineBotApi(credentials_data['channel_access_token'])
     try:
         line_bot_api.push_message(
-            user_id,
+            line_id,
             TextSendMessage(text=message)
         )
         return True
     except Exception as e:
-        print(f"Error sending message to {user_id}: {e}")
+        print(f"Error sending message to {line_id}: {e}")
         return False
 
+def finish_task(task, status):
+    update_task_status(task['task_id'], status)
+    # ลบการ์ดออกทันทีโดยไม่ต้องรอ Refresh รอบถัดไป
+    task_view.apply_local(task['task_id'], status)
+
 # --- Main UI for Awaiting Approval Tasks ---
 st.header("ข้อความที่รอการอนุมัติ")
-tasks = get_tasks_by_status("Awaiting_Approval")
 
-if not tasks:
+# 🟢 TaskView อยู่ใน session_state: Rerun จากการกดปุ่มอ่านเฉพาะ Task ที่เปลี่ยนตั้งแต่ครั้งก่อน
+if "task_view" not in st.session_state:
+    st.session_state.task_view = TaskView("Awaiting_Approval")
+task_view = st.session_state.task_view
+if st.button("🔄 โหลดใหม่"):
+    task_view.refresh(force=True)
+else:
+    task_view.refresh()
+
+if not len(task_view):
     st.info("ไม่มีข้อความที่รอการอนุมัติในขณะนี้")
 else:
+    page_count = (len(task_view) + ADMIN_PAGE_SIZE - 1) // ADMIN_PAGE_SIZE
+    page_number = st.number_input(f"หน้า (ทั้งหมด {page_count} หน้า, {len(task_view)} งาน)", min_value=1, max_value=page_count, value=1) - 1
+    tasks = task_view.page(page_number, ADMIN_PAGE_SIZE)
+    profiles = get_user_profiles(tasks)
     for task in tasks:
-        # Note: We assume 'line_id' in tasks table is our unique 'user_id'
+        # line_id คือลูกค้า ส่วน user_id คือร้าน (เจ้าของ Channel)
         user_id = task['line_id']
         with st.expander(f"ข้อความจากลูกค้า"):
-            user_name, user_pic = get_user_profile(user_id)
+            user_name, user_pic = profiles[(task['user_id'], user_id)]
             
             # Display user profile
             st.markdown("---")
@@ -89,6 +113,19 @@ else:
             else:
                 ai_response = ai_response_full
             
+            # Trace ของ Agent: Expander รันเนื้อหาทุกครั้งแม้ปิดอยู่ จึงโหลดเฉพาะเมื่อเปิด Toggle
+            if st.toggle("แสดงขั้นตอนของ AI", key=f"trace_{task['task_id']}"):
+                trace = load_trace(task['task_id'], task['user_id'])
+                if trace is None:
+                    st.caption("ไม่มี Trace ของงานนี้")
+                else:
+                    if trace.get("usage"):
+                        st.caption(f"{trace['usage']['llm_calls']} LLM calls · {trace['usage']['tokens']} tokens · {trace['usage']['seconds']}s")
+                    for index, step in enumerate(trace["steps"], start=1):
+                        st.markdown(f"**{index}. {step['tool'] or 'step'}**")
+                        st.code(step['tool_input'] if isinstance(step['tool_input'], str) else str(step['tool_input']))
+                        st.text(step['observation'])
+
             # Editable text area for admin to review/edit
             edited_response = st.text_area(
                 "คำตอบที่แก้ไข",
@@ -100,8 +137,8 @@ else:
             with col1:
                 if st.button("บันทึกและส่งข้อความ", key=f"save_{task['task_id']}"):
                     final_response = edited_response
-                    if send_line_message(user_id, final_response):
-                        update_task_status(task['task_id'], "Sent")
+                    if send_line_message(task['user_id'], user_id, final_response):
+                        finish_task(task, "Sent")
                         st.success("ส่งข้อความสำเร็จ! สถานะอัปเดตแล้ว")
                         st.rerun()
                     else:
@@ -109,14 +146,14 @@ else:
             with col2:
                 if st.button("อนุมัติและส่งข้อความ", key=f"approve_{task['task_id']}"):
                     final_response = edited_response
-                    if send_line_message(user_id, final_response):
-                        update_task_status(task['task_id'], "Sent")
+                    if send_line_message(task['user_id'], user_id, final_response):
+                        finish_task(task, "Sent")
                         st.success("ส่งข้อความสำเร็จ! สถานะอัปเดตแล้ว")
                         st.rerun()
                     else:
                         st.error("เกิดข้อผิดพลาดในการส่งข้อความ LINE")
             
             if st.button("ปฏิเสธ (ยกเลิกงาน)", key=f"reject_{task['task_id']}"):
-                update_task_status(task['task_id'], "Rejected")
+                finish_task(task, "Rejected")
                 st.warning("งานถูกปฏิเสธแล้ว")
                 st.rerun()
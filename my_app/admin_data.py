@@ -0,0 +1,121 @@
+# admin_data.py
+
+import os
+import sqlite3
+import time
+
+import metrics
+from database import get_connection
+
+# =========================================================================
+# 🟢 Data Layer ของ Admin Console (admin_app.py, Streamlit)
+# Streamlit รันสคริปต์ใหม่ทั้งไฟล์ทุกครั้งที่มีการกดปุ่ม เดิมจึง Query งานทั้งหมดใหม่ทุก Rerun
+# - TaskView: โหลดงานของสถานะหนึ่งครั้งแรกครั้งเดียว หลังจากนั้นอ่านเฉพาะ Task ที่เปลี่ยนตั้งแต่ event_id ล่าสุดที่เห็น
+#   (ตาราง task_events ที่ Trigger ของ tasks เขียนไว้) และไม่อ่านซ้ำถ้า Refresh ล่าสุดยังไม่เกิน ADMIN_REFRESH_SECONDS
+# Profile ของลูกค้าดูได้จาก line_profiles.py
+# =========================================================================
+
+ADMIN_REFRESH_SECONDS = float(os.getenv("ADMIN_REFRESH_SECONDS", "2"))
+
+_TASK_COLUMNS = "t.task_id, t.user_id, t.line_id, t.user_message, t.ai_response, t.admin_response, t.status, t.timestamp"
+
+
+class TaskView:
+    """Tasks with one status (optionally of one store), kept current by applying task_events deltas."""
+
+    def __init__(self, status, user_id=None, refresh_seconds=ADMIN_REFRESH_SECONDS):
+        self.status = status
+        self.user_id = user_id
+        self.refresh_seconds = refresh_seconds
+        self.tasks = {}
+        # event_id ล่าสุดที่รวมอยู่ใน self.tasks แล้ว (None = ยังไม่เคยโหลด)
+        self.event_cursor = None
+        # เพิ่มขึ้นทุกครั้งที่เนื้อหาเปลี่ยน (ใช้เป็น Key ของผลที่เรียงไว้)
+        self.version = 0
+        self.refreshed_at = 0.0
+        self.full_loads = 0
+        self.delta_loads = 0
+        self._sorted = (None, [])
+
+    def _store_filter(self, alias):
+        return (f" AND {alias}.user_id = ?", (self.user_id,)) if self.user_id is not None else ("", ())
+
+    def _full_load(self, conn):
+        store_sql, store_params = self._store_filter("t")
+        rows = conn.execute(
+            f"SELECT {_TASK_COLUMNS} FROM tasks t WHERE t.status = ?{store_sql}", (self.status, *store_params)
+        ).fetchall()
+        self.tasks = {row["task_id"]: dict(row) for row in rows}
+        self.full_loads += 1
+        metrics.increment("admin_task_loads", kind="full")
+
+    def _delta_load(self, conn, cursor):
+        store_sql, store_params = self._store_filter("e")
+        rows = conn.execute(f"""
+            SELECT {_TASK_COLUMNS} FROM tasks t
+            WHERE t.task_id IN (SELECT e.task_id FROM task_events e WHERE e.event_id > ?{store_sql})
+        """, (cursor, *store_params)).fetchall()
+        for row in rows:
+            if row["status"] == self.status:
+                self.tasks[row["task_id"]] = dict(row)
+            else:
+                self.tasks.pop(row["task_id"], None)
+        self.delta_loads += 1
+        metrics.increment("admin_task_loads", kind="delta")
+        return len(rows)
+
+    def refresh(self, force=False):
+        """Brings the view up to date. Returns True when its content may have changed."""
+        if not force and self.event_cursor is not None and time.monotonic() - self.refreshed_at < self.refresh_seconds:
+            return False
+        conn = get_connection()
+        conn.row_factory = sqlite3.Row
+        try:
+            # อ่าน event_id และแถว Task ใน Snapshot เดียวกัน (WAL) เพื่อไม่ให้ Event ที่ Commit ระหว่างนั้นหายไป
+            conn.execute("BEGIN")
+            latest, oldest = conn.execute("SELECT COALESCE(MAX(event_id), 0), MIN(event_id) FROM task_events").fetchone()
+            if latest == self.event_cursor:
+                changed = False
+            elif self.event_cursor is None or (oldest is not None and self.event_cursor < oldest - 1):
+                # ยังไม่เคยโหลด หรือ Event ที่พลาดไปถูกลบแล้ว: โหลดทั้งหมดใหม่
+                self._full_load(conn)
+                changed = True
+            else:
+                changed = self._delta_load(conn, self.event_cursor) > 0
+            conn.execute("COMMIT")
+            self.event_cursor = latest
+        except sqlite3.Error as e:
+            print(f"Database error refreshing admin tasks: {e}")
+            return False
+        finally:
+            conn.close()
+        self.refreshed_at = time.monotonic()
+        if changed:
+            self.version += 1
+        return changed
+
+    def apply_local(self, task_id, status):
+        """Reflects a status change this console just wrote, without waiting for the next refresh."""
+        task = self.tasks.get(task_id)
+        if task is None:
+            return
+        if status == self.status:
+            task["status"] = status
+        else:
+            del self.tasks[task_id]
+        self.version += 1
+
+    def sorted_tasks(self):
+        """Tasks newest first (same order as get_tasks_by_status), re-sorted only when the view changed."""
+        version, tasks = self._sorted
+        if version != self.version:
+            tasks = sorted(self.tasks.values(), key=lambda task: (task["timestamp"] or "", task["task_id"]), reverse=True)
+            self._sorted = (self.version, tasks)
+        return tasks
+
+    def page(self, number, size):
+        """One page (0-based) of sorted_tasks."""
+        return self.sorted_tasks()[number * size:(number + 1) * size]
+
+    def __len__(self):
+        return len(self.tasks)
@@ -0,0 +1,201 @@
+# admission.py
+
+import collections
+import os
+import threading
+import time
+
+import metrics
+from task_status import AWAITING_APPROVAL
+from write_buffer import stage_task_status
+
+# =========================================================================
+# 🟢 Admission Control + Load Shedding ของ Agent Run
+# เดิมไม่มีอะไรจำกัดจำนวน Agent Run ที่ทำงานพร้อมกัน โพสต์ไวรัลของร้านเดียวส่งข้อความหลายพันข้อความ
+# เข้ามาพร้อมกัน ทำให้ Thread/หน่วยความจำ/โควตา API หมด และร้านอื่นต้องรอคิวหลังร้านนั้นทั้งหมด
+#   - FairScheduler: จำกัด Agent Run ทั้งระบบ (ADMISSION_MAX_IN_FLIGHT) และต่อร้าน (ADMISSION_MAX_IN_FLIGHT_PER_STORE)
+#     บทสนทนาที่รอถูกหยิบแบบ Round-robin ทีละร้าน ร้านที่งานล้นจึงไม่แย่งคิวร้านอื่น
+#     โควตาต่อร้านใช้เฉพาะเมื่อมีร้านอื่นรออยู่ ถ้าไม่มี (เช่นระบบที่มีร้านเดียว) ร้านนั้นใช้ Slot ที่ว่างได้ทั้งหมด
+#   - LoadShedder: เมื่อบทสนทนาที่รอของร้านเกินเกณฑ์ (หรือคิวรวมเกินเกณฑ์และร้านนั้นใช้คิวมากกว่าส่วนแบ่ง)
+#     ร้านถูกสลับเป็นโหมดให้แอดมินตอบ ข้อความใหม่เป็น Awaiting_Approval ทันทีโดยไม่สร้าง Agent
+#     และกลับเป็นปกติเองเมื่อคิวลดลงต่ำกว่าครึ่งของเกณฑ์ (อยู่ในโหมดนี้อย่างน้อย ADMISSION_SHED_MIN_SECONDS)
+# PROCESSING_MODE=queue ใช้การจำกัดต่อร้านและลำดับแบบเดียวกันใน claim_next_conversation_batch (task_queue.py)
+# =========================================================================
+
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "32"))
+ADMISSION_MAX_IN_FLIGHT_PER_STORE = int(os.getenv("ADMISSION_MAX_IN_FLIGHT_PER_STORE", "4"))
+ADMISSION_SHEDDING_ENABLED = os.getenv("ADMISSION_SHEDDING_ENABLED", "true").lower() in ("1", "true", "yes")
+# หน่วยเป็นจำนวนบทสนทนาที่รอ Agent (ไม่ใช่จำนวนข้อความ)
+ADMISSION_SHED_STORE_BACKLOG = int(os.getenv("ADMISSION_SHED_STORE_BACKLOG", "100"))
+ADMISSION_SHED_TOTAL_BACKLOG = int(os.getenv("ADMISSION_SHED_TOTAL_BACKLOG", "1000"))
+ADMISSION_SHED_MIN_SECONDS = float(os.getenv("ADMISSION_SHED_MIN_SECONDS", "60"))
+ADMISSION_BACKLOG_CACHE_SECONDS = float(os.getenv("ADMISSION_BACKLOG_CACHE_SECONDS", "1"))
+
+
+class FairScheduler:
+    """
+    Bounded, round-robin admission of work items across stores.
+    Non-blocking: add() queues an item, pop_ready() hands out the items that may start now
+    (marking them in flight), and release() must be called when each one finishes.
+    """
+
+    def __init__(self, max_in_flight=ADMISSION_MAX_IN_FLIGHT, max_per_store=ADMISSION_MAX_IN_FLIGHT_PER_STORE):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_per_store = max(1, max_per_store)
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._rotation = collections.deque()
+        self._in_flight = collections.Counter()
+        self._total_in_flight = 0
+
+    def add(self, store, item):
+        with self._lock:
+            queue = self._queues.get(store)
+            if queue is None:
+                queue = self._queues[store] = collections.deque()
+                self._rotation.append(store)
+            queue.append(item)
+
+    def pop_ready(self):
+        """
+        Returns [(store, item), ...] that may start now, taking one item per store in turn.
+        The per-store cap only holds while a store under its cap is waiting: when every waiting store
+        is at the cap, free slots go to the one with the fewest items in flight instead of sitting idle.
+        """
+        started = []
+        over_cap = 0
+        with self._lock:
+            skipped = 0
+            while self._total_in_flight < self.max_in_flight and skipped < len(self._rotation):
+                store = self._rotation[0]
+                self._rotation.rotate(-1)
+                if self._in_flight[store] >= self.max_per_store:
+                    # ร้านนี้ใช้โควตาครบแล้ว ข้ามไปร้านถัดไป
+                    skipped += 1
+                    continue
+                skipped = 0
+                started.append(self._start(store))
+            # ทุกร้านที่รออยู่ใช้โควตาครบแล้ว (เช่นมีร้านเดียว) ไม่มีร้านอื่นให้กันที่ไว้ จึงให้ Slot ที่ว่างแทนการปล่อยทิ้ง
+            while self._total_in_flight < self.max_in_flight and self._rotation:
+                store = min(self._rotation, key=lambda name: self._in_flight[name])
+                started.append(self._start(store))
+                over_cap += 1
+        if started:
+            metrics.increment("admission_started", len(started))
+        if over_cap:
+            metrics.increment("admission_started_over_store_cap", over_cap)
+        return started
+
+    def _start(self, store):
+        # เรียกขณะถือ self._lock
+        queue = self._queues[store]
+        item = queue.popleft()
+        self._in_flight[store] += 1
+        self._total_in_flight += 1
+        if not queue:
+            del self._queues[store]
+            self._rotation.remove(store)
+        return store, item
+
+    def release(self, store):
+        with self._lock:
+            self._in_flight[store] -= 1
+            if self._in_flight[store] <= 0:
+                del self._in_flight[store]
+            self._total_in_flight -= 1
+
+    def queued_by_store(self):
+        """{store: number of items waiting for a slot}"""
+        with self._lock:
+            return {store: len(queue) for store, queue in self._queues.items()}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": self._total_in_flight,
+                "max_in_flight": self.max_in_flight,
+                "max_in_flight_per_store": self.max_per_store,
+                "queued": sum(len(queue) for queue in self._queues.values()),
+                "stores_waiting": len(self._queues),
+                "busiest_stores": dict(self._in_flight.most_common(5)),
+            }
+
+
+class LoadShedder:
+    """
+    Decides per store whether new messages skip the agent and go straight to the admin.
+    `backlog` returns {store: waiting conversations}; it is cached for cache_seconds because
+    in queue mode it is a database query and the webhook asks on every message.
+    """
+
+    def __init__(self, backlog, store_limit=ADMISSION_SHED_STORE_BACKLOG, total_limit=ADMISSION_SHED_TOTAL_BACKLOG,
+                 min_seconds=ADMISSION_SHED_MIN_SECONDS, cache_seconds=ADMISSION_BACKLOG_CACHE_SECONDS, enabled=ADMISSION_SHEDDING_ENABLED):
+        self.backlog = backlog
+        self.store_limit = max(1, store_limit)
+        self.total_limit = max(1, total_limit)
+        self.min_seconds = min_seconds
+        self.cache_seconds = cache_seconds
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._cached = {}
+        self._cached_at = None
+        self._shed_since = {}
+
+    def _current_backlog(self, now):
+        with self._lock:
+            if self._cached_at is not None and now - self._cached_at < self.cache_seconds:
+                return self._cached
+        try:
+            backlog = self.backlog()
+        except Exception as e:
+            # อ่านคิวไม่ได้ ใช้ค่าล่าสุดแทน (ไม่ตัดงานของร้านเพราะข้อผิดพลาดนี้)
+            print(f"Could not read the agent backlog: {e}")
+            backlog = self._cached
+        with self._lock:
+            self._cached, self._cached_at = backlog, now
+        return backlog
+
+    def _overloaded(self, depth, backlog):
+        if depth >= self.store_limit:
+            return True
+        total = sum(backlog.values())
+        # คิวรวมล้น: ตัดเฉพาะร้านที่ใช้คิวมากกว่าส่วนแบ่งเฉลี่ย
+        return total >= self.total_limit and depth * len(backlog) >= total
+
+    def should_shed(self, store):
+        """True while the store is in shed mode (its new messages go to Awaiting_Approval)."""
+        if not self.enabled:
+            return False
+        now = time.monotonic()
+        backlog = self._current_backlog(now)
+        depth = backlog.get(store, 0)
+        with self._lock:
+            since = self._shed_since.get(store)
+            if since is None:
+                if not self._overloaded(depth, backlog):
+                    return False
+                self._shed_since[store] = now
+                print(f"Store {store} has {depth} conversations waiting. New messages go to the admin until the backlog drains.")
+                metrics.increment("admission_shed_transitions", state="shedding")
+            elif now - since >= self.min_seconds and depth <= self.store_limit // 2 and not self._overloaded(depth, backlog):
+                del self._shed_since[store]
+                print(f"Store {store} backlog drained to {depth}. Agent replies resume.")
+                metrics.increment("admission_shed_transitions", state="recovered")
+                metrics.set_gauge("admission_shedding_stores", len(self._shed_since))
+                return False
+            metrics.set_gauge("admission_shedding_stores", len(self._shed_since))
+        return True
+
+    def shedding_stores(self):
+        with self._lock:
+            return {str(store): round(time.monotonic() - since, 1) for store, since in self._shed_since.items()}
+
+    def stats(self):
+        return {"enabled": self.enabled, "store_limit": self.store_limit, "total_limit": self.total_limit, "shedding_stores": self.shedding_stores()}
+
+
+def shed_task(task_id):
+    """Hands a task to the admin without an agent run (the store is over its backlog limit)."""
+    metrics.increment("admission_shed_tasks")
+    if task_id is not None:
+        stage_task_status(task_id, AWAITING_APPROVAL)
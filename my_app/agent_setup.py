@@ -2,16 +2,16 @@
 
 import os
 from dotenv import load_dotenv
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_ollama import ChatOllama
 from langchain_community.utilities import SQLDatabase
 from langchain_community.agent_toolkits import SQLDatabaseToolkit
 from langchain_community.agent_toolkits.sql.base import create_sql_agent
 from langchain.memory import ConversationBufferMemory
 # from langchain_core.chat_history import ConversationBufferMemory
-from history_utils import load_history_from_db 
+from history_utils import load_summarized_history 
 from langchain.agents import AgentExecutor
 from database import get_store_info_direct 
+from prompt_compiler import get_store_prompt
+from llm_providers import get_chat_model
 
 
 load_dotenv()
@@ -80,14 +80,9 @@ def initialize_sql_agent(db_uri, llm_choice, user_id: str, line_id: str):
         
     llm = None
     try:
-        if "gemini-2.5-flash" in llm_choice:
-            google_api_key = os.getenv("GOOGLE_API_KEY")
-            if not google_api_key:
-                print(f"ERROR: ไม่พบ GOOGLE_API_KEY สำหรับ {llm_choice}. โปรดตั้งค่าในไฟล์ .env.")
-                return None
-            llm = ChatGoogleGenerativeAI(model=llm_choice, temperature=0, google_api_key=google_api_key)
-        else:
-            print("ERROR: Model ที่เลือกไม่ถูกต้อง.")
+        # Client ที่ Pool ไว้ (llm_providers.py) คืน None เมื่อไม่มีผู้ให้บริการที่ใช้ได้ (เช่นไม่มี GOOGLE_API_KEY)
+        llm = get_chat_model(llm_choice)
+        if llm is None:
             return None
     except Exception as e:
         print(f"Error initializing LLM ({llm_choice}): {e}")
@@ -96,8 +91,8 @@ def initialize_sql_agent(db_uri, llm_choice, user_id: str, line_id: str):
     store_id, store_name = get_store_info_direct(user_id)
     if not store_id:
         print(f"WARNING: Could not find store_id for user {user_id}. Using default settings.")
-    # 3. 🟢 สร้าง AGENT_PREFIX แบบ Dynamic
-    agent_prefix_final = create_agent_prefix(store_id, store_name, user_id)
+    # 3. 🟢 สร้าง AGENT_PREFIX แบบ Dynamic (สร้างครั้งเดียวต่อร้าน คงตัวหนาไว้เพราะ Prompt สั่งให้ตอบ **คำสั่ง SQL ที่ใช้:**)
+    agent_prefix_final = get_store_prompt(create_agent_prefix, store_id, store_name, user_id, strip_emphasis=False).text
 
     if llm is None:
         return None 
@@ -106,14 +101,13 @@ def initialize_sql_agent(db_uri, llm_choice, user_id: str, line_id: str):
         toolkit = SQLDatabaseToolkit(db=db_instance, llm=llm)
 
         # 1. โหลดประวัติการสนทนา
-        chat_history = load_history_from_db(user_id, line_id) 
+        chat_history = load_summarized_history(user_id, line_id, llm) 
 
         # 2. สร้าง Memory
         memory = ConversationBufferMemory(
             memory_key="chat_history", 
             return_messages=True,
-            chat_memory=chat_history,  # inject ประวัติ
-            k=8 #k เป็น 8 (4 คู่สนทนา)
+            chat_memory=chat_history,  # inject ประวัติ (สรุป + รอบล่าสุด ภายใน Token Budget)
         )
         print("=== DEBUG MEMORY ===")
         print(memory.load_memory_variables({}))
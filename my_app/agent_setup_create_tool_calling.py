@@ -1,6 +1,6 @@
 
 import os
-import nest_asyncio
+import textwrap
 from dotenv import load_dotenv
 import sqlite3 
 # 🟢 LangChain Core Imports
@@ -9,18 +9,23 @@ from langchain.tools import Tool
 from langchain.memory import ConversationBufferMemory
 from langchain.agents import AgentExecutor, create_tool_calling_agent # 🟢 NEW AGENT
 from langchain.prompts import ChatPromptTemplate # 🟢 NEW PROMPT
-# 🟢 Google GenAI Imports
-from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
-from langchain_community.vectorstores import Chroma 
 # 🟢 SQL Imports
 from langchain_community.utilities import SQLDatabase
 from langchain_community.agent_toolkits import SQLDatabaseToolkit
 # 🟢 Utility Imports (Assumed to be in your project)
-from history_utils import load_history_from_db 
-from database import get_store_info_direct 
+from history_utils import load_summarized_history 
+from database import get_store_info_direct, fetch_knowledge_rows
+from async_runtime import apply_nest_asyncio_if_enabled
+from parallel_tools import ParallelToolAgentExecutor
+from prompt_compiler import get_store_prompt
+from llm_providers import get_chat_model
+from model_router import GREETING_TEMPLATE
+from knowledge_index import HybridKnowledgeRetriever, get_knowledge_index, knowledge_document
+from vector_index import get_store_retriever
 
 load_dotenv()
-nest_asyncio.apply()
+# 🟢 ไม่ Patch Event Loop ทั้ง Process ด้วย nest_asyncio แล้ว (เปิดได้ด้วย NEST_ASYNCIO=1)
+apply_nest_asyncio_if_enabled()
 
 # =========================================================================
 # 🟢 [RAG SECTION] (Functions remain largely the same, but simplified)
@@ -28,65 +33,15 @@ nest_asyncio.apply()
 
 def fetch_knowledge_from_db(store_id: str):
     """Fetches knowledge from the knowledge_base table filtered by store_id."""
-    DB_FILE_NAME = "store_database.db"
-    conn = sqlite3.connect(DB_FILE_NAME)
-    cursor = conn.cursor()
-    
-    knowledge_docs = []
-    try:
-        cursor.execute("""
-            SELECT question_or_topic, answer_or_detail 
-            FROM knowledge_base 
-            WHERE store_id = ?
-        """, (store_id,))
-        
-        results = cursor.fetchall()
-        
-        for topic, detail in results:
-            content = f"หัวข้อ: {topic}\nรายละเอียด: {detail}"
-            knowledge_docs.append(Document(page_content=content, metadata={"store_id": store_id, "topic": topic, "source": "knowledge_base_db"}))
-            
-    except sqlite3.Error as e:
-        print(f"Database error fetching knowledge: {e}")
-    finally:
-        conn.close()
-        
-    return knowledge_docs
+    return [knowledge_document(store_id, kb_id, topic, detail) for kb_id, topic, detail in fetch_knowledge_rows(store_id)]
 
 def initialize_rag_retriever(store_id: str):
     """
-    Loads or creates a persistent ChromaDB store for the given store_id.
+    Returns a retriever over the shared knowledge collection filtered by store_id
+    (the store's rows are indexed on first use). Returns None when the store has no knowledge.
     """
-    embeddings = GoogleGenerativeAIEmbeddings(model="text-embedding-004")
-    
-    persist_directory = "./chroma_vector_db/" 
-    collection_name = f"store_{store_id}_knowledge"
-    
     try:
-        vector_store = Chroma(
-            collection_name=collection_name, 
-            embedding_function=embeddings, 
-            persist_directory=persist_directory
-        )
-        
-        collection_count = vector_store._collection.count()
-        
-        if collection_count == 0:
-            print(f"Collection '{collection_name}' is empty. Indexing from SQLite...")
-            documents = fetch_knowledge_from_db(store_id)
-            
-            if not documents:
-                print(f"WARNING: No knowledge documents found for store {store_id}. RAG will be disabled.")
-                return None
-            
-            vector_store.add_documents(documents)
-            vector_store.persist()
-            print(f"Indexing completed. {len(documents)} documents added.")
-        else:
-            print(f"Collection '{collection_name}' loaded from Disk ({collection_count} documents).")
-
-        return vector_store.as_retriever(search_kwargs={"k": 3})
-
+        return get_store_retriever(store_id)
     except Exception as e:
         print(f"ERROR: ChromaDB initialization failed: {e}")
         return None
@@ -98,13 +53,17 @@ def get_rag_tool(retriever):
     return Tool(
         name="knowledge_base_search",
         description="""ใช้สำหรับการค้นหาข้อมูลความรู้ทั่วไปของร้านค้า เช่น นโยบายการคืนสินค้า, นโยบายการจัดส่ง, ที่อยู่ร้าน, เบอร์โทร, หรือคำถามที่ไม่เกี่ยวกับเมนูหรือโปรโมชั่น ให้ส่งคำถามของลูกค้าเข้ามาใน tool นี้""",
-        func=lambda query: retriever.invoke(query)
+        func=lambda query: retriever.invoke(query),
+        coroutine=lambda query: retriever.ainvoke(query),
     )
 
 # =========================================================================
 # 🟢 [AGENT PREFIX/SYSTEM INSTRUCTION] - ปรับปรุงเพื่อ Native Tool Calling
 # =========================================================================
 
+# ข้อความเดียวกับคำตอบ template ของ Model Router (model_router.GREETING_TEMPLATE)
+_EARLY_EXIT_EXAMPLE = textwrap.indent(GREETING_TEMPLATE, " " * 6)
+
 def create_agent_prefix_with_rag(store_id, store_name, user_id):
     """
     Creates the system instruction for the Native Tool Calling Agent.
@@ -136,11 +95,7 @@ def create_agent_prefix_with_rag(store_id, store_name, user_id):
 
 7.  **[Early Exit Logic - ตรรกะการตัดสินใจ]:**
     * หากคุณไม่จำเป็นต้องใช้ Tool ใดๆ (เช่น การทักทาย การขอบคุณ) ให้ตอบกลับเป็นข้อความที่เป็นมิตรทันที โดยใช้รูปแบบแนะนำการสอบถามดังนี้:
-      ยินดีต้อนรับค่ะ! คุณสามารถสอบถามเกี่ยวกับ:
-      - เมนูอาหาร: มีเมนูอะไรบ้าง, ราคาเท่าไหร่, แนะนำเมนู (พร้อมแจ้งข้อจำกัด)
-      - โปรโมชั่น: มีโปรโมชั่นอะไรบ้าง
-      - ข้อมูลร้าน: ที่อยู่, เบอร์โทรศัพท์, เวลาทำการ, หรือนโยบายต่างๆ ของร้าน
-      พร้อมให้บริการค่ะ!
+{_EARLY_EXIT_EXAMPLE}
     * **[Pre-Tool-Call Logic สำหรับเมนูแนะนำ]:** หากลูกค้าถามคำถามที่เกี่ยวข้องกับการ "แนะนำเมนู" และคุณตรวจสอบ **'chat_history' แล้วพบว่ายังไม่มีข้อจำกัด** (เช่น ไม่ทาน/แพ้) ที่ลูกค้าเคยระบุ **คุณต้องตอบกลับทันทีด้วยการสอบถามข้อจำกัด (เช่น วัตถุดิบที่ไม่ทานหรือไม่ชอบ) โดยไม่ต้องเรียก Tool ใดๆ เลย**
 
 **ตัวอย่างการใช้ SQL (สำหรับการอ้างอิงและกรองวัตถุดิบ):**
@@ -164,13 +119,10 @@ def initialize_native_tool_calling_agent(db_uri, llm_choice, user_id: str, line_
         print(f"ERROR: Failed to initialize SQLDatabase from URI '{db_uri}': {e}")
         return None
     
-    # 2. เตรียม LLM
-    google_api_key = os.getenv("GOOGLE_API_KEY")
-    if not google_api_key:
-        print(f"ERROR: ไม่พบ GOOGLE_API_KEY สำหรับ {llm_choice}. โปรดตั้งค่าในไฟล์ .env.")
+    # 2. เตรียม LLM (Client ที่ Pool ไว้ของ Gemini/Ollama/fake ตาม Route ของข้อความ ดู llm_providers.py)
+    llm = get_chat_model(llm_choice)
+    if llm is None:
         return None
-        
-    llm = ChatGoogleGenerativeAI(model=llm_choice, temperature=0, google_api_key=google_api_key)
 
     # 3. ดึงข้อมูลร้านค้าและสร้าง Prefix
     store_id, store_name = get_store_info_direct(user_id)
@@ -178,7 +130,8 @@ def initialize_native_tool_calling_agent(db_uri, llm_choice, user_id: str, line_
         store_id = "DEFAULT" 
         store_name = "ร้านค้าทั่วไป"
         
-    agent_prefix_final = create_agent_prefix_with_rag(store_id, store_name, user_id)
+    # Prefix ถูกสร้างและย่อ Token ครั้งเดียวต่อร้าน (ดู prompt_compiler.py)
+    compiled_prefix = get_store_prompt(create_agent_prefix_with_rag, store_id, store_name, user_id)
 
     # 4. สร้าง SQL Tools และกรอง
     sql_toolkit = SQLDatabaseToolkit(db=db_instance, llm=llm)
@@ -191,11 +144,12 @@ def initialize_native_tool_calling_agent(db_uri, llm_choice, user_id: str, line_
     ]
     # **Rename Tools (Optional):** หากต้องการให้ชื่อ Tool ใน Description ดูเป็นมิตรกับ Gemini มากขึ้น
 
-    # 5. สร้าง RAG Tool (ChromaDB)
+    # 5. สร้าง RAG Tool (Lexical Index + ChromaDB แบบ Hybrid)
     rag_tools_list = []
     try:
-        rag_retriever = initialize_rag_retriever(store_id) 
-        if rag_retriever:
+        # คำถามที่ตรงหัวข้อตอบจาก Lexical Index ใน Memory ส่วน Chroma/Embedding ถูกโหลดเมื่อจำเป็นเท่านั้น
+        if len(get_knowledge_index(store_id)) > 0:
+            rag_retriever = HybridKnowledgeRetriever(store_id=store_id, vector_factory=lambda: initialize_rag_retriever(store_id))
             rag_tool = get_rag_tool(rag_retriever)
             rag_tools_list = [rag_tool]
             print("RAG Tool (ChromaDB) initialized successfully.")
@@ -207,19 +161,19 @@ def initialize_native_tool_calling_agent(db_uri, llm_choice, user_id: str, line_
     final_tools = sql_tools + rag_tools_list 
 
     # 7. โหลดประวัติการสนทนาและสร้าง Memory
-    chat_history = load_history_from_db(user_id, line_id) 
+    chat_history = load_summarized_history(user_id, line_id, llm) 
     memory = ConversationBufferMemory(
         memory_key="chat_history", 
         return_messages=True,
         chat_memory=chat_history,
-        k=8 
     )
 
     # 8. สร้าง Prompt Template สำหรับ Tool Calling Agent
     # ChatPromptTemplate นี้จะใส่ System Instruction, History, User Input และ Scratchpad
+    # System Prefix ต้องอยู่หน้าสุดและเหมือนเดิมทุกไบต์ เพื่อให้ Gemini ใช้ Implicit Context Cache ได้ทุก LLM Hop
     prompt_template = ChatPromptTemplate.from_messages(
         [
-            ("system", agent_prefix_final),
+            compiled_prefix.as_system_message(),
             ("placeholder", "{chat_history}"), 
             ("human", "{input}"),
             ("placeholder", "{agent_scratchpad}"), 
@@ -233,8 +187,8 @@ def initialize_native_tool_calling_agent(db_uri, llm_choice, user_id: str, line_
         prompt=prompt_template
     )
 
-    # 10. สร้าง Agent Executor
-    agent_executor = AgentExecutor(
+    # 10. สร้าง Agent Executor (Tool Call หลายตัวใน Turn เดียวกันจะถูกรันพร้อมกัน พร้อม Timeout ต่อ Tool)
+    agent_executor = ParallelToolAgentExecutor(
         agent=agent,
         tools=final_tools,             
         memory=memory,
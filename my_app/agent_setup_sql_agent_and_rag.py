@@ -1,13 +1,9 @@
 # my_app/agent_setup.py
 
 import os
-import nest_asyncio
 from dotenv import load_dotenv
 import sqlite3 # 🟢 ต้องใช้สำหรับดึงข้อมูล Knowledge Base
-from langchain_google_genai import ChatGoogleGenerativeAI
-# 🟢 New Imports สำหรับ RAG (ChromaDB)
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from langchain_community.vectorstores import Chroma # 🟢 ใช้ Chroma
+# 🟢 New Imports สำหรับ RAG
 from langchain.tools import Tool
 from langchain_core.documents import Document
 # -----------------------------------------------
@@ -16,16 +12,21 @@ from langchain_community.utilities import SQLDatabase
 from langchain_community.agent_toolkits import SQLDatabaseToolkit
 from langchain_community.agent_toolkits.sql.base import create_sql_agent
 from langchain.memory import ConversationBufferMemory
-from history_utils import load_history_from_db 
+from history_utils import load_summarized_history 
 from langchain.agents import AgentExecutor
-from database import get_store_info_direct 
+from database import get_store_info_direct, fetch_knowledge_rows
+from prompt_compiler import get_store_prompt
+from llm_providers import get_chat_model
+from knowledge_index import HybridKnowledgeRetriever, get_knowledge_index, knowledge_document
+from vector_index import get_store_retriever
+from async_runtime import apply_nest_asyncio_if_enabled
 
 
 load_dotenv()
 
-# 🟢 ใส่บรรทัดนี้เพื่อแก้ไขปัญหา AsyncIO/Threading
-# มันจะอนุญาตให้โค้ด Async (เช่น Embedding Model) ทำงานใน Thread Synchronous ได้
-nest_asyncio.apply()
+# 🟢 ไม่ Patch Event Loop ทั้ง Process ด้วย nest_asyncio แล้ว (เปิดได้ด้วย NEST_ASYNCIO=1)
+# Thread ที่สร้าง Embedding Model (vector_index.py) จะได้ Event Loop ของตัวเองจาก ensure_event_loop() แทน
+apply_nest_asyncio_if_enabled()
 # =========================================================================
 # 🟢 [RAG SECTION] ฟังก์ชันใหม่สำหรับจัดการ Knowledge Base ด้วย ChromaDB
 # =========================================================================
@@ -33,79 +34,18 @@ nest_asyncio.apply()
 # 1. ฟังก์ชันดึงข้อมูลจาก SQLite (ใช้ Logic เดิม)
 def fetch_knowledge_from_db(store_id: str):
     """Fetches knowledge from the knowledge_base table filtered by store_id."""
-    DB_FILE_NAME = "store_database.db"
-    conn = sqlite3.connect(DB_FILE_NAME)
-    cursor = conn.cursor()
-    
-    knowledge_docs = []
-    try:
-        # ดึงคำถามและคำตอบของร้านค้านั้น
-        cursor.execute("""
-            SELECT question_or_topic, answer_or_detail 
-            FROM knowledge_base 
-            WHERE store_id = ?
-        """, (store_id,))
-        
-        results = cursor.fetchall()
-        
-        for topic, detail in results:
-            content = f"หัวข้อ: {topic}\nรายละเอียด: {detail}"
-            # ใช้ topic เป็น Metadata สำหรับการกรอง
-            knowledge_docs.append(Document(page_content=content, metadata={"store_id": store_id, "topic": topic, "source": "knowledge_base_db"}))
-            
-    except sqlite3.Error as e:
-        print(f"Database error fetching knowledge: {e}")
-    finally:
-        conn.close()
-        
-    return knowledge_docs
+    return [knowledge_document(store_id, kb_id, topic, detail) for kb_id, topic, detail in fetch_knowledge_rows(store_id)]
 
 
 
-# 2. ฟังก์ชันสร้าง RAG Retriever (ใช้ ChromaDB)
+# 2. ฟังก์ชันสร้าง RAG Retriever (Chroma Collection กลาง กรองด้วย store_id)
 def initialize_rag_retriever(store_id: str):
     """
-    Loads or creates a persistent ChromaDB store for the given store_id.
-    If the store is empty, it fetches data from SQLite and indexes it.
+    Returns a retriever over the shared knowledge collection filtered by store_id
+    (the store's rows are indexed on first use). Returns None when the store has no knowledge.
     """
-    embeddings = GoogleGenerativeAIEmbeddings(model="text-embedding-004")
-    
-    # กำหนด Directory สำหรับเก็บไฟล์ Vector และ Collection Name
-    persist_directory = "./chroma_vector_db/" 
-    collection_name = f"store_{store_id}_knowledge"
-    
     try:
-        # เชื่อมต่อ/สร้าง ChromaDB (Persistent)
-        vector_store = Chroma(
-            collection_name=collection_name, 
-            embedding_function=embeddings, 
-            persist_directory=persist_directory
-        )
-        
-        # ตรวจสอบว่า Collection มีข้อมูลหรือไม่
-        collection_count = vector_store._collection.count()
-        
-        # หากไม่มีข้อมูล ให้ดึงจาก SQLite มา Index
-        if collection_count == 0:
-            print(f"Collection '{collection_name}' is empty. Indexing from SQLite...")
-            
-            documents = fetch_knowledge_from_db(store_id)
-            
-            if not documents:
-                print(f"WARNING: No knowledge documents found for store {store_id}. RAG will be disabled.")
-                return None
-            
-            # Index ข้อมูลลงใน ChromaDB
-            vector_store.add_documents(documents)
-            vector_store.persist()
-            
-            print(f"Indexing completed. {len(documents)} documents added.")
-        else:
-            print(f"Collection '{collection_name}' loaded from Disk ({collection_count} documents).")
-
-        # คืนค่าเป็น Retriever 
-        return vector_store.as_retriever(search_kwargs={"k": 3})
-
+        return get_store_retriever(store_id)
     except Exception as e:
         print(f"ERROR: ChromaDB initialization failed: {e}")
         return None
@@ -115,7 +55,8 @@ def get_rag_tool(retriever):
     return Tool(
         name="knowledge_base_search",
         description="""ใช้สำหรับการค้นหาข้อมูลความรู้ทั่วไปของร้านค้า เช่น นโยบายการคืนสินค้า, นโยบายการจัดส่ง, ที่อยู่ร้าน, เบอร์โทร, หรือคำถามที่ไม่เกี่ยวกับเมนูหรือโปรโมชั่น ให้ส่งคำถามของลูกค้าเข้ามาใน tool นี้""",
-        func=lambda query: retriever.invoke(query)
+        func=lambda query: retriever.invoke(query),
+        coroutine=lambda query: retriever.ainvoke(query),
     )
 
 # =========================================================================
@@ -208,17 +149,11 @@ def initialize_sql_agent_and_rag(db_uri, llm_choice, user_id: str, line_id: str)
         print(f"ERROR: Failed to initialize SQLDatabase from URI '{db_uri}': {e}")
         return None
     
-    # 2. เตรียม LLM
+    # 2. เตรียม LLM (Client ที่ Pool ไว้ของ Gemini/Ollama/fake ตาม Route ของข้อความ ดู llm_providers.py)
     llm = None
     try:
-        if "gemini-2.5-flash" in llm_choice:
-            google_api_key = os.getenv("GOOGLE_API_KEY")
-            if not google_api_key:
-                print(f"ERROR: ไม่พบ GOOGLE_API_KEY สำหรับ {llm_choice}. โปรดตั้งค่าในไฟล์ .env.")
-                return None
-            llm = ChatGoogleGenerativeAI(model=llm_choice, temperature=0, google_api_key=google_api_key)
-        else:
-            print("ERROR: Model ที่เลือกไม่ถูกต้อง.")
+        llm = get_chat_model(llm_choice)
+        if llm is None:
             return None
     except Exception as e:
         print(f"Error initializing LLM ({llm_choice}): {e}")
@@ -232,7 +167,8 @@ def initialize_sql_agent_and_rag(db_uri, llm_choice, user_id: str, line_id: str)
         store_id = "DEFAULT" 
         store_name = "ร้านค้าทั่วไป"
         
-    agent_prefix_final = create_agent_prefix_with_rag(store_id, store_name, user_id)
+    # Prefix ถูกสร้างครั้งเดียวต่อร้าน (คงตัวหนาไว้เพราะ split_agent_output อ่าน **คำสั่ง SQL ที่ใช้** จากคำตอบ)
+    agent_prefix_final = get_store_prompt(create_agent_prefix_with_rag, store_id, store_name, user_id, strip_emphasis=False).text
 
     if llm is None:
         return None 
@@ -242,11 +178,12 @@ def initialize_sql_agent_and_rag(db_uri, llm_choice, user_id: str, line_id: str)
         sql_toolkit = SQLDatabaseToolkit(db=db_instance, llm=llm)
         sql_tools = sql_toolkit.get_tools()
         
-        # 5. สร้าง RAG Tool (ChromaDB)
+        # 5. สร้าง RAG Tool (Lexical Index + ChromaDB แบบ Hybrid)
         rag_tools_list = []
         try:
-            rag_retriever = initialize_rag_retriever(store_id) 
-            if rag_retriever:
+            # คำถามที่ตรงหัวข้อตอบจาก Lexical Index ใน Memory ส่วน Chroma/Embedding ถูกโหลดเมื่อจำเป็นเท่านั้น
+            if len(get_knowledge_index(store_id)) > 0:
+                rag_retriever = HybridKnowledgeRetriever(store_id=store_id, vector_factory=lambda: initialize_rag_retriever(store_id))
                 rag_tool = get_rag_tool(rag_retriever)
                 rag_tools_list = [rag_tool]
                 print("RAG Tool (ChromaDB) initialized successfully.")
@@ -258,12 +195,11 @@ def initialize_sql_agent_and_rag(db_uri, llm_choice, user_id: str, line_id: str)
         final_tools = sql_tools + rag_tools_list 
 
         # 7. โหลดประวัติการสนทนาและสร้าง Memory
-        chat_history = load_history_from_db(user_id, line_id) 
+        chat_history = load_summarized_history(user_id, line_id, llm) 
         memory = ConversationBufferMemory(
             memory_key="chat_history", 
             return_messages=True,
             chat_memory=chat_history,
-            k=8 
         )
         print("=== DEBUG MEMORY ===")
         print(memory.load_memory_variables({}))
@@ -1,15 +1,27 @@
 # ai_processor.py
+import asyncio
 import time
 import os
 import sqlite3
+import weakref
 # นำเข้าทุกฟังก์ชันที่จำเป็น
-from database import initialize_database, get_tasks_by_status, update_task_status, update_task_response, get_credentials, get_auto_reply_setting, update_auto_reply_setting
+from database import initialize_database, get_tasks_by_status, update_task_status, update_task_response, get_credentials, get_auto_reply_setting, update_auto_reply_setting, get_store_info_direct
 from agent_setup import initialize_sql_agent
 from agent_setup_sql_agent_and_rag import initialize_sql_agent_and_rag
 from agent_setup_create_tool_calling import initialize_native_tool_calling_agent
-from linebot import LineBotApi
+from linebot import LineBotApi, AsyncLineBotApi
+from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
 from linebot.models import TextSendMessage
 from linebot.exceptions import LineBotApiError
+from write_buffer import commit_task_response, stage_task_status
+from async_runtime import run_sync
+from task_budget import TaskBudget, BudgetExceeded
+from task_traces import save_trace, using_sql_summary
+from model_router import plan_route, invoke_routed_agent, ainvoke_routed_agent, template_response
+from llm_providers import CircuitOpenError, is_outage_error, llm_available
+from knowledge_index import find_faq_answer
+import metrics
+import aiohttp
 
 
 db_uri_to_use = initialize_database()
@@ -33,6 +45,139 @@ def send_message_to_line(line_id, message, channel_access_token):
         print(f"General error when sending message to {line_id}: {e}")
         return False
 
+def split_agent_output(ai_response_raw):
+    """Splits the agent output into (message for the customer, SQL/Tool command for the back office)."""
+    # 🟢 แก้ไขให้รองรับการแยกคำสั่ง SQL หรือ Tool (ตาม Prefix)
+    # พยายามแยกด้วย "คำสั่ง SQL ที่ใช้:" ก่อน
+    response_message_sql, delimiter_sql, command_sql_raw = ai_response_raw.partition("**คำสั่ง SQL ที่ใช้:**")
+    if command_sql_raw.strip():
+        return response_message_sql.strip(), f"SQL: {command_sql_raw.strip()}"
+
+    # ถ้าไม่พบ SQL ให้พยายามแยกด้วย "Tool ที่ใช้:"
+    response_message_tool, delimiter_tool, command_tool_raw = ai_response_raw.partition("**Tool ที่ใช้:")
+    if command_tool_raw.strip():
+        return response_message_tool.strip(), f"Tool: {command_tool_raw.strip()}"
+
+    # ไม่พบทั้ง SQL และ Tool (น่าจะเป็น Early Exit/ทักทาย)
+    return ai_response_raw.strip(), "None"
+
+def record_agent_trace(user_id, task_id, response, tool_or_sql_command, budget=None):
+    """Stores the full agent trace (task_traces) and returns the short command kept in tasks.using_sql."""
+    save_trace(task_id, user_id, response, tool_or_sql_command, budget)
+    return using_sql_summary(tool_or_sql_command)
+
+def print_agent_history(agent_executor):
+    """Debug print of the memory loaded into an agent. Returns the executor unchanged."""
+    if not agent_executor:
+        return agent_executor
+    print("\n--- DEBUG: AGENT SUCCESSFUL. LOADING HISTORY NOW ---")
+    memory_loaded = getattr(agent_executor, "memory", None)
+    if memory_loaded:
+        current_history = memory_loaded.load_memory_variables({})['chat_history']
+        print("*********")
+        for message in current_history:
+            print(f"[{message.type.upper()}]: {message.content}")
+        print("-------------------------------------------\n")
+    return agent_executor
+
+def plan_task_route(user_id, task_id, user_message):
+    """Picks the route/models of a message (model_router.py)."""
+    plan = plan_route(user_id, user_message)
+    print(f"Task {task_id} routed to {plan.route} ({plan.reason}): {', '.join(plan.models) or 'template'}")
+    return plan
+
+def answer_from_template(user_id, line_id, task_id, plan):
+    """Answers a greeting route from its template without creating an agent."""
+    response = template_response(plan)
+    command = record_agent_trace(user_id, task_id, response, f"Route: {plan.route} (template)")
+    deliver_agent_response(user_id, line_id, task_id, response["output"], command, get_auto_reply_setting(user_id))
+
+def is_retryable_error(error):
+    """True for Rate Limit (429), server overload (5xx), timeouts and open circuits of the LLM provider."""
+    return isinstance(error, CircuitOpenError) or is_outage_error(error)
+
+def _degraded_response(user_id, user_message, reason):
+    """(response, command) answered from the store's FAQ without a model, or None when no row answers it."""
+    store_id, _ = get_store_info_direct(user_id)
+    faq = find_faq_answer(store_id, user_message) if store_id else None
+    if faq is None:
+        return None
+    topic, detail = faq
+    response = {"output": detail, "intermediate_steps": [], "route": {"route": "degraded", "reason": reason, "model": None, "faq_topic": topic}}
+    return response, f"Degraded: FAQ {topic}"
+
+def answer_degraded(user_id, line_id, task_id, user_message, reason):
+    """
+    Answers a task while no LLM provider can take calls (circuit open or retries used up):
+    from a confident FAQ match when there is one, otherwise hands it to the admin (Awaiting_Approval).
+    """
+    degraded = _degraded_response(user_id, user_message, reason)
+    if degraded is None:
+        print(f"LLM unavailable ({reason}). Task {task_id} is waiting for the admin.")
+        metrics.increment("degraded_tasks", mode="admin")
+        stage_task_status(task_id, "Awaiting_Approval")
+        return
+    response, command = degraded
+    print(f"LLM unavailable ({reason}). Task {task_id} answered from the FAQ.")
+    metrics.increment("degraded_tasks", mode="faq")
+    command = record_agent_trace(user_id, task_id, response, command)
+    deliver_agent_response(user_id, line_id, task_id, response["output"], command, get_auto_reply_setting(user_id))
+
+def prepare_agent_response_delivery(user_id, task_id, final_response_message, tool_or_sql_command, is_auto_reply_enabled):
+    """
+    Records the agent's answer. Returns the channel access token when the answer is committed
+    and should now be pushed to LINE, or None when nothing must be sent.
+    The response is committed before the push (durability contract of write_buffer);
+    the follow-up status change is buffered and coalesced with other task updates.
+    """
+    if not is_auto_reply_enabled:
+        # คำตอบและสถานะ Awaiting_Approval ถูกรวมเป็น UPDATE เดียว
+        print(f"Auto-reply is disabled. Updating status to Awaiting_Approval for task {task_id}.")
+        commit_task_response(task_id, final_response_message, tool_or_sql_command, status="Awaiting_Approval")
+        return None
+
+    print(f"Auto-reply is enabled. Sending message for task {task_id}.")
+    credentials_data = get_credentials(user_id)
+    if not credentials_data:
+        print(f"Credentials not found for user {user_id}. Cannot send message.")
+        commit_task_response(task_id, final_response_message, tool_or_sql_command, status="Error")
+        return None
+
+    # 🛑 ห้ามส่งข้อความหาลูกค้าก่อนที่คำตอบจะถูก Commit ลง DB
+    if not commit_task_response(task_id, final_response_message, tool_or_sql_command):
+        print(f"Response for task {task_id} was not committed. Setting status to Awaiting_Approval.")
+        stage_task_status(task_id, "Awaiting_Approval")
+        return None
+    return credentials_data['channel_access_token']
+
+def deliver_agent_response(user_id, line_id, task_id, final_response_message, tool_or_sql_command, is_auto_reply_enabled):
+    """Records the agent's answer and, when auto-reply is on, pushes it to LINE."""
+    channel_access_token = prepare_agent_response_delivery(user_id, task_id, final_response_message, tool_or_sql_command, is_auto_reply_enabled)
+    if not channel_access_token:
+        return
+
+    # ส่งข้อความ Line (สถานะเป็น Responded แล้วจากการ Commit ด้านบน)
+    send_success = send_message_to_line(line_id, final_response_message, channel_access_token)
+    if not send_success:
+        # 🟡 หากส่งล้มเหลว ให้เปลี่ยนสถานะเป็น Awaiting_Approval เพื่อให้ admin ตอบกลับ
+        print(f"Failed to send message for task {task_id}. Setting status to Awaiting_Approval.")
+        stage_task_status(task_id, "Awaiting_Approval")
+
+def notify_processing_error(user_id, line_id, tasks, error):
+    """
+    Error handler of the conversation dispatchers: a batch raised outside the processor's own
+    retry handling, so the customer gets the fallback message (push, the reply token may be gone).
+    """
+    credentials_data = get_credentials(user_id)
+    if credentials_data:
+        send_message_to_line(line_id, "ขออภัยค่ะ ระบบกำลังมีปัญหา ไม่สามารถตอบกลับได้ในขณะนี้", credentials_data['channel_access_token'])
+
+def handle_budget_exhausted(task_id, budget, reason, error=None):
+    """Degrades a task whose budget ran out: no more retries, the admin answers it instead."""
+    print(f"Budget exhausted for task {task_id} ({reason}): {error}. Setting status to Awaiting_Approval.")
+    budget.record_exhausted(reason)
+    stage_task_status(task_id, "Awaiting_Approval")
+
 def process_pending_tasks():
     user_id = "d65e044b-1136-4020-9b72-e3b7e5092d30"
     
@@ -70,7 +215,7 @@ def process_pending_tasks():
             # ------------------------------------------------------------------
             ai_response_raw = response.get("output", "ขออภัยครับ เกิดข้อผิดพลาดในการประมวลผลคำตอบ")
             response_message, delimiter, sql_command_raw = ai_response_raw.partition("คำสั่ง SQL ที่ใช้:")
-            sql_command = sql_command_raw.strip()
+            sql_command = record_agent_trace(user_id, task_id, response, sql_command_raw.strip())
             
             # อัปเดตฐานข้อมูลด้วยคำตอบของ AI และคำสั่ง SQL
             update_task_response(task_id, response_message.strip(), sql_command if sql_command else "None")
@@ -104,7 +249,14 @@ def process_new_tasks(user_id, line_id, user_message, task_id):
     MAX_RETRIES = 5 
     BASE_WAIT_TIME = 5 # วินาที เริ่มต้นรอ 5, 10, 20, ...
 
+    # 🟢 Budget (LLM Calls / Tokens / Seconds) เดียว ใช้ร่วมกันทุก Retry ของ Task นี้
+    budget = TaskBudget(user_id)
+
     for attempt in range(MAX_RETRIES):
+        # 🟢 Circuit ของผู้ให้บริการ LLM ทุกตัวของ Task นี้เปิดอยู่: ไม่สร้าง Agent และไม่รอ Retry
+        if not llm_available([AGENT_MODEL_CHOICE]):
+            answer_degraded(user_id, line_id, task_id, user_message, "circuit open")
+            return
         try:
             is_auto_reply_enabled = get_auto_reply_setting(user_id)      
             
@@ -143,14 +295,14 @@ def process_new_tasks(user_id, line_id, user_message, task_id):
             
             # 3. Invoke the AI Agent with the user's message
             # ลบคืนค่า Callback ที่ไม่ได้ประกาศออกไป
-            response = sql_agent_executor.invoke({"input": user_message})
+            response = budget.invoke(sql_agent_executor, {"input": user_message})
 
             
             ai_response_raw = response.get("output", "ขออภัยครับ เกิดข้อผิดพลาดในการประมวลผลคำตอบ")     
             
             # 4. แยกคำตอบและ SQL เพียงครั้งเดียว (ถูกต้อง)
             response_message, delimiter, sql_command_raw = ai_response_raw.partition("**คำสั่ง SQL ที่ใช้**")
-            sql_command = sql_command_raw.strip()
+            sql_command = record_agent_trace(user_id, task_id, response, sql_command_raw.strip(), budget)
             final_response_message = response_message.strip() # ข้อความตอบลูกค้า
             
             # 5. อัปเดต DB และส่ง LINE
@@ -184,18 +336,23 @@ def process_new_tasks(user_id, line_id, user_message, task_id):
             # 🟢 สำเร็จแล้ว: ออกจาก Loop และฟังก์ชัน
             return 
         
+        # 🟢 Budget หมด: ไม่ Retry ต่อ ส่งให้แอดมินตอบแทน
+        except BudgetExceeded as e:
+            handle_budget_exhausted(task_id, budget, e.reason, e)
+            return
+
         # 🟢 ดักจับ Error ที่เป็น Rate Limit หรือ Server Overload
         except Exception as e:
-            error_message = str(e).lower()
-            
-            # ตรวจสอบ Error 429 (Rate Limit) หรือ 503 (Overloaded) หรือ 500
-            is_retryable = ("429" in error_message or 
-                            "503" in error_message or 
-                            "500" in error_message)
-
-            if is_retryable and attempt < MAX_RETRIES - 1:
+            # 🟢 ผู้ให้บริการล่ม (Circuit เปิดแล้ว หรือ Retry ครบ): ตอบจาก FAQ หรือส่งให้แอดมิน แทนข้อความ "ระบบไม่ว่าง"
+            if is_retryable_error(e) and (attempt == MAX_RETRIES - 1 or not llm_available([AGENT_MODEL_CHOICE])):
+                answer_degraded(user_id, line_id, task_id, user_message, f"provider outage: {e}")
+                return
+            if is_retryable_error(e) and attempt < MAX_RETRIES - 1:
                 # 🟢 คำนวณเวลาหน่วงแบบทวีคูณ (Exponential Backoff)
                 wait_time = BASE_WAIT_TIME * (2 ** attempt) + (attempt * 2)
+                if not budget.can_wait(wait_time):
+                    handle_budget_exhausted(task_id, budget, "seconds", e)
+                    return
                 
                 print(f"Attempt {attempt + 1} failed (Error: {e}). Retrying in {wait_time} seconds...")
                 time.sleep(wait_time) 
@@ -227,114 +384,66 @@ def process_new_tasks_using_sql_and_RAG(user_id, line_id, user_message, task_id)
     MAX_RETRIES = 5 
     BASE_WAIT_TIME = 5 # วินาที เริ่มต้นรอ 5, 10, 20, ...
 
+    # 🟢 Budget (LLM Calls / Tokens / Seconds) เดียว ใช้ร่วมกันทุก Retry ของ Task นี้
+    budget = TaskBudget(user_id)
+
+    # 🟢 เลือก Model ตามประเภทข้อความ ทักทายล้วนตอบจาก Template โดยไม่เรียก LLM
+    plan = plan_task_route(user_id, task_id, user_message)
+    if plan.template is not None:
+        answer_from_template(user_id, line_id, task_id, plan)
+        return
+
     for attempt in range(MAX_RETRIES):
+        # 🟢 Circuit ของผู้ให้บริการ LLM ทุกตัวของ Task นี้เปิดอยู่: ไม่สร้าง Agent และไม่รอ Retry
+        if not llm_available(plan.models):
+            answer_degraded(user_id, line_id, task_id, user_message, "circuit open")
+            return
         try:
             is_auto_reply_enabled = get_auto_reply_setting(user_id)      
             
-            # 1. สร้าง Agent (อาจคืนค่า None)
-            sql_agent_executor = initialize_sql_agent_and_rag(db_uri_to_use, AGENT_MODEL_CHOICE, user_id, line_id)
-            
-            # 2. 🛑 ตรวจสอบความสำเร็จของการสร้าง Agent
-            if not sql_agent_executor:
-                print(f"🛑 FATAL ERROR: initialize_sql_agent returned None for task {task_id}. Check API Key/LLM setup.")
+            # 1. สร้าง Agent ตาม Route ของข้อความและเรียก Agent (Model ถูกก่อน แล้ว Escalate เมื่อจำเป็น)
+            response = invoke_routed_agent(
+                plan, budget, {"input": user_message},
+                lambda model: print_agent_history(initialize_sql_agent_and_rag(db_uri_to_use, model, user_id, line_id)),
+            )
+
+            # 2. 🛑 สร้าง Agent ไม่ได้เลยสักตัว
+            if response is None:
+                print(f"🛑 FATAL ERROR: no agent could be initialized for task {task_id}. Check API Key/LLM setup.")
                 update_task_status(task_id, "FatalError") 
                 return 
-            
-            # ----------------------------------------------------
-            # 🛑 โค้ดสำหรับ DEBUG (แสดง History)
-            # ----------------------------------------------------
-            print("\n--- DEBUG: AGENT SUCCESSFUL. LOADING HISTORY NOW ---")
-            
-            memory_loaded = None 
-            
-            try:
-                memory_loaded = sql_agent_executor.memory 
-            except AttributeError:
-                print("WARNING: Could not access .memory attribute on AgentExecutor. Skipping history display.")
-                pass 
-            
-            if memory_loaded:
-                current_history = memory_loaded.load_memory_variables({})['chat_history'] 
-                print("*********")
-                for message in current_history:
-                    print(f"[{message.type.upper()}]: {message.content}") 
-                
-                print("-------------------------------------------\n")
-            
-            # ----------------------------------------------------
-            
-            # 3. Invoke the AI Agent with the user's message
-            response = sql_agent_executor.invoke({"input": user_message})
 
             
             ai_response_raw = response.get("output", "ขออภัยครับ เกิดข้อผิดพลาดในการประมวลผลคำตอบ")     
             
-            # 4. แยกคำตอบและ Tool/SQL Command 
-            # 🟢 แก้ไขให้รองรับการแยกคำสั่ง SQL หรือ Tool (ตาม Prefix)
-            
-            # พยายามแยกด้วย "คำสั่ง SQL ที่ใช้:" ก่อน
-            response_message_sql, delimiter_sql, command_sql_raw = ai_response_raw.partition("**คำสั่ง SQL ที่ใช้:**")
+            # 3. แยกคำตอบและ Tool/SQL Command 
+            final_response_message, tool_or_sql_command = split_agent_output(ai_response_raw)
+            tool_or_sql_command = record_agent_trace(user_id, task_id, response, tool_or_sql_command, budget)
             
-            # ถ้าไม่พบ SQL ให้พยายามแยกด้วย "Tool ที่ใช้:"
-            if not command_sql_raw.strip():
-                response_message_tool, delimiter_tool, command_tool_raw = ai_response_raw.partition("**Tool ที่ใช้:")
-                
-                if command_tool_raw.strip():
-                    final_response_message = response_message_tool.strip()
-                    tool_or_sql_command = f"Tool: {command_tool_raw.strip()}"
-                else:
-                    # ไม่พบทั้ง SQL และ Tool (น่าจะเป็น Early Exit/ทักทาย)
-                    final_response_message = ai_response_raw.strip()
-                    tool_or_sql_command = "None"
-            else:
-                # พบ SQL Command
-                final_response_message = response_message_sql.strip()
-                tool_or_sql_command = f"SQL: {command_sql_raw.strip()}"
-            
-            # 5. อัปเดต DB และส่ง LINE
-            # ... (ส่วนที่เหลือของการอัปเดต DB และส่ง LINE ยังคงเหมือนเดิม โดยใช้ final_response_message และ tool_or_sql_command)
-            if is_auto_reply_enabled:
-                print(f"Auto-reply is enabled. Sending message for task {task_id}.")
-                credentials_data = get_credentials(user_id)
-                if credentials_data:
-                    
-                    update_task_response(task_id, final_response_message, tool_or_sql_command)
-                    
-                    # ส่งข้อความ Line (ใช้ final_response_message)
-                    send_success = send_message_to_line(line_id, final_response_message, credentials_data['channel_access_token'])
-                    # 3. อัปเดตสถานะตามผลลัพธ์การส่ง
-                    if send_success:
-                        update_task_status(task_id, "Responded") # 🟢 สำเร็จ
-                    else:
-                        # 🟡 หากส่งล้มเหลว (เกิด LineBotApiError หรือ General Error) 
-                        # ให้เปลี่ยนสถานะเป็น Awaiting_Approval เพื่อให้ adminตอบกลับ
-                        print(f"Failed to send message for task {task_id}. Setting status to Awaiting_Approval.")
-                        update_task_status(task_id, "Awaiting_Approval")
-                else:
-                    print(f"Credentials not found for user {user_id}. Cannot send message.")
-                    update_task_status(task_id, "Error")
-            else:
-                # อัปเดต DB ก่อนเปลี่ยนสถานะ
-                update_task_response(task_id, final_response_message, tool_or_sql_command)
-                print(f"Auto-reply is disabled. Updating status to Awaiting_Approval for task {task_id}.")
-                update_task_status(task_id, "Awaiting_Approval")
+            # 4. อัปเดต DB และส่ง LINE
+            deliver_agent_response(user_id, line_id, task_id, final_response_message, tool_or_sql_command, is_auto_reply_enabled)
             
             # 🟢 สำเร็จแล้ว: ออกจาก Loop และฟังก์ชัน
             return 
         
+        # 🟢 Budget หมด: ไม่ Retry ต่อ ส่งให้แอดมินตอบแทน
+        except BudgetExceeded as e:
+            handle_budget_exhausted(task_id, budget, e.reason, e)
+            return
+
         # 🟢 ดักจับ Error ที่เป็น Rate Limit หรือ Server Overload
         except Exception as e:
             # ... (ส่วน Retry Logic เหมือนเดิม)
-            error_message = str(e).lower()
-            
-            # ตรวจสอบ Error 429 (Rate Limit) หรือ 503 (Overloaded) หรือ 500
-            is_retryable = ("429" in error_message or 
-                            "503" in error_message or 
-                            "500" in error_message)
-
-            if is_retryable and attempt < MAX_RETRIES - 1:
+            # 🟢 ผู้ให้บริการล่ม (Circuit เปิดแล้ว หรือ Retry ครบ): ตอบจาก FAQ หรือส่งให้แอดมิน แทนข้อความ "ระบบไม่ว่าง"
+            if is_retryable_error(e) and (attempt == MAX_RETRIES - 1 or not llm_available(plan.models)):
+                answer_degraded(user_id, line_id, task_id, user_message, f"provider outage: {e}")
+                return
+            if is_retryable_error(e) and attempt < MAX_RETRIES - 1:
                 # 🟢 คำนวณเวลาหน่วงแบบทวีคูณ (Exponential Backoff)
                 wait_time = BASE_WAIT_TIME * (2 ** attempt) + (attempt * 2)
+                if not budget.can_wait(wait_time):
+                    handle_budget_exhausted(task_id, budget, "seconds", e)
+                    return
                 
                 print(f"Attempt {attempt + 1} failed (Error: {e}). Retrying in {wait_time} seconds...")
                 time.sleep(wait_time) 
@@ -343,7 +452,7 @@ def process_new_tasks_using_sql_and_RAG(user_id, line_id, user_message, task_id)
                 print(f"Max retries reached or unrecoverable error for Task {task_id}: {e}")
                 
                 # 1. อัปเดตสถานะเป็น Error
-                update_task_status(task_id, "Error")
+                stage_task_status(task_id, "Error")
                 
                 # 2. ตอบกลับลูกค้าว่าระบบไม่ว่าง
                 credentials_data = get_credentials(user_id)
@@ -364,114 +473,66 @@ def process_new_tasks_using_tool_callig(user_id, line_id, user_message, task_id)
     MAX_RETRIES = 5 
     BASE_WAIT_TIME = 5 # วินาที เริ่มต้นรอ 5, 10, 20, ...
 
+    # 🟢 Budget (LLM Calls / Tokens / Seconds) เดียว ใช้ร่วมกันทุก Retry ของ Task นี้
+    budget = TaskBudget(user_id)
+
+    # 🟢 เลือก Model ตามประเภทข้อความ ทักทายล้วนตอบจาก Template โดยไม่เรียก LLM
+    plan = plan_task_route(user_id, task_id, user_message)
+    if plan.template is not None:
+        answer_from_template(user_id, line_id, task_id, plan)
+        return
+
     for attempt in range(MAX_RETRIES):
+        # 🟢 Circuit ของผู้ให้บริการ LLM ทุกตัวของ Task นี้เปิดอยู่: ไม่สร้าง Agent และไม่รอ Retry
+        if not llm_available(plan.models):
+            answer_degraded(user_id, line_id, task_id, user_message, "circuit open")
+            return
         try:
             is_auto_reply_enabled = get_auto_reply_setting(user_id)      
             
-            # 1. สร้าง Agent (อาจคืนค่า None)
-            sql_agent_executor = initialize_native_tool_calling_agent(db_uri_to_use, AGENT_MODEL_CHOICE, user_id, line_id)
-            
-            # 2. 🛑 ตรวจสอบความสำเร็จของการสร้าง Agent
-            if not sql_agent_executor:
-                print(f"🛑 FATAL ERROR: initialize_sql_agent returned None for task {task_id}. Check API Key/LLM setup.")
+            # 1. สร้าง Agent ตาม Route ของข้อความและเรียก Agent (Model ถูกก่อน แล้ว Escalate เมื่อจำเป็น)
+            response = invoke_routed_agent(
+                plan, budget, {"input": user_message},
+                lambda model: print_agent_history(initialize_native_tool_calling_agent(db_uri_to_use, model, user_id, line_id)),
+            )
+
+            # 2. 🛑 สร้าง Agent ไม่ได้เลยสักตัว
+            if response is None:
+                print(f"🛑 FATAL ERROR: no agent could be initialized for task {task_id}. Check API Key/LLM setup.")
                 update_task_status(task_id, "FatalError") 
                 return 
-            
-            # ----------------------------------------------------
-            # 🛑 โค้ดสำหรับ DEBUG (แสดง History)
-            # ----------------------------------------------------
-            print("\n--- DEBUG: AGENT SUCCESSFUL. LOADING HISTORY NOW ---")
-            
-            memory_loaded = None 
-            
-            try:
-                memory_loaded = sql_agent_executor.memory 
-            except AttributeError:
-                print("WARNING: Could not access .memory attribute on AgentExecutor. Skipping history display.")
-                pass 
-            
-            if memory_loaded:
-                current_history = memory_loaded.load_memory_variables({})['chat_history'] 
-                print("*********")
-                for message in current_history:
-                    print(f"[{message.type.upper()}]: {message.content}") 
-                
-                print("-------------------------------------------\n")
-            
-            # ----------------------------------------------------
-            
-            # 3. Invoke the AI Agent with the user's message
-            response = sql_agent_executor.invoke({"input": user_message})
 
             
             ai_response_raw = response.get("output", "ขออภัยครับ เกิดข้อผิดพลาดในการประมวลผลคำตอบ")     
             
-            # 4. แยกคำตอบและ Tool/SQL Command 
-            # 🟢 แก้ไขให้รองรับการแยกคำสั่ง SQL หรือ Tool (ตาม Prefix)
+            # 3. แยกคำตอบและ Tool/SQL Command 
+            final_response_message, tool_or_sql_command = split_agent_output(ai_response_raw)
+            tool_or_sql_command = record_agent_trace(user_id, task_id, response, tool_or_sql_command, budget)
             
-            # พยายามแยกด้วย "คำสั่ง SQL ที่ใช้:" ก่อน
-            response_message_sql, delimiter_sql, command_sql_raw = ai_response_raw.partition("**คำสั่ง SQL ที่ใช้:**")
-            
-            # ถ้าไม่พบ SQL ให้พยายามแยกด้วย "Tool ที่ใช้:"
-            if not command_sql_raw.strip():
-                response_message_tool, delimiter_tool, command_tool_raw = ai_response_raw.partition("**Tool ที่ใช้:")
-                
-                if command_tool_raw.strip():
-                    final_response_message = response_message_tool.strip()
-                    tool_or_sql_command = f"Tool: {command_tool_raw.strip()}"
-                else:
-                    # ไม่พบทั้ง SQL และ Tool (น่าจะเป็น Early Exit/ทักทาย)
-                    final_response_message = ai_response_raw.strip()
-                    tool_or_sql_command = "None"
-            else:
-                # พบ SQL Command
-                final_response_message = response_message_sql.strip()
-                tool_or_sql_command = f"SQL: {command_sql_raw.strip()}"
-            
-            # 5. อัปเดต DB และส่ง LINE
-            # ... (ส่วนที่เหลือของการอัปเดต DB และส่ง LINE ยังคงเหมือนเดิม โดยใช้ final_response_message และ tool_or_sql_command)
-            if is_auto_reply_enabled:
-                print(f"Auto-reply is enabled. Sending message for task {task_id}.")
-                credentials_data = get_credentials(user_id)
-                if credentials_data:
-                    
-                    update_task_response(task_id, final_response_message, tool_or_sql_command)
-                    
-                    # ส่งข้อความ Line (ใช้ final_response_message)
-                    send_success = send_message_to_line(line_id, final_response_message, credentials_data['channel_access_token'])
-                    # 3. อัปเดตสถานะตามผลลัพธ์การส่ง
-                    if send_success:
-                        update_task_status(task_id, "Responded") # 🟢 สำเร็จ
-                    else:
-                        # 🟡 หากส่งล้มเหลว (เกิด LineBotApiError หรือ General Error) 
-                        # ให้เปลี่ยนสถานะเป็น Awaiting_Approval เพื่อให้ adminตอบกลับ
-                        print(f"Failed to send message for task {task_id}. Setting status to Awaiting_Approval.")
-                        update_task_status(task_id, "Awaiting_Approval")
-                else:
-                    print(f"Credentials not found for user {user_id}. Cannot send message.")
-                    update_task_status(task_id, "Error")
-            else:
-                # อัปเดต DB ก่อนเปลี่ยนสถานะ
-                update_task_response(task_id, final_response_message, tool_or_sql_command)
-                print(f"Auto-reply is disabled. Updating status to Awaiting_Approval for task {task_id}.")
-                update_task_status(task_id, "Awaiting_Approval")
+            # 4. อัปเดต DB และส่ง LINE
+            deliver_agent_response(user_id, line_id, task_id, final_response_message, tool_or_sql_command, is_auto_reply_enabled)
             
             # 🟢 สำเร็จแล้ว: ออกจาก Loop และฟังก์ชัน
             return 
         
+        # 🟢 Budget หมด: ไม่ Retry ต่อ ส่งให้แอดมินตอบแทน
+        except BudgetExceeded as e:
+            handle_budget_exhausted(task_id, budget, e.reason, e)
+            return
+
         # 🟢 ดักจับ Error ที่เป็น Rate Limit หรือ Server Overload
         except Exception as e:
             # ... (ส่วน Retry Logic เหมือนเดิม)
-            error_message = str(e).lower()
-            
-            # ตรวจสอบ Error 429 (Rate Limit) หรือ 503 (Overloaded) หรือ 500
-            is_retryable = ("429" in error_message or 
-                            "503" in error_message or 
-                            "500" in error_message)
-
-            if is_retryable and attempt < MAX_RETRIES - 1:
+            # 🟢 ผู้ให้บริการล่ม (Circuit เปิดแล้ว หรือ Retry ครบ): ตอบจาก FAQ หรือส่งให้แอดมิน แทนข้อความ "ระบบไม่ว่าง"
+            if is_retryable_error(e) and (attempt == MAX_RETRIES - 1 or not llm_available(plan.models)):
+                answer_degraded(user_id, line_id, task_id, user_message, f"provider outage: {e}")
+                return
+            if is_retryable_error(e) and attempt < MAX_RETRIES - 1:
                 # 🟢 คำนวณเวลาหน่วงแบบทวีคูณ (Exponential Backoff)
                 wait_time = BASE_WAIT_TIME * (2 ** attempt) + (attempt * 2)
+                if not budget.can_wait(wait_time):
+                    handle_budget_exhausted(task_id, budget, "seconds", e)
+                    return
                 
                 print(f"Attempt {attempt + 1} failed (Error: {e}). Retrying in {wait_time} seconds...")
                 time.sleep(wait_time) 
@@ -480,7 +541,7 @@ def process_new_tasks_using_tool_callig(user_id, line_id, user_message, task_id)
                 print(f"Max retries reached or unrecoverable error for Task {task_id}: {e}")
                 
                 # 1. อัปเดตสถานะเป็น Error
-                update_task_status(task_id, "Error")
+                stage_task_status(task_id, "Error")
                 
                 # 2. ตอบกลับลูกค้าว่าระบบไม่ว่าง
                 credentials_data = get_credentials(user_id)
@@ -492,4 +553,148 @@ def process_new_tasks_using_tool_callig(user_id, line_id, user_message, task_id)
                         TextSendMessage(text="ขออภัยค่ะ ระบบกำลังประมวลผลเยอะ รบกวนลองใหม่อีกครั้งค่ะ")
                     )
                 # 3. จบการทำงาน (ไม่ raise e เพื่อไม่ให้ Webhook พัง)
-                return
\ No newline at end of file
+                return
+
+
+# =========================================================================
+# 🟢 Async Pipeline (ใช้กับ asgi_app.py และ AsyncConversationDispatcher)
+# การรอ LLM / Tool / LINE API เป็น await ทั้งหมด บทสนทนาจำนวนมากจึงใช้ Thread เพียงไม่กี่ตัว
+# งาน DB ที่เป็น Blocking (sqlite3, write_buffer) ถูกส่งไปทำใน Thread ด้วย asyncio.to_thread
+# =========================================================================
+
+# aiohttp Session ผูกกับ Event Loop ที่สร้าง จึงเก็บแยกตาม Loop (และใช้ Connection Pool ร่วมกันภายใน Loop)
+_line_http_sessions = weakref.WeakKeyDictionary()
+
+def _get_line_http_session():
+    loop = asyncio.get_running_loop()
+    session = _line_http_sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession()
+        _line_http_sessions[loop] = session
+    return session
+
+def get_async_line_bot_api(channel_access_token):
+    """Returns an AsyncLineBotApi that shares the pooled aiohttp session of the running loop."""
+    return AsyncLineBotApi(channel_access_token, AiohttpAsyncHttpClient(_get_line_http_session()))
+
+async def close_async_line_clients():
+    """Closes the aiohttp session of the running loop (call on application shutdown)."""
+    session = _line_http_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
+async def asend_message_to_line(line_id, message, channel_access_token):
+    """Async variant of send_message_to_line."""
+    try:
+        await get_async_line_bot_api(channel_access_token).push_message(line_id, TextSendMessage(text=message))
+        print(f"Successfully sent message to LINE user {line_id}.")
+        return True
+    except LineBotApiError as e:
+        print(f"LINE API Error when sending message to {line_id}: {e}")
+        return False
+    except Exception as e:
+        print(f"General error when sending message to {line_id}: {e}")
+        return False
+
+async def adeliver_agent_response(user_id, line_id, task_id, final_response_message, tool_or_sql_command, is_auto_reply_enabled):
+    """Async variant of deliver_agent_response (same commit-before-send contract)."""
+    channel_access_token = await asyncio.to_thread(
+        prepare_agent_response_delivery, user_id, task_id, final_response_message, tool_or_sql_command, is_auto_reply_enabled
+    )
+    if not channel_access_token:
+        return
+    if not await asend_message_to_line(line_id, final_response_message, channel_access_token):
+        print(f"Failed to send message for task {task_id}. Setting status to Awaiting_Approval.")
+        stage_task_status(task_id, "Awaiting_Approval")
+
+async def aanswer_degraded(user_id, line_id, task_id, user_message, reason):
+    """Async variant of answer_degraded."""
+    degraded = await asyncio.to_thread(_degraded_response, user_id, user_message, reason)
+    if degraded is None:
+        print(f"LLM unavailable ({reason}). Task {task_id} is waiting for the admin.")
+        metrics.increment("degraded_tasks", mode="admin")
+        await asyncio.to_thread(stage_task_status, task_id, "Awaiting_Approval")
+        return
+    response, command = degraded
+    print(f"LLM unavailable ({reason}). Task {task_id} answered from the FAQ.")
+    metrics.increment("degraded_tasks", mode="faq")
+    command = await asyncio.to_thread(record_agent_trace, user_id, task_id, response, command)
+    is_auto_reply_enabled = await asyncio.to_thread(get_auto_reply_setting, user_id)
+    await adeliver_agent_response(user_id, line_id, task_id, response["output"], command, is_auto_reply_enabled)
+
+async def aprocess_new_tasks_using_tool_callig(user_id, line_id, user_message, task_id):
+    """Async variant of process_new_tasks_using_tool_callig using AgentExecutor.ainvoke."""
+    print(f"Processing new task {task_id} (async) for user {user_id} and line_id {line_id}.")
+
+    # 🟢 กำหนดค่า Retry (เหมือนเวอร์ชัน Sync แต่รอด้วย asyncio.sleep จึงไม่กิน Thread)
+    MAX_RETRIES = 5
+    BASE_WAIT_TIME = 5
+
+    # 🟢 Budget (LLM Calls / Tokens / Seconds) เดียว ใช้ร่วมกันทุก Retry ของ Task นี้
+    budget = TaskBudget(user_id)
+
+    # 🟢 เลือก Model ตามประเภทข้อความ ทักทายล้วนตอบจาก Template โดยไม่เรียก LLM
+    plan = await asyncio.to_thread(plan_task_route, user_id, task_id, user_message)
+    if plan.template is not None:
+        response = template_response(plan)
+        command = await asyncio.to_thread(record_agent_trace, user_id, task_id, response, f"Route: {plan.route} (template)")
+        is_auto_reply_enabled = await asyncio.to_thread(get_auto_reply_setting, user_id)
+        await adeliver_agent_response(user_id, line_id, task_id, response["output"], command, is_auto_reply_enabled)
+        return
+
+    for attempt in range(MAX_RETRIES):
+        # 🟢 Circuit ของผู้ให้บริการ LLM ทุกตัวของ Task นี้เปิดอยู่: ไม่สร้าง Agent และไม่รอ Retry
+        if not llm_available(plan.models):
+            await aanswer_degraded(user_id, line_id, task_id, user_message, "circuit open")
+            return
+        try:
+            is_auto_reply_enabled = await asyncio.to_thread(get_auto_reply_setting, user_id)
+
+            # 1-2. สร้าง Agent ตาม Route (อ่าน DB / Chroma / History แบบ Blocking จึงทำใน Thread)
+            # แล้วเรียกแบบ Async (LLM และ Tool ที่รองรับ Async จะไม่ Block Event Loop)
+            response = await ainvoke_routed_agent(
+                plan, budget, {"input": user_message},
+                lambda model: initialize_native_tool_calling_agent(db_uri_to_use, model, user_id, line_id),
+            )
+            if response is None:
+                print(f"🛑 FATAL ERROR: no agent could be initialized for task {task_id}. Check API Key/LLM setup.")
+                await asyncio.to_thread(update_task_status, task_id, "FatalError")
+                return
+            ai_response_raw = response.get("output", "ขออภัยครับ เกิดข้อผิดพลาดในการประมวลผลคำตอบ")
+
+            # 3. แยกคำตอบ อัปเดต DB และส่ง LINE
+            final_response_message, tool_or_sql_command = split_agent_output(ai_response_raw)
+            tool_or_sql_command = await asyncio.to_thread(record_agent_trace, user_id, task_id, response, tool_or_sql_command, budget)
+            await adeliver_agent_response(user_id, line_id, task_id, final_response_message, tool_or_sql_command, is_auto_reply_enabled)
+            return
+
+        except BudgetExceeded as e:
+            handle_budget_exhausted(task_id, budget, e.reason, e)
+            return
+
+        except Exception as e:
+            # 🟢 ผู้ให้บริการล่ม (Circuit เปิดแล้ว หรือ Retry ครบ): ตอบจาก FAQ หรือส่งให้แอดมิน แทนข้อความ "ระบบไม่ว่าง"
+            if is_retryable_error(e) and (attempt == MAX_RETRIES - 1 or not llm_available(plan.models)):
+                await aanswer_degraded(user_id, line_id, task_id, user_message, f"provider outage: {e}")
+                return
+            if is_retryable_error(e) and attempt < MAX_RETRIES - 1:
+                wait_time = BASE_WAIT_TIME * (2 ** attempt) + (attempt * 2)
+                if not budget.can_wait(wait_time):
+                    handle_budget_exhausted(task_id, budget, "seconds", e)
+                    return
+                print(f"Attempt {attempt + 1} failed (Error: {e}). Retrying in {wait_time} seconds...")
+                await asyncio.sleep(wait_time)
+            else:
+                print(f"Max retries reached or unrecoverable error for Task {task_id}: {e}")
+                stage_task_status(task_id, "Error")
+                credentials_data = await asyncio.to_thread(get_credentials, user_id)
+                if credentials_data:
+                    await asend_message_to_line(line_id, "ขออภัยค่ะ ระบบกำลังประมวลผลเยอะ รบกวนลองใหม่อีกครั้งค่ะ", credentials_data['channel_access_token'])
+                return
+
+def process_new_tasks_using_tool_callig_sync_shim(user_id, line_id, user_message, task_id):
+    """
+    Sync shim for thread-based callers (ConversationDispatcher, ai_worker --processor):
+    runs the async pipeline on the shared background event loop and waits for it.
+    """
+    return run_sync(aprocess_new_tasks_using_tool_callig(user_id, line_id, user_message, task_id))
@@ -0,0 +1,150 @@
+# ai_worker.py
+#
+# AI Worker Pool สำหรับโหมด Multi-process (PROCESSING_MODE=queue)
+#
+#   gunicorn -c gunicorn.conf.py api_app:app      # N Web Workers: รับ Webhook และใส่งานลง job_queue เท่านั้น
+#   python ai_worker.py --workers 4               # M AI Workers: ดึงงานไปเรียก Agent
+#
+# Process หลักของ ai_worker.py เป็นเจ้าของ DBWriter ตัวเดียว ทุกคำสั่งเขียนของ AI Worker (multiprocessing.Queue)
+# และของ Web Worker (Unix Socket DB_WRITER_SOCKET, db_writer.SocketWriteClient) จะถูกส่งมาที่นี่
+# และ Commit รวมกันเป็น Batch (Single Writer)
+
+import argparse
+import importlib
+import multiprocessing
+import os
+import threading
+import time
+
+import database
+from database import set_write_executor
+from db_writer import DBWriter, RemoteWriteClient, serve_remote_writes, serve_socket_writes
+from admission import ADMISSION_MAX_IN_FLIGHT_PER_STORE
+from conversation_dispatcher import run_conversation_batch, MESSAGE_DEBOUNCE_SECONDS, MESSAGE_DEBOUNCE_MAX_WAIT
+from task_queue import claim_next_conversation_batch, complete_job, requeue_stale_jobs
+from task_archive import TASK_MAINTENANCE_INTERVAL, start_maintenance_thread
+from write_buffer import get_task_write_buffer
+
+DEFAULT_PROCESSOR = "ai_processor:process_new_tasks_using_tool_callig"
+STALE_JOB_SECONDS = int(os.getenv("AI_WORKER_STALE_JOB_SECONDS", "600"))
+
+
+def resolve_processor(processor_spec):
+    """Imports a 'module:function' processor. The function takes (user_id, line_id, user_message, task_id)."""
+    module_name, _, function_name = processor_spec.partition(":")
+    module = importlib.import_module(module_name)
+    return getattr(module, function_name)
+
+
+def run_worker(worker_id, processor, poll_interval=0.5, stop_event=None, exit_when_idle=False):
+    """
+    Claims and processes jobs until stop_event is set (or the queue is empty when exit_when_idle).
+    Jobs are claimed per conversation: rapid-fire messages become one agent run, and a conversation
+    is never processed by two workers at the same time.
+    """
+    processed = 0
+    try:
+        while not (stop_event is not None and stop_event.is_set()):
+            jobs = claim_next_conversation_batch(worker_id, MESSAGE_DEBOUNCE_SECONDS, MESSAGE_DEBOUNCE_MAX_WAIT, ADMISSION_MAX_IN_FLIGHT_PER_STORE)
+            if not jobs:
+                if exit_when_idle:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            first = jobs[0]
+            try:
+                run_conversation_batch(processor, first["user_id"], first["line_id"], jobs)
+                status, error = "done", None
+            except Exception as e:
+                print(f"[{worker_id}] Error processing jobs {[job['job_id'] for job in jobs]}: {e}")
+                status, error = "failed", str(e)
+            for job in jobs:
+                complete_job(job["job_id"], status, error)
+            processed += len(jobs)
+    finally:
+        # Thread ของ TaskWriteBuffer เป็น Daemon: สถานะที่ Stage ไว้ต้องถูกเขียนก่อน Worker จบ
+        get_task_write_buffer().flush()
+    return processed
+
+
+def _worker_process_main(worker_index, db_file, processor_spec, poll_interval, exit_when_idle, request_queue, reply_queue, stop_event):
+    database.DB_FILE_NAME = db_file
+    set_write_executor(RemoteWriteClient(worker_index, request_queue, reply_queue))
+    processor = resolve_processor(processor_spec)
+    worker_id = f"ai-worker-{worker_index}-{os.getpid()}"
+    print(f"[{worker_id}] started.")
+    processed = run_worker(worker_id, processor, poll_interval, stop_event, exit_when_idle)
+    print(f"[{worker_id}] stopped after {processed} jobs.")
+
+
+def run_pool(num_workers, processor_spec=DEFAULT_PROCESSOR, poll_interval=0.5, exit_when_idle=False):
+    """
+    Starts num_workers AI worker processes plus the single DB writer in this process.
+    Blocks until all workers exit (or Ctrl+C). Returns the writer so callers can read its counters.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    writer = DBWriter(database.DB_FILE_NAME).start()
+    set_write_executor(writer)
+
+    request_queue = ctx.Queue()
+    reply_queues = [ctx.Queue() for _ in range(num_workers)]
+    bridge = threading.Thread(target=serve_remote_writes, args=(writer, request_queue, reply_queues), name="db-writer-bridge", daemon=True)
+    bridge.start()
+    # การเขียนจาก gunicorn Web Worker (PROCESSING_MODE=queue) เข้ามาทาง Unix Socket
+    listener = serve_socket_writes(writer)
+
+    stop_event = ctx.Event()
+    processes = [
+        ctx.Process(
+            target=_worker_process_main,
+            args=(i, database.DB_FILE_NAME, processor_spec, poll_interval, exit_when_idle, request_queue, reply_queues[i], stop_event),
+            name=f"ai-worker-{i}",
+        )
+        for i in range(num_workers)
+    ]
+    for process in processes:
+        process.start()
+
+    # Archive/Vacuum รันใน Process นี้ การเขียนจึงผ่าน Writer ตัวเดียวกับ Worker
+    maintenance_stop = threading.Event()
+    if TASK_MAINTENANCE_INTERVAL > 0 and not exit_when_idle:
+        start_maintenance_thread(TASK_MAINTENANCE_INTERVAL, maintenance_stop)
+
+    try:
+        while any(process.is_alive() for process in processes):
+            for process in processes:
+                process.join(timeout=1)
+            if not exit_when_idle:
+                requeue_stale_jobs(STALE_JOB_SECONDS)
+    except KeyboardInterrupt:
+        print("Stopping AI workers...")
+        stop_event.set()
+        for process in processes:
+            process.join()
+    finally:
+        maintenance_stop.set()
+        listener.close()
+        request_queue.put(None)
+        bridge.join(timeout=5)
+        for reply_queue in reply_queues:
+            reply_queue.put(None)
+        writer.stop()
+        set_write_executor(None)
+    return writer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run AI worker processes that consume the shared job queue.")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("AI_WORKERS", "2")))
+    parser.add_argument("--processor", default=os.getenv("AI_WORKER_PROCESSOR", DEFAULT_PROCESSOR))
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    args = parser.parse_args()
+
+    database.initialize_database()
+    print(f"Starting {args.workers} AI workers using {args.processor} on {database.DB_FILE_NAME}")
+    run_pool(args.workers, args.processor, args.poll_interval)
+
+
+if __name__ == "__main__":
+    main()
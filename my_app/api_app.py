@@ -1,6 +1,6 @@
 #api_app.py
 import os
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template, stream_with_context
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import TextMessage, MessageEvent, StickerMessage, ImageMessage 
@@ -12,13 +12,48 @@ import sqlite3
 
 # from database import initialize_database, add_new_task, get_credentials, add_credentials, get_tasks_by_status, update_task_status, update_admin_response, update_task_response, get_auto_reply_setting, update_auto_reply_setting, get_chat_history
 from database import initialize_database, add_new_task, get_credentials, add_credentials, get_tasks_by_status, update_task_status, update_admin_response, update_task_response, get_auto_reply_setting, update_auto_reply_setting, get_chat_history, get_chat_threads_by_status
-from ai_processor import process_new_tasks, process_new_tasks_using_sql_and_RAG,process_new_tasks_using_tool_callig
+from ai_processor import process_new_tasks, process_new_tasks_using_sql_and_RAG,process_new_tasks_using_tool_callig, notify_processing_error
+from task_queue import enqueue_job, get_queue_backlog_by_store
+from database import set_write_executor
+from db_writer import SocketWriteClient
+from conversation_dispatcher import get_conversation_dispatcher
+from webhook_dedup import idempotent_handler
+from kb_import import detect_format, index_new_rows, iter_import
+from task_events import acquire_stream_slot, release_stream_slot, sse_stream
+from task_status import TASK_STATUSES, is_valid_status
+from line_profiles import get_profiles, get_profile_resolver
+from task_traces import load_trace
+from model_router import MODEL_TIERS, effective_routes, set_store_route
+from quick_replies import IMAGE, IMAGE_MESSAGE, STICKER, STICKER_MESSAGE, TEXT, answer_quick_reply, effective_rules, set_quick_reply
+from admission import LoadShedder, shed_task
+import metrics
 # from database import initialize_database, add_new_task, get_credentials, add_credentials, get_tasks_by_status, update_task_status, update_admin_response, update_task_response, get_auto_reply_setting, update_auto_reply_setting
 # --- 1. Flask App and Database Setup ---
 load_dotenv()
 app = Flask(__name__)
 DB_FILE_NAME = "store_database.db"
 initialize_database()
+# "inline" = ประมวลผล AI ใน Request เดียวกับ Webhook (Dev Server)
+# "queue"  = ใส่งานลง job_queue แล้วให้ ai_worker.py ประมวลผล (gunicorn + AI Worker หลาย Process)
+PROCESSING_MODE = os.getenv("PROCESSING_MODE", "inline")
+if PROCESSING_MODE == "queue":
+    # การเขียนของ Web Worker ผ่าน DBWriter ของ ai_worker.py (Single Writer) และเขียนตรงเมื่อ Coordinator ไม่ได้ทำงาน
+    set_write_executor(SocketWriteClient())
+
+def conversation_dispatcher():
+    """The inline-mode dispatcher; a batch that fails on its thread still gets the fallback reply."""
+    return get_conversation_dispatcher(process_new_tasks_using_tool_callig, on_error=notify_processing_error)
+
+def agent_backlog():
+    """{user_id: conversations waiting for an agent run} used by the load shedder."""
+    if PROCESSING_MODE == "queue":
+        # คิวกลางใน job_queue (รวมทุก Web Worker)
+        return get_queue_backlog_by_store()
+    return conversation_dispatcher().queued_by_store()
+
+# ร้านที่มีบทสนทนารอ Agent เกินเกณฑ์ ข้อความใหม่ถูกส่งให้แอดมินตอบ (admission.py)
+load_shedder = LoadShedder(agent_backlog)
+metrics.register_collector("load_shedding", load_shedder.stats)
 
 # --- 2. LINE Messaging API Webhook Update Function ---
 def update_line_webhook(access_token, webhook_url):
@@ -59,6 +94,14 @@ def get_chat_history_api(user_id, line_id):
     history = get_chat_history(user_id, line_id)
     return jsonify(history)
 
+@app.route('/api/task_trace/<user_id>/<int:task_id>')
+def get_task_trace_api(user_id, task_id):
+    """Agent trace (intermediate steps) of one task, loaded only when an admin opens the task."""
+    trace = load_trace(task_id, user_id)
+    if trace is None:
+        return jsonify({'message': 'No trace recorded for this task.'}), 404
+    return jsonify(trace)
+
 
 @app.route('/dashboard/<user_id>')
 def dashboard(user_id):
@@ -90,6 +133,8 @@ def save_credentials(user_id):
         if not add_credentials(user_id, channel_secret, channel_access_token):
             print("Failed to save credentials to database.")
             return jsonify({'message': 'Failed to save credentials to database.'}), 500
+        # Token ใหม่: ให้ Resolver ของ Profile สร้าง LINE Client ใหม่
+        get_profile_resolver().forget_store(user_id)
 
         # Ensure BASE_URL is set in your .env file
         base_url = os.getenv('BASE_URL')
@@ -166,8 +211,11 @@ def api_update_task_status(user_id):
 
     if not task_id or not new_status:
         return jsonify({'message': 'Missing task ID or new status.'}), 400
+    if not is_valid_status(new_status):
+        return jsonify({'message': f'Unknown status. Use one of: {", ".join(TASK_STATUSES)}.'}), 400
 
-    update_task_status(task_id, new_status)
+    if not update_task_status(task_id, new_status):
+        return jsonify({'message': f'Task cannot move to {new_status} from its current status.'}), 409
     return jsonify({'message': 'Task status updated successfully.'}), 200
 
 @app.route('/webhook/<user_id>', methods=['POST'])
@@ -188,8 +236,12 @@ def callback(user_id):
     body = request.get_data(as_text=True)
     signature = request.headers.get('X-Line-Signature')
     
+    def reply_text(reply_token):
+        return lambda text: line_bot_api_dynamic.reply_message(reply_token, TextSendMessage(text=text))
+
     try:
         @handler_dynamic.add(MessageEvent, message=TextMessage)
+        @idempotent_handler(user_id)
         def handle_message(event):
             user_message = event.message.text
             reply_token = event.reply_token
@@ -200,14 +252,26 @@ def callback(user_id):
             
             # --- ตรงนี้คือส่วนที่แก้ไข ---
             is_auto_reply_enabled = get_auto_reply_setting(user_id)
-            if is_auto_reply_enabled:
+            if is_auto_reply_enabled and answer_quick_reply(user_id, task_id, TEXT, user_message, reply_text(reply_token)):
+                # ตรงกับกฎตอบกลับทันที (quick_replies.py) ไม่ต้องสร้าง Agent
+                return
+            if is_auto_reply_enabled and load_shedder.should_shed(user_id):
+                # งานของร้านนี้ล้นคิว: ไม่สร้าง Agent ให้แอดมินตอบแทน (Awaiting_Approval)
+                shed_task(task_id)
+                return
+            if is_auto_reply_enabled and PROCESSING_MODE == "queue":
+                # Web Worker ทำแค่รับงาน ส่วน AI Worker จะดึงงานไปประมวลผลเอง
+                if task_id is None or enqueue_job(task_id, user_id, line_user_id, user_message) is None:
+                    print(f"Failed to enqueue task for LINE user {line_user_id}.")
+            elif is_auto_reply_enabled:
                 print("Auto-reply is enabled. Generating AI response...")
                 
                 try:
-                    # เรียกใช้ฟังก์ชันจาก ai_processor.py โดยตรง
+                    # เรียกใช้ฟังก์ชันจาก ai_processor.py ผ่าน Dispatcher
+                    # ข้อความที่พิมพ์ติดกันจะถูกรวมเป็น Agent Run เดียว และตอบตามลำดับของแต่ละบทสนทนา
                     # process_new_tasks(user_id, line_user_id, user_message, task_id)
                     # process_new_tasks_using_sql_and_RAG(user_id, line_user_id, user_message, task_id)
-                    process_new_tasks_using_tool_callig(user_id, line_user_id, user_message, task_id)
+                    conversation_dispatcher().submit(user_id, line_user_id, task_id, user_message)
 
                 except Exception as e:
                     print(f"Error during AI processing: {e}")
@@ -217,21 +281,22 @@ def callback(user_id):
                     )
         # 🟢 Handler สำหรับ Sticker Message
         @handler_dynamic.add(MessageEvent, message=StickerMessage)
+        @idempotent_handler(user_id)
         def handle_sticker_message(event):
-            # ตัวอย่าง: ตอบกลับด้วยข้อความปกติเมื่อได้รับ Sticker
-            line_bot_api_dynamic.reply_message(
-                event.reply_token,
-                TextSendMessage(text="สวัสดีค่ะมีอะไรสอบถามแจ้งได้เลยนะคะ")
-            )
+            # ตอบด้วยกฎ sticker ของร้าน (ค่าเริ่มต้น: ข้อความทักทาย) และบันทึกเป็น Task
+            task_id = add_new_task(user_id, event.source.user_id, event.reply_token, STICKER_MESSAGE)
+            if get_auto_reply_setting(user_id):
+                sticker = f"{event.message.package_id}/{event.message.sticker_id}"
+                answer_quick_reply(user_id, task_id, STICKER, sticker, reply_text(event.reply_token))
             
         # 🟢 Handler สำหรับ Image Message
         @handler_dynamic.add(MessageEvent, message=ImageMessage)
+        @idempotent_handler(user_id)
         def handle_image_message(event):
-            # ตัวอย่าง: ตอบกลับด้วยข้อความปกติเมื่อได้รับ Image
-            line_bot_api_dynamic.reply_message(
-                event.reply_token,
-                TextSendMessage(text="ขอบคุณสำหรับรูปภาพค่ะ รบกวนพิมพ์คำถาม หรือมีอะไรสอบถามแจ้งได้เลยนะคะ")
-            )
+            # ตอบด้วยกฎ image ของร้าน และบันทึกเป็น Task
+            task_id = add_new_task(user_id, event.source.user_id, event.reply_token, IMAGE_MESSAGE)
+            if get_auto_reply_setting(user_id):
+                answer_quick_reply(user_id, task_id, IMAGE, "", reply_text(event.reply_token))
         handler_dynamic.handle(body, signature)
 
     except InvalidSignatureError:
@@ -263,6 +328,116 @@ def update_auto_reply_status(user_id):
     update_auto_reply_setting(user_id, status_int)
     return jsonify({'message': 'Auto-reply setting updated successfully.'}), 200
 
+@app.route('/api/stream/tasks/<user_id>')
+def stream_task_events(user_id):
+    """
+    Server-Sent Events stream of the store's task changes (created / status / updated).
+    The dashboard applies each event to its chat list instead of re-fetching /api/tasks.
+    Answers 503 when the process already serves SSE_MAX_STREAMS streams; the dashboard then polls.
+    """
+    # แต่ละ Stream ถือ Thread ของ Web Worker ไว้ ต้องเหลือ Thread ให้ /webhook เสมอ
+    if not acquire_stream_slot():
+        return jsonify({'message': 'Too many live streams on this worker; poll /api/tasks instead.'}), 503
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+    response = Response(stream_with_context(sse_stream(user_id, last_event_id)), mimetype='text/event-stream')
+    # คืน Slot เมื่อ Server ปิด Response (จบ Stream หรือ Client ตัดการเชื่อมต่อ แม้ Generator ยังไม่เริ่ม)
+    response.call_on_close(release_stream_slot)
+    response.headers['Cache-Control'] = 'no-cache'
+    # ไม่ให้ Reverse Proxy (nginx) Buffer Event ไว้
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/profiles/<user_id>', methods=['GET', 'POST'])
+def get_line_profiles(user_id):
+    """
+    Returns the cached LINE profiles of a batch of the store's customers:
+    POST {"line_ids": [...]} or GET ?line_ids=a,b. Profiles not cached yet are fetched in the
+    background and come back with "pending": true; ?wait=<seconds> waits for them up to 5 seconds.
+    """
+    if request.method == 'POST':
+        line_ids = (request.get_json(silent=True) or {}).get('line_ids') or []
+    else:
+        line_ids = [line_id for line_id in request.args.get('line_ids', '').split(',') if line_id]
+    if not isinstance(line_ids, list):
+        return jsonify({'message': 'line_ids must be a list.'}), 400
+    try:
+        wait_seconds = min(float(request.args.get('wait', 0)), 5.0)
+    except ValueError:
+        wait_seconds = 0.0
+    return jsonify(get_profiles(user_id, [str(line_id) for line_id in line_ids], wait_seconds=wait_seconds))
+
+@app.route('/api/model_routes/<user_id>', methods=['GET', 'POST'])
+def api_model_routes(user_id):
+    """
+    Returns the tier/model used for each message route of the store.
+    POST {"faq": "local", "menu": "gemini-2.5-flash", "complex": null} changes routes (null resets to the default).
+    Other processes pick the change up within MODEL_ROUTES_CACHE_SECONDS.
+    """
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'message': 'Expected a JSON object of route -> tier or model.'}), 400
+        try:
+            for route, tier_or_model in data.items():
+                set_store_route(user_id, route, tier_or_model)
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
+    return jsonify({'routes': effective_routes(user_id), 'tiers': MODEL_TIERS})
+
+@app.route('/api/quick_replies/<user_id>', methods=['GET', 'POST'])
+def api_quick_replies(user_id):
+    """
+    Returns the store's quick reply rules (defaults merged with its own), in matching order.
+    POST {"hours": {"pattern": "เปิดกี่โมง", "reply": "...", "priority": 10}, "greeting": {"enabled": false}, "old": null}
+    creates/replaces rules (null deletes the store's row). Other processes pick the change up within QUICK_REPLIES_CACHE_SECONDS.
+    """
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'message': 'Expected a JSON object of rule name -> rule or null.'}), 400
+        try:
+            for name, rule in data.items():
+                set_quick_reply(user_id, name, rule)
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
+    return jsonify({'rules': [rule._asdict() for rule in effective_rules(user_id)]})
+
+@app.route('/api/metrics')
+def get_metrics():
+    """Returns in-process counters, gauges and latency summaries as JSON."""
+    return jsonify(metrics.snapshot())
+
+@app.route('/api/knowledge/import/<store_id>', methods=['POST'])
+def import_knowledge_api(store_id):
+    """
+    Streams a CSV or JSONL file of FAQ rows, sent as the raw request body, into the store's knowledge base
+    (e.g. curl --data-binary @faq.csv). ?format=csv|jsonl overrides detection from ?filename= / Content-Type.
+    Responds with NDJSON progress lines, one per committed chunk, ending with the final report.
+    """
+    # อ่านจาก Body ตรง ๆ แทน multipart: Werkzeug จะเขียน multipart ทั้งไฟล์ลง Temp File ก่อน
+    # และปิดไฟล์นั้นก่อนที่ Response แบบ Streaming จะเริ่มอ่าน
+    if request.mimetype == 'multipart/form-data':
+        return jsonify({'message': 'Send the file as the raw request body, not multipart/form-data.'}), 400
+    stream = request.stream
+    file_format = request.args.get('format') or detect_format(request.args.get('filename'), request.mimetype)
+    if file_format not in ('csv', 'jsonl'):
+        return jsonify({'message': 'format must be csv or jsonl.'}), 400
+    run_index = request.args.get('index', '1') != '0'
+
+    def generate():
+        for report in iter_import(store_id, stream, file_format):
+            if report['done'] and report['inserted'] and run_index:
+                # Index Vector เฉพาะแถวใหม่ใน Background (ต่อจาก Checkpoint ของร้าน)
+                index_new_rows(store_id)
+                report['indexing'] = 'started'
+            yield json.dumps(report, ensure_ascii=False) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 # ... (โค้ดส่วนอื่น ๆ เหมือนเดิม)
 
 if __name__ == '__main__':
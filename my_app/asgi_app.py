@@ -0,0 +1,184 @@
+# asgi_app.py
+#
+# ASGI Entry Point สำหรับ Async Pipeline
+#
+#   uvicorn asgi_app:app --host 0.0.0.0 --port 9000
+#
+# - POST /webhook/<user_id> ทำงานแบบ Async บน Event Loop โดยตรง: ตรวจลายเซ็น บันทึก Task
+#   แล้วส่งเข้า AsyncConversationDispatcher ซึ่งเรียก Agent ด้วย ainvoke และตอบด้วย AsyncLineBotApi
+# - Route อื่นทั้งหมด (Dashboard, API ของแอดมิน) ส่งต่อให้ Flask app เดิมผ่าน WSGIMiddleware
+# - PROCESSING_MODE=queue ยังใช้ job_queue เหมือน api_app.py
+
+import asyncio
+import os
+import re
+
+from linebot import WebhookParser
+from linebot.exceptions import InvalidSignatureError
+from linebot.models import MessageEvent, TextMessage, StickerMessage, ImageMessage, TextSendMessage
+from uvicorn.middleware.wsgi import WSGIMiddleware
+
+from admission import LoadShedder, shed_task
+from api_app import app as flask_app, PROCESSING_MODE
+from ai_processor import aprocess_new_tasks_using_tool_callig, get_async_line_bot_api, close_async_line_clients, notify_processing_error
+from conversation_dispatcher import AsyncConversationDispatcher
+from database import add_new_task, get_credentials, get_auto_reply_setting
+from quick_replies import IMAGE, IMAGE_MESSAGE, STICKER, STICKER_MESSAGE, TEXT, aanswer_quick_reply
+from task_queue import enqueue_job, get_queue_backlog_by_store
+from webhook_dedup import claim_webhook_event, release_webhook_event
+import metrics
+
+WEBHOOK_PATH = re.compile(r"^/webhook/(?P<user_id>[^/]+)/?$")
+WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "10"))
+
+_flask_asgi = WSGIMiddleware(flask_app, workers=WSGI_THREADS)
+_dispatcher = None
+
+
+def get_async_dispatcher():
+    """Returns the dispatcher of this event loop (created on first use inside the loop)."""
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = AsyncConversationDispatcher(aprocess_new_tasks_using_tool_callig, on_error=notify_processing_error)
+        metrics.register_collector("async_dispatcher", lambda: {"active_conversations": _dispatcher.active_conversations(), **_dispatcher.admission.stats()})
+    return _dispatcher
+
+
+def _agent_backlog():
+    if PROCESSING_MODE == "queue":
+        return get_queue_backlog_by_store()
+    return _dispatcher.queued_by_store() if _dispatcher is not None else {}
+
+
+# แทนที่ load_shedder ของ api_app.py เพราะ Webhook ของ ASGI ใช้ Dispatcher ของ Event Loop นี้
+_load_shedder = LoadShedder(_agent_backlog)
+metrics.register_collector("load_shedding", _load_shedder.stats)
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def _respond(send, status, text):
+    body = text.encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"text/plain; charset=utf-8"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def _reply_text(channel_access_token, reply_token):
+    async def send(text):
+        await get_async_line_bot_api(channel_access_token).reply_message(reply_token, TextSendMessage(text=text))
+    return send
+
+
+async def _handle_text_message(user_id, channel_access_token, event):
+    line_user_id = event.source.user_id
+    user_message = event.message.text
+
+    # บันทึกข้อความของลูกค้าลงในฐานข้อมูล
+    task_id = await asyncio.to_thread(add_new_task, user_id, line_user_id, event.reply_token, user_message)
+    is_auto_reply_enabled = await asyncio.to_thread(get_auto_reply_setting, user_id)
+    if not is_auto_reply_enabled:
+        return
+    # ตรงกับกฎตอบกลับทันที (quick_replies.py) ไม่ต้องสร้าง Agent
+    if await aanswer_quick_reply(user_id, task_id, TEXT, user_message, _reply_text(channel_access_token, event.reply_token)):
+        return
+    # งานของร้านนี้ล้นคิว: ไม่สร้าง Agent ให้แอดมินตอบแทน (Awaiting_Approval)
+    if PROCESSING_MODE == "queue":
+        shed = await asyncio.to_thread(_load_shedder.should_shed, user_id)
+    else:
+        shed = _load_shedder.should_shed(user_id)
+    if shed:
+        shed_task(task_id)
+        return
+    if PROCESSING_MODE == "queue":
+        if task_id is None or await asyncio.to_thread(enqueue_job, task_id, user_id, line_user_id, user_message) is None:
+            print(f"Failed to enqueue task for LINE user {line_user_id}.")
+        return
+    get_async_dispatcher().submit(user_id, line_user_id, task_id, user_message)
+
+
+async def _handle_media_message(user_id, channel_access_token, event):
+    # สติกเกอร์/รูปภาพถูกบันทึกเป็น Task และตอบด้วยกฎ sticker/image ของร้าน
+    if isinstance(event.message, StickerMessage):
+        kind, user_message, text = STICKER, STICKER_MESSAGE, f"{event.message.package_id}/{event.message.sticker_id}"
+    else:
+        kind, user_message, text = IMAGE, IMAGE_MESSAGE, ""
+    task_id = await asyncio.to_thread(add_new_task, user_id, event.source.user_id, event.reply_token, user_message)
+    if await asyncio.to_thread(get_auto_reply_setting, user_id):
+        await aanswer_quick_reply(user_id, task_id, kind, text, _reply_text(channel_access_token, event.reply_token))
+
+
+async def _handle_event(user_id, channel_access_token, event):
+    if not isinstance(event, MessageEvent):
+        return
+    if not await asyncio.to_thread(claim_webhook_event, user_id, event):
+        return
+    try:
+        if isinstance(event.message, TextMessage):
+            await _handle_text_message(user_id, channel_access_token, event)
+        elif isinstance(event.message, (StickerMessage, ImageMessage)):
+            await _handle_media_message(user_id, channel_access_token, event)
+    except Exception:
+        await asyncio.to_thread(release_webhook_event, event)
+        raise
+
+
+async def handle_webhook(user_id, scope, receive, send):
+    print(f"--- LINE Webhook Request (async) for user: {user_id} ---")
+    body = (await _read_body(receive)).decode("utf-8")
+
+    credentials_data = await asyncio.to_thread(get_credentials, user_id)
+    if not credentials_data:
+        print(f"Credentials not found for user ID: {user_id}")
+        return await _respond(send, 404, "Not Found")
+
+    headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+    try:
+        events = WebhookParser(credentials_data['channel_secret']).parse(body, headers.get("x-line-signature", ""))
+    except InvalidSignatureError:
+        print("Invalid signature. Please check your channel secret.")
+        return await _respond(send, 400, "Invalid signature")
+
+    try:
+        for event in events:
+            await _handle_event(user_id, credentials_data['channel_access_token'], event)
+    except Exception as e:
+        print(f"Error handling webhook: {e}")
+        return await _respond(send, 500, f"Internal Server Error: {e}")
+    return await _respond(send, 200, "OK")
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await close_async_line_clients()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] == "http" and scope["method"] == "POST":
+        match = WEBHOOK_PATH.match(scope["path"])
+        if match:
+            return await handle_webhook(match.group("user_id"), scope, receive, send)
+    return await _flask_asgi(scope, receive, send)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 9000)))
@@ -0,0 +1,67 @@
+# async_runtime.py
+
+import asyncio
+import os
+import threading
+
+# =========================================================================
+# 🟢 Async Runtime กลางของโปรเจกต์
+# เดิมทุกไฟล์ Agent เรียก nest_asyncio.apply() ตอน Import ซึ่ง Patch Event Loop ทั้ง Process
+# ตอนนี้ Pipeline หลักเป็น Async (ainvoke, AsyncLineBotApi, asgi_app.py) และใช้เครื่องมือในไฟล์นี้แทน:
+#   - ensure_event_loop(): ให้ Thread ที่ยังไม่มี Event Loop (เช่น Worker Thread) สร้าง Client ของ Google GenAI ได้
+#   - run_sync(coro): Sync Shim สำหรับผู้เรียกเดิม รัน Coroutine บน Background Loop กลางแล้วรอผล
+#   - apply_nest_asyncio_if_enabled(): เปิด nest_asyncio แบบเดิมได้เฉพาะเมื่อตั้ง NEST_ASYNCIO=1 (เช่น Notebook)
+# =========================================================================
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def ensure_event_loop():
+    """Returns the current thread's event loop, creating and registering one if the thread has none."""
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    try:
+        return asyncio.get_event_loop_policy().get_event_loop()
+    except RuntimeError:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        return loop
+
+
+def get_background_loop():
+    """Returns the process-wide event loop that runs on its own daemon thread (started on first use)."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="async-runtime", daemon=True)
+            thread.start()
+            _loop = loop
+        return _loop
+
+
+def submit(coro):
+    """Schedules coro on the background loop and returns a concurrent.futures.Future."""
+    return asyncio.run_coroutine_threadsafe(coro, get_background_loop())
+
+
+def run_sync(coro, timeout=None):
+    """Runs coro on the background loop and blocks the calling (non-async) thread until it finishes."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return submit(coro).result(timeout)
+    coro.close()
+    raise RuntimeError("run_sync() cannot be called from a running event loop; await the coroutine instead.")
+
+
+def apply_nest_asyncio_if_enabled():
+    """Legacy opt-in: patches the event loop with nest_asyncio only when NEST_ASYNCIO=1."""
+    if os.getenv("NEST_ASYNCIO", "0") != "1":
+        return False
+    import nest_asyncio
+    nest_asyncio.apply()
+    return True
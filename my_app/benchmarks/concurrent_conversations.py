@@ -0,0 +1,163 @@
+# benchmarks/concurrent_conversations.py
+#
+# เปรียบเทียบความจุของบทสนทนาพร้อมกัน ระหว่าง Pipeline แบบ Sync (Thread ต่อบทสนทนา) กับแบบ Async (ainvoke บน Event Loop เดียว)
+#
+#   cd my_app && python benchmarks/concurrent_conversations.py --conversations 50 200 1000 --threads 8
+#
+# ใช้ AgentExecutor + create_tool_calling_agent จริง แต่แทน Gemini ด้วย SimulatedToolCallingLLM
+# (หน่วงเวลาเท่ากับ LLM จริงหนึ่งรอบ) และ Tool ที่หน่วงเวลาเหมือน Query/RAG
+# รอบแรก LLM ขอเรียก Tool รอบสองตอบลูกค้า จึงเท่ากับ 1 ข้อความที่ใช้ 1 Tool
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain.agents import AgentExecutor, create_tool_calling_agent
+from langchain.prompts import ChatPromptTemplate
+from langchain.tools import Tool
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+LLM_LATENCY_MS = float(os.getenv("BENCH_LLM_MS", "300"))
+TOOL_LATENCY_MS = float(os.getenv("BENCH_TOOL_MS", "100"))
+
+
+class SimulatedToolCallingLLM(BaseChatModel):
+    """Chat model stand-in: asks for one tool call, then answers. Sleeps like a remote LLM."""
+
+    latency: float = LLM_LATENCY_MS / 1000
+    tool_names: list = ["sql_db_query"]
+
+    @property
+    def _llm_type(self):
+        return "simulated-tool-calling"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _respond(self, messages):
+        if any(isinstance(message, ToolMessage) for message in messages):
+            return AIMessage(content="เมนูแนะนำวันนี้คือข้าวผัดค่ะ")
+        tool_calls = [
+            {"name": name, "args": {"__arg1": "ขอเมนูแนะนำ"}, "id": f"call_{i}"}
+            for i, name in enumerate(self.tool_names)
+        ]
+        return AIMessage(content="", tool_calls=tool_calls)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._respond(messages))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self._respond(messages))])
+
+
+def _query(query):
+    time.sleep(TOOL_LATENCY_MS / 1000)
+    return "ข้าวผัด 60 บาท"
+
+
+async def _aquery(query):
+    await asyncio.sleep(TOOL_LATENCY_MS / 1000)
+    return "ข้าวผัด 60 บาท"
+
+
+def build_agent_executor():
+    tools = [Tool(name="sql_db_query", description="query menu", func=_query, coroutine=_aquery)]
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", "คุณคือผู้ช่วยร้านอาหาร"),
+        ("human", "{input}"),
+        ("placeholder", "{agent_scratchpad}"),
+    ])
+    agent = create_tool_calling_agent(llm=SimulatedToolCallingLLM(), tools=tools, prompt=prompt)
+    return AgentExecutor(agent=agent, tools=tools)
+
+
+class _ThreadPeak:
+    """Samples threading.active_count() in the background and keeps the maximum."""
+
+    def __init__(self):
+        self.peak = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(0.01):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+# Latency นับจากเวลาที่ข้อความทั้งหมดเข้ามาพร้อมกัน (รวมเวลารอ Thread ว่างในโหมด Sync)
+def run_sync_mode(agent_executor, conversations, threads):
+    latencies = []
+    started = time.perf_counter()
+
+    def one_conversation(i):
+        agent_executor.invoke({"input": f"ขอเมนูแนะนำ {i}"})
+        latencies.append(time.perf_counter() - started)
+
+    with _ThreadPeak() as peak:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(one_conversation, range(conversations)))
+        elapsed = time.perf_counter() - started
+    return elapsed, latencies, peak.peak
+
+
+def run_async_mode(agent_executor, conversations):
+    latencies = []
+    started = time.perf_counter()
+
+    async def one_conversation(i):
+        await agent_executor.ainvoke({"input": f"ขอเมนูแนะนำ {i}"})
+        latencies.append(time.perf_counter() - started)
+
+    async def run_all():
+        await asyncio.gather(*(one_conversation(i) for i in range(conversations)))
+
+    with _ThreadPeak() as peak:
+        asyncio.run(run_all())
+        elapsed = time.perf_counter() - started
+    return elapsed, latencies, peak.peak
+
+
+def _p95(values):
+    return statistics.quantiles(values, n=20)[-1] if len(values) >= 2 else values[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare concurrent-conversation capacity of the sync and async agent pipelines.")
+    parser.add_argument("--conversations", type=int, nargs="+", default=[50, 200])
+    parser.add_argument("--threads", type=int, default=int(os.getenv("CONVERSATION_WORKERS", "8")),
+                        help="thread pool size of the sync pipeline (CONVERSATION_WORKERS)")
+    args = parser.parse_args()
+
+    agent_executor = build_agent_executor()
+    print(f"LLM latency {LLM_LATENCY_MS:.0f} ms x2, tool latency {TOOL_LATENCY_MS:.0f} ms, sync threads {args.threads}")
+    print("\nmode  | conversations | seconds | conv/sec | p95 latency (s) | peak threads")
+    for conversations in args.conversations:
+        for mode in ("sync", "async"):
+            if mode == "sync":
+                elapsed, latencies, peak_threads = run_sync_mode(agent_executor, conversations, args.threads)
+            else:
+                elapsed, latencies, peak_threads = run_async_mode(agent_executor, conversations)
+            print(f"{mode:5s} | {conversations:13d} | {elapsed:7.2f} | {conversations / elapsed:8.1f} | {_p95(latencies):15.2f} | {peak_threads:12d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# benchmarks/kb_onboarding.py
+#
+# วัดเวลา Onboard ร้านที่มี FAQ จำนวนมาก (ค่าเริ่มต้น 5,000 แถว) เข้า Vector Backend ด้วย kb_indexer
+#
+#   cd my_app && python benchmarks/kb_onboarding.py --rows 5000 --quota-rpm 300
+#
+# Embedding API จำลอง: แต่ละ Request ใช้เวลา BENCH_EMBED_REQUEST_MS + BENCH_EMBED_TEXT_MS ต่อข้อความ
+# และตอบ 429 เมื่อมี Request เริ่มเกินโควตาต่อวินาที (quota-rpm / 60) เหมือน Rate Limit ของ API จริง
+# เปรียบเทียบ:
+#   sequential  - Batch ละ 100 ทีละ Request (พฤติกรรมเดิมของ add_documents)
+#   burst       - ยิงพร้อมกัน 8 Request โดยไม่จำกัดอัตรา (โดน 429 แล้ว Backoff)
+#   pipeline    - kb_indexer: Concurrency 4 + Rate Limiter เท่ากับโควตา
+#   resume      - pipeline ที่ถูกขัดจังหวะกลางทางแล้วรันต่อจาก Checkpoint (เวลารวมทั้งสองครั้ง)
+
+import argparse
+import collections
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_workdir = tempfile.mkdtemp(prefix="kb_onboarding_")
+os.environ["STORE_DB_FILE"] = os.path.join(_workdir, "store_database.db")
+os.environ["KB_VECTOR_DIRECTORY"] = os.path.join(_workdir, "kb_vectors")
+
+from langchain_core.embeddings import DeterministicFakeEmbedding, Embeddings
+
+from database import initialize_database, execute_write_many
+from kb_indexer import RateLimiter, index_store
+import metrics
+
+REQUEST_MS = float(os.getenv("BENCH_EMBED_REQUEST_MS", "200"))
+TEXT_MS = float(os.getenv("BENCH_EMBED_TEXT_MS", "4"))
+STORE_ID = "900"
+
+
+class Interrupted(Exception):
+    pass
+
+
+class SimulatedEmbeddingAPI(Embeddings):
+    """Remote embedding API stand-in with per-request latency and a requests-per-second quota."""
+
+    def __init__(self, quota_rpm, fail_after_requests=None):
+        self.per_second = max(1, int(quota_rpm / 60))
+        self.fail_after_requests = fail_after_requests
+        self.requests = 0
+        self.rejected = 0
+        self._starts = collections.deque()
+        self._lock = threading.Lock()
+        self._fake = DeterministicFakeEmbedding(size=768)
+
+    def embed_documents(self, texts):
+        with self._lock:
+            now = time.monotonic()
+            while self._starts and now - self._starts[0] >= 1.0:
+                self._starts.popleft()
+            if len(self._starts) >= self.per_second:
+                self.rejected += 1
+                raise RuntimeError("429 Resource has been exhausted (e.g. check quota).")
+            self._starts.append(now)
+            self.requests += 1
+            if self.fail_after_requests is not None and self.requests > self.fail_after_requests:
+                raise Interrupted("process stopped")
+        time.sleep((REQUEST_MS + TEXT_MS * len(texts)) / 1000)
+        return self._fake.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self._fake.embed_query(text)
+
+
+def seed_rows(rows):
+    statements = [("DELETE FROM knowledge_base WHERE store_id = ?", (STORE_ID,))]
+    statements += [
+        ("INSERT INTO knowledge_base (store_id, question_or_topic, answer_or_detail) VALUES (?, ?, ?)",
+         (STORE_ID, f"คำถามที่พบบ่อยข้อ {i}", f"คำตอบของคำถามข้อ {i} สำหรับลูกค้าของร้าน"))
+        for i in range(rows)
+    ]
+    execute_write_many(statements)
+
+
+def run(label, api, concurrency, limiter, rebuild=True):
+    started = time.perf_counter()
+    retries_before = metrics.get_counter("kb_embed_retries")
+    summary = index_store(STORE_ID, backend="numpy", embeddings=api, concurrency=concurrency, limiter=limiter, rebuild=rebuild)
+    elapsed = time.perf_counter() - started
+    return label, elapsed, summary, metrics.get_counter("kb_embed_retries") - retries_before
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure onboarding time of a large knowledge base with kb_indexer.")
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--quota-rpm", type=float, default=300, help="requests per minute the simulated API accepts")
+    args = parser.parse_args()
+
+    initialize_database()
+    seed_rows(args.rows)
+    print(f"{args.rows} rows, batch 100, request latency {REQUEST_MS:.0f} ms + {TEXT_MS:.0f} ms/text, API quota {args.quota_rpm:g} req/min\n")
+
+    results = [
+        run("sequential", SimulatedEmbeddingAPI(args.quota_rpm), 1, RateLimiter(0)),
+        run("burst", SimulatedEmbeddingAPI(args.quota_rpm), 8, RateLimiter(0)),
+        run("pipeline", SimulatedEmbeddingAPI(args.quota_rpm), 4, RateLimiter(args.quota_rpm)),
+    ]
+
+    # ขัดจังหวะหลัง Request ที่ 20 แล้วรันต่อด้วย Process State ใหม่ (Checkpoint อยู่ใน SQLite)
+    started = time.perf_counter()
+    try:
+        index_store(STORE_ID, backend="numpy", embeddings=SimulatedEmbeddingAPI(args.quota_rpm, fail_after_requests=20),
+                    concurrency=4, limiter=RateLimiter(args.quota_rpm), rebuild=True)
+    except Interrupted:
+        pass
+    label, elapsed, summary, retries = run("resume", SimulatedEmbeddingAPI(args.quota_rpm), 4, RateLimiter(args.quota_rpm), rebuild=False)
+    results.append((f"resume (from {summary['resumed_from']})", time.perf_counter() - started, summary, retries))
+
+    print("\nmode                 | seconds | rows indexed | 429 retries")
+    for label, elapsed, summary, retries in results:
+        print(f"{label:20s} | {elapsed:7.1f} | {summary['indexed']:12d} | {retries:11d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# benchmarks/knowledge_search.py
+#
+# วัดเวลาค้นหา Knowledge Base ด้วย HybridKnowledgeRetriever (Lexical Index ใน Memory)
+# เทียบกับการเรียก Embedding API + Chroma ทุกครั้งแบบเดิม (จำลองด้วยเวลาหน่วง BENCH_EMBED_MS)
+#
+#   cd my_app && python benchmarks/knowledge_search.py --rows 8 200 2000 --lookups 5000
+#
+# ใช้ฐานข้อมูลชั่วคราว ไม่ต้องมี GOOGLE_API_KEY และไม่เรียก Network
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["STORE_DB_FILE"] = os.path.join(tempfile.mkdtemp(), "knowledge_bench.db")
+
+from database import initialize_database, execute_write_many
+from knowledge_index import HybridKnowledgeRetriever, invalidate_knowledge_index
+import metrics
+
+EMBED_LATENCY_MS = float(os.getenv("BENCH_EMBED_MS", "150"))
+BENCH_STORE_ID = 3
+
+COMMON_QUESTIONS = [
+    "มีที่จอดรถไหมคะ",
+    "จอดรถได้ไหม",
+    "wifi รหัสอะไร",
+    "มี wifi ไหมครับ",
+    "ที่จอดรถ",
+    "รหัส wi-fi",
+]
+# คำถามเชิงความหมายที่ไม่มีคำตรงกับ Knowledge Base จะถูกส่งต่อให้ Vector Search
+SEMANTIC_QUESTIONS = ["ขับรถไปจะมีที่วางรถหรือเปล่า", "เน็ตฟรีมีให้ใช้ไหม", "มีไวไฟไหมครับ"]
+
+
+class SimulatedVectorRetriever:
+    """Stands in for Chroma + the remote embedding call."""
+
+    def invoke(self, query):
+        time.sleep(EMBED_LATENCY_MS / 1000)
+        return []
+
+
+def seed_rows(rows):
+    statements = [("DELETE FROM knowledge_base WHERE store_id = ? AND kb_id > 100", (BENCH_STORE_ID,))]
+    for i in range(max(0, rows - 2)):
+        statements.append((
+            "INSERT INTO knowledge_base (kb_id, store_id, question_or_topic, answer_or_detail) VALUES (?, ?, ?, ?)",
+            (1000 + i, BENCH_STORE_ID, f"หัวข้อทั่วไปที่ {i} เรื่องบริการพิเศษ", f"รายละเอียดบริการพิเศษหมายเลข {i} สำหรับลูกค้าสมาชิก"),
+        ))
+    execute_write_many(statements)
+    invalidate_knowledge_index(BENCH_STORE_ID)
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure knowledge-base lookup latency of the hybrid retriever.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[8, 200, 2000], help="knowledge_base rows of the store")
+    parser.add_argument("--lookups", type=int, default=5000)
+    args = parser.parse_args()
+
+    initialize_database()
+    retriever = HybridKnowledgeRetriever(store_id=str(BENCH_STORE_ID), vector_factory=SimulatedVectorRetriever)
+    print(f"embedding + vector search stand-in: {EMBED_LATENCY_MS:.0f} ms per call")
+    print("\nrows  | common p50 (ms) | common p99 (ms) | semantic p50 (ms) | local hit rate")
+    for rows in args.rows:
+        seed_rows(rows)
+        retriever.invoke(COMMON_QUESTIONS[0])  # โหลด Index ก่อนจับเวลา
+        latencies = []
+        for i in range(args.lookups):
+            started = time.perf_counter()
+            retriever.invoke(COMMON_QUESTIONS[i % len(COMMON_QUESTIONS)])
+            latencies.append((time.perf_counter() - started) * 1000)
+        semantic = []
+        for question in SEMANTIC_QUESTIONS:
+            started = time.perf_counter()
+            retriever.invoke(question)
+            semantic.append((time.perf_counter() - started) * 1000)
+        series = metrics.get_counter_series("kb_search")
+        total = sum(series.values())
+        local = sum(value for labels, value in series.items() if "path=hybrid" not in labels)
+        print(f"{rows:5d} | {statistics.median(latencies):15.3f} | {_percentile(latencies, 99):15.3f} | {statistics.median(semantic):17.1f} | {local / total:14.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# benchmarks/load_test_workers.py
+#
+# Load test สำหรับโหมด Multi-process: วัด Throughput ของ job_queue เมื่อเพิ่มจำนวน AI Worker (M)
+#
+#   cd my_app && python benchmarks/load_test_workers.py --jobs 200 --workers 1 2 4 8
+#
+# ใช้ simulated_agent_task แทน Agent จริง (ไม่เรียก Gemini) โดยจำลองงาน CPU (ถือ GIL)
+# และการรอ I/O ของ LLM แล้วเขียนผลลง tasks ผ่าน Single Writer เหมือน Pipeline จริง
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# วัด Throughput ดิบ: ปิด Debounce และให้แต่ละงานเป็นบทสนทนาของตัวเอง (ไม่ถูกรวมข้อความ)
+# ตั้งค่าก่อน Spawn Worker เพื่อให้ทุก Process เห็นค่าเดียวกัน
+os.environ.setdefault("MESSAGE_DEBOUNCE_SECONDS", "0")
+
+SIM_CPU_MS = float(os.getenv("LOADTEST_CPU_MS", "40"))
+SIM_IO_MS = float(os.getenv("LOADTEST_IO_MS", "60"))
+
+
+def simulated_agent_task(user_id, line_id, user_message, task_id):
+    """Stand-in for process_new_tasks_using_tool_callig: CPU work + simulated LLM wait + DB writes."""
+    from database import update_task_response, update_task_status
+
+    deadline = time.perf_counter() + SIM_CPU_MS / 1000
+    counter = 0
+    while time.perf_counter() < deadline:
+        counter += 1
+    time.sleep(SIM_IO_MS / 1000)
+    update_task_response(task_id, f"simulated answer for: {user_message}", "None")
+    update_task_status(task_id, "Responded")
+
+
+def _prepare_database(db_file, num_jobs):
+    import database
+    from task_queue import enqueue_job
+
+    database.DB_FILE_NAME = db_file
+    database.initialize_database()
+    for i in range(num_jobs):
+        task_id = database.add_new_task("loadtest-store", f"line-{i}", f"token-{i}", f"message {i}")
+        enqueue_job(task_id, "loadtest-store", f"line-{i}", f"message {i}")
+
+
+def run_load_test(num_jobs, worker_counts):
+    from ai_worker import run_pool
+
+    results = []
+    for num_workers in worker_counts:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_file = os.path.join(tmp_dir, "loadtest.db")
+            _prepare_database(db_file, num_jobs)
+
+            started = time.perf_counter()
+            writer = run_pool(num_workers, "load_test_workers:simulated_agent_task", poll_interval=0.05, exit_when_idle=True)
+            elapsed = time.perf_counter() - started
+            results.append((num_workers, elapsed, num_jobs / elapsed, writer.commit_count, writer.statement_count))
+
+    print("\nworkers | seconds | jobs/sec | speedup | commits | statements")
+    base = results[0][2]
+    for num_workers, elapsed, throughput, commits, statements in results:
+        print(f"{num_workers:7d} | {elapsed:7.2f} | {throughput:8.1f} | {throughput / base:6.2f}x | {commits:7d} | {statements:10d}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure job throughput as the number of AI worker processes grows.")
+    parser.add_argument("--jobs", type=int, default=200)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+    run_load_test(args.jobs, args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# benchmarks/parallel_tool_calls.py
+#
+# วัดเวลาที่ลดลงเมื่อรัน Tool Call หลายตัวใน Turn เดียวกันพร้อมกัน (คำถามหลายเรื่องในข้อความเดียว)
+#
+#   cd my_app && python benchmarks/parallel_tool_calls.py --tools 1 2 3 --runs 5
+#
+# LLM จำลองขอเรียก sql_db_query, knowledge_base_search, ... พร้อมกันในรอบแรก แล้วตอบในรอบสอง
+# เทียบ AgentExecutor เดิม (Tool ต่อกันทีละตัว) กับ ParallelToolAgentExecutor
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain.agents import AgentExecutor, create_tool_calling_agent
+from langchain.prompts import ChatPromptTemplate
+from langchain.tools import Tool
+
+from concurrent_conversations import SimulatedToolCallingLLM, LLM_LATENCY_MS
+from parallel_tools import ParallelToolAgentExecutor
+
+TOOL_NAMES = ["sql_db_query", "knowledge_base_search", "sql_db_schema"]
+TOOL_LATENCY_MS = {"sql_db_query": 250, "knowledge_base_search": 400, "sql_db_schema": 150}
+
+
+def _make_tool(name):
+    def run(query):
+        time.sleep(TOOL_LATENCY_MS[name] / 1000)
+        return f"ผลลัพธ์จาก {name}"
+    return Tool(name=name, description=name, func=run)
+
+
+def build(executor_class, num_tools):
+    tools = [_make_tool(name) for name in TOOL_NAMES]
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", "คุณคือผู้ช่วยร้านอาหาร"),
+        ("human", "{input}"),
+        ("placeholder", "{agent_scratchpad}"),
+    ])
+    llm = SimulatedToolCallingLLM(tool_names=TOOL_NAMES[:num_tools])
+    agent = create_tool_calling_agent(llm=llm, tools=tools, prompt=prompt)
+    return executor_class(agent=agent, tools=tools)
+
+
+def measure(agent_executor, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        agent_executor.invoke({"input": "มีเมนูอะไรแนะนำ แล้วร้านมีที่จอดรถไหม"})
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare sequential and parallel tool execution for multi-intent questions.")
+    parser.add_argument("--tools", type=int, nargs="+", default=[1, 2, 3])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"LLM latency {LLM_LATENCY_MS:.0f} ms x2, tool latency {TOOL_LATENCY_MS} ms")
+    print("\ntool calls | sequential (s) | parallel (s) | saved")
+    for num_tools in args.tools:
+        sequential = measure(build(AgentExecutor, num_tools), args.runs)
+        parallel = measure(build(ParallelToolAgentExecutor, num_tools), args.runs)
+        print(f"{num_tools:10d} | {sequential:14.3f} | {parallel:12.3f} | {(1 - parallel / sequential) * 100:4.0f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# benchmarks/prompt_tokens.py
+#
+# วัด Prompt Token ต่อ Task ก่อน/หลัง Prompt Compiler และ Context Cache
+#
+#   cd my_app && python benchmarks/prompt_tokens.py --tasks 20 --tools 1
+#
+# ใช้ System Prompt จริงของ agent_setup_create_tool_calling กับ AgentExecutor จริง
+# แทน Gemini ด้วย SimulatedToolCallingLLM ที่รายงาน usage_metadata:
+#   - input_tokens ประมาณจากทุกข้อความที่ส่งในแต่ละ LLM Hop (estimate_tokens)
+#   - cache_read จำลอง Implicit Context Cache: ถ้า System Prefix เหมือนกับที่เคยส่งมาทุกไบต์ ส่วนนั้นนับว่าอ่านจาก Cache
+# Token นับด้วยค่าประมาณ ~3 ตัวอักษร/Token ตัวเลขจริงของ Gemini ดูได้จาก task_prompt_tokens ใน /api/metrics
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain.agents import AgentExecutor, create_tool_calling_agent
+from langchain.prompts import ChatPromptTemplate
+from langchain.tools import Tool
+from langchain_core.messages import AIMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from concurrent_conversations import SimulatedToolCallingLLM
+from agent_setup_create_tool_calling import create_agent_prefix_with_rag
+from memory_store import estimate_tokens
+from prompt_compiler import get_store_prompt
+from task_budget import TaskBudget
+
+
+class PrefixCachingLLM(SimulatedToolCallingLLM):
+    """Simulated model that reports prompt tokens and treats a byte-identical system prefix as a cache hit."""
+
+    seen_prefixes: set = set()
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        message = self._respond(messages)
+        system_text = "".join(m.content for m in messages if isinstance(m, SystemMessage))
+        input_tokens = sum(estimate_tokens(str(m.content)) + estimate_tokens(str(getattr(m, "tool_calls", "") or "")) for m in messages)
+        cache_read = estimate_tokens(system_text) if system_text in self.seen_prefixes else 0
+        self.seen_prefixes.add(system_text)
+        output_tokens = estimate_tokens(str(message.content) or str(message.tool_calls))
+        message = AIMessage(
+            content=message.content,
+            tool_calls=message.tool_calls,
+            usage_metadata={
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens,
+                "input_token_details": {"cache_read": cache_read},
+            },
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+def _query(query):
+    return "ข้าวผัด 60 บาท"
+
+
+def build_agent_executor(system_message, tool_names):
+    tools = [Tool(name=name, description="query menu", func=_query) for name in {"sql_db_query", *tool_names}]
+    prompt = ChatPromptTemplate.from_messages([
+        system_message,
+        ("human", "{input}"),
+        ("placeholder", "{agent_scratchpad}"),
+    ])
+    llm = PrefixCachingLLM(latency=0, tool_names=tool_names)
+    agent = create_tool_calling_agent(llm=llm, tools=tools, prompt=prompt)
+    return AgentExecutor(agent=agent, tools=tools)
+
+
+def run_mode(mode, tasks, tool_names, store_count):
+    PrefixCachingLLM.seen_prefixes = set()
+    totals = {"prompt": 0, "cached": 0, "build_ms": 0.0}
+    for i in range(tasks):
+        store_id = i % store_count + 1
+        started = time.perf_counter()
+        if mode == "raw":
+            # แบบเดิม: สร้าง Prefix ใหม่ด้วย f-string ทุกข้อความ
+            system_message = ("system", create_agent_prefix_with_rag(store_id, f"ร้านที่ {store_id}", f"user{store_id}"))
+        else:
+            system_message = get_store_prompt(create_agent_prefix_with_rag, store_id, f"ร้านที่ {store_id}", f"user{store_id}").as_system_message()
+        executor = build_agent_executor(system_message, tool_names)
+        totals["build_ms"] += (time.perf_counter() - started) * 1000
+
+        budget = TaskBudget(f"user{store_id}", max_tokens=10**9)
+        budget.invoke(executor, {"input": f"ขอเมนูแนะนำ {i}"})
+        totals["prompt"] += budget.prompt_tokens
+        totals["cached"] += budget.cached_prompt_tokens
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare prompt tokens per task with the raw and the compiled system prefix.")
+    parser.add_argument("--tasks", type=int, default=20)
+    parser.add_argument("--tools", type=int, default=1, help="tool calls per agent turn (LLM hops stay 2)")
+    parser.add_argument("--stores", type=int, default=2)
+    args = parser.parse_args()
+    tool_names = ["sql_db_query", "knowledge_base_search", "sql_db_schema"][:args.tools]
+
+    print(f"{args.tasks} tasks over {args.stores} stores, {len(tool_names)} tool call(s) per turn, 2 LLM hops per task")
+    print("\nmode     | prompt tok/task | cached tok/task | uncached tok/task | prefix build ms/task")
+    for mode in ("raw", "compiled"):
+        totals = run_mode(mode, args.tasks, tool_names, args.stores)
+        uncached = totals["prompt"] - totals["cached"]
+        print(f"{mode:8s} | {totals['prompt'] / args.tasks:15.0f} | {totals['cached'] / args.tasks:15.0f} | {uncached / args.tasks:17.0f} | {totals['build_ms'] / args.tasks:20.3f}")
+
+
+if __name__ == "__main__":
+    main()
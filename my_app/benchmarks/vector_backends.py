@@ -0,0 +1,119 @@
+# benchmarks/vector_backends.py
+#
+# เปรียบเทียบ RAG Backend: NumPy (memmap ต่อร้าน) กับ Chroma (Collection กลาง)
+# วัด Startup (Process ใหม่: import + เปิด Index + ค้นครั้งแรก) และ Latency ของการค้นหาต่อครั้ง
+#
+#   cd my_app && python benchmarks/vector_backends.py --stores 50 --docs 30 --queries 2000
+#
+# ใช้ DeterministicFakeEmbedding (ไม่เรียก Network) เวลาที่วัดจึงเป็นเวลาของ Backend ล้วน ๆ ไม่รวม Embedding API
+# ถ้ายังไม่ได้ติดตั้ง chromadb จะวัดเฉพาะ NumPy
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+EMBEDDING_SIZE = int(os.getenv("BENCH_EMBEDDING_SIZE", "768"))
+
+
+def _configure(workdir, backend):
+    os.environ["STORE_DB_FILE"] = os.path.join(workdir, "store_database.db")
+    os.environ["KB_VECTOR_DIRECTORY"] = os.path.join(workdir, "kb_vectors")
+    os.environ["CHROMA_PERSIST_DIRECTORY"] = os.path.join(workdir, "chroma")
+    os.environ["RAG_BACKEND"] = backend
+
+
+def _seed_and_index(workdir, backend, stores, docs):
+    """Fills knowledge_base and builds the backend's index (child process)."""
+    _configure(workdir, backend)
+    from database import initialize_database, execute_write_many
+    import vector_index
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    initialize_database()
+    statements = [("DELETE FROM knowledge_base", ())]
+    for store_id in range(1, stores + 1):
+        for i in range(docs):
+            statements.append((
+                "INSERT INTO knowledge_base (store_id, question_or_topic, answer_or_detail) VALUES (?, ?, ?)",
+                (store_id, f"หัวข้อ {i} ของร้าน {store_id}", f"รายละเอียดข้อ {i} ของร้าน {store_id}"),
+            ))
+    execute_write_many(statements)
+    vector_index._embeddings = DeterministicFakeEmbedding(size=EMBEDDING_SIZE)
+    for store_id in range(1, stores + 1):
+        vector_index.get_store_retriever(str(store_id)).invoke("warm up")
+
+
+def _measure(workdir, backend, stores, queries):
+    """Startup and query latency in a fresh process (child process)."""
+    started = time.perf_counter()
+    _configure(workdir, backend)
+    import vector_index
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    vector_index._embeddings = DeterministicFakeEmbedding(size=EMBEDDING_SIZE)
+    vector_index.get_store_retriever("1").invoke("ที่จอดรถ")
+    startup_ms = (time.perf_counter() - started) * 1000
+
+    rng = random.Random(7)
+    retrievers = {}
+    latencies = []
+    for _ in range(queries):
+        store_id = str(rng.randint(1, stores))
+        started = time.perf_counter()
+        retriever = retrievers.get(store_id) or retrievers.setdefault(store_id, vector_index.get_store_retriever(store_id))
+        retriever.invoke("ที่จอดรถ")
+        latencies.append((time.perf_counter() - started) * 1000)
+    return {
+        "startup_ms": startup_ms,
+        "p50_ms": statistics.median(latencies),
+        "p95_ms": statistics.quantiles(latencies, n=20)[-1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the NumPy and Chroma RAG backends.")
+    parser.add_argument("--stores", type=int, default=50)
+    parser.add_argument("--docs", type=int, default=30, help="knowledge rows per store")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--child", nargs=3, metavar=("STEP", "WORKDIR", "BACKEND"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        step, workdir, backend = args.child
+        if step == "index":
+            _seed_and_index(workdir, backend, args.stores, args.docs)
+        else:
+            print(json.dumps(_measure(workdir, backend, args.stores, args.queries)))
+        return
+
+    backends = ["numpy"]
+    if importlib.util.find_spec("chromadb"):
+        backends.append("chroma")
+    else:
+        print("chromadb is not installed: measuring the numpy backend only")
+
+    print(f"{args.stores} stores x {args.docs} docs, {EMBEDDING_SIZE}-dim fake embeddings, {args.queries} queries")
+    print("\nbackend | startup (ms) | query p50 (ms) | query p95 (ms)")
+    for backend in backends:
+        workdir = tempfile.mkdtemp(prefix=f"rag_{backend}_")
+        common = ["--stores", str(args.stores), "--docs", str(args.docs), "--queries", str(args.queries)]
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--child", "index", workdir, backend, *common], check=True, capture_output=True)
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", "measure", workdir, backend, *common],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{backend:7s} | {result['startup_ms']:12.1f} | {result['p50_ms']:14.3f} | {result['p95_ms']:14.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# benchmarks/vector_store_scaling.py
+#
+# เปรียบเทียบ Chroma แบบ Collection ต่อร้าน (เดิม: เปิด Client ใหม่ทุกข้อความ) กับ Collection กลางที่กรองด้วย store_id
+# เมื่อจำนวนร้านเพิ่มขึ้น วัดเวลา Index, Latency ของการค้นหา, RSS ของ Process และขนาดบนดิสก์
+#
+#   cd my_app && python benchmarks/vector_store_scaling.py --stores 100 1000 10000 --docs 8 --queries 300
+#
+# ใช้ DeterministicFakeEmbedding แทน Embedding API (ไม่เรียก Network) แต่ละโหมด/จำนวนร้านรันใน Process แยก
+# เพื่อให้ค่า Memory ไม่ปนกัน
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+EMBEDDING_SIZE = int(os.getenv("BENCH_EMBEDDING_SIZE", "768"))
+
+
+def _rss_mb():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _dir_size_mb(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total / (1024 * 1024)
+
+
+def _store_documents(store_id, docs):
+    from knowledge_index import knowledge_document
+    return [knowledge_document(str(store_id), i, f"หัวข้อ {i} ของร้าน {store_id}", f"รายละเอียดข้อ {i} ของร้าน {store_id}") for i in range(docs)]
+
+
+def run_case(mode, stores, docs, queries):
+    """Builds the index for `stores` stores in a fresh directory and measures queries. Runs in a child process."""
+    import chromadb
+    from langchain_community.vectorstores import Chroma
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    directory = tempfile.mkdtemp(prefix=f"chroma_{mode}_")
+    embeddings = DeterministicFakeEmbedding(size=EMBEDDING_SIZE)
+    baseline_rss = _rss_mb()
+
+    started = time.perf_counter()
+    if mode == "per_store":
+        client = chromadb.PersistentClient(path=directory)
+        for store_id in range(stores):
+            Chroma(client=client, collection_name=f"store_{store_id}_knowledge", embedding_function=embeddings).add_documents(_store_documents(store_id, docs))
+    else:
+        import vector_index
+        vector_index.CHROMA_PERSIST_DIRECTORY = directory
+        shared = vector_index.get_knowledge_vector_store(embedding_function=embeddings)
+        batch = []
+        for store_id in range(stores):
+            batch.extend(_store_documents(store_id, docs))
+            if len(batch) >= 4000:
+                shared.add_documents(batch, ids=[f"{d.metadata['store_id']}:{d.metadata['kb_id']}" for d in batch])
+                batch = []
+        if batch:
+            shared.add_documents(batch, ids=[f"{d.metadata['store_id']}:{d.metadata['kb_id']}" for d in batch])
+    build_seconds = time.perf_counter() - started
+
+    rng = random.Random(7)
+    latencies = []
+    for _ in range(queries):
+        store_id = rng.randrange(stores)
+        started = time.perf_counter()
+        if mode == "per_store":
+            # แบบเดิม: สร้าง Chroma ใหม่ทุกข้อความ แล้วค้นใน Collection ของร้าน
+            store = Chroma(collection_name=f"store_{store_id}_knowledge", embedding_function=embeddings, persist_directory=directory)
+            store.as_retriever(search_kwargs={"k": 3}).invoke("ที่จอดรถ")
+        else:
+            vector_index.get_store_retriever(store_id).invoke("ที่จอดรถ")
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    return {
+        "build_seconds": build_seconds,
+        "p50_ms": statistics.median(latencies),
+        "p95_ms": statistics.quantiles(latencies, n=20)[-1],
+        "rss_mb": _rss_mb() - baseline_rss,
+        "disk_mb": _dir_size_mb(directory),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-store Chroma collections with one shared collection filtered by store_id.")
+    parser.add_argument("--stores", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--docs", type=int, default=8, help="knowledge rows per store")
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--case", nargs=2, metavar=("MODE", "STORES"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(args.case[0], int(args.case[1]), args.docs, args.queries)))
+        return
+
+    print(f"{args.docs} docs per store, {EMBEDDING_SIZE}-dim fake embeddings, {args.queries} queries on random stores")
+    print("\nmode      | stores | build (s) | p50 (ms) | p95 (ms) | RSS (MB) | disk (MB)")
+    for stores in args.stores:
+        for mode in ("per_store", "shared"):
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--case", mode, str(stores), "--docs", str(args.docs), "--queries", str(args.queries)],
+                capture_output=True, text=True, check=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{mode:9s} | {stores:6d} | {result['build_seconds']:9.1f} | {result['p50_ms']:8.2f} | {result['p95_ms']:8.2f} | {result['rss_mb']:8.0f} | {result['disk_mb']:9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+# conversation_dispatcher.py
+
+import asyncio
+import collections
+import heapq
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from admission import ADMISSION_MAX_IN_FLIGHT, ADMISSION_MAX_IN_FLIGHT_PER_STORE, FairScheduler
+from database import link_merged_tasks
+
+# =========================================================================
+# 🟢 Per-conversation Serial Executor + Debounce
+# ลูกค้า LINE มักพิมพ์ 3-4 ข้อความสั้น ๆ ติดกัน เดิมแต่ละข้อความได้ Agent Run ของตัวเอง
+# ทำให้คำตอบสลับลำดับและเสียค่า LLM 3-4 เท่า
+#   - ข้อความของ line_id เดียวกันที่มาภายใน MESSAGE_DEBOUNCE_SECONDS จะถูกรวมเป็น Agent Run เดียว
+#   - แต่ละบทสนทนาถูกประมวลผลทีละ Batch ตามลำดับเสมอ (คนละบทสนทนาทำงานขนานกันได้)
+#   - MESSAGE_DEBOUNCE_MAX_WAIT จำกัดเวลารอสูงสุด เมื่อลูกค้าพิมพ์ต่อเนื่องไม่หยุด
+#   - บทสนทนาที่พร้อมทำงานผ่าน FairScheduler (admission.py) ก่อน: จำกัดจำนวนต่อร้านและสลับร้านแบบ Round-robin
+# =========================================================================
+
+MESSAGE_DEBOUNCE_SECONDS = float(os.getenv("MESSAGE_DEBOUNCE_SECONDS", "1.5"))
+MESSAGE_DEBOUNCE_MAX_WAIT = float(os.getenv("MESSAGE_DEBOUNCE_MAX_WAIT", "5"))
+CONVERSATION_WORKERS = int(os.getenv("CONVERSATION_WORKERS", "8"))
+
+
+def merge_messages(tasks):
+    """Joins the messages of a batch (oldest first) into one agent input."""
+    return "\n".join(task["user_message"] for task in tasks)
+
+
+def prepare_conversation_batch(line_id, tasks):
+    """
+    Links older tasks of a batch to the newest one (status 'Merged') and returns
+    (merged_message, primary_task_id) for the single agent invocation.
+    """
+    tasks = sorted(tasks, key=lambda task: task["task_id"])
+    primary = tasks[-1]
+    if len(tasks) > 1:
+        merged_ids = [task["task_id"] for task in tasks[:-1]]
+        link_merged_tasks(primary["task_id"], merged_ids)
+        metrics.increment("messages_merged", len(merged_ids))
+        print(f"Merged tasks {merged_ids} into task {primary['task_id']} for LINE user {line_id}.")
+    metrics.increment("agent_batches")
+    return merge_messages(tasks), primary["task_id"]
+
+
+def run_conversation_batch(processor, user_id, line_id, tasks):
+    """
+    Runs one agent invocation for a batch of tasks from the same conversation.
+    The newest task carries the answer; older tasks are linked to it with status 'Merged'.
+    `processor` has the signature of process_new_tasks_using_tool_callig(user_id, line_id, user_message, task_id).
+    """
+    merged_message, primary_task_id = prepare_conversation_batch(line_id, tasks)
+    processor(user_id, line_id, merged_message, primary_task_id)
+
+
+async def arun_conversation_batch(processor, user_id, line_id, tasks):
+    """Async variant of run_conversation_batch; `processor` is a coroutine function with the same signature."""
+    merged_message, primary_task_id = await asyncio.to_thread(prepare_conversation_batch, line_id, tasks)
+    await processor(user_id, line_id, merged_message, primary_task_id)
+
+
+class ConversationDispatcher:
+    """
+    Debounces messages per (user_id, line_id) and runs each conversation's batches strictly in order.
+    Conversations start through a FairScheduler, so at most min(max_workers, ADMISSION_MAX_IN_FLIGHT) run
+    at once and a single store cannot take every worker while other stores wait. `on_error(user_id, line_id, tasks, error)` is called when a batch raises.
+    """
+
+    def __init__(self, processor, debounce_seconds=MESSAGE_DEBOUNCE_SECONDS, max_wait_seconds=MESSAGE_DEBOUNCE_MAX_WAIT, max_workers=CONVERSATION_WORKERS, max_per_store=ADMISSION_MAX_IN_FLIGHT_PER_STORE, on_error=None):
+        self.processor = processor
+        self.on_error = on_error
+        self.debounce_seconds = debounce_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="conversation")
+        self.admission = FairScheduler(max_in_flight=min(max_workers, ADMISSION_MAX_IN_FLIGHT), max_per_store=max_per_store)
+        self._lock = threading.Condition()
+        self._conversations = {}
+        self._timers = []
+        self._scheduler = threading.Thread(target=self._run_scheduler, name="conversation-debounce", daemon=True)
+        self._scheduler.start()
+
+    def _state(self, key):
+        state = self._conversations.get(key)
+        if state is None:
+            state = {"pending": [], "first_at": None, "due_at": None, "ready": collections.deque(), "running": False}
+            self._conversations[key] = state
+        return state
+
+    def submit(self, user_id, line_id, task_id, user_message):
+        """Queues a message; it is processed after the debounce window closes for this conversation."""
+        key = (user_id, line_id)
+        now = time.monotonic()
+        with self._lock:
+            state = self._state(key)
+            state["pending"].append({"task_id": task_id, "user_message": user_message})
+            if state["first_at"] is None:
+                state["first_at"] = now
+            # เลื่อนเวลาออกไปทุกครั้งที่มีข้อความใหม่ แต่ไม่เกิน max_wait นับจากข้อความแรก
+            state["due_at"] = min(now + self.debounce_seconds, state["first_at"] + self.max_wait_seconds)
+            heapq.heappush(self._timers, (state["due_at"], key))
+            self._lock.notify()
+
+    def _run_scheduler(self):
+        while True:
+            with self._lock:
+                while not self._timers or self._timers[0][0] > time.monotonic():
+                    timeout = self._timers[0][0] - time.monotonic() if self._timers else None
+                    self._lock.wait(timeout)
+                due_at, key = heapq.heappop(self._timers)
+                state = self._conversations.get(key)
+                # ข้าม Timer เก่าที่ถูกเลื่อนออกไปแล้ว
+                if state is None or state["due_at"] != due_at or not state["pending"]:
+                    continue
+                state["ready"].append(state["pending"])
+                state["pending"], state["first_at"], state["due_at"] = [], None, None
+                if not state["running"]:
+                    # running = รอคิวใน FairScheduler หรือกำลังทำงาน
+                    state["running"] = True
+                    self.admission.add(key[0], key)
+            self._start_ready()
+
+    def _start_ready(self):
+        for _, key in self.admission.pop_ready():
+            self._executor.submit(self._run_admitted, key)
+
+    def _run_admitted(self, key):
+        try:
+            self._drain(key)
+        finally:
+            self.admission.release(key[0])
+            self._start_ready()
+
+    def queued_by_store(self):
+        """{user_id: conversations waiting for a worker}"""
+        return self.admission.queued_by_store()
+
+    def _drain(self, key):
+        user_id, line_id = key
+        while True:
+            with self._lock:
+                state = self._conversations[key]
+                if not state["ready"]:
+                    state["running"] = False
+                    if not state["pending"]:
+                        del self._conversations[key]
+                    return
+                batch = state["ready"].popleft()
+            try:
+                run_conversation_batch(self.processor, user_id, line_id, batch)
+            except Exception as e:
+                print(f"Error processing conversation batch for LINE user {line_id}: {e}")
+                if self.on_error is not None:
+                    try:
+                        self.on_error(user_id, line_id, batch, e)
+                    except Exception as handler_error:
+                        print(f"Conversation error handler failed for LINE user {line_id}: {handler_error}")
+
+
+class AsyncConversationDispatcher:
+    """
+    Event-loop version of ConversationDispatcher for the async pipeline (asgi_app.py).
+    Same debounce and per-conversation ordering, but every conversation is an asyncio task
+    instead of a pool thread, so many conversations can wait on the LLM at once
+    (up to max_in_flight, admitted fairly across stores). Must be used from a single event loop.
+    `on_error` is a plain function with the same signature as ConversationDispatcher's; it runs in a thread.
+    """
+
+    def __init__(self, processor, debounce_seconds=MESSAGE_DEBOUNCE_SECONDS, max_wait_seconds=MESSAGE_DEBOUNCE_MAX_WAIT, max_in_flight=ADMISSION_MAX_IN_FLIGHT, max_per_store=ADMISSION_MAX_IN_FLIGHT_PER_STORE, on_error=None):
+        self.processor = processor
+        self.on_error = on_error
+        self.debounce_seconds = debounce_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.admission = FairScheduler(max_in_flight=max_in_flight, max_per_store=max_per_store)
+        self._conversations = {}
+        self._drains = set()
+
+    def submit(self, user_id, line_id, task_id, user_message):
+        """Queues a message; it is processed after the debounce window closes for this conversation."""
+        loop = asyncio.get_running_loop()
+        key = (user_id, line_id)
+        now = loop.time()
+        state = self._conversations.get(key)
+        if state is None:
+            state = {"pending": [], "first_at": None, "timer": None, "ready": collections.deque(), "running": False}
+            self._conversations[key] = state
+        state["pending"].append({"task_id": task_id, "user_message": user_message})
+        if state["first_at"] is None:
+            state["first_at"] = now
+        if state["timer"] is not None:
+            state["timer"].cancel()
+        due_at = min(now + self.debounce_seconds, state["first_at"] + self.max_wait_seconds)
+        state["timer"] = loop.call_at(due_at, self._close_window, key)
+
+    def _close_window(self, key):
+        state = self._conversations[key]
+        state["ready"].append(state["pending"])
+        state["pending"], state["first_at"], state["timer"] = [], None, None
+        if not state["running"]:
+            state["running"] = True
+            self.admission.add(key[0], key)
+            self._start_ready()
+
+    def _start_ready(self):
+        loop = asyncio.get_running_loop()
+        for _, key in self.admission.pop_ready():
+            # เก็บ Reference ของ Task ไว้จนทำงานเสร็จ
+            drain = loop.create_task(self._run_admitted(key))
+            self._drains.add(drain)
+            drain.add_done_callback(self._drains.discard)
+
+    async def _run_admitted(self, key):
+        try:
+            await self._drain(key)
+        finally:
+            self.admission.release(key[0])
+            self._start_ready()
+
+    def queued_by_store(self):
+        """{user_id: conversations waiting for a slot}"""
+        return self.admission.queued_by_store()
+
+    async def _drain(self, key):
+        user_id, line_id = key
+        state = self._conversations[key]
+        while state["ready"]:
+            batch = state["ready"].popleft()
+            try:
+                await arun_conversation_batch(self.processor, user_id, line_id, batch)
+            except Exception as e:
+                print(f"Error processing conversation batch for LINE user {line_id}: {e}")
+                if self.on_error is not None:
+                    try:
+                        await asyncio.to_thread(self.on_error, user_id, line_id, batch, e)
+                    except Exception as handler_error:
+                        print(f"Conversation error handler failed for LINE user {line_id}: {handler_error}")
+        state["running"] = False
+        if not state["pending"]:
+            del self._conversations[key]
+
+    def active_conversations(self):
+        return len(self._conversations)
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_conversation_dispatcher(processor, on_error=None):
+    """Returns the process-wide dispatcher (created with `processor` and `on_error` on first use)."""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = ConversationDispatcher(processor, on_error=on_error)
+            metrics.register_collector("conversation_dispatcher", _dispatcher.admission.stats)
+        return _dispatcher
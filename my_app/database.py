@@ -1,15 +1,123 @@
 #database.py
 
+import os
 import sqlite3
 import datetime
+import json
+import zlib
 
-DB_FILE_NAME = "store_database.db"
+from task_status import MERGED, RESPONDED, status_assignment
+
+DB_FILE_NAME = os.getenv("STORE_DB_FILE", "store_database.db")
+# เวลารอ (วินาที) เมื่อมี Process อื่นกำลังเขียนฐานข้อมูลอยู่
+DB_BUSY_TIMEOUT = float(os.getenv("STORE_DB_BUSY_TIMEOUT", "30"))
+
+# 🟢 Write Executor: ถ้าถูกติดตั้ง (เช่น DBWriter ใน ai_worker.py) การเขียนทั้งหมดจะถูกส่งผ่านตัวนี้
+_write_executor = None
+
+# 🟢 Listener ที่ถูกเรียกหลังการเขียนตาราง tasks ถูก Commit แล้ว (เช่น History Cache)
+TASK_EVENT_COLUMNS = ("task_id", "user_id", "line_id", "user_message", "ai_response", "admin_response", "status", "merged_into_task_id")
+TASK_RETURNING_CLAUSE = "RETURNING " + ", ".join(TASK_EVENT_COLUMNS)
+# Unix time (วินาที, ทศนิยม) ใน SQL สำหรับ Trigger
+_SQL_EPOCH_NOW = "(julianday('now') - 2440587.5) * 86400.0"
+_task_listeners = []
+
+def get_connection():
+    """Opens a SQLite connection configured for multi-process access (WAL + busy timeout)."""
+    conn = sqlite3.connect(DB_FILE_NAME, timeout=DB_BUSY_TIMEOUT)
+    # WAL ทำให้ fsync เกิดตอน checkpoint เท่านั้น จึงปลอดภัยที่จะใช้ synchronous=NORMAL
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def set_write_executor(executor):
+    """
+    Installs (or removes, with None) the executor that performs every write in this process.
+    The executor must provide submit(statements) and return one result per statement.
+    """
+    global _write_executor
+    _write_executor = executor
+
+def execute_write_many(statements):
+    """
+    Executes a list of (sql, params) write statements in a single transaction.
+    Returns a list of dicts with 'lastrowid', 'rowcount' and 'rows' (for RETURNING clauses).
+    """
+    if _write_executor is not None:
+        return _write_executor.submit(statements)
+    return execute_write_direct(statements)
+
+def execute_write_direct(statements):
+    """Runs statements in one transaction on this process's own connection (waits up to DB_BUSY_TIMEOUT for the lock)."""
+    conn = get_connection()
+    try:
+        results = run_write_statements(conn, statements)
+        conn.commit()
+        return results
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def add_task_listener(callback):
+    """Registers callback(event_dict) to run after a committed write to a task row."""
+    if callback not in _task_listeners:
+        _task_listeners.append(callback)
+
+def notify_task_changes(results):
+    """Calls task listeners for every row returned by a write using TASK_RETURNING_CLAUSE."""
+    for result in results:
+        for row in result["rows"]:
+            event = dict(zip(TASK_EVENT_COLUMNS, row))
+            for callback in list(_task_listeners):
+                try:
+                    callback(event)
+                except Exception as e:
+                    print(f"Task listener error for task {event.get('task_id')}: {e}")
+
+def execute_write(sql, params=()):
+    """Executes a single write statement and returns its result dict."""
+    return execute_write_many([(sql, params)])[0]
+
+def run_write_statements(conn, statements):
+    """Runs (sql, params) statements on an open connection without committing. A list of params tuples runs as executemany."""
+    results = []
+    cursor = conn.cursor()
+    for sql, params in statements:
+        if isinstance(params, list):
+            cursor.executemany(sql, params)
+            results.append({"lastrowid": cursor.lastrowid, "rowcount": cursor.rowcount, "rows": []})
+            continue
+        cursor.execute(sql, params)
+        rows = [tuple(row) for row in cursor.fetchall()] if cursor.description else []
+        results.append({"lastrowid": cursor.lastrowid, "rowcount": cursor.rowcount, "rows": rows})
+    return results
+
+class _StatementBatch:
+    """Cursor-like collector: execute() records (sql, params) for one execute_write_many call."""
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, sql, params=()):
+        self.statements.append((sql, params))
 
 def initialize_database():
     """Initializes the database by creating tables if they don't exist."""
     try:
-        conn = sqlite3.connect(DB_FILE_NAME)
-        cursor = conn.cursor()
+        conn = get_connection()
+        try:
+            # PRAGMA ของไฟล์ต้องรันนอก Transaction จึงไม่ผ่าน Write Executor
+            # ต้องตั้งก่อนสร้างตารางแรก จึงมีผลกับไฟล์ใหม่เท่านั้น (ไฟล์เดิมใช้ python task_archive.py --enable-incremental-vacuum)
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            # WAL ให้ Reader หลาย Process อ่านได้พร้อมกับ Writer (ค่านี้ถูกเก็บถาวรในไฟล์ DB)
+            conn.execute("PRAGMA journal_mode=WAL")
+            tasks_columns = [row[1] for row in conn.execute("PRAGMA table_info(tasks)")]
+        finally:
+            conn.close()
+
+        # ตารางและข้อมูลเริ่มต้นถูกเขียนผ่าน execute_write_many เป็น Transaction เดียว (Single Writer)
+        cursor = _StatementBatch()
 
         # Create menu table
         cursor.execute('''
@@ -64,9 +172,12 @@ def initialize_database():
                 reply_token TEXT NOT NULL,
                 status TEXT NOT NULL,
                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                response_timestamp DATETIME
+                response_timestamp DATETIME,
+                merged_into_task_id INTEGER
             )
         ''')
+        # ฐานข้อมูลเดิมที่สร้างก่อนมีคอลัมน์ใหม่
+        _ensure_column(cursor, tasks_columns, "tasks", "merged_into_task_id", "INTEGER")
 
         # Create line_channels table to store per-user credentials
         cursor.execute('''
@@ -99,14 +210,153 @@ def initialize_database():
             )
         ''')
 
-        # Add initial data if tables are empty
-        seed_data(conn, cursor)
+        # 🟢 คิวงานสำหรับโหมด Multi-process: Web Worker ใส่งาน, AI Worker ดึงงานไปประมวลผล
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS job_queue (
+                job_id INTEGER PRIMARY KEY,
+                task_id INTEGER NOT NULL,
+                user_id TEXT NOT NULL,
+                line_id TEXT NOT NULL,
+                user_message TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                worker_id TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at DATETIME,
+                claimed_at DATETIME,
+                finished_at DATETIME
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_job_queue_status ON job_queue (status, job_id)")
+        # นับบทสนทนาที่รอ/กำลังทำงานต่อร้าน (admission control)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_job_queue_store ON job_queue (status, user_id, line_id)")
+
+        # 🟢 Memory ของแต่ละบทสนทนา: สรุปแบบสะสม + task_id ล่าสุดที่ถูกสรุปไปแล้ว
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS conversation_memory (
+                user_id TEXT NOT NULL,
+                line_id TEXT NOT NULL,
+                summary TEXT NOT NULL DEFAULT '',
+                summarized_until_task_id INTEGER NOT NULL DEFAULT 0,
+                updated_at DATETIME,
+                PRIMARY KEY (user_id, line_id)
+            )
+        ''')
+        # Index สำหรับดึงประวัติของบทสนทนาเดียว (เดิมต้อง Scan ทั้งตาราง tasks)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_conversation ON tasks (user_id, line_id, task_id)")
+        # Inbox ตามสถานะ (Admin Console โหลดงานของสถานะหนึ่งทั้งหมดในครั้งแรก)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status, user_id)")
+
+        # 🟢 Webhook Event ที่รับแล้ว (กันการประมวลผลซ้ำเมื่อ LINE ส่ง Event เดิมซ้ำ) ถูกลบเมื่อเกิน WEBHOOK_DEDUP_TTL
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS webhook_events (
+                webhook_event_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                is_redelivery INTEGER NOT NULL DEFAULT 0,
+                received_at REAL NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_webhook_events_received ON webhook_events (received_at)")
+
+        # 🟢 จุด Checkpoint ของการ Index Knowledge Base ลง Vector Backend (ทำต่อจาก last_kb_id เมื่อถูกขัดจังหวะ)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS kb_index_checkpoints (
+                store_id TEXT NOT NULL,
+                backend TEXT NOT NULL,
+                source_fingerprint TEXT NOT NULL,
+                last_kb_id INTEGER NOT NULL DEFAULT 0,
+                indexed_count INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL DEFAULT 'running',
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (store_id, backend)
+            )
+        ''')
+
+        # 🟢 Cache ของ Profile ลูกค้า LINE ต่อร้าน (line_profiles.py)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS line_profiles (
+                user_id TEXT NOT NULL,
+                line_id TEXT NOT NULL,
+                display_name TEXT,
+                picture_url TEXT,
+                status TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (user_id, line_id)
+            ) WITHOUT ROWID
+        ''')
+
+        # 🟢 Trace ของ Agent (intermediate_steps) แยกจาก tasks และบีบอัด (task_traces.py)
+        # อ่านเฉพาะตอนแอดมินเปิดดู Task ตาราง tasks ที่ทุก Inbox Query สแกนจึงไม่ต้องแบก Trace
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS task_traces (
+                task_id INTEGER PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                codec TEXT NOT NULL,
+                raw_bytes INTEGER NOT NULL,
+                payload BLOB NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_task_traces_created ON task_traces (created_at)")
+
+        # 🟢 Tier/Model ต่อ Route ของแต่ละร้าน (model_router.py) ไม่มีแถว = ใช้ค่าเริ่มต้น
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS store_model_routes (
+                user_id TEXT NOT NULL,
+                route TEXT NOT NULL,
+                model TEXT NOT NULL,
+                PRIMARY KEY (user_id, route)
+            ) WITHOUT ROWID
+        ''')
+
+        # 🟢 กฎตอบกลับทันทีต่อร้าน (quick_replies.py) แถวที่ name ตรงกับกฎเริ่มต้นใช้แทนกฎนั้น
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS quick_replies (
+                user_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                kind TEXT NOT NULL DEFAULT 'text',
+                pattern TEXT NOT NULL DEFAULT '',
+                reply TEXT NOT NULL DEFAULT '',
+                priority INTEGER NOT NULL DEFAULT 100,
+                enabled INTEGER NOT NULL DEFAULT 1,
+                PRIMARY KEY (user_id, name)
+            ) WITHOUT ROWID
+        ''')
+
+        # 🟢 Journal ของการเปลี่ยนแปลง Task สำหรับ Live Update ของ Dashboard (task_events.py)
+        # เขียนด้วย Trigger ใน Transaction เดียวกับการเขียน tasks จึงครอบคลุมทุก Write Path และทุก Process
+        # AUTOINCREMENT กัน event_id ถูกใช้ซ้ำหลังลบ Event เก่า (Client ใช้ event_id เป็น Last-Event-ID)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS task_events (
+                event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                task_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_task_events_created ON task_events (created_at)")
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_tasks_created AFTER INSERT ON tasks
+            BEGIN
+                INSERT INTO task_events (user_id, task_id, kind, created_at)
+                VALUES (NEW.user_id, NEW.task_id, 'created', {_SQL_EPOCH_NOW});
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_tasks_updated AFTER UPDATE OF status, ai_response, admin_response ON tasks
+            WHEN OLD.status IS NOT NEW.status OR OLD.ai_response IS NOT NEW.ai_response OR OLD.admin_response IS NOT NEW.admin_response
+            BEGIN
+                INSERT INTO task_events (user_id, task_id, kind, created_at)
+                VALUES (NEW.user_id, NEW.task_id, CASE WHEN OLD.status IS NOT NEW.status THEN 'status' ELSE 'updated' END, {_SQL_EPOCH_NOW});
+            END
+        ''')
 
         # Add initial data if tables are empty
-        seed_data(conn, cursor)
+        seed_data(cursor)
 
-        conn.commit()
-        conn.close()
+        execute_write_many(cursor.statements)
         print(f"Database '{DB_FILE_NAME}' initialized successfully.")
         return f"sqlite:///{DB_FILE_NAME}"
 
@@ -114,131 +364,119 @@ def initialize_database():
         print(f"Database error: {e}")
         return None
 
-def seed_data(conn, cursor):
+def _ensure_column(cursor, existing_columns, table, column, definition):
+    """Adds a column to a table created before it existed (lightweight migration). existing_columns is empty for a new table."""
+    if existing_columns and column not in existing_columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def _seed_if_empty(cursor, table, columns, rows):
+    """Inserts rows only while the table is still empty; the check runs inside the same write transaction."""
+    values = ", ".join("(" + ", ".join("?" * len(columns)) + ")" for _ in rows)
+    params = tuple(value for row in rows for value in row)
+    cursor.execute(
+        f"INSERT INTO {table} ({', '.join(columns)}) SELECT * FROM (VALUES {values}) WHERE NOT EXISTS (SELECT 1 FROM {table})",
+        params,
+    )
+
+def seed_data(cursor):
     """Inserts initial data into tables if they are empty."""
-    cursor.execute("SELECT COUNT(*) FROM stores")
-    if cursor.fetchone()[0] == 0:
-        stores_data = [
-            (1, 'user1', 'สาขาพระราม 9', 'Open', 'อาคารฟอร์จูนทาวน์ ชั้น 2', 1),
-            (2, 'user2', 'สาขาสุขุมวิท 21', 'Closed', 'อาคาร GMM Grammy Place', 1),
-            (3, 'user3', 'สาขาพญาไท', 'Open', 'อาคาร CP Tower', 1)
-        ]
-        cursor.executemany("INSERT INTO stores (store_id, user_id, store_name, status, location, is_auto_reply_enabled) VALUES (?, ?, ?, ?, ?, ?)", stores_data)
-        conn.commit()
+    stores_data = [
+        (1, 'user1', 'สาขาพระราม 9', 'Open', 'อาคารฟอร์จูนทาวน์ ชั้น 2', 1),
+        (2, 'user2', 'สาขาสุขุมวิท 21', 'Closed', 'อาคาร GMM Grammy Place', 1),
+        (3, 'user3', 'สาขาพญาไท', 'Open', 'อาคาร CP Tower', 1)
+    ]
+    _seed_if_empty(cursor, "stores", ("store_id", "user_id", "store_name", "status", "location", "is_auto_reply_enabled"), stores_data)
     
-    cursor.execute("SELECT COUNT(*) FROM menu")
-    if cursor.fetchone()[0] == 0:
-        menu_data = [
-            (1, 'ข้าวผัดกะเพราไก่', 50.00, 'อาหารจานเดียว', 1),
-            (2, 'ผัดซีอิ๊วหมู', 55.00, 'อาหารจานเดียว', 1),
-            (3, 'ต้มยำกุ้ง', 80.00, 'อาหารไทย', 2),
-            (4, 'แกงเขียวหวานเนื้อ', 75.00, 'อาหารไทย', 2),
-            (5, 'ชาเย็น', 25.00, 'เครื่องดื่ม', 3),
-            (6, 'กาแฟ', 30.00, 'เครื่องดื่ม', 3)
-        ]
-        cursor.executemany("INSERT INTO menu (menu_id, menu_name, price, category, store_id) VALUES (?, ?, ?, ?, ?)", menu_data)
-        conn.commit()
+    menu_data = [
+        (1, 'ข้าวผัดกะเพราไก่', 50.00, 'อาหารจานเดียว', 1),
+        (2, 'ผัดซีอิ๊วหมู', 55.00, 'อาหารจานเดียว', 1),
+        (3, 'ต้มยำกุ้ง', 80.00, 'อาหารไทย', 2),
+        (4, 'แกงเขียวหวานเนื้อ', 75.00, 'อาหารไทย', 2),
+        (5, 'ชาเย็น', 25.00, 'เครื่องดื่ม', 3),
+        (6, 'กาแฟ', 30.00, 'เครื่องดื่ม', 3)
+    ]
+    _seed_if_empty(cursor, "menu", ("menu_id", "menu_name", "price", "category", "store_id"), menu_data)
         
-    cursor.execute("SELECT COUNT(*) FROM promotions")
-    if cursor.fetchone()[0] == 0:
-        promotions_data = [
-            ('WELCOME10', 'ลด 10% สำหรับลูกค้าใหม่', '2025-01-01', '2025-12-31', None, 1),
-            ('BUY3GET1', 'ซื้อ 3 จานฟรี 1 จาน', '2025-09-01', '2025-10-31', 1, 1),
-            ('SUMMER_SALE', 'โปรโมชั่นฤดูร้อน ลด 20%', '2025-06-01', '2025-08-31', 3, 2),
-            ('COFFEE_DEAL', 'ซื้อกาแฟแก้วที่ 2 ลด 50%', '2025-09-15', '2025-11-15', 6, 3)
-        ]
-        cursor.executemany("INSERT INTO promotions (promo_code, description, start_date, end_date, menu_id, store_id) VALUES (?, ?, ?, ?, ?, ?)", promotions_data)
-        conn.commit()
+    promotions_data = [
+        ('WELCOME10', 'ลด 10% สำหรับลูกค้าใหม่', '2025-01-01', '2025-12-31', None, 1),
+        ('BUY3GET1', 'ซื้อ 3 จานฟรี 1 จาน', '2025-09-01', '2025-10-31', 1, 1),
+        ('SUMMER_SALE', 'โปรโมชั่นฤดูร้อน ลด 20%', '2025-06-01', '2025-08-31', 3, 2),
+        ('COFFEE_DEAL', 'ซื้อกาแฟแก้วที่ 2 ลด 50%', '2025-09-15', '2025-11-15', 6, 3)
+    ]
+    _seed_if_empty(cursor, "promotions", ("promo_code", "description", "start_date", "end_date", "menu_id", "store_id"), promotions_data)
     
-    cursor.execute("SELECT COUNT(*) FROM ingredients")
-    if cursor.fetchone()[0] == 0:
-        ingredients_data = [
-            (1, 'ข้าวสวย', '1 ถ้วย', 'Grain'),        
-            (1, 'เนื้อไก่', '100 กรัม', 'Meat'),
-            (1, 'ใบกะเพรา', '5 กรัม', 'Vegetable'),  
-            (2, 'เส้นใหญ่', '150 กรัม', 'Wheat/Grain'),
-            (2, 'เนื้อหมู', '100 กรัม', 'Meat'),
-            (3, 'กุ้งสด', '200 กรัม', 'Seafood'),    
-            (3, 'พริก', '3 เม็ด', 'Vegetable'),
-            (4, 'เนื้อวัว', '150 กรัม', 'Meat'),
-            (4, 'มะเขือ', '2 ลูก', 'Vegetable'),
-            (5, 'ชาซีลอน', '1 ช้อนชา', 'Spice'),    
-            (5, 'นมสด', '30 มล.', 'Dairy'),     
-            (6, 'ผงกาแฟ', '1 ช้อนชา', 'Spice')
-        ]
-        cursor.executemany("INSERT INTO ingredients (menu_id, ingredient_name, quantity,ingredient_type) VALUES (?, ?, ?, ?)", ingredients_data)
-        conn.commit()
+    ingredients_data = [
+        (1, 'ข้าวสวย', '1 ถ้วย', 'Grain'),        
+        (1, 'เนื้อไก่', '100 กรัม', 'Meat'),
+        (1, 'ใบกะเพรา', '5 กรัม', 'Vegetable'),  
+        (2, 'เส้นใหญ่', '150 กรัม', 'Wheat/Grain'),
+        (2, 'เนื้อหมู', '100 กรัม', 'Meat'),
+        (3, 'กุ้งสด', '200 กรัม', 'Seafood'),    
+        (3, 'พริก', '3 เม็ด', 'Vegetable'),
+        (4, 'เนื้อวัว', '150 กรัม', 'Meat'),
+        (4, 'มะเขือ', '2 ลูก', 'Vegetable'),
+        (5, 'ชาซีลอน', '1 ช้อนชา', 'Spice'),    
+        (5, 'นมสด', '30 มล.', 'Dairy'),     
+        (6, 'ผงกาแฟ', '1 ช้อนชา', 'Spice')
+    ]
+    _seed_if_empty(cursor, "ingredients", ("menu_id", "ingredient_name", "quantity", "ingredient_type"), ingredients_data)
     
     # อัปเดตข้อมูล stores
-    cursor.execute("SELECT COUNT(*) FROM stores")
-    if cursor.fetchone()[0] == 0:
-        stores_data = [
-            ('user1', 'สาขาพระราม 9', 'Open', 'อาคารฟอร์จูนทาวน์ ชั้น 2', 1),
-            ('user2', 'สาขาสุขุมวิท 21', 'Closed', 'อาคาร GMM Grammy Place', 1),
-            ('user3', 'สาขาพญาไท', 'Open', 'อาคาร CP Tower', 1)
-        ]
-        cursor.executemany("INSERT INTO stores (user_id, store_name, status, location, is_auto_reply_enabled) VALUES (?, ?, ?, ?, ?)", stores_data)
-        conn.commit()
+    stores_data = [
+        ('user1', 'สาขาพระราม 9', 'Open', 'อาคารฟอร์จูนทาวน์ ชั้น 2', 1),
+        ('user2', 'สาขาสุขุมวิท 21', 'Closed', 'อาคาร GMM Grammy Place', 1),
+        ('user3', 'สาขาพญาไท', 'Open', 'อาคาร CP Tower', 1)
+    ]
+    _seed_if_empty(cursor, "stores", ("user_id", "store_name", "status", "location", "is_auto_reply_enabled"), stores_data)
 
 # ในโค้ด seed_data()
-    cursor.execute("SELECT COUNT(*) FROM promotions")
-    if cursor.fetchone()[0] == 0:
-        promotions_data = [
-            ('WELCOME10', 'ลด 10% สำหรับลูกค้าใหม่', None, None, '2025-01-01', '2025-12-31'),
-            ('BUY3GET1', 'ซื้อ 3 จานฟรี 1 จาน', 1, 1, '2025-09-01', '2025-10-31'),
-            ('SUMMER_SALE', 'โปรโมชั่นฤดูร้อน ลด 20%', 3, 2, '2025-06-01', '2025-08-31'),
-            ('COFFEE_DEAL', 'ซื้อกาแฟแก้วที่ 2 ลด 50%', 6, 3, '2025-09-15', '2025-11-15')
-        ]
-        cursor.executemany("INSERT INTO promotions (promo_code, description, menu_id, store_id, start_date, end_date) VALUES (?, ?, ?, ?, ?, ?)", promotions_data)
-        conn.commit()
+    promotions_data = [
+        ('WELCOME10', 'ลด 10% สำหรับลูกค้าใหม่', None, None, '2025-01-01', '2025-12-31'),
+        ('BUY3GET1', 'ซื้อ 3 จานฟรี 1 จาน', 1, 1, '2025-09-01', '2025-10-31'),
+        ('SUMMER_SALE', 'โปรโมชั่นฤดูร้อน ลด 20%', 3, 2, '2025-06-01', '2025-08-31'),
+        ('COFFEE_DEAL', 'ซื้อกาแฟแก้วที่ 2 ลด 50%', 6, 3, '2025-09-15', '2025-11-15')
+    ]
+    _seed_if_empty(cursor, "promotions", ("promo_code", "description", "menu_id", "store_id", "start_date", "end_date"), promotions_data)
     
-    cursor.execute("SELECT COUNT(*) FROM knowledge_base")
-    if cursor.fetchone()[0] == 0:
-        knowledge_data = [
-            # ข้อมูลสำหรับ store_id = 1 (สาขาพระราม 9)
-            (1, 'นโยบายการคืนสินค้า', 'สินค้าที่ซื้อแล้วไม่สามารถคืนได้ ยกเว้นสินค้ามีตำหนิ หรือผิดออเดอร์ ซึ่งต้องแจ้งภายใน 1 ชั่วโมงหลังรับสินค้า'),
-            (1, 'เวลาเปิด-ปิดร้าน', 'ร้านเปิดทำการทุกวัน ตั้งแต่เวลา 10:00 น. ถึง 21:00 น.'),
-            (1, 'การรับประกันความสดใหม่', 'เรารับประกันความสดใหม่ของอาหาร หากมีปัญหาด้านรสชาติ โปรดแจ้งเราทันทีเพื่อทำการแก้ไข'),
-            
-            # ข้อมูลสำหรับ store_id = 2 (สาขาสุขุมวิท 21)
-            (2, 'วิธีการสั่งจองโต๊ะ', 'คุณสามารถโทรจองโต๊ะล่วงหน้าได้ที่เบอร์ 02-123-4567 หรือจองผ่าน Line OA'),
-            (2, 'รับบัตรเครดิตหรือไม่', 'เรายินดีรับบัตรเครดิต Visa และ Mastercard ทุกประเภท ไม่มีค่าธรรมเนียมเพิ่มเติม'),
-            
-            # ข้อมูลสำหรับ store_id = 3 (สาขาพญาไท)
-            (3, 'มี Wi-Fi ให้บริการไหม', 'มีบริการ Wi-Fi ฟรีสำหรับลูกค้าทุกคน รหัสผ่านคือ "PhayathaiFreeWiFi"'),
-            (3, 'ที่จอดรถ', 'มีบริการที่จอดรถฟรีบริเวณด้านหลังอาคาร CP Tower รองรับได้ 20 คัน'),
-        ]
-        cursor.executemany("INSERT INTO knowledge_base (store_id, question_or_topic, answer_or_detail) VALUES (?, ?, ?)", knowledge_data)
-        conn.commit()
+    knowledge_data = [
+        # ข้อมูลสำหรับ store_id = 1 (สาขาพระราม 9)
+        (1, 'นโยบายการคืนสินค้า', 'สินค้าที่ซื้อแล้วไม่สามารถคืนได้ ยกเว้นสินค้ามีตำหนิ หรือผิดออเดอร์ ซึ่งต้องแจ้งภายใน 1 ชั่วโมงหลังรับสินค้า'),
+        (1, 'เวลาเปิด-ปิดร้าน', 'ร้านเปิดทำการทุกวัน ตั้งแต่เวลา 10:00 น. ถึง 21:00 น.'),
+        (1, 'การรับประกันความสดใหม่', 'เรารับประกันความสดใหม่ของอาหาร หากมีปัญหาด้านรสชาติ โปรดแจ้งเราทันทีเพื่อทำการแก้ไข'),
+        
+        # ข้อมูลสำหรับ store_id = 2 (สาขาสุขุมวิท 21)
+        (2, 'วิธีการสั่งจองโต๊ะ', 'คุณสามารถโทรจองโต๊ะล่วงหน้าได้ที่เบอร์ 02-123-4567 หรือจองผ่าน Line OA'),
+        (2, 'รับบัตรเครดิตหรือไม่', 'เรายินดีรับบัตรเครดิต Visa และ Mastercard ทุกประเภท ไม่มีค่าธรรมเนียมเพิ่มเติม'),
+        
+        # ข้อมูลสำหรับ store_id = 3 (สาขาพญาไท)
+        (3, 'มี Wi-Fi ให้บริการไหม', 'มีบริการ Wi-Fi ฟรีสำหรับลูกค้าทุกคน รหัสผ่านคือ "PhayathaiFreeWiFi"'),
+        (3, 'ที่จอดรถ', 'มีบริการที่จอดรถฟรีบริเวณด้านหลังอาคาร CP Tower รองรับได้ 20 คัน'),
+    ]
+    _seed_if_empty(cursor, "knowledge_base", ("store_id", "question_or_topic", "answer_or_detail"), knowledge_data)
     
 def add_credentials(user_id, channel_secret, channel_access_token):
     """Adds or updates a user's LINE channel credentials."""
-    conn = sqlite3.connect(DB_FILE_NAME)
-    cursor = conn.cursor()
     try:
-        # เพิ่มข้อมูลในตาราง line_channels
-        cursor.execute('''
-            INSERT OR REPLACE INTO line_channels (user_id, channel_secret, channel_access_token)
-            VALUES (?, ?, ?)
-        ''', (user_id, channel_secret, channel_access_token))
-        
-        # เพิ่มข้อมูลในตาราง stores ด้วย user_id และตั้งค่าเริ่มต้น is_auto_reply_enabled เป็น 1
-        cursor.execute('''
-            INSERT OR IGNORE INTO stores (user_id, is_auto_reply_enabled)
-            VALUES (?, 1)
-        ''', (user_id,))
-        
-        conn.commit()
+        execute_write_many([
+            # เพิ่มข้อมูลในตาราง line_channels
+            ('''
+                INSERT OR REPLACE INTO line_channels (user_id, channel_secret, channel_access_token)
+                VALUES (?, ?, ?)
+            ''', (user_id, channel_secret, channel_access_token)),
+            # เพิ่มข้อมูลในตาราง stores ด้วย user_id และตั้งค่าเริ่มต้น is_auto_reply_enabled เป็น 1
+            ('''
+                INSERT OR IGNORE INTO stores (user_id, is_auto_reply_enabled)
+                VALUES (?, 1)
+            ''', (user_id,)),
+        ])
         return True
     except sqlite3.Error as e:
         print(f"Database error adding credentials: {e}")
         return False
-    finally:
-        conn.close()
 
 def get_credentials(user_id):
     """Retrieves a user's LINE channel credentials."""
-    conn = sqlite3.connect(DB_FILE_NAME)
+    conn = get_connection()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     try:
@@ -254,7 +492,7 @@ def get_credentials(user_id):
 
 def get_auto_reply_setting(user_id):
     """Retrieves the auto-reply status for a specific user from the stores table."""
-    conn = sqlite3.connect(DB_FILE_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     try:
         cursor.execute("SELECT is_auto_reply_enabled FROM stores WHERE user_id = ?", (user_id,))
@@ -269,39 +507,31 @@ def get_auto_reply_setting(user_id):
 
 def update_auto_reply_setting(user_id, status):
     """Updates the auto-reply status for a specific user in the stores table."""
-    conn = sqlite3.connect(DB_FILE_NAME)
-    cursor = conn.cursor()
     try:
-        cursor.execute("UPDATE stores SET is_auto_reply_enabled = ? WHERE user_id = ?", (status, user_id))
-        conn.commit()
+        execute_write("UPDATE stores SET is_auto_reply_enabled = ? WHERE user_id = ?", (status, user_id))
     except sqlite3.Error as e:
         print(f"Database error updating auto-reply setting: {e}")
-    finally:
-        conn.close()
         
 
 def add_new_task(user_id, line_id, reply_token, user_message):
     """Adds a new message task from a LINE user to the database."""
-    conn = sqlite3.connect(DB_FILE_NAME)
-    cursor = conn.cursor()
     timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
     try:
-        cursor.execute("""
+        result = execute_write(f"""
             INSERT INTO tasks (user_id, line_id, reply_token, user_message, status,timestamp)
             VALUES (?, ?, ?, ?, ?, ?)
+            {TASK_RETURNING_CLAUSE}
         """, (user_id, line_id, reply_token, user_message, "Pending",timestamp))
-        conn.commit()
-        return cursor.lastrowid  # คืนค่า ID ที่สร้างขึ้นมา
+        notify_task_changes([result])
+        return result["rows"][0][0]  # คืนค่า ID ที่สร้างขึ้นมา
     except sqlite3.Error as e:
         print(f"Database error adding new task: {e}")
         return None
-    finally:
-        conn.close()
 
 # อัปเดตฟังก์ชันให้ใช้ 'user_id'
 def get_tasks_by_status(user_id, status):
     """Fetches tasks from the tasks table based on their status and store user ID."""
-    conn = sqlite3.connect(DB_FILE_NAME)
+    conn = get_connection()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     try:
@@ -315,65 +545,137 @@ def get_tasks_by_status(user_id, status):
         conn.close()
 
 def update_task_status(task_id, new_status):
-    """Updates the status of a specific task."""
-    conn = sqlite3.connect(DB_FILE_NAME)
-    cursor = conn.cursor()
+    """
+    Updates the status of a specific task if the state machine (task_status.py) allows it.
+    Returns True when the task now has new_status, False otherwise.
+    """
     try:
-        cursor.execute("UPDATE tasks SET status = ? WHERE task_id = ?", (new_status, task_id))
-        conn.commit()
+        result = execute_write(f"UPDATE tasks SET {status_assignment(new_status)} WHERE task_id = ? {TASK_RETURNING_CLAUSE}", (new_status, task_id))
+        notify_task_changes([result])
     except sqlite3.Error as e:
         print(f"Database error updating task status: {e}")
-    finally:
-        conn.close()
+        return False
+    if not result["rows"]:
+        return False
+    current_status = dict(zip(TASK_EVENT_COLUMNS, result["rows"][0]))["status"]
+    if current_status != new_status:
+        print(f"Rejected status change of task {task_id}: {current_status} -> {new_status}")
+        return False
+    return True
+
+def link_merged_tasks(primary_task_id, merged_task_ids):
+    """
+    Marks tasks whose messages were merged into primary_task_id's agent run.
+    They keep their user_message but get status 'Merged' and point to the primary task.
+    """
+    if not merged_task_ids:
+        return
+    placeholders = ", ".join("?" for _ in merged_task_ids)
+    try:
+        result = execute_write(f"""
+            UPDATE tasks
+            SET {status_assignment(MERGED)}, merged_into_task_id = ?
+            WHERE task_id IN ({placeholders})
+            {TASK_RETURNING_CLAUSE}
+        """, (MERGED, primary_task_id, *merged_task_ids))
+        notify_task_changes([result])
+    except sqlite3.Error as e:
+        print(f"Database error linking merged tasks to {primary_task_id}: {e}")
 
 def update_task_response(task_id, response,sql_text):
     """
     Updates the AI's response, status, and records a dedicated response timestamp.
     """
-    conn = sqlite3.connect(DB_FILE_NAME)
-    cursor = conn.cursor()
     timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
     try:
-        cursor.execute("""
+        result = execute_write(f"""
             UPDATE tasks
             SET
                 ai_response = ?,
-                status = 'Responded',
+                {status_assignment(RESPONDED)},
                 response_timestamp = ?,
                 using_sql = ?
             WHERE
                 task_id = ?
-        """, (response, timestamp, sql_text, task_id))
-        conn.commit()
+            {TASK_RETURNING_CLAUSE}
+        """, (response, RESPONDED, timestamp, sql_text, task_id))
+        notify_task_changes([result])
     except sqlite3.Error as e:
         print(f"Database error updating AI response: {e}")
-    finally:
-        conn.close()
 
 def update_admin_response(task_id, response):
     """
     Updates the admin's response, status, and records a dedicated response timestamp.
     """
-    conn = sqlite3.connect(DB_FILE_NAME)
-    cursor = conn.cursor()
     timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
     try:
-        cursor.execute("""
+        result = execute_write(f"""
             UPDATE tasks
             SET
                 admin_response = ?,
-                status = 'Responded',
+                {status_assignment(RESPONDED)},
                 response_timestamp = ?
             WHERE
                 task_id = ?
-        """, (response, task_id,timestamp))
-        conn.commit()
+            {TASK_RETURNING_CLAUSE}
+        """, (response, RESPONDED, timestamp, task_id))
+        notify_task_changes([result])
     except sqlite3.Error as e:
         print(f"Database error updating admin response: {e}")
-    finally:
-        conn.close()
 
 
+# 🟢 Archive ของ Task เก่า (task_archive.py): ตาราง tasks_archive_YYYY_MM หนึ่งตารางต่อเดือน
+# คอลัมน์ที่ใช้ค้นหาเก็บตรง ๆ ส่วนเนื้อหาที่เหลือเก็บเป็น JSON บีบอัดด้วย zlib ในคอลัมน์ payload
+ARCHIVE_TABLE_PREFIX = "tasks_archive_"
+ARCHIVE_PAYLOAD_COLUMNS = ("user_message", "ai_response", "using_sql", "admin_response", "reply_token", "response_timestamp", "merged_into_task_id")
+
+def list_archive_tables(conn):
+    """Names of the monthly archive tables, newest month first."""
+    rows = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ? ESCAPE '\\' ORDER BY name DESC",
+        (ARCHIVE_TABLE_PREFIX.replace("_", "\\_") + "%",),
+    ).fetchall()
+    return [row[0] for row in rows]
+
+def decode_archived_task(row):
+    """Turns an archive row (task_id, user_id, line_id, status, timestamp, payload) back into a tasks-shaped dict."""
+    task_id, user_id, line_id, status, timestamp, payload = row
+    task = {"task_id": task_id, "user_id": user_id, "line_id": line_id, "status": status, "timestamp": timestamp}
+    task.update(zip(ARCHIVE_PAYLOAD_COLUMNS, json.loads(zlib.decompress(payload))))
+    return task
+
+def fetch_archived_tasks(conn, user_id, line_id, after_task_id=0, statuses=None, limit=None):
+    """
+    Archived tasks of one conversation with task_id > after_task_id, newest first.
+    Reads the monthly tables from the newest month and stops as soon as `limit` rows are found.
+    """
+    tasks = []
+    status_sql = f" AND status IN ({', '.join('?' for _ in statuses)})" if statuses else ""
+    for table in list_archive_tables(conn):
+        remaining = None if limit is None else limit - len(tasks)
+        if remaining is not None and remaining <= 0:
+            break
+        rows = conn.execute(f"""
+            SELECT task_id, user_id, line_id, status, timestamp, payload FROM {table}
+            WHERE user_id = ? AND line_id = ? AND task_id > ?{status_sql}
+            ORDER BY task_id DESC
+            {'LIMIT ?' if remaining is not None else ''}
+        """, (user_id, line_id, after_task_id, *(statuses or ()), *(() if remaining is None else (remaining,)))).fetchall()
+        tasks.extend(decode_archived_task(tuple(row)) for row in rows)
+    return tasks
+
+def _with_archived(conn, hot_tasks, user_id, line_id, limit, after_task_id=0, statuses=None):
+    """Tops up a newest-first hot result with archived tasks when it has fewer than `limit` rows."""
+    if len(hot_tasks) >= limit:
+        return hot_tasks
+    hot_ids = {task["task_id"] for task in hot_tasks}
+    # Task ที่ถูกเขียนระหว่างย้ายอาจมีทั้งในตารางหลักและ Archive: ใช้แถวในตารางหลัก
+    archived = [
+        task for task in fetch_archived_tasks(conn, user_id, line_id, after_task_id, statuses, limit)
+        if task["task_id"] not in hot_ids
+    ]
+    return sorted(hot_tasks + archived, key=lambda task: task["task_id"], reverse=True)[:limit]
+
 def get_chat_history(user_id, line_id, limit=20):
     """
     Fetches the entire chat history for a specific LINE user.
@@ -383,13 +685,16 @@ def get_chat_history(user_id, line_id, limit=20):
     Returns:
         list: A list of dictionaries, each representing a message/task.
     """
-    conn = sqlite3.connect(DB_FILE_NAME)
+    conn = get_connection()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     try:
         cursor.execute("SELECT * FROM tasks WHERE user_id = ? AND line_id = ? ORDER BY timestamp ASC", (user_id, line_id))
-        tasks = cursor.fetchall()
-        return [dict(task) for task in tasks]
+        tasks = [dict(task) for task in cursor.fetchall()]
+        # Task ที่ย้ายไป Archive แล้ว (task_archive.py) เก่ากว่า Task ในตารางหลัก จึงต่อไว้ข้างหน้า
+        hot_ids = {task["task_id"] for task in tasks}
+        archived = [task for task in reversed(fetch_archived_tasks(conn, user_id, line_id)) if task["task_id"] not in hot_ids]
+        return archived + tasks
     except sqlite3.Error as e:
         print(f"Database error fetching chat history: {e}")
         return []
@@ -400,13 +705,13 @@ def get_chat_history(user_id, line_id, limit=20):
 
 def get_chat_history_for_memory(user_id, line_id, limit=20):  # <--- MUST include 'limit' here
     """Fetches the chat history for a specific LINE user, limited by the last N messages."""
-    conn = sqlite3.connect(DB_FILE_NAME)
+    conn = get_connection()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     try:
         # Use LIMIT in the SQL query
         cursor.execute("""
-            SELECT user_message, ai_response
+            SELECT task_id, user_message, ai_response
             FROM tasks 
             WHERE user_id = ? AND line_id = ? AND status IN ('Responded')
             ORDER BY timestamp DESC
@@ -414,8 +719,8 @@ def get_chat_history_for_memory(user_id, line_id, limit=20):  # <--- MUST includ
         """, (user_id, line_id, limit)) # <--- MUST pass 'limit' here
         
         # ... (rest of the code to reverse and return tasks) ...
-        tasks = cursor.fetchall()
-        return [dict(task) for task in reversed(tasks)]
+        tasks = _with_archived(conn, [dict(task) for task in cursor.fetchall()], user_id, line_id, limit, statuses=("Responded",))
+        return [{"user_message": task["user_message"], "ai_response": task["ai_response"]} for task in reversed(tasks)]
         
     except sqlite3.Error as e:
         print(f"Database error fetching chat history: {e}")
@@ -423,12 +728,75 @@ def get_chat_history_for_memory(user_id, line_id, limit=20):  # <--- MUST includ
     finally:
         conn.close()
 
+def get_recent_turns_after(user_id, line_id, after_task_id, limit):
+    """
+    Fetches up to `limit` of the most recent answered (or merged) turns with task_id > after_task_id,
+    returned oldest first. Uses idx_tasks_conversation, so the cost does not grow with history length.
+    """
+    conn = get_connection()
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT task_id, user_message, ai_response, admin_response, status, merged_into_task_id
+            FROM tasks
+            WHERE user_id = ? AND line_id = ? AND task_id > ? AND status IN ('Responded', 'Merged')
+            ORDER BY task_id DESC
+            LIMIT ?
+        """, (user_id, line_id, after_task_id, limit))
+        tasks = _with_archived(conn, [dict(task) for task in cursor.fetchall()], user_id, line_id, limit,
+                               after_task_id=after_task_id, statuses=("Responded", "Merged"))
+        return [
+            {column: task.get(column) for column in ("task_id", "user_message", "ai_response", "admin_response", "status", "merged_into_task_id")}
+            for task in reversed(tasks)
+        ]
+    except sqlite3.Error as e:
+        print(f"Database error fetching recent turns: {e}")
+        return []
+    finally:
+        conn.close()
+
+def get_conversation_memory(user_id, line_id):
+    """Returns the stored rolling summary state for a conversation (empty summary if none yet)."""
+    conn = get_connection()
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT summary, summarized_until_task_id
+            FROM conversation_memory
+            WHERE user_id = ? AND line_id = ?
+        """, (user_id, line_id))
+        row = cursor.fetchone()
+        if row:
+            return dict(row)
+    except sqlite3.Error as e:
+        print(f"Database error fetching conversation memory: {e}")
+    finally:
+        conn.close()
+    return {"summary": "", "summarized_until_task_id": 0}
+
+def save_conversation_memory(user_id, line_id, summary, summarized_until_task_id):
+    """Persists the rolling summary and the last task_id folded into it."""
+    timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    try:
+        execute_write("""
+            INSERT INTO conversation_memory (user_id, line_id, summary, summarized_until_task_id, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, line_id) DO UPDATE SET
+                summary = excluded.summary,
+                summarized_until_task_id = excluded.summarized_until_task_id,
+                updated_at = excluded.updated_at
+        """, (user_id, line_id, summary, summarized_until_task_id, timestamp))
+    except sqlite3.Error as e:
+        print(f"Database error saving conversation memory: {e}")
+
 # def get_chat_threads_by_status(user_id, status):
 #     """
 #     Fetches a list of unique line_ids where the latest task has the specified status.
 #     This is used to group chats by the status of their most recent message.
 #     """
-#     conn = sqlite3.connect(DB_FILE_NAME)
+#     conn = get_connection()
 #     conn.row_factory = sqlite3.Row
 #     cursor = conn.cursor()
 #     try:
@@ -470,7 +838,7 @@ def get_chat_threads_by_status(user_id, status):
     Fetches a list of unique line_ids where the latest task has the specified status.
     This is used to group chats by the status of their most recent message.
     """
-    conn = sqlite3.connect(DB_FILE_NAME)
+    conn = get_connection()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     try:
@@ -508,10 +876,28 @@ def get_chat_threads_by_status(user_id, status):
     finally:
         conn.close()
 
+def fetch_knowledge_rows(store_id):
+    """Returns (kb_id, question_or_topic, answer_or_detail) rows of a store's knowledge base, ordered by kb_id."""
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT kb_id, question_or_topic, answer_or_detail
+            FROM knowledge_base
+            WHERE store_id = ?
+            ORDER BY kb_id
+        """, (store_id,))
+        return cursor.fetchall()
+    except sqlite3.Error as e:
+        print(f"Database error fetching knowledge: {e}")
+        return []
+    finally:
+        conn.close()
+
 # 🟢 ฟังก์ชันใหม่: ดึงข้อมูล Store ID และ Store Name
 def get_store_info_direct(user_id: str):
     """Retrieves store_id and store_name for a given user_id using direct SQLite connection."""
-    conn = sqlite3.connect(DB_FILE_NAME)
+    conn = get_connection()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     
@@ -0,0 +1,326 @@
+# db_writer.py
+
+import itertools
+import os
+import queue
+import sqlite3
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import database
+from database import run_write_statements
+
+# =========================================================================
+# 🟢 Single-Writer Coordinator
+# SQLite อนุญาตให้มี Writer ได้ทีละหนึ่งเท่านั้น แทนที่ทุก Thread/Process จะแย่งกันล็อกไฟล์
+# เราให้ Thread เดียวถือ Connection สำหรับเขียน และรวมหลายคำขอไว้ใน Transaction เดียว (Group Commit)
+# =========================================================================
+
+class _WriteRequest:
+    def __init__(self, statements, callback=None):
+        self.statements = statements
+        self.callback = callback
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class DBWriter:
+    """Owns the coordinator's SQLite write connection and commits queued statements in batches."""
+
+    def __init__(self, db_file, max_batch=64, max_delay=0.005, busy_timeout=30.0):
+        self.db_file = db_file
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.busy_timeout = busy_timeout
+        self._queue = queue.Queue()
+        self._thread = None
+        self._stopping = threading.Event()
+        self.commit_count = 0
+        self.statement_count = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        self._queue.put(None)
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        # คำขอที่เข้าคิวหลัง Thread จบไปแล้วจะไม่ถูกเขียน: แจ้งผู้รอแทนการปล่อยให้รอตลอดไป
+        leftover = []
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                request.error = sqlite3.OperationalError("DB writer is stopped")
+                leftover.append(request)
+        self._finish(leftover)
+
+    @property
+    def stopping(self):
+        return self._stopping.is_set()
+
+    def submit(self, statements, callback=None):
+        """
+        Queues statements for the next batch. Without a callback this blocks until the batch
+        containing them is committed and returns the results (or raises the sqlite3 error).
+        """
+        request = _WriteRequest(list(statements), callback)
+        self._queue.put(request)
+        if callback is not None:
+            return None
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    def _collect_batch(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self._stopping.set()
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_file, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        try:
+            while True:
+                first = self._queue.get()
+                if first is None:
+                    break
+                batch = self._collect_batch(first)
+                self._commit_batch(conn, batch)
+                if self._stopping.is_set() and self._queue.empty():
+                    break
+        finally:
+            conn.close()
+
+    def _commit_batch(self, conn, batch):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.Error as e:
+            for request in batch:
+                request.error = e
+            self._finish(batch)
+            return
+
+        for request in batch:
+            # SAVEPOINT ต่อคำขอ: คำขอที่ล้มเหลวจะไม่ทำให้คำขออื่นใน Batch เดียวกันถูก Rollback ไปด้วย
+            conn.execute("SAVEPOINT write_request")
+            try:
+                request.results = run_write_statements(conn, request.statements)
+                conn.execute("RELEASE write_request")
+            except sqlite3.Error as e:
+                conn.execute("ROLLBACK TO write_request")
+                conn.execute("RELEASE write_request")
+                request.error = e
+
+        try:
+            conn.execute("COMMIT")
+            self.commit_count += 1
+            self.statement_count += sum(len(r.statements) for r in batch if r.error is None)
+        except sqlite3.Error as e:
+            conn.execute("ROLLBACK")
+            for request in batch:
+                request.results = None
+                request.error = e
+        self._finish(batch)
+
+    def _finish(self, batch):
+        for request in batch:
+            request.done.set()
+            if request.callback is not None:
+                try:
+                    request.callback(request.results, request.error)
+                except Exception as e:
+                    print(f"DB writer callback error: {e}")
+
+# =========================================================================
+# 🟢 Cross-process bridge
+# AI Worker แต่ละ Process ส่งคำสั่งเขียนผ่าน multiprocessing.Queue มาที่ Process หลัก
+# ซึ่งเป็นเจ้าของ DBWriter เพียงตัวเดียว
+# =========================================================================
+
+def serve_remote_writes(writer, request_queue, reply_queues):
+    """Bridges write requests from worker processes into the local DBWriter (runs until None is received)."""
+    while True:
+        message = request_queue.get()
+        if message is None:
+            break
+        worker_index, request_id, statements = message
+        reply_queue = reply_queues[worker_index]
+
+        def _reply(results, error, reply_queue=reply_queue, request_id=request_id):
+            reply_queue.put((request_id, results, error))
+
+        writer.submit(statements, callback=_reply)
+
+
+class RemoteWriteClient:
+    """Write executor used inside worker processes; forwards statements to the coordinator process."""
+
+    def __init__(self, worker_index, request_queue, reply_queue):
+        self.worker_index = worker_index
+        self._request_queue = request_queue
+        self._reply_queue = reply_queue
+        self._ids = itertools.count()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_replies, name="db-writer-replies", daemon=True)
+        self._reader.start()
+
+    def submit(self, statements):
+        request_id = next(self._ids)
+        slot = {"done": threading.Event(), "results": None, "error": None}
+        with self._lock:
+            self._pending[request_id] = slot
+        self._request_queue.put((self.worker_index, request_id, list(statements)))
+        slot["done"].wait()
+        if slot["error"] is not None:
+            raise slot["error"]
+        return slot["results"]
+
+    def _read_replies(self):
+        while True:
+            reply = self._reply_queue.get()
+            if reply is None:
+                break
+            request_id, results, error = reply
+            with self._lock:
+                slot = self._pending.pop(request_id, None)
+            if slot is not None:
+                slot["results"] = results
+                slot["error"] = error
+                slot["done"].set()
+
+
+# =========================================================================
+# 🟢 Web Process bridge
+# gunicorn Web Worker ไม่ได้ถูกสร้างจาก ai_worker.py จึงใช้ multiprocessing.Queue ข้างบนไม่ได้
+# Process หลักของ ai_worker.py จึงเปิด Unix Socket (DB_WRITER_SOCKET) ให้ Web Worker ส่งคำสั่งเขียนเข้า DBWriter ตัวเดียวกัน
+# ถ้าไม่มี Coordinator ฟังอยู่ (ยังไม่ได้รัน ai_worker.py หรือกำลัง Restart) Web Worker เขียนตรงเองด้วย busy_timeout
+# =========================================================================
+
+def default_socket_path():
+    return os.getenv("DB_WRITER_SOCKET") or f"{database.DB_FILE_NAME}.writer.sock"
+
+
+def serve_socket_writes(writer, address=None):
+    """Accepts write connections from web processes on a Unix socket and runs their statements on writer. Returns the Listener."""
+    address = address or default_socket_path()
+    if os.path.exists(address):
+        try:
+            Client(address, family="AF_UNIX").close()
+        except OSError:
+            # Socket ค้างจาก Coordinator ที่จบไปแล้ว
+            os.unlink(address)
+        else:
+            raise RuntimeError(f"Another DB writer is already listening on {address}")
+    listener = Listener(address, family="AF_UNIX")
+    threading.Thread(target=_accept_socket_writes, args=(writer, listener), name="db-writer-socket", daemon=True).start()
+    return listener
+
+
+def _accept_socket_writes(writer, listener):
+    while True:
+        try:
+            conn = listener.accept()
+        except OSError:
+            break
+        threading.Thread(target=_serve_socket_connection, args=(writer, conn), name="db-writer-socket-conn", daemon=True).start()
+
+
+def _serve_socket_connection(writer, conn):
+    # หนึ่ง Connection ต่อหนึ่ง Thread ของ Web Worker: ส่งทีละคำขอแล้วรอคำตอบ
+    with conn:
+        while True:
+            try:
+                statements = conn.recv()
+            except (EOFError, OSError):
+                break
+            if writer.stopping:
+                # ยังไม่ได้เขียน: ให้ Web Worker เขียนเอง
+                conn.send(None)
+                break
+            try:
+                reply = (writer.submit(statements), None)
+            except sqlite3.Error as e:
+                reply = (None, e)
+            try:
+                conn.send(reply)
+            except OSError:
+                break
+
+
+class SocketWriteClient:
+    """
+    Write executor for web processes: forwards statements to the ai_worker.py coordinator over its Unix socket,
+    and writes directly (database.execute_write_direct) while no coordinator is listening.
+    """
+
+    def __init__(self, address=None, retry_seconds=5.0):
+        self.address = address or default_socket_path()
+        self.retry_seconds = retry_seconds
+        self._local = threading.local()
+        self._unavailable_until = 0.0
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None and time.monotonic() >= self._unavailable_until:
+            try:
+                conn = self._local.conn = Client(self.address, family="AF_UNIX")
+            except OSError as e:
+                print(f"DB writer not reachable at {self.address} ({e}); writing directly for {self.retry_seconds:g}s.")
+                self._unavailable_until = time.monotonic() + self.retry_seconds
+        return conn
+
+    def _reset(self, conn):
+        self._local.conn = None
+        conn.close()
+
+    def submit(self, statements):
+        statements = list(statements)
+        for _ in range(2):
+            conn = self._connection()
+            if conn is None:
+                return database.execute_write_direct(statements)
+            try:
+                conn.send(statements)
+            except OSError:
+                # Coordinator ปิด Connection ไปแล้ว (เช่น Restart) คำขอยังไม่ถูกส่ง จึงเชื่อมต่อใหม่แล้วส่งซ้ำได้
+                self._reset(conn)
+                continue
+            try:
+                reply = conn.recv()
+            except (EOFError, OSError) as e:
+                self._reset(conn)
+                # ไม่รู้ว่าคำสั่งถูก Commit แล้วหรือยัง จึงไม่เขียนซ้ำ ให้ผู้เรียกจัดการเหมือนข้อผิดพลาดของ SQLite
+                raise sqlite3.OperationalError(f"Lost connection to the DB writer: {e}") from e
+            if reply is None:
+                # Coordinator กำลังหยุดและไม่ได้เขียนคำขอนี้
+                self._reset(conn)
+                continue
+            results, error = reply
+            if error is not None:
+                raise error
+            return results
+        return database.execute_write_direct(statements)
@@ -0,0 +1,15 @@
+# gunicorn.conf.py
+#
+# gunicorn -c gunicorn.conf.py api_app:app
+# Web Worker ใน Production ทำหน้าที่รับ Webhook เท่านั้น ให้ตั้ง PROCESSING_MODE=queue
+# แล้วรัน `python ai_worker.py --workers M` แยกต่างหากเพื่อประมวลผล AI
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 9000)}"
+workers = int(os.environ.get("WEB_WORKERS", "2"))
+threads = int(os.environ.get("WEB_THREADS", "4"))
+worker_class = "gthread"
+timeout = 30
+
+raw_env = [f"PROCESSING_MODE={os.environ.get('PROCESSING_MODE', 'queue')}"]
@@ -0,0 +1,127 @@
+# history_cache.py
+
+import collections
+import os
+import threading
+import time
+
+import metrics
+from database import add_task_listener, get_recent_turns_after, get_conversation_memory
+
+# =========================================================================
+# 🟢 In-memory History Cache (LRU) ต่อบทสนทนา (user_id, line_id)
+# - โหลดจาก DB ครั้งแรกที่เจอบทสนทนา หลังจากนั้นเป็นการ Lookup ใน Memory
+# - ถูกต่อท้าย (Append-on-write) ทุกครั้งที่คำตอบของ AI หรือแอดมินถูก Commit ผ่าน database.add_task_listener
+# - เก็บสถานะสรุปของ memory_store ไว้ด้วย เพื่อไม่ต้อง Query conversation_memory ทุกข้อความ
+# หมายเหตุ: ในโหมด Multi-process แต่ละ Process มี Cache ของตัวเอง HISTORY_CACHE_TTL จึงกำหนดอายุสูงสุด
+# เพื่อให้คำตอบที่ถูกเขียนจาก Process อื่น (เช่น แอดมินตอบผ่าน Dashboard) ถูกโหลดใหม่
+# =========================================================================
+
+HISTORY_CACHE_MAX_CONVERSATIONS = int(os.getenv("HISTORY_CACHE_MAX_CONVERSATIONS", "2000"))
+HISTORY_CACHE_MAX_TURNS = int(os.getenv("HISTORY_CACHE_MAX_TURNS", "20"))
+HISTORY_CACHE_TTL = float(os.getenv("HISTORY_CACHE_TTL", "300"))
+
+
+class ConversationHistoryCache:
+    """Bounded LRU of recent answered turns and memory state per (user_id, line_id)."""
+
+    def __init__(self, max_conversations=HISTORY_CACHE_MAX_CONVERSATIONS, max_turns=HISTORY_CACHE_MAX_TURNS, ttl=HISTORY_CACHE_TTL):
+        self.max_conversations = max_conversations
+        self.max_turns = max_turns
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load(self, user_id, line_id):
+        turns = get_recent_turns_after(user_id, line_id, 0, self.max_turns)
+        return {
+            "turns": collections.OrderedDict((turn["task_id"], turn) for turn in turns),
+            "memory_state": get_conversation_memory(user_id, line_id),
+            "loaded_at": time.monotonic(),
+        }
+
+    def _get_entry(self, user_id, line_id):
+        key = (user_id, line_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry["loaded_at"] < self.ttl:
+                self._entries.move_to_end(key)
+                metrics.increment("history_cache_hits")
+                return entry
+
+        metrics.increment("history_cache_misses")
+        entry = self._load(user_id, line_id)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_conversations:
+                self._entries.popitem(last=False)
+        return entry
+
+    def get_turns(self, user_id, line_id, after_task_id=0, limit=None):
+        """
+        Returns up to `limit` most recent answered turns with task_id > after_task_id, oldest first.
+        A merged turn is included only once the task it was merged into has been answered.
+        """
+        entry = self._get_entry(user_id, line_id)
+        with self._lock:
+            answered = {task_id for task_id, turn in entry["turns"].items() if turn["status"] != "Merged"}
+            # ข้อความที่ถูก Merge เข้ากับ Task ที่ยังไม่ได้ตอบ (เช่น Task ที่ Agent กำลังตอบอยู่) เป็นส่วนหนึ่งของ Input อยู่แล้ว
+            # ถ้าใส่ใน Memory ด้วย ลูกค้าจะพิมพ์ข้อความนั้นซ้ำสองครั้งในสายตาของโมเดล
+            turns = [
+                dict(turn) for task_id, turn in entry["turns"].items()
+                if task_id > after_task_id and (turn["status"] != "Merged" or turn["merged_into_task_id"] in answered)
+            ]
+        return turns[-limit:] if limit else turns
+
+    def get_memory_state(self, user_id, line_id):
+        entry = self._get_entry(user_id, line_id)
+        with self._lock:
+            return dict(entry["memory_state"])
+
+    def set_memory_state(self, user_id, line_id, summary, summarized_until_task_id):
+        with self._lock:
+            entry = self._entries.get((user_id, line_id))
+            if entry is not None:
+                entry["memory_state"] = {"summary": summary, "summarized_until_task_id": summarized_until_task_id}
+
+    def on_task_change(self, event):
+        """Task listener: appends answered or merged turns and drops turns that are no longer answered."""
+        key = (event["user_id"], event["line_id"])
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                # ยังไม่ได้อยู่ใน Cache: จะถูกโหลดจาก DB เมื่อมีการใช้งานครั้งแรก
+                return
+            turns = entry["turns"]
+            answered = event["status"] == "Responded" and (event["ai_response"] or event["admin_response"])
+            # ข้อความที่ถูกรวมเข้ากับข้อความถัดไป (Merged) ยังเป็นบริบทที่ลูกค้าพิมพ์จริง
+            if not answered and event["status"] != "Merged":
+                turns.pop(event["task_id"], None)
+                return
+            turns[event["task_id"]] = {
+                "task_id": event["task_id"],
+                "user_message": event["user_message"],
+                "ai_response": event["ai_response"],
+                "admin_response": event["admin_response"],
+                "status": event["status"],
+                "merged_into_task_id": event["merged_into_task_id"],
+            }
+            # task_id ของคำตอบแอดมินอาจเก่ากว่ารายการล่าสุด จึงต้องเรียงใหม่ก่อนตัดให้เหลือ max_turns
+            if next(reversed(turns)) != event["task_id"] or len(turns) > self.max_turns:
+                ordered = sorted(turns.items())[-self.max_turns:]
+                entry["turns"] = collections.OrderedDict(ordered)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_history_cache():
+    """Returns the process-wide history cache, registering it as a task listener on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ConversationHistoryCache()
+            add_task_listener(_cache.on_task_change)
+        return _cache
@@ -1,8 +1,9 @@
 # history_utils.py
 
-from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 # from langchain.memory import ChatMessageHistory
 from database import get_chat_history_for_memory
+from memory_store import load_conversation_memory, fit_to_token_budget, make_llm_summarizer
 from langchain_community.chat_message_histories import ChatMessageHistory
 
 def load_history_from_db(user_id: str, line_id: str) -> ChatMessageHistory:
@@ -30,4 +31,29 @@ def load_history_from_db(user_id: str, line_id: str) -> ChatMessageHistory:
         if ai_resp and ai_resp.strip():
             history.add_message(AIMessage(content=ai_resp))
             
-    return history
\ No newline at end of file
+    return history
+
+
+def load_summarized_history(user_id: str, line_id: str, llm=None) -> ChatMessageHistory:
+    """
+    Loads the rolling summary plus the last few turns (within MEMORY_TOKEN_BUDGET)
+    as a ChatMessageHistory. The summary is sent as a SystemMessage before the recent turns.
+    """
+    summarizer = make_llm_summarizer(llm) if llm is not None else None
+    memory = load_conversation_memory(user_id, line_id, summarizer)
+    summary, turns = fit_to_token_budget(memory["summary"], memory["turns"])
+
+    history = ChatMessageHistory()
+    if summary:
+        history.add_message(SystemMessage(content=f"สรุปบทสนทนาก่อนหน้ากับลูกค้ารายนี้:\n{summary}"))
+
+    for task in turns:
+        if task.get('user_message'):
+            history.add_message(HumanMessage(content=task['user_message']))
+        if task.get('ai_response') and task['ai_response'].strip():
+            history.add_message(AIMessage(content=task['ai_response']))
+        # คำตอบจากแอดมินเป็นบริบทที่ลูกค้าเห็นจริง จึงต้องอยู่ใน Memory ด้วย
+        if task.get('admin_response') and task['admin_response'].strip():
+            history.add_message(AIMessage(content=f"แอดมิน: {task['admin_response']}"))
+
+    return history
@@ -0,0 +1,201 @@
+# kb_import.py
+#
+# นำเข้า FAQ จำนวนมากลงตาราง knowledge_base ของร้าน แบบ Streaming
+#
+#   python kb_import.py 3 faq.csv
+#   python kb_import.py 3 faq.jsonl --format jsonl --no-index
+#
+# - อ่านไฟล์ทีละแถว (CSV ผ่าน csv.DictReader, JSONL ทีละบรรทัด) Memory จึงคงที่แม้ไฟล์ใหญ่หลายร้อย MB
+# - แถวหนึ่งต้องมีคอลัมน์ question/topic/question_or_topic และ answer/detail/answer_or_detail
+#   แถวที่ไม่ครบหรืออ่านไม่ได้จะถูกข้ามและนับเป็น errors
+# - INSERT ด้วย executemany ทีละ KB_IMPORT_CHUNK_SIZE แถว (หนึ่ง Transaction ต่อ Chunk) และรายงานความคืบหน้าทุก Chunk
+# - เมื่อจบจะ Index Vector เฉพาะแถวใหม่ (kb_indexer ทำต่อจาก Checkpoint เดิมของร้าน)
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+import metrics
+from database import execute_write_many, initialize_database
+from knowledge_index import invalidate_knowledge_index
+
+KB_IMPORT_CHUNK_SIZE = int(os.getenv("KB_IMPORT_CHUNK_SIZE", "1000"))
+# ความยาวสูงสุดต่อช่อง (ตัวอักษร) กันแถวที่เสียทำให้ Prompt/Embedding ใหญ่ผิดปกติ
+KB_IMPORT_MAX_FIELD_CHARS = int(os.getenv("KB_IMPORT_MAX_FIELD_CHARS", "8000"))
+
+QUESTION_COLUMNS = ("question_or_topic", "question", "topic")
+ANSWER_COLUMNS = ("answer_or_detail", "answer", "detail")
+
+_INSERT_SQL = "INSERT INTO knowledge_base (store_id, question_or_topic, answer_or_detail) VALUES (?, ?, ?)"
+
+
+class _CountingReader(io.RawIOBase):
+    """Wraps a binary stream and counts the bytes read from it (for progress reports)."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        if not data:
+            return 0
+        buffer[:len(data)] = data
+        self.bytes_read += len(data)
+        return len(data)
+
+
+def _pick(record, columns):
+    for column in columns:
+        value = record.get(column)
+        if isinstance(value, str) and value.strip():
+            return value.strip()
+    return None
+
+
+def detect_format(filename=None, content_type=None):
+    """Guesses 'csv' or 'jsonl' from a filename or content type (defaults to csv)."""
+    name = (filename or "").lower()
+    content_type = (content_type or "").lower()
+    if name.endswith((".jsonl", ".ndjson", ".json")) or "json" in content_type:
+        return "jsonl"
+    return "csv"
+
+
+def iter_records(text_stream, file_format):
+    """Yields a dict per CSV row / JSONL line, or None for a line that cannot be parsed."""
+    if file_format == "csv":
+        reader = csv.DictReader(text_stream)
+        if reader.fieldnames:
+            reader.fieldnames = [name.strip().lower() for name in reader.fieldnames]
+        yield from reader
+        return
+    for line in text_stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield None
+            continue
+        yield {str(key).lower(): value for key, value in record.items()} if isinstance(record, dict) else None
+
+
+def iter_import(store_id, binary_stream, file_format="csv", chunk_size=KB_IMPORT_CHUNK_SIZE):
+    """
+    Streams FAQ rows from a binary file object into knowledge_base for one store.
+    Yields a progress report dict after every committed chunk; the last one yielded has done=True.
+    """
+    store_id = str(store_id)
+    counting = _CountingReader(binary_stream)
+    # utf-8-sig ตัด BOM ที่ Excel ใส่หน้าไฟล์ CSV
+    text_stream = io.TextIOWrapper(io.BufferedReader(counting), encoding="utf-8-sig", errors="replace", newline="")
+    report = {"store_id": store_id, "format": file_format, "rows": 0, "inserted": 0, "errors": 0,
+              "chunks": 0, "bytes": 0, "seconds": 0.0, "done": False}
+    started = time.perf_counter()
+    chunk = []
+
+    def flush():
+        execute_write_many([(_INSERT_SQL, chunk)])
+        metrics.increment("kb_import_rows", len(chunk))
+        report["inserted"] += len(chunk)
+        report["chunks"] += 1
+        report["bytes"] = counting.bytes_read
+        report["seconds"] = time.perf_counter() - started
+        chunk.clear()
+        return dict(report)
+
+    try:
+        for record in iter_records(text_stream, file_format):
+            report["rows"] += 1
+            question = _pick(record, QUESTION_COLUMNS) if record else None
+            answer = _pick(record, ANSWER_COLUMNS) if record else None
+            if not question or not answer:
+                report["errors"] += 1
+                continue
+            chunk.append((store_id, question[:KB_IMPORT_MAX_FIELD_CHARS], answer[:KB_IMPORT_MAX_FIELD_CHARS]))
+            if len(chunk) >= chunk_size:
+                yield flush()
+        if chunk:
+            yield flush()
+    except csv.Error as e:
+        report["error"] = f"CSV parse error at row {report['rows'] + 1}: {e}"
+        print(f"Knowledge import for store {store_id} stopped: {report['error']}")
+    finally:
+        # Chunk ที่ Commit แล้วยังอยู่ในฐานข้อมูล แม้การนำเข้าจะหยุดกลางทาง
+        if report["inserted"]:
+            invalidate_knowledge_index(store_id)
+        metrics.increment("kb_import_errors", report["errors"])
+
+    report["bytes"] = counting.bytes_read
+    report["seconds"] = time.perf_counter() - started
+    report["done"] = True
+    print(f"Imported {report['inserted']} knowledge rows into store {store_id} "
+          f"({report['errors']} skipped, {report['bytes'] / 1e6:.1f} MB in {report['seconds']:.1f}s).")
+    yield report
+
+
+def import_knowledge(store_id, binary_stream, file_format="csv", chunk_size=KB_IMPORT_CHUNK_SIZE, progress=None):
+    """Runs iter_import to completion, calling progress(report) per chunk. Returns the final report."""
+    for report in iter_import(store_id, binary_stream, file_format, chunk_size):
+        if report["done"]:
+            return report
+        if progress:
+            progress(report)
+
+
+def index_new_rows(store_id, background=True):
+    """Embeds rows added since the store's last index checkpoint (in a background thread by default)."""
+    from kb_indexer import index_store
+
+    def run():
+        try:
+            return index_store(store_id)
+        except Exception as e:
+            print(f"Incremental knowledge indexing failed for store {store_id}: {e}")
+            return None
+
+    if not background:
+        return run()
+    threading.Thread(target=run, name=f"kb-index-{store_id}", daemon=True).start()
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream a CSV or JSONL file of FAQ rows into a store's knowledge base.")
+    parser.add_argument("store_id")
+    parser.add_argument("path", help="file to import, or - for stdin")
+    parser.add_argument("--format", choices=["csv", "jsonl"])
+    parser.add_argument("--chunk-size", type=int, default=KB_IMPORT_CHUNK_SIZE)
+    parser.add_argument("--no-index", action="store_true", help="skip vector indexing of the new rows")
+    args = parser.parse_args()
+
+    initialize_database()
+    file_format = args.format or detect_format(args.path)
+    total_bytes = os.path.getsize(args.path) if args.path != "-" else 0
+
+    def progress(report):
+        done = f"{report['bytes'] / total_bytes:6.1%}" if total_bytes else f"{report['bytes'] / 1e6:.1f} MB"
+        print(f"  {done}  {report['inserted']} inserted, {report['errors']} skipped", file=sys.stderr)
+
+    if args.path == "-":
+        report = import_knowledge(args.store_id, sys.stdin.buffer, file_format, args.chunk_size, progress)
+    else:
+        with open(args.path, "rb") as binary_stream:
+            report = import_knowledge(args.store_id, binary_stream, file_format, args.chunk_size, progress)
+    if report["inserted"] and not args.no_index:
+        report["index"] = index_new_rows(args.store_id, background=False)
+    print(json.dumps(report, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
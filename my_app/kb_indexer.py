@@ -0,0 +1,326 @@
+# kb_indexer.py
+#
+# Index Knowledge Base ของร้านลง Vector Backend แบบแบ่ง Batch
+#
+#   python kb_indexer.py 3 7 --backend chroma --batch-size 100 --concurrency 4 --rpm 300
+#
+# - เรียก Embedding ทีละ Batch (KB_EMBED_BATCH_SIZE) พร้อมกันหลาย Batch (KB_EMBED_CONCURRENCY)
+#   โดยไม่เกิน KB_EMBED_REQUESTS_PER_MINUTE ของทั้ง Process และ Retry แบบ Backoff เมื่อโดน 429
+# - บันทึก Checkpoint (kb_id ล่าสุดที่เขียนลง Backend แล้ว) ในตาราง kb_index_checkpoints ทุก Batch
+#   เมื่อถูกขัดจังหวะ การรันครั้งถัดไปจะทำต่อจาก Checkpoint ถ้า Knowledge Base ยังเหมือนเดิม
+# - Fingerprint ใน Checkpoint ครอบคลุมเฉพาะแถวที่ Index แล้ว (kb_id <= last_kb_id)
+#   แถวที่เพิ่มต่อท้ายภายหลัง (เช่นจาก kb_import.py) จึง Embed เฉพาะแถวใหม่ ไม่ต้อง Index ทั้งร้านใหม่
+
+import argparse
+import collections
+import hashlib
+import json
+import os
+import shutil
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import metrics
+from database import execute_write, fetch_knowledge_rows, get_connection
+from knowledge_index import knowledge_document, update_fingerprint
+
+KB_EMBED_BATCH_SIZE = int(os.getenv("KB_EMBED_BATCH_SIZE", "100"))
+KB_EMBED_CONCURRENCY = int(os.getenv("KB_EMBED_CONCURRENCY", "4"))
+KB_EMBED_REQUESTS_PER_MINUTE = float(os.getenv("KB_EMBED_REQUESTS_PER_MINUTE", "300"))
+KB_EMBED_MAX_RETRIES = int(os.getenv("KB_EMBED_MAX_RETRIES", "5"))
+
+
+class RateLimiter:
+    """Spaces request starts evenly so that at most `per_minute` begin in any minute (0 disables the limit)."""
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self._next_at = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start_at = max(now, self._next_at)
+            self._next_at = start_at + self.interval
+        if start_at > now:
+            time.sleep(start_at - now)
+
+
+# Quota ของ Embedding API ผูกกับ API Key จึงใช้ Limiter เดียวทั้ง Process
+_rate_limiter = RateLimiter(KB_EMBED_REQUESTS_PER_MINUTE)
+
+
+def _is_rate_limited(error):
+    error_message = str(error).lower()
+    return "429" in error_message or "resource exhausted" in error_message or "quota" in error_message or "503" in error_message
+
+
+def embed_batch(embeddings, texts, limiter=_rate_limiter, max_retries=KB_EMBED_MAX_RETRIES):
+    """One rate-limited embedding request for a batch of texts, retried with backoff on rate-limit errors."""
+    for attempt in range(max_retries + 1):
+        limiter.acquire()
+        started = time.perf_counter()
+        try:
+            vectors = embeddings.embed_documents(texts)
+            metrics.observe("kb_embed_request_seconds", time.perf_counter() - started)
+            return vectors
+        except Exception as e:
+            if attempt >= max_retries or not _is_rate_limited(e):
+                raise
+            wait_time = min(60.0, 2 ** attempt) + random.uniform(0, 1)
+            metrics.increment("kb_embed_retries")
+            print(f"Embedding request rate-limited ({e}). Retrying in {wait_time:.1f}s ({attempt + 1}/{max_retries}).")
+            time.sleep(wait_time)
+
+
+# =========================================================================
+# 🟢 Checkpoint
+# =========================================================================
+
+def get_checkpoint(store_id, backend):
+    conn = get_connection()
+    conn.row_factory = sqlite3.Row
+    try:
+        row = conn.execute(
+            "SELECT * FROM kb_index_checkpoints WHERE store_id = ? AND backend = ?", (str(store_id), backend)
+        ).fetchone()
+        return dict(row) if row else None
+    except sqlite3.Error as e:
+        print(f"Database error reading index checkpoint: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+def save_checkpoint(store_id, backend, source_fingerprint, last_kb_id, indexed_count, status="running"):
+    execute_write("""
+        INSERT INTO kb_index_checkpoints (store_id, backend, source_fingerprint, last_kb_id, indexed_count, status, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (store_id, backend) DO UPDATE SET
+            source_fingerprint = excluded.source_fingerprint, last_kb_id = excluded.last_kb_id,
+            indexed_count = excluded.indexed_count, status = excluded.status, updated_at = excluded.updated_at
+    """, (str(store_id), backend, source_fingerprint, last_kb_id, indexed_count, status, time.time()))
+
+
+# =========================================================================
+# 🟢 Backend Sinks: เขียนผลของแต่ละ Batch ลง Backend ตามลำดับ kb_id
+# =========================================================================
+
+class ChromaSink:
+    """Upserts precomputed vectors into the shared Chroma collection."""
+
+    backend = "chroma"
+
+    def __init__(self, store_id):
+        from vector_index import get_knowledge_vector_store
+        self.store_id = str(store_id)
+        self.collection = get_knowledge_vector_store()._collection
+
+    def reset(self):
+        self.collection.delete(where={"store_id": self.store_id})
+
+    def resume(self, indexed_count):
+        return True
+
+    def write(self, documents, vectors):
+        self.collection.upsert(
+            ids=[f"{self.store_id}:{document.metadata['kb_id']}" for document in documents],
+            embeddings=vectors,
+            documents=[document.page_content for document in documents],
+            metadatas=[document.metadata for document in documents],
+        )
+
+    def finish(self, source_fingerprint, indexed_count):
+        import vector_index
+        vector_index._indexed_stores.add(self.store_id)
+
+
+class NumpySink:
+    """Appends vectors to a partial float32 file; the final normalized matrix is written when all batches are done."""
+
+    backend = "numpy"
+    # ไฟล์ .partial = int32 จำนวนมิติ ตามด้วยแถว float32 เรียงตาม kb_id
+    HEADER_BYTES = 4
+
+    def __init__(self, store_id):
+        from numpy_vector_index import NumpyVectorIndex
+        self.store_id = str(store_id)
+        self.partial_path = NumpyVectorIndex.paths(self.store_id)[0] + ".partial"
+
+    def _dim(self):
+        with open(self.partial_path, "rb") as partial_file:
+            return int(np.frombuffer(partial_file.read(self.HEADER_BYTES), dtype=np.int32)[0])
+
+    def reset(self):
+        if os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
+
+    def _seed_from_final(self, indexed_count):
+        """Starts the partial file from a finished matrix of exactly indexed_count rows (appending new rows later)."""
+        from numpy_vector_index import NumpyVectorIndex
+        matrix_path, manifest_path = NumpyVectorIndex.paths(self.store_id)
+        try:
+            with open(manifest_path, encoding="utf-8") as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            return False
+        if manifest["rows"] != indexed_count or not os.path.exists(matrix_path):
+            return False
+        with open(matrix_path, "rb") as matrix_file, open(self.partial_path, "wb") as partial_file:
+            partial_file.write(np.int32(manifest["dim"]).tobytes())
+            shutil.copyfileobj(matrix_file, partial_file)
+        return True
+
+    def resume(self, indexed_count):
+        """Drops rows written after the last checkpoint. False when neither the partial file nor the final matrix has them."""
+        if not indexed_count:
+            self.reset()
+            return True
+        if not os.path.exists(self.partial_path) or os.path.getsize(self.partial_path) < self.HEADER_BYTES:
+            self.reset()
+            if not self._seed_from_final(indexed_count):
+                return False
+        keep_bytes = self.HEADER_BYTES + indexed_count * self._dim() * 4
+        if os.path.getsize(self.partial_path) < keep_bytes:
+            return False
+        os.truncate(self.partial_path, keep_bytes)
+        return True
+
+    def write(self, documents, vectors):
+        matrix = np.asarray(vectors, dtype=np.float32)
+        os.makedirs(os.path.dirname(self.partial_path), exist_ok=True)
+        with open(self.partial_path, "ab") as partial_file:
+            if partial_file.tell() == 0:
+                partial_file.write(np.int32(matrix.shape[1]).tobytes())
+            partial_file.write(matrix.tobytes())
+
+    def finish(self, source_fingerprint, indexed_count):
+        from numpy_vector_index import NumpyVectorIndex
+        if not indexed_count:
+            return
+        dim = self._dim()
+        matrix = np.fromfile(self.partial_path, dtype=np.float32, count=indexed_count * dim, offset=self.HEADER_BYTES)
+        NumpyVectorIndex.write(self.store_id, matrix.reshape(indexed_count, dim), source_fingerprint)
+        os.remove(self.partial_path)
+
+
+SINKS = {"chroma": ChromaSink, "numpy": NumpySink}
+
+
+# Index ร้านเดียวกันได้ทีละงาน (เช่น Import ที่ Index ใน Background กับการค้นครั้งแรกที่ Index แบบ Lazy)
+_store_locks = collections.defaultdict(threading.Lock)
+
+
+def index_store(store_id, backend=None, embeddings=None, batch_size=KB_EMBED_BATCH_SIZE,
+                concurrency=KB_EMBED_CONCURRENCY, limiter=_rate_limiter, rebuild=False):
+    """
+    Embeds a store's knowledge_base rows in batches and writes them to the vector backend.
+    Resumes from the last checkpoint while the rows it covers are unchanged, so rows appended
+    since the last run are the only ones embedded. Returns a summary dict.
+    """
+    store_id = str(store_id)
+    with _store_locks[store_id]:
+        return _index_store(store_id, backend, embeddings, batch_size, concurrency, limiter, rebuild)
+
+
+def _index_store(store_id, backend, embeddings, batch_size, concurrency, limiter, rebuild):
+    from vector_index import RAG_BACKEND, get_embeddings
+    backend = backend or RAG_BACKEND
+    started = time.perf_counter()
+
+    documents = [knowledge_document(store_id, kb_id, topic, detail) for kb_id, topic, detail in fetch_knowledge_rows(store_id)]
+    summary = {"store_id": store_id, "backend": backend, "rows": len(documents), "indexed": 0, "resumed_from": 0, "batches": 0, "seconds": 0.0}
+    if not documents:
+        return summary
+    sink = SINKS[backend](store_id)
+
+    checkpoint = None if rebuild else get_checkpoint(store_id, backend)
+    if checkpoint:
+        done = [document for document in documents if document.metadata["kb_id"] <= checkpoint["last_kb_id"]]
+        digest = update_fingerprint(hashlib.sha256(), done)
+        if len(done) != checkpoint["indexed_count"] or digest.hexdigest() != checkpoint["source_fingerprint"]:
+            checkpoint = None
+    if checkpoint and checkpoint["status"] == "done" and len(done) == len(documents):
+        summary["indexed"] = checkpoint["indexed_count"]
+        return summary
+    if checkpoint and sink.resume(checkpoint["indexed_count"]):
+        last_kb_id, indexed_count = checkpoint["last_kb_id"], checkpoint["indexed_count"]
+        summary["resumed_from"] = indexed_count
+        print(f"Resuming index of store {store_id} ({backend}) after kb_id {last_kb_id} ({indexed_count}/{len(documents)} rows done).")
+    else:
+        last_kb_id, indexed_count = 0, 0
+        digest = hashlib.sha256()
+        sink.reset()
+        save_checkpoint(store_id, backend, digest.hexdigest(), 0, 0)
+
+    embeddings = embeddings or get_embeddings()
+    pending = [document for document in documents if document.metadata["kb_id"] > last_kb_id]
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    lower_bound = len(batches) * limiter.interval
+    print(f"Indexing store {store_id} ({backend}): {len(pending)} rows in {len(batches)} batches of {batch_size}, "
+          f"concurrency {concurrency}, rate-limit bound ~{lower_bound:.1f}s")
+
+    # ส่ง Batch ล่วงหน้าไม่เกิน 2 เท่าของ Concurrency แต่เขียนลง Backend และขยับ Checkpoint ตามลำดับเท่านั้น
+    pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="kb-embed")
+    in_flight = collections.deque()
+    batch_iter = iter(batches)
+
+    def fill():
+        while len(in_flight) < concurrency * 2:
+            batch = next(batch_iter, None)
+            if batch is None:
+                return
+            in_flight.append((batch, pool.submit(embed_batch, embeddings, [d.page_content for d in batch], limiter)))
+
+    try:
+        fill()
+        while in_flight:
+            batch, future = in_flight.popleft()
+            sink.write(batch, future.result())
+            indexed_count += len(batch)
+            last_kb_id = batch[-1].metadata["kb_id"]
+            update_fingerprint(digest, batch)
+            save_checkpoint(store_id, backend, digest.copy().hexdigest(), last_kb_id, indexed_count)
+            summary["batches"] += 1
+            metrics.increment("kb_indexed_rows", len(batch), backend=backend)
+            fill()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    # ตอนนี้ทุกแถวถูก Index แล้ว Fingerprint ของส่วนที่ Index จึงเท่ากับ documents_fingerprint ของทั้งร้าน
+    fingerprint = digest.hexdigest()
+    sink.finish(fingerprint, indexed_count)
+    save_checkpoint(store_id, backend, fingerprint, last_kb_id, indexed_count, status="done")
+    summary["indexed"] = indexed_count
+    summary["seconds"] = time.perf_counter() - started
+    metrics.observe("kb_index_seconds", summary["seconds"], backend=backend)
+    print(f"Indexed store {store_id} ({backend}): {indexed_count} rows in {summary['seconds']:.1f}s.")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embed stores' knowledge bases into the vector backend in batches.")
+    parser.add_argument("store_ids", nargs="+")
+    parser.add_argument("--backend", choices=sorted(SINKS))
+    parser.add_argument("--batch-size", type=int, default=KB_EMBED_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=KB_EMBED_CONCURRENCY)
+    parser.add_argument("--rpm", type=float, default=KB_EMBED_REQUESTS_PER_MINUTE, help="embedding requests per minute")
+    parser.add_argument("--rebuild", action="store_true", help="ignore checkpoints and re-embed everything")
+    args = parser.parse_args()
+
+    limiter = RateLimiter(args.rpm)
+    for store_id in args.store_ids:
+        index_store(store_id, backend=args.backend, batch_size=args.batch_size, concurrency=args.concurrency,
+                    limiter=limiter, rebuild=args.rebuild)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+# knowledge_index.py
+
+import asyncio
+import collections
+import hashlib
+import math
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import PrivateAttr
+
+import metrics
+from database import fetch_knowledge_rows
+
+# =========================================================================
+# 🟢 Hybrid Retrieval สำหรับ Knowledge Base ภาษาไทย (Lexical + Vector)
+# เดิม knowledge_base_search เรียก Embedding API ทุกครั้ง แม้คำถามจะตรงหัวข้อเป๊ะ ๆ เช่น "ที่จอดรถ"
+# ที่นี่มี Index แบบ BM25 ใน Process ต่อร้าน (โหลดจากตาราง knowledge_base) ภาษาไทยไม่มีช่องว่างระหว่างคำ
+# จึงตัดเป็น Character Bigram (ภาษาอังกฤษ/ตัวเลขตัดตามคำ) ไม่ต้องพึ่งตัวตัดคำภายนอก
+#   1. หัวข้ออยู่ในคำถาม (หรือกลับกัน) -> ตอบจาก Index ทันที (exact)
+#   2. คำถามส่วนใหญ่พบในเอกสารอันดับแรก -> ตอบจาก Index ทันที (lexical)
+#   3. นอกนั้นเรียก Vector Retriever (Chroma) แล้วรวมผลด้วย Reciprocal Rank Fusion (hybrid)
+# =========================================================================
+
+KB_INDEX_TTL = float(os.getenv("KB_INDEX_TTL", "300"))
+KB_INDEX_MAX_STORES = int(os.getenv("KB_INDEX_MAX_STORES", "1000"))
+# สัดส่วน N-gram ของคำถามที่ต้องพบในเอกสารอันดับแรก จึงจะไม่ต้องเรียก Embedding
+KB_LEXICAL_MIN_COVERAGE = float(os.getenv("KB_LEXICAL_MIN_COVERAGE", "0.75"))
+RRF_K = 60
+BM25_K1 = 1.5
+BM25_B = 0.75
+TOPIC_WEIGHT = 2
+
+_THAI_OR_WORD = re.compile(r"[฀-๿]+|[a-z0-9]+")
+# คำลงท้าย/คำถามที่ไม่ช่วยในการค้นหา (ตัดเฉพาะท้ายช่วงข้อความภาษาไทย)
+_THAI_TRAILING_PARTICLES = re.compile(
+    r"(?:ครับ|คับ|ค่ะ|คะ|จ้า|จ้ะ|นะ|ไหม|มั้ย|มั๊ย|หรือไม่|หรือเปล่า|ป่าว|บ้าง|ได้"
+    r"|อะไร|ยังไง|อย่างไร|ทำไง|ที่ไหน|เท่าไหร่|เท่าไร|กี่โมง)+$"
+)
+# "Wi-Fi" / "wi fi" / "wifi" ให้เป็นคำเดียวกัน
+_WORD_JOINER = re.compile(r"(?<=[a-z0-9])[-.](?=[a-z0-9])")
+
+
+def _words(text):
+    return _THAI_OR_WORD.findall(_WORD_JOINER.sub("", text.lower()))
+
+
+def _normalize(text):
+    return "".join(_words(text))
+
+
+def _strip_particles(run):
+    stripped = _THAI_TRAILING_PARTICLES.sub("", run)
+    return stripped or run
+
+
+def tokenize(text, is_query=False):
+    """Thai-aware tokens: character bigrams for Thai runs, whole words for Latin letters and digits."""
+    tokens = []
+    for run in _words(text):
+        if not "฀" <= run[0] <= "๿":
+            tokens.append(run)
+            continue
+        if is_query:
+            run = _strip_particles(run)
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def knowledge_document(store_id, kb_id, topic, detail):
+    """Builds the Document for one knowledge_base row (same content as the documents indexed in Chroma)."""
+    return Document(
+        page_content=f"หัวข้อ: {topic}\nรายละเอียด: {detail}",
+        metadata={"store_id": store_id, "topic": topic, "kb_id": kb_id, "source": "knowledge_base_db"},
+    )
+
+
+def update_fingerprint(digest, documents):
+    """Feeds documents into a running sha256 so a prefix's fingerprint can be extended batch by batch."""
+    for document in documents:
+        digest.update(document.page_content.encode("utf-8"))
+        digest.update(b"\0")
+    return digest
+
+
+def documents_fingerprint(documents):
+    """sha256 over the documents' page_content; changes whenever a store's knowledge base changes."""
+    return update_fingerprint(hashlib.sha256(), documents).hexdigest()
+
+
+class KnowledgeIndex:
+    """In-memory BM25 index over one store's knowledge_base rows (topic tokens weighted double)."""
+
+    def __init__(self, store_id, rows):
+        self.store_id = store_id
+        self.documents = [knowledge_document(store_id, kb_id, topic, detail) for kb_id, topic, detail in rows]
+        self._topics = [_normalize(topic) for _, topic, _ in rows]
+        # Inverted Index: term -> [(document, BM25 term weight)] จึงคำนวณเฉพาะเอกสารที่มีคำในคำถาม
+        self._postings = collections.defaultdict(list)
+        term_freqs = []
+        lengths = []
+        for _, topic, detail in rows:
+            tokens = tokenize(topic) * TOPIC_WEIGHT + tokenize(detail)
+            term_freqs.append(collections.Counter(tokens))
+            lengths.append(len(tokens))
+        count = len(rows)
+        # ทุกแถวไม่มี Token เลย (เช่นมีแต่ Emoji/เครื่องหมาย) ก็ต้องสร้าง Index ได้ (ไม่มี Posting) ไม่หารด้วยศูนย์
+        avg_length = (sum(lengths) / count) if count and sum(lengths) else 1.0
+        for i, term_freq in enumerate(term_freqs):
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[i] / avg_length)
+            for term, freq in term_freq.items():
+                self._postings[term].append((i, freq * (BM25_K1 + 1) / (freq + norm)))
+        self._idf = {term: math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5)) for term, postings in self._postings.items()}
+        self.loaded_at = time.monotonic()
+
+    def __len__(self):
+        return len(self.documents)
+
+    def exact_matches(self, query):
+        """Indexes of documents whose topic appears in the query, or that contain the whole (short) query in their topic."""
+        normalized = _normalize(query)
+        core = _normalize(_strip_particles(normalized)) if normalized else ""
+        matches = []
+        for i, topic in enumerate(self._topics):
+            if len(topic) >= 2 and topic in normalized:
+                matches.append(i)
+            elif len(core) >= 3 and core in topic:
+                matches.append(i)
+        # หัวข้อที่ยาวกว่าเจาะจงกว่า
+        return sorted(matches, key=lambda i: -len(self._topics[i]))
+
+    def search(self, query, k):
+        """Returns [(index, score, coverage)] of the top-k documents by BM25; coverage is the share of query terms found."""
+        terms = set(tokenize(query, is_query=True))
+        if not terms:
+            return []
+        scores = {}
+        found = collections.Counter()
+        for term in terms:
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            for i, weight in self._postings[term]:
+                scores[i] = scores.get(i, 0.0) + idf * weight
+                found[i] += 1
+        top = sorted(scores, key=lambda i: -scores[i])[:k]
+        return [(i, scores[i], found[i] / len(terms)) for i in top]
+
+
+_lock = threading.Lock()
+_indexes = collections.OrderedDict()
+
+
+def peek_knowledge_index(store_id):
+    """Returns the store's cached KnowledgeIndex if it is still fresh, without touching the database."""
+    key = str(store_id)
+    with _lock:
+        index = _indexes.get(key)
+        if index is not None and time.monotonic() - index.loaded_at < KB_INDEX_TTL:
+            _indexes.move_to_end(key)
+            return index
+    return None
+
+
+def get_knowledge_index(store_id):
+    """Returns the store's KnowledgeIndex, rebuilt from SQLite when missing or older than KB_INDEX_TTL."""
+    index = peek_knowledge_index(store_id)
+    if index is not None:
+        return index
+
+    key = str(store_id)
+    index = KnowledgeIndex(key, fetch_knowledge_rows(store_id))
+    with _lock:
+        _indexes[key] = index
+        _indexes.move_to_end(key)
+        while len(_indexes) > KB_INDEX_MAX_STORES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def invalidate_knowledge_index(store_id=None):
+    """Drops the cached index of one store (after its knowledge_base changed), or of all stores."""
+    with _lock:
+        if store_id is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(str(store_id), None)
+
+
+def find_faq_answer(store_id, question):
+    """
+    (topic, detail) of the knowledge row that answers the question with the same confidence the retriever
+    needs to skip vector search (exact topic match or KB_LEXICAL_MIN_COVERAGE), else None. Never calls a model.
+    """
+    index = get_knowledge_index(store_id)
+    exact = index.exact_matches(question)
+    if exact:
+        document = index.documents[exact[0]]
+    else:
+        hits = index.search(question, 1)
+        if not hits or hits[0][2] < KB_LEXICAL_MIN_COVERAGE:
+            return None
+        document = index.documents[hits[0][0]]
+    return document.metadata["topic"], document.page_content.partition("\nรายละเอียด: ")[2]
+
+
+def reciprocal_rank_fusion(*rankings, k=RRF_K):
+    """Fuses ranked Document lists; documents are identified by page_content."""
+    scores = {}
+    documents = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking):
+            key = document.page_content
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+            documents.setdefault(key, document)
+    return [documents[key] for key in sorted(scores, key=lambda key: -scores[key])]
+
+
+class HybridKnowledgeRetriever(BaseRetriever):
+    """Answers from the lexical index when it is confident and falls back to vector search fused with RRF."""
+
+    store_id: str
+    k: int = 3
+    vector_factory: Optional[Callable[[], Any]] = None
+    """Builds the vector retriever (Chroma) on first use, so lexical hits never load embeddings."""
+
+    _vector: Any = PrivateAttr(default=None)
+    _vector_loaded: bool = PrivateAttr(default=False)
+    _vector_lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    def _vector_retriever(self):
+        if not self._vector_loaded:
+            with self._vector_lock:
+                if not self._vector_loaded:
+                    self._vector = self.vector_factory() if self.vector_factory else None
+                    self._vector_loaded = True
+        return self._vector
+
+    def _lexical(self, index, query):
+        """Returns (path, documents) when the index can answer alone, else (None, lexical ranking)."""
+        exact = index.exact_matches(query)
+        if exact:
+            return "exact", [index.documents[i] for i in exact[:self.k]]
+        hits = index.search(query, self.k)
+        ranking = [index.documents[i] for i, _, _ in hits]
+        if hits and hits[0][2] >= KB_LEXICAL_MIN_COVERAGE:
+            top_score = hits[0][1]
+            return "lexical", [index.documents[i] for i, score, _ in hits if score >= top_score / 2]
+        return None, ranking
+
+    def _finish(self, path, documents, started):
+        metrics.increment("kb_search", store=self.store_id, path=path)
+        metrics.observe("kb_search_seconds", time.perf_counter() - started, path=path)
+        return documents
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        started = time.perf_counter()
+        path, documents = self._lexical(get_knowledge_index(self.store_id), query)
+        if path:
+            return self._finish(path, documents, started)
+        vector = self._vector_retriever()
+        if vector is None:
+            return self._finish("lexical_only", documents, started)
+        try:
+            vector_documents = vector.invoke(query)
+        except Exception as e:
+            print(f"Vector search failed for store {self.store_id}, using lexical results: {e}")
+            return self._finish("lexical_only", documents, started)
+        return self._finish("hybrid", reciprocal_rank_fusion(documents, vector_documents)[:self.k], started)
+
+    async def _aget_relevant_documents(self, query, *, run_manager=None):
+        started = time.perf_counter()
+        # Index ที่อยู่ใน Memory ค้นได้บน Event Loop โดยตรง โหลดจาก SQLite ใน Thread เฉพาะตอนยังไม่มี
+        index = peek_knowledge_index(self.store_id) or await asyncio.to_thread(get_knowledge_index, self.store_id)
+        path, documents = self._lexical(index, query)
+        if path:
+            return self._finish(path, documents, started)
+        vector = await asyncio.to_thread(self._vector_retriever)
+        if vector is None:
+            return self._finish("lexical_only", documents, started)
+        try:
+            vector_documents = await vector.ainvoke(query)
+        except Exception as e:
+            print(f"Vector search failed for store {self.store_id}, using lexical results: {e}")
+            return self._finish("lexical_only", documents, started)
+        return self._finish("hybrid", reciprocal_rank_fusion(documents, vector_documents)[:self.k], started)
+
+
+def kb_search_stats():
+    series = metrics.get_counter_series("kb_search")
+    total = sum(series.values())
+    local = sum(value for labels, value in series.items() if "path=hybrid" not in labels)
+    return {"searches": total, "local_hit_rate": round(local / total, 3) if total else 0.0}
+
+
+metrics.register_collector("kb_search", kb_search_stats)
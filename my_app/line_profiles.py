@@ -0,0 +1,185 @@
+# line_profiles.py
+
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import metrics
+from database import execute_write_many, get_connection, get_credentials
+
+# =========================================================================
+# 🟢 Cache ของ Profile ลูกค้า LINE (ตาราง line_profiles)
+# เดิม Admin Console เรียก LINE Profile API หนึ่งครั้งต่อการ์ด (ทีละ Request) และ Dashboard ไม่มีชื่อลูกค้าเลย
+# - อ่าน Profile ของหลาย line_id ด้วย Query เดียว Profile ที่หมดอายุ (LINE_PROFILE_TTL) ยังคืนค่าเดิมไปก่อน
+#   แล้วถูกส่งให้ Resolver ดึงใหม่ใน Background (Stale-while-revalidate)
+# - Resolver ดึง Profile ที่ขาดพร้อมกันไม่เกิน LINE_PROFILE_CONCURRENCY Request และไม่ดึง line_id ซ้ำที่กำลังดึงอยู่
+#   Inbox 200 แชทจึงใช้เวลาประมาณ 200 / LINE_PROFILE_CONCURRENCY Request แทน 200 Request ต่อกัน
+# =========================================================================
+
+LINE_PROFILE_TTL = float(os.getenv("LINE_PROFILE_TTL", "86400"))
+# Profile ที่ดึงไม่สำเร็จ (เช่นลูกค้า Block บัญชี) จะลองใหม่เร็วกว่า
+LINE_PROFILE_ERROR_TTL = float(os.getenv("LINE_PROFILE_ERROR_TTL", "600"))
+LINE_PROFILE_CONCURRENCY = int(os.getenv("LINE_PROFILE_CONCURRENCY", "8"))
+LINE_PROFILE_BATCH_LIMIT = int(os.getenv("LINE_PROFILE_BATCH_LIMIT", "500"))
+
+_SQL_VARIABLES_PER_QUERY = 500
+
+
+def fetch_cached_profiles(user_id, line_ids):
+    """Returns {line_id: row dict} of the cached profiles (fresh or expired) of one store."""
+    profiles = {}
+    line_ids = list(dict.fromkeys(line_ids))
+    conn = get_connection()
+    conn.row_factory = sqlite3.Row
+    try:
+        for start in range(0, len(line_ids), _SQL_VARIABLES_PER_QUERY):
+            chunk = line_ids[start:start + _SQL_VARIABLES_PER_QUERY]
+            placeholders = ", ".join("?" for _ in chunk)
+            rows = conn.execute(f"""
+                SELECT line_id, display_name, picture_url, status, expires_at
+                FROM line_profiles WHERE user_id = ? AND line_id IN ({placeholders})
+            """, (str(user_id), *chunk)).fetchall()
+            profiles.update((row["line_id"], dict(row)) for row in rows)
+    except sqlite3.Error as e:
+        print(f"Database error reading LINE profiles: {e}")
+    finally:
+        conn.close()
+    return profiles
+
+
+def save_profiles(user_id, results):
+    """Upserts [(line_id, display_name, picture_url, status, ttl)] in one transaction."""
+    now = time.time()
+    rows = [(str(user_id), line_id, name, picture, status, now, now + ttl) for line_id, name, picture, status, ttl in results]
+    execute_write_many([("""
+        INSERT INTO line_profiles (user_id, line_id, display_name, picture_url, status, fetched_at, expires_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, line_id) DO UPDATE SET
+            display_name = CASE WHEN excluded.status = 'ok' THEN excluded.display_name ELSE line_profiles.display_name END,
+            picture_url = CASE WHEN excluded.status = 'ok' THEN excluded.picture_url ELSE line_profiles.picture_url END,
+            status = CASE WHEN excluded.status = 'ok' OR line_profiles.status <> 'ok' THEN excluded.status ELSE line_profiles.status END,
+            fetched_at = excluded.fetched_at, expires_at = excluded.expires_at
+    """, rows)])
+
+
+class ProfileResolver:
+    """Fetches missing or expired profiles from the LINE API in the background with bounded parallelism."""
+
+    def __init__(self, concurrency=LINE_PROFILE_CONCURRENCY):
+        self.concurrency = concurrency
+        self._pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="line-profile")
+        self._lock = threading.Lock()
+        # (user_id, line_id) -> Future ของ Request ที่กำลังดึงอยู่
+        self._in_flight = {}
+        self._apis = {}
+
+    def _api(self, user_id):
+        from linebot import LineBotApi
+        with self._lock:
+            if user_id in self._apis:
+                return self._apis[user_id]
+        credentials_data = get_credentials(user_id)
+        api = LineBotApi(credentials_data['channel_access_token']) if credentials_data else None
+        with self._lock:
+            self._apis[user_id] = api
+        return api
+
+    def _fetch(self, user_id, line_id):
+        api = self._api(user_id)
+        started = time.perf_counter()
+        try:
+            if api is None:
+                raise LookupError(f"no channel credentials for store {user_id}")
+            profile = api.get_profile(line_id)
+            metrics.observe("line_profile_fetch_seconds", time.perf_counter() - started)
+            return (line_id, profile.display_name, profile.picture_url, "ok", LINE_PROFILE_TTL)
+        except Exception as e:
+            metrics.increment("line_profile_fetch_errors")
+            print(f"Error fetching user profile for {line_id}: {e}")
+            return (line_id, None, None, "error", LINE_PROFILE_ERROR_TTL)
+
+    def _fetch_and_save(self, user_id, line_id):
+        try:
+            result = self._fetch(user_id, line_id)
+            save_profiles(user_id, [result])
+            return result
+        finally:
+            with self._lock:
+                self._in_flight.pop((user_id, line_id), None)
+
+    def submit(self, user_id, line_ids):
+        """Queues fetches of the given profiles (already queued ones are reused). Returns their futures."""
+        user_id = str(user_id)
+        futures = []
+        with self._lock:
+            for line_id in dict.fromkeys(line_ids):
+                key = (user_id, line_id)
+                future = self._in_flight.get(key)
+                if future is None:
+                    future = self._pool.submit(self._fetch_and_save, user_id, line_id)
+                    self._in_flight[key] = future
+                    metrics.increment("line_profile_fetches")
+                futures.append(future)
+        return futures
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._in_flight)
+
+    def forget_store(self, user_id):
+        """Drops the cached LINE client of a store (e.g. after its channel token changed)."""
+        with self._lock:
+            self._apis.pop(str(user_id), None)
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def get_profile_resolver():
+    global _resolver
+    with _resolver_lock:
+        if _resolver is None:
+            _resolver = ProfileResolver()
+            metrics.register_collector("line_profiles", lambda: {"pending_fetches": _resolver.pending_count()})
+        return _resolver
+
+
+def get_profiles(user_id, line_ids, wait_seconds=0.0):
+    """
+    Returns {line_id: {"display_name", "picture_url", "pending"}} for a batch of one store's customers.
+    Missing or expired profiles are resolved in the background; with wait_seconds > 0 the call waits
+    that long for the missing ones. A profile still being fetched has pending=True (display_name may be None).
+    """
+    user_id = str(user_id)
+    line_ids = [line_id for line_id in dict.fromkeys(line_ids) if line_id][:LINE_PROFILE_BATCH_LIMIT]
+    cached = fetch_cached_profiles(user_id, line_ids)
+    now = time.time()
+    missing = [line_id for line_id in line_ids if line_id not in cached]
+    expired = [line_id for line_id in line_ids if line_id in cached and cached[line_id]["expires_at"] <= now]
+    metrics.increment("line_profile_cache_hits", len(line_ids) - len(missing) - len(expired))
+    metrics.increment("line_profile_cache_misses", len(missing) + len(expired))
+
+    pending = set()
+    if missing or expired:
+        futures = get_profile_resolver().submit(user_id, missing + expired)
+        # รอเฉพาะ Profile ที่ไม่เคยมีเลย Profile ที่หมดอายุใช้ค่าเดิมไปก่อน
+        if wait_seconds > 0 and missing:
+            wait(futures[:len(missing)], timeout=wait_seconds)
+            for future in futures[:len(missing)]:
+                if future.done() and not future.exception():
+                    line_id, name, picture, status, _ = future.result()
+                    cached[line_id] = {"display_name": name, "picture_url": picture, "status": status}
+        pending = {line_id for line_id in missing if line_id not in cached}
+
+    profiles = {}
+    for line_id in line_ids:
+        row = cached.get(line_id)
+        profiles[line_id] = {
+            "display_name": row["display_name"] if row else None,
+            "picture_url": row["picture_url"] if row else None,
+            "pending": line_id in pending,
+        }
+    return profiles
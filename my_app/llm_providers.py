@@ -0,0 +1,498 @@
+# llm_providers.py
+
+import asyncio
+import os
+import re
+import threading
+import time
+import weakref
+import zlib
+from typing import Any, List
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+import metrics
+
+# =========================================================================
+# 🟢 Registry ของผู้ให้บริการ LLM (Gemini / Ollama / Fake)
+# เดิมทุกไฟล์ agent_setup*.py สร้าง ChatGoogleGenerativeAI ใหม่ทุก Task และตรวจ GOOGLE_API_KEY เอง
+# - Model Spec: "gemini-2.5-flash" (หรือ "gemini:<model>"), "ollama:<model>", "fake:<name>"
+# - Client ถูก Pool ต่อ (Spec, temperature): Sync ใช้ร่วมกันทั้ง Process ส่วน Async แยกต่อ Event Loop
+#   (Async Client ของ Gemini/Ollama ผูกกับ Loop ที่สร้าง) Connection/gRPC Channel จึงถูกใช้ซ้ำข้าม Task
+# - Timeout ต่อผู้ให้บริการ (GEMINI_TIMEOUT_SECONDS, OLLAMA_TIMEOUT_SECONDS)
+# - Circuit Breaker ต่อผู้ให้บริการ: Outage ติดกัน LLM_PROVIDER_FAILURE_THRESHOLD ครั้ง -> ไม่เรียกผู้ให้บริการนั้น
+#   LLM_PROVIDER_RETRY_SECONDS วินาที แล้วให้การเรียกจริงหนึ่งครั้งเป็น Probe (half-open) เพื่อเปิดบริการคืนเอง
+# - get_chat_model() คืน ProviderChatModel ซึ่งเลือกผู้ให้บริการทุกครั้งที่ถูกเรียก: ลอง Spec หลักก่อน แล้วตาม
+#   LLM_FAILOVER_MODELS (ข้ามผู้ให้บริการที่ Circuit เปิดอยู่) Agent ที่สร้างแล้วจึงย้ายผู้ให้บริการได้โดยไม่ต้องสร้างใหม่
+# - fake = Model จำลองแบบ Deterministic สำหรับ Load Test (ไม่เรียก Network) "fake:error" ล้มทุกครั้ง
+# =========================================================================
+
+GEMINI = "gemini"
+OLLAMA = "ollama"
+FAKE = "fake"
+
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+GEMINI_TIMEOUT_SECONDS = float(os.getenv("GEMINI_TIMEOUT_SECONDS", str(LLM_TIMEOUT_SECONDS)))
+OLLAMA_TIMEOUT_SECONDS = float(os.getenv("OLLAMA_TIMEOUT_SECONDS", str(LLM_TIMEOUT_SECONDS)))
+# Retry ภายใน Client ของ Gemini (ค่าเริ่มต้นของ Library คือ 6) ai_processor มี Retry ของตัวเองอยู่แล้ว
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "2"))
+# ค่าว่าง = OLLAMA_HOST หรือค่าเริ่มต้นของ Ollama (http://localhost:11434)
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL") or os.getenv("OLLAMA_HOST")
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "10m")
+# Latency จำลองของ fake (วินาทีต่อการเรียก)
+FAKE_LLM_LATENCY_SECONDS = float(os.getenv("FAKE_LLM_LATENCY_SECONDS", "0"))
+# Spec สำรองเมื่อผู้ให้บริการของ Spec หลักล้ม เช่น "ollama:llama3.1" (คั่นด้วย ,)
+LLM_FAILOVER_MODELS = [spec.strip() for spec in os.getenv("LLM_FAILOVER_MODELS", "").split(",") if spec.strip()]
+LLM_PROVIDER_FAILURE_THRESHOLD = int(os.getenv("LLM_PROVIDER_FAILURE_THRESHOLD", "3"))
+# วินาทีที่ Circuit เปิดก่อน Probe ครั้งแรก (เพิ่มเป็นสองเท่าทุกครั้งที่ Probe ล้ม ไม่เกิน LLM_PROVIDER_MAX_OPEN_SECONDS)
+LLM_PROVIDER_RETRY_SECONDS = float(os.getenv("LLM_PROVIDER_RETRY_SECONDS", "30"))
+LLM_PROVIDER_MAX_OPEN_SECONDS = float(os.getenv("LLM_PROVIDER_MAX_OPEN_SECONDS", "300"))
+
+
+def parse_model_spec(model_spec):
+    """'ollama:llama3.1' -> ('ollama', 'llama3.1'); a spec without a known provider prefix is a Gemini model."""
+    provider, sep, model = model_spec.partition(":")
+    if sep and provider in _providers:
+        return provider, model
+    return GEMINI, model_spec
+
+
+def is_known_spec(model_spec):
+    if not isinstance(model_spec, str) or not model_spec:
+        return False
+    provider, model = parse_model_spec(model_spec)
+    return bool(model) and (provider != GEMINI or model.startswith("gemini-"))
+
+
+# -------------------------------------------------------------------------
+# ผู้ให้บริการ
+# -------------------------------------------------------------------------
+class FakeChatModel(BaseChatModel):
+    """Deterministic chat model for load tests: answers from the last message, never calls a tool."""
+
+    name_suffix: str = "default"
+    latency_seconds: float = 0.0
+
+    @property
+    def _llm_type(self):
+        return "fake"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _result(self, messages):
+        if self.name_suffix == "error":
+            raise RuntimeError("fake:error provider always fails")
+        text = str(messages[-1].content) if messages else ""
+        content = f"[fake:{self.name_suffix}] ได้รับข้อความแล้วค่ะ (#{zlib.crc32(text.encode('utf-8')) % 10000:04d})"
+        prompt_tokens = sum(len(str(message.content)) for message in messages) // 4
+        output_tokens = len(content) // 4
+        message = AIMessage(content=content, usage_metadata={
+            "input_tokens": prompt_tokens, "output_tokens": output_tokens, "total_tokens": prompt_tokens + output_tokens,
+        })
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        return self._result(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.latency_seconds:
+            await asyncio.sleep(self.latency_seconds)
+        return self._result(messages)
+
+
+class GeminiProvider:
+    name = GEMINI
+    timeout = GEMINI_TIMEOUT_SECONDS
+
+    def unavailable_reason(self):
+        return None if os.getenv("GOOGLE_API_KEY") else "GOOGLE_API_KEY is not set"
+
+    def create(self, model, temperature):
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        return ChatGoogleGenerativeAI(
+            model=model, temperature=temperature, google_api_key=os.getenv("GOOGLE_API_KEY"),
+            timeout=self.timeout, max_retries=GEMINI_MAX_RETRIES,
+        )
+
+
+class OllamaProvider:
+    name = OLLAMA
+    timeout = OLLAMA_TIMEOUT_SECONDS
+
+    def unavailable_reason(self):
+        return None
+
+    def create(self, model, temperature):
+        from langchain_ollama import ChatOllama
+        return ChatOllama(
+            model=model, temperature=temperature, base_url=OLLAMA_BASE_URL, keep_alive=OLLAMA_KEEP_ALIVE,
+            client_kwargs={"timeout": self.timeout},
+        )
+
+
+class FakeProvider:
+    name = FAKE
+    timeout = None
+
+    def unavailable_reason(self):
+        return None
+
+    def create(self, model, temperature):
+        return FakeChatModel(name_suffix=model or "default", latency_seconds=FAKE_LLM_LATENCY_SECONDS)
+
+
+_providers = {provider.name: provider for provider in (GeminiProvider(), OllamaProvider(), FakeProvider())}
+
+
+def register_provider(provider):
+    """Adds or replaces a provider (an object with name, timeout, unavailable_reason() and create(model, temperature))."""
+    _providers[provider.name] = provider
+
+
+# -------------------------------------------------------------------------
+# Circuit Breaker ต่อผู้ให้บริการ
+#   closed    -> เรียกได้ตามปกติ ล้มแบบ Outage (429/5xx/Timeout/เชื่อมต่อไม่ได้) ติดกันครบ Threshold -> open
+#   open      -> ไม่เรียกเลย (ProviderChatModel ข้ามไปผู้ให้บริการสำรอง) จนครบ open_seconds -> half_open
+#   half_open -> ให้การเรียกจริงหนึ่งครั้งเป็น Probe: สำเร็จ -> closed, ล้ม -> open อีกครั้งโดยเวลารอเพิ่มเป็นสองเท่า
+# Error อื่น (เช่น 400 Prompt ไม่ถูกต้อง) แปลว่าผู้ให้บริการยังตอบได้ จึงไม่นับเป็น Outage
+# -------------------------------------------------------------------------
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+_STATE_GAUGE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+_OUTAGE_STATUS_CODES = {429, 500, 502, 503, 504}
+_OUTAGE_GRPC_CODES = {"RESOURCE_EXHAUSTED", "UNAVAILABLE", "DEADLINE_EXCEEDED", "INTERNAL"}
+_OUTAGE_ERROR_NAMES = ("Timeout", "Connect", "Unavailable", "ResourceExhausted", "DeadlineExceeded", "InternalServerError")
+# Fallback เมื่อ Exception ไม่มี Status Code: รับเฉพาะรูปแบบ "HTTP 503" / "status code: 429"
+# หรือข้อความที่ขึ้นต้นด้วย Code แบบ google.api_core ("503 Service Unavailable") ไม่ใช่ตัวเลขใดก็ได้ในข้อความ
+_OUTAGE_STATUS_TEXT = re.compile(r"\b(?:HTTP(?:/[\d.]+)?|status(?: code)?|error code)\W{0,3}(?:429|500|502|503|504)\b", re.IGNORECASE)
+_OUTAGE_STATUS_PREFIX = re.compile(r"^(?:429|500|502|503|504) [A-Z]")
+
+
+class CircuitOpenError(RuntimeError):
+    """No provider of a chat model can take a call right now (every circuit is open or the provider is unavailable)."""
+
+
+def _status_codes(error):
+    """HTTP status codes / gRPC code names carried by an exception's attributes."""
+    response = getattr(error, "response", None)
+    values = [getattr(error, name, None) for name in ("status_code", "code", "status", "grpc_status_code")]
+    values.append(getattr(response, "status_code", None))
+    for value in values:
+        if callable(value):
+            # grpc.RpcError.code() เป็น Method
+            try:
+                value = value()
+            except Exception:
+                continue
+        if isinstance(value, bool) or value is None:
+            continue
+        if isinstance(value, int) or (isinstance(value, str) and value.isdigit()):
+            yield int(value)
+        elif isinstance(value, str):
+            yield value.upper()
+        elif getattr(value, "name", None):
+            # grpc.StatusCode
+            yield value.name
+
+
+def is_outage_error(error):
+    """
+    True for rate limits, server errors, timeouts and connection failures (errors that say the provider is unhealthy),
+    judged from the exception type and status-code attributes along the cause chain. Request errors are not outages
+    even when their message contains such a number (e.g. "max_output_tokens must be <= 500").
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, (TimeoutError, ConnectionError)):
+            return True
+        if any(name in type(error).__name__ for name in _OUTAGE_ERROR_NAMES):
+            return True
+        codes = list(_status_codes(error))
+        if codes:
+            return any(code in _OUTAGE_STATUS_CODES or code in _OUTAGE_GRPC_CODES for code in codes)
+        message = str(error)
+        if _OUTAGE_STATUS_TEXT.search(message) or _OUTAGE_STATUS_PREFIX.match(message):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+class CircuitBreaker:
+    def __init__(self, provider):
+        self.provider = provider
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.open_seconds = LLM_PROVIDER_RETRY_SECONDS
+        self.opened_at = None
+        self.probe_started_at = None
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.last_error = None
+        self.last_failure_at = None
+        self.last_success_at = None
+        self._lock = threading.Lock()
+
+    def _probe_due(self, now):
+        if self.state == OPEN:
+            return now - self.opened_at >= self.open_seconds
+        # Probe ที่ค้าง (เช่น Task ถูกยกเลิกกลางทาง) ไม่กั้นการ Probe ครั้งใหม่ตลอดไป
+        return self.probe_started_at is None or now - self.probe_started_at >= self.open_seconds
+
+    def available(self):
+        """True when a call would be let through now (without claiming the half-open probe)."""
+        with self._lock:
+            return self.state == CLOSED or self._probe_due(time.monotonic())
+
+    def allow(self):
+        """Claims permission for one call. Returns False when the circuit rejects it."""
+        now = time.monotonic()
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if not self._probe_due(now):
+                self.rejected += 1
+                metrics.increment("llm_circuit_rejected", provider=self.provider)
+                return False
+            if self.state == OPEN:
+                self._set_state(HALF_OPEN)
+            self.probe_started_at = now
+            print(f"LLM provider {self.provider}: circuit half-open, probing.")
+            return True
+
+    def record_success(self, seconds):
+        with self._lock:
+            self.calls += 1
+            self.consecutive_failures = 0
+            self.last_success_at = time.time()
+            if self.state != CLOSED:
+                print(f"LLM provider {self.provider}: probe succeeded, circuit closed.")
+                self.open_seconds = LLM_PROVIDER_RETRY_SECONDS
+                self.probe_started_at = None
+                self._set_state(CLOSED)
+        metrics.increment("llm_provider_calls", provider=self.provider, outcome="ok")
+        metrics.observe("llm_provider_latency_seconds", seconds, provider=self.provider)
+
+    def record_failure(self, error):
+        outage = is_outage_error(error)
+        with self._lock:
+            self.calls += 1
+            self.failures += 1
+            self.last_error = f"{type(error).__name__}: {error}"[:300]
+            self.last_failure_at = time.time()
+            if not outage:
+                # ผู้ให้บริการตอบกลับได้ (Error ของคำขอเอง) ถือเป็นผล Probe ที่ดี
+                self.consecutive_failures = 0
+                if self.state != CLOSED:
+                    self.probe_started_at = None
+                    self._set_state(CLOSED)
+            else:
+                self.consecutive_failures += 1
+                if self.state == HALF_OPEN:
+                    self.open_seconds = min(self.open_seconds * 2, LLM_PROVIDER_MAX_OPEN_SECONDS)
+                    self._open()
+                elif self.state == CLOSED and self.consecutive_failures >= LLM_PROVIDER_FAILURE_THRESHOLD:
+                    self._open()
+        metrics.increment("llm_provider_calls", provider=self.provider, outcome="outage" if outage else "error")
+
+    def release(self):
+        """Gives the half-open probe back when a call was cancelled before it finished."""
+        with self._lock:
+            self.probe_started_at = None
+
+    def _open(self):
+        print(f"LLM provider {self.provider}: circuit open for {self.open_seconds:g}s ({self.last_error}).")
+        self.opened_at = time.monotonic()
+        self.probe_started_at = None
+        self._set_state(OPEN)
+
+    def _set_state(self, state):
+        if state != self.state:
+            metrics.increment("llm_circuit_transitions", provider=self.provider, state=state)
+        self.state = state
+        metrics.set_gauge("llm_circuit_state", _STATE_GAUGE[state], provider=self.provider)
+
+    def as_dict(self):
+        with self._lock:
+            retry_in = None
+            if self.state == OPEN:
+                retry_in = round(max(self.open_seconds - (time.monotonic() - self.opened_at), 0.0), 1)
+            return {
+                "state": self.state, "consecutive_failures": self.consecutive_failures, "retry_in_seconds": retry_in,
+                "calls": self.calls, "failures": self.failures, "rejected": self.rejected, "last_error": self.last_error,
+                "last_failure_at": self.last_failure_at, "last_success_at": self.last_success_at,
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(provider):
+    with _breakers_lock:
+        breaker = _breakers.get(provider)
+        if breaker is None:
+            breaker = _breakers[provider] = CircuitBreaker(provider)
+        return breaker
+
+
+def provider_health():
+    """{provider: circuit breaker state and call counts} for /api/metrics."""
+    with _breakers_lock:
+        names = set(_providers) | set(_breakers)
+    return {name: get_circuit_breaker(name).as_dict() for name in sorted(names)}
+
+
+metrics.register_collector("llm_providers", provider_health)
+
+
+def _spec_usable(spec):
+    provider = parse_model_spec(spec)[0]
+    return _providers[provider].unavailable_reason() is None and get_circuit_breaker(provider).available()
+
+
+def llm_available(model_specs):
+    """True when at least one spec (or its failover) has a usable provider whose circuit lets calls through."""
+    return any(_spec_usable(spec) for model_spec in model_specs for spec in failover_chain(model_spec))
+
+
+# -------------------------------------------------------------------------
+# Pool ของ Client
+# -------------------------------------------------------------------------
+_sync_clients = {}
+# Event Loop -> {(spec, temperature): client}
+_async_clients = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+
+def get_client(model_spec, temperature=0, loop=None):
+    """
+    The pooled provider client for a spec (created on first use). With loop, the client belongs to that event loop.
+    Raises RuntimeError when the provider cannot be used (e.g. no API key).
+    """
+    provider_name, model = parse_model_spec(model_spec)
+    provider = _providers[provider_name]
+    reason = provider.unavailable_reason()
+    if reason:
+        raise RuntimeError(f"LLM provider {provider_name} is unavailable: {reason}")
+    key = (model_spec, temperature)
+    with _clients_lock:
+        pool = _sync_clients if loop is None else _async_clients.setdefault(loop, {})
+        client = pool.get(key)
+        if client is None:
+            client = pool[key] = provider.create(model, temperature)
+            metrics.increment("llm_clients_created", provider=provider_name)
+    return client
+
+
+def failover_chain(model_spec):
+    """The spec followed by LLM_FAILOVER_MODELS of other providers."""
+    provider = parse_model_spec(model_spec)[0]
+    chain = [model_spec]
+    for spec in LLM_FAILOVER_MODELS:
+        if spec not in chain and parse_model_spec(spec)[0] != provider and is_known_spec(spec):
+            chain.append(spec)
+    return chain
+
+
+# Callback ของผู้เรียก (เช่น TaskBudget) ผูกกับ ProviderChatModel แล้ว: Client ด้านในต้องไม่รับซ้ำจาก Context
+_INNER_CALL_CONFIG = {"callbacks": []}
+
+
+class ProviderChatModel(BaseChatModel):
+    """
+    Chat model that runs each call on a pooled provider client, trying model_specs in order
+    (skipping providers whose circuit is open) until one answers. Tools bound to it are bound to whichever client runs the call.
+    """
+
+    model_specs: List[str]
+    temperature: float = 0
+    bound_tools: List[Any] = []
+    tool_kwargs: dict = {}
+
+    @property
+    def _llm_type(self):
+        return "provider-pool"
+
+    @property
+    def _identifying_params(self):
+        return {"model_specs": self.model_specs, "temperature": self.temperature}
+
+    def bind_tools(self, tools, **kwargs):
+        return self.model_copy(update={"bound_tools": list(tools), "tool_kwargs": kwargs})
+
+    def _claims(self):
+        """Yields (spec, breaker) for each spec whose provider is configured and whose circuit lets this call through."""
+        for spec in self.model_specs:
+            provider = parse_model_spec(spec)[0]
+            if _providers[provider].unavailable_reason() is None and get_circuit_breaker(provider).allow():
+                yield spec, get_circuit_breaker(provider)
+
+    def _runnable(self, client):
+        return client.bind_tools(self.bound_tools, **self.tool_kwargs) if self.bound_tools else client
+
+    def _answered(self, spec, breaker, message, started):
+        breaker.record_success(time.perf_counter() - started)
+        if spec != self.model_specs[0]:
+            metrics.increment("llm_failovers", provider=breaker.provider)
+        return ChatResult(generations=[ChatGeneration(message=message)], llm_output={"model_spec": spec})
+
+    def _no_answer(self, error):
+        return error or CircuitOpenError(f"No LLM provider can take calls for {self.model_specs} (circuit open or not configured)")
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        error = None
+        for spec, breaker in self._claims():
+            started = time.perf_counter()
+            try:
+                message = self._runnable(get_client(spec, self.temperature)).invoke(messages, _INNER_CALL_CONFIG, stop=stop, **kwargs)
+            except Exception as e:
+                breaker.record_failure(e)
+                print(f"LLM provider {breaker.provider} failed ({e}).")
+                error = e
+                continue
+            except BaseException:
+                breaker.release()
+                raise
+            return self._answered(spec, breaker, message, started)
+        raise self._no_answer(error)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        error = None
+        loop = asyncio.get_running_loop()
+        for spec, breaker in self._claims():
+            started = time.perf_counter()
+            try:
+                message = await self._runnable(get_client(spec, self.temperature, loop)).ainvoke(messages, _INNER_CALL_CONFIG, stop=stop, **kwargs)
+            except Exception as e:
+                breaker.record_failure(e)
+                print(f"LLM provider {breaker.provider} failed ({e}).")
+                error = e
+                continue
+            except BaseException:
+                # เช่น asyncio.CancelledError: คืน Probe ให้การเรียกถัดไป
+                breaker.release()
+                raise
+            return self._answered(spec, breaker, message, started)
+        raise self._no_answer(error)
+
+
+def get_chat_model(model_spec, temperature=0):
+    """
+    Chat model for a spec backed by the pooled clients, with failover to LLM_FAILOVER_MODELS.
+    Returns None (and prints why) when no provider of the chain can be used.
+    """
+    chain = failover_chain(model_spec)
+    if not any(_providers[parse_model_spec(spec)[0]].unavailable_reason() is None for spec in chain):
+        reasons = {spec: _providers[parse_model_spec(spec)[0]].unavailable_reason() for spec in chain}
+        print(f"ERROR: ไม่มีผู้ให้บริการ LLM ที่ใช้ได้สำหรับ {model_spec}: {reasons}. โปรดตั้งค่าในไฟล์ .env.")
+        return None
+    return ProviderChatModel(model_specs=chain, temperature=temperature)
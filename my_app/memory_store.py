@@ -0,0 +1,126 @@
+# memory_store.py
+
+import math
+import os
+
+from database import save_conversation_memory
+from history_cache import get_history_cache
+
+# =========================================================================
+# 🟢 Conversation Memory แบบ "สรุปสะสม + N รอบล่าสุด"
+# แทนการส่งประวัติดิบ 10 คู่ทุกข้อความ เราเก็บ:
+#   - summary: สรุปบทสนทนาเก่า (อัปเดตทีละช่วง และบันทึกในตาราง conversation_memory)
+#   - recent turns: N รอบล่าสุดที่ยังไม่ถูกสรุป
+# จำนวนแถวที่ Query และจำนวน Token ใน Prompt จึงคงที่ ไม่ว่าบทสนทนาจะยาวแค่ไหน
+# =========================================================================
+
+MEMORY_RECENT_TURNS = int(os.getenv("MEMORY_RECENT_TURNS", "4"))
+# สรุปทีละ FOLD_BATCH รอบ เพื่อไม่ต้องเรียก LLM สรุปทุกข้อความ
+MEMORY_FOLD_BATCH = int(os.getenv("MEMORY_FOLD_BATCH", "4"))
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "1200"))
+SUMMARY_TOKEN_BUDGET = int(os.getenv("MEMORY_SUMMARY_TOKEN_BUDGET", "400"))
+
+SUMMARY_PROMPT = """สรุปบทสนทนาระหว่างลูกค้ากับร้านอาหารให้กระชับที่สุด (ไม่เกิน {max_tokens} โทเค็น)
+ต้องเก็บข้อมูลสำคัญไว้เสมอ: ข้อจำกัดด้านวัตถุดิบ/อาหารที่แพ้หรือไม่ทาน, ความชอบ, เมนูหรือออเดอร์ที่กำลังคุยอยู่, คำถามที่ยังไม่ได้ตอบ
+ตอบเป็นข้อความสรุปอย่างเดียว
+
+สรุปเดิม:
+{previous_summary}
+
+บทสนทนาใหม่:
+{transcript}
+"""
+
+
+def estimate_tokens(text):
+    """Rough token estimate (about 3 characters per token for mixed Thai/English text)."""
+    if not text:
+        return 0
+    return math.ceil(len(text) / 3)
+
+
+def truncate_to_tokens(text, max_tokens, keep="tail"):
+    """Cuts text to roughly max_tokens, keeping the newest part ('tail') or the beginning ('head')."""
+    max_chars = max_tokens * 3
+    if len(text) <= max_chars:
+        return text
+    return text[-max_chars:] if keep == "tail" else text[:max_chars]
+
+
+def format_transcript(turns):
+    lines = []
+    for turn in turns:
+        if turn.get("user_message"):
+            lines.append(f"ลูกค้า: {turn['user_message']}")
+        if turn.get("ai_response"):
+            lines.append(f"ร้าน: {turn['ai_response']}")
+        if turn.get("admin_response"):
+            lines.append(f"แอดมิน: {turn['admin_response']}")
+    return "\n".join(lines)
+
+
+def extractive_summarizer(previous_summary, turns):
+    """Fallback summarizer without an LLM: keeps the customer's own words, newest last."""
+    customer_lines = [f"- ลูกค้า: {turn['user_message'][:200]}" for turn in turns if turn.get("user_message")]
+    combined = "\n".join(part for part in [previous_summary] + customer_lines if part)
+    return truncate_to_tokens(combined, SUMMARY_TOKEN_BUDGET)
+
+
+def make_llm_summarizer(llm):
+    """Builds a summarizer that folds new turns into the previous summary with one LLM call."""
+    def _summarize(previous_summary, turns):
+        prompt = SUMMARY_PROMPT.format(
+            max_tokens=SUMMARY_TOKEN_BUDGET,
+            previous_summary=previous_summary or "(ไม่มี)",
+            transcript=format_transcript(turns),
+        )
+        try:
+            result = llm.invoke(prompt)
+            summary = result.content if hasattr(result, "content") else str(result)
+            return truncate_to_tokens(summary.strip(), SUMMARY_TOKEN_BUDGET)
+        except Exception as e:
+            print(f"WARNING: LLM summarization failed, using extractive summary: {e}")
+            return extractive_summarizer(previous_summary, turns)
+    return _summarize
+
+
+def load_conversation_memory(user_id, line_id, summarizer=None):
+    """
+    Returns {'summary': str, 'turns': [...]} for the conversation.
+    When more than MEMORY_RECENT_TURNS + MEMORY_FOLD_BATCH turns are unsummarized, the oldest
+    ones are folded into the summary and the new state is persisted.
+    """
+    summarizer = summarizer or extractive_summarizer
+    cache = get_history_cache()
+    state = cache.get_memory_state(user_id, line_id)
+    summary = state["summary"]
+    summarized_until = state["summarized_until_task_id"]
+
+    # ดึงเฉพาะรอบที่ยังไม่ถูกสรุป และไม่เกินขนาดหน้าต่าง (+1 เพื่อรู้ว่าถึงเวลาสรุปหรือยัง)
+    # บทสนทนาเก่าที่ยาวกว่าหน้าต่างตั้งแต่ก่อนมี Memory Store จะถูกสรุปเฉพาะส่วนล่าสุดนี้
+    window = MEMORY_RECENT_TURNS + MEMORY_FOLD_BATCH
+    turns = cache.get_turns(user_id, line_id, summarized_until, window + 1)
+
+    if len(turns) > window:
+        to_fold, turns = turns[:-MEMORY_RECENT_TURNS], turns[-MEMORY_RECENT_TURNS:]
+        summary = summarizer(summary, to_fold)
+        summarized_until = to_fold[-1]["task_id"]
+        save_conversation_memory(user_id, line_id, summary, summarized_until)
+        cache.set_memory_state(user_id, line_id, summary, summarized_until)
+        print(f"Memory for {line_id}: folded {len(to_fold)} turns into summary (until task {summarized_until}).")
+
+    return {"summary": summary, "turns": turns}
+
+
+def fit_to_token_budget(summary, turns, token_budget=MEMORY_TOKEN_BUDGET):
+    """Drops the oldest recent turns (never the summary) until everything fits in token_budget."""
+    summary = truncate_to_tokens(summary, SUMMARY_TOKEN_BUDGET)
+    used = estimate_tokens(summary)
+    kept = []
+    for turn in reversed(turns):
+        cost = sum(estimate_tokens(turn.get(field) or "") for field in ("user_message", "ai_response", "admin_response"))
+        if used + cost > token_budget:
+            break
+        kept.append(turn)
+        used += cost
+    return summary, list(reversed(kept))
@@ -0,0 +1,95 @@
+# metrics.py
+
+import threading
+
+# =========================================================================
+# 🟢 In-process Metrics (แสดงผลที่ /api/metrics)
+# Counter/Gauge/Histogram แบบง่าย ๆ แยกตาม Label เช่น increment("dedup_events", store="user1")
+# =========================================================================
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+_collectors = {}
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def increment(name, amount=1, **labels):
+    """Adds amount to a counter."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    """Sets a gauge to its current value."""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    """Records one sample (count, sum, min, max) for a histogram-like metric such as a latency."""
+    key = _key(name, labels)
+    with _lock:
+        stats = _histograms.get(key)
+        if stats is None:
+            _histograms[key] = {"count": 1, "sum": value, "min": value, "max": value}
+        else:
+            stats["count"] += 1
+            stats["sum"] += value
+            stats["min"] = min(stats["min"], value)
+            stats["max"] = max(stats["max"], value)
+
+
+def get_counter(name, **labels):
+    with _lock:
+        return _counters.get(_key(name, labels), 0)
+
+
+def get_counter_series(name):
+    """Returns {label_text: value} for every label combination of a counter."""
+    with _lock:
+        series = {key: value for key, value in _counters.items() if key[0] == name}
+    return _render(series).get(name, {})
+
+
+def register_collector(name, collector):
+    """Registers a callable whose return value is included in snapshot() under name."""
+    with _lock:
+        _collectors[name] = collector
+
+
+def _render(series):
+    rendered = {}
+    for (name, labels), value in series.items():
+        label_text = ",".join(f"{k}={v}" for k, v in labels)
+        rendered.setdefault(name, {})[label_text or "_total"] = value
+    return rendered
+
+
+def snapshot():
+    """Returns every metric as a JSON-serialisable dict."""
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        histograms = {key: dict(stats) for key, stats in _histograms.items()}
+        collectors = dict(_collectors)
+
+    for stats in histograms.values():
+        stats["avg"] = stats["sum"] / stats["count"]
+
+    result = {
+        "counters": _render(counters),
+        "gauges": _render(gauges),
+        "histograms": _render(histograms),
+    }
+    for name, collector in collectors.items():
+        try:
+            result[name] = collector()
+        except Exception as e:
+            result[name] = {"error": str(e)}
+    return result
@@ -0,0 +1,329 @@
+# model_router.py
+
+import asyncio
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+import metrics
+from database import execute_write, get_connection
+from llm_providers import OLLAMA, FAKE, is_known_spec, parse_model_spec
+from task_budget import BudgetExceeded
+
+# =========================================================================
+# 🟢 Model Routing ต่อร้าน: ใช้ Model ถูก/เร็วก่อน และส่งต่อ Model ที่เก่งกว่าเมื่อจำเป็น
+# เดิมทุกข้อความใช้ AGENT_MODEL_CHOICE ตัวเดียว แม้เป็นแค่คำทักทาย
+# - classify_message(): Classifier แบบ Keyword/Regex ใน Process (ไม่เรียก LLM) แบ่งเป็น
+#   greeting (ทักทาย/ขอบคุณ/Emoji), faq (ข้อมูลร้าน), menu (เมนู/ราคา/โปร), complex (สั่ง/จอง/หลายคำถาม/ข้อจำกัดอาหาร/ไม่รู้จัก)
+# - แต่ละ Route ใช้ Tier (template / fast / standard / local) หรือชื่อ Model ตรง ๆ ร้านตั้งค่าเองได้ (ตาราง store_model_routes)
+#   template = ตอบด้วยข้อความ Early Exit ของ Prompt ทันทีโดยไม่เรียก LLM
+#   local = Ollama ในเครื่อง (MODEL_TIER_LOCAL เช่น "ollama:llama3.1")
+# - Tier ที่ถูกกว่า standard จะถูกส่งต่อ (Escalate) ไป MODEL_ESCALATION_TIER เมื่อ Agent หยุดเพราะวนเกินรอบ
+#   หรือได้คำตอบว่าง (ใช้ TaskBudget เดียวกัน จึงไม่เกิน Budget ของ Task)
+# - Metrics ต่อ Route/Model: route_requests, route_latency_seconds, route_cost_usd, route_escalations
+# =========================================================================
+
+GREETING = "greeting"
+FAQ = "faq"
+MENU = "menu"
+COMPLEX = "complex"
+ROUTES = (GREETING, FAQ, MENU, COMPLEX)
+
+TEMPLATE_MODEL = "template"
+
+MODEL_ROUTING_ENABLED = os.getenv("MODEL_ROUTING_ENABLED", "1") == "1"
+MODEL_TIERS = {
+    "template": TEMPLATE_MODEL,
+    "fast": os.getenv("MODEL_TIER_FAST", "gemini-2.5-flash-lite"),
+    "standard": os.getenv("MODEL_TIER_STANDARD", "gemini-2.5-flash"),
+    "local": os.getenv("MODEL_TIER_LOCAL", "ollama:llama3.1"),
+}
+DEFAULT_ROUTE_TIERS = {GREETING: "template", FAQ: "fast", MENU: "fast", COMPLEX: "standard"}
+MODEL_ESCALATION_TIER = os.getenv("MODEL_ESCALATION_TIER", "standard")
+# ข้อความยาวกว่านี้ถือว่าซับซ้อน (มักมีหลายคำถามหรือรายละเอียดออเดอร์)
+ROUTER_COMPLEX_MIN_CHARS = int(os.getenv("ROUTER_COMPLEX_MIN_CHARS", "160"))
+MODEL_ROUTES_CACHE_SECONDS = float(os.getenv("MODEL_ROUTES_CACHE_SECONDS", "30"))
+
+# USD ต่อ 1M Token (Input, Output) สำหรับประมาณต้นทุน เพิ่ม/แก้ได้ด้วย MODEL_PRICES='{"model": [in, out]}'
+MODEL_PRICES_PER_MTOK = {
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+    "gemini-2.5-pro": (1.25, 10.00),
+}
+MODEL_PRICES_PER_MTOK.update({model: tuple(prices) for model, prices in json.loads(os.getenv("MODEL_PRICES", "{}")).items()})
+
+# ข้อความ Early Exit: Prompt ของ Agent (agent_setup_create_tool_calling.py) ใช้ข้อความนี้เป็นตัวอย่างคำตอบด้วย
+GREETING_TEMPLATE = """ยินดีต้อนรับค่ะ! คุณสามารถสอบถามเกี่ยวกับ:
+- เมนูอาหาร: มีเมนูอะไรบ้าง, ราคาเท่าไหร่, แนะนำเมนู (พร้อมแจ้งข้อจำกัด)
+- โปรโมชั่น: มีโปรโมชั่นอะไรบ้าง
+- ข้อมูลร้าน: ที่อยู่, เบอร์โทรศัพท์, เวลาทำการ, หรือนโยบายต่างๆ ของร้าน
+พร้อมให้บริการค่ะ!"""
+THANKS_TEMPLATE = "ยินดีค่ะ 😊 หากต้องการสอบถามเมนู โปรโมชั่น หรือข้อมูลร้านเพิ่มเติม พิมพ์มาได้เลยค่ะ"
+
+# ไม่รวมคำตอบรับ (โอเค/ได้เลย/รับทราบ/ok): กลางบทสนทนามักเป็นการยืนยันออเดอร์ ต้องไปถึง Agent พร้อมบริบท
+_GREETING_WORDS = (
+    "สวัสดี", "หวัดดี", "ดีจ้า", "ขอบคุณ", "ขอบใจ",
+    "hello", "hi", "hey", "thank you", "thanks", "thx",
+)
+_THANKS_WORDS = ("ขอบคุณ", "ขอบใจ", "thank", "thx")
+POLITE_PARTICLES = ("ครับ", "ค่ะ", "คะ", "คับ", "ค่า", "จ้า", "จ้ะ", "นะ", "น้า", "ฮะ", "มาก", "มากๆ", "เลย")
+_ORDER_WORDS = ("สั่ง", "จอง", "ออเดอร์", "ยกเลิก", "ชำระ", "โอนเงิน", "จ่ายเงิน", "order", "book", "reserve", "cancel")
+_RESTRICTION_WORDS = ("ไม่ทาน", "ไม่กิน", "ไม่มี", "ไม่เอา", "แพ้", "ไม่ใส่", "ไม่", "allergy", "allergic", "without")
+_MENU_WORDS = (
+    "เมนู", "ราคา", "กี่บาท", "บาท", "อาหาร", "เครื่องดื่ม", "ของหวาน", "โปร", "แนะนำ", "ขายดี", "เผ็ด", "มังสวิรัติ",
+    "menu", "price", "promotion", "promo", "recommend",
+)
+_FAQ_WORDS = (
+    "เปิด", "ปิด", "กี่โมง", "เวลา", "ที่อยู่", "อยู่ที่ไหน", "อยู่ไหน", "แผนที่", "เบอร์", "โทร", "จอดรถ", "ไวไฟ", "wifi",
+    "เดลิเวอรี่", "delivery", "นโยบาย", "บัตรเครดิต", "สาขา", "open", "hours", "address", "phone", "parking",
+)
+# ตัวอักษร/ตัวเลข (ไทยและละติน): ข้อความที่ไม่มีเลยคือ Emoji/สัญลักษณ์ล้วน
+_WORD_CHARS = re.compile(r"[0-9a-z\u0e00-\u0e7f]")
+
+RouteDecision = namedtuple("RouteDecision", ["route", "reason"])
+RoutePlan = namedtuple("RoutePlan", ["route", "reason", "models", "template"])
+
+
+def _strip_words(text, words):
+    for word in sorted(words, key=len, reverse=True):
+        text = text.replace(word, " ")
+    return text
+
+
+def _hits(text, words):
+    return [word for word in words if word in text]
+
+
+def classify_message(message):
+    """Classifies one customer message into a route without calling a model. Returns a RouteDecision."""
+    text = (message or "").strip().lower()
+    if not _WORD_CHARS.search(text):
+        return RouteDecision(GREETING, "emoji/empty")
+    # คำทักทาย/ขอบคุณล้วน (มีคำทักทาย และหลังตัดคำลงท้ายและเครื่องหมายออกแล้วไม่เหลืออะไร)
+    rest = _strip_words(text, _GREETING_WORDS + POLITE_PARTICLES)
+    if len(text) <= 40 and _hits(text, _GREETING_WORDS) and not _WORD_CHARS.search(rest):
+        return RouteDecision(GREETING, "greeting words")
+
+    orders, restrictions = _hits(text, _ORDER_WORDS), _hits(text, _RESTRICTION_WORDS)
+    menu, faq = _hits(text, _MENU_WORDS), _hits(text, _FAQ_WORDS)
+    if orders:
+        return RouteDecision(COMPLEX, f"order: {orders[0]}")
+    if restrictions:
+        # กรองเมนูตามวัตถุดิบต้อง JOIN menu/ingredients
+        return RouteDecision(COMPLEX, f"restriction: {restrictions[0]}")
+    if len(text) > ROUTER_COMPLEX_MIN_CHARS:
+        return RouteDecision(COMPLEX, f"long message ({len(text)} chars)")
+    if text.count("?") + text.count("？") > 1 or (menu and faq):
+        return RouteDecision(COMPLEX, "multiple questions")
+    if menu:
+        return RouteDecision(MENU, f"menu: {menu[0]}")
+    if faq:
+        return RouteDecision(FAQ, f"faq: {faq[0]}")
+    # ไม่รู้จัก (เช่นคำถามต่อเนื่องที่อาศัยบริบท): ใช้ Model มาตรฐานเหมือนเดิม
+    return RouteDecision(COMPLEX, "unrecognized")
+
+
+def resolve_model(tier_or_model):
+    """A tier name ('fast', 'local', ...) or an explicit model spec -> the model spec."""
+    return MODEL_TIERS.get(tier_or_model, tier_or_model)
+
+
+def is_valid_model_spec(value):
+    return isinstance(value, str) and (value in MODEL_TIERS or is_known_spec(value))
+
+
+# -------------------------------------------------------------------------
+# การตั้งค่าต่อร้าน (ตาราง store_model_routes) Cache ใน Process ไม่เกิน MODEL_ROUTES_CACHE_SECONDS
+# -------------------------------------------------------------------------
+_routes_cache = {}
+_routes_lock = threading.Lock()
+
+
+def get_store_routes(user_id):
+    """Returns {route: tier_or_model} overrides of one store."""
+    user_id = str(user_id)
+    with _routes_lock:
+        cached = _routes_cache.get(user_id)
+        if cached and time.monotonic() - cached[0] < MODEL_ROUTES_CACHE_SECONDS:
+            return cached[1]
+    conn = get_connection()
+    try:
+        routes = dict(conn.execute("SELECT route, model FROM store_model_routes WHERE user_id = ?", (user_id,)).fetchall())
+    except sqlite3.Error as e:
+        print(f"Database error reading model routes: {e}")
+        routes = {}
+    finally:
+        conn.close()
+    with _routes_lock:
+        _routes_cache[user_id] = (time.monotonic(), routes)
+    return routes
+
+
+def set_store_route(user_id, route, tier_or_model):
+    """Sets (or with None, resets to the default) the tier/model of one route of a store."""
+    if route not in ROUTES:
+        raise ValueError(f"Unknown route: {route!r}")
+    if tier_or_model is None:
+        execute_write("DELETE FROM store_model_routes WHERE user_id = ? AND route = ?", (str(user_id), route))
+    else:
+        if not is_valid_model_spec(tier_or_model):
+            raise ValueError(f"Unknown tier or model: {tier_or_model!r}")
+        execute_write("""
+            INSERT INTO store_model_routes (user_id, route, model) VALUES (?, ?, ?)
+            ON CONFLICT (user_id, route) DO UPDATE SET model = excluded.model
+        """, (str(user_id), route, tier_or_model))
+    with _routes_lock:
+        _routes_cache.pop(str(user_id), None)
+
+
+def effective_routes(user_id):
+    """{route: {"tier": tier_or_model, "model": model_spec, "custom": bool}} for a store."""
+    overrides = get_store_routes(user_id)
+    return {
+        route: {
+            "tier": overrides.get(route, DEFAULT_ROUTE_TIERS[route]),
+            "model": resolve_model(overrides.get(route, DEFAULT_ROUTE_TIERS[route])),
+            "custom": route in overrides,
+        }
+        for route in ROUTES
+    }
+
+
+def plan_route(user_id, message):
+    """Classifies a message and returns the RoutePlan (models to try in order, or a template answer)."""
+    if not MODEL_ROUTING_ENABLED:
+        return RoutePlan(COMPLEX, "routing disabled", [resolve_model(MODEL_ESCALATION_TIER)], None)
+    decision = classify_message(message)
+    metrics.increment("route_classified", route=decision.route)
+    model = resolve_model(get_store_routes(user_id).get(decision.route, DEFAULT_ROUTE_TIERS[decision.route]))
+    if model == TEMPLATE_MODEL:
+        template = THANKS_TEMPLATE if _hits((message or "").lower(), _THANKS_WORDS) else GREETING_TEMPLATE
+        return RoutePlan(decision.route, decision.reason, [], template)
+    models = [model]
+    escalation = resolve_model(MODEL_ESCALATION_TIER)
+    if escalation not in models:
+        models.append(escalation)
+    return RoutePlan(decision.route, decision.reason, models, None)
+
+
+# -------------------------------------------------------------------------
+# LLM ของแต่ละ Tier
+# -------------------------------------------------------------------------
+def estimate_cost(model_spec, prompt_tokens, output_tokens):
+    """Approximate USD cost of a call (0 for local models and models without a known price)."""
+    prices = MODEL_PRICES_PER_MTOK.get(model_spec)
+    if parse_model_spec(model_spec)[0] in (OLLAMA, FAKE) or prices is None:
+        return 0.0
+    return (prompt_tokens * prices[0] + output_tokens * prices[1]) / 1_000_000
+
+
+def record_route(route, model_spec, seconds, prompt_tokens=0, output_tokens=0, outcome="ok"):
+    metrics.increment("route_requests", route=route, model=model_spec, outcome=outcome)
+    metrics.observe("route_latency_seconds", seconds, route=route, model=model_spec)
+    metrics.observe("route_cost_usd", estimate_cost(model_spec, prompt_tokens, output_tokens), route=route, model=model_spec)
+
+
+# -------------------------------------------------------------------------
+# เรียก Agent ตาม Plan พร้อม Escalation
+# -------------------------------------------------------------------------
+class _Attempt:
+    """Usage of one model attempt, measured as the difference of the shared TaskBudget counters."""
+
+    def __init__(self, plan, model_spec, budget):
+        self.plan = plan
+        self.model_spec = model_spec
+        self.budget = budget
+        self.started = time.perf_counter()
+        self.prompt_tokens = budget.prompt_tokens
+        self.tokens = budget.tokens
+
+    def finish(self, outcome):
+        prompt_tokens = self.budget.prompt_tokens - self.prompt_tokens
+        output_tokens = self.budget.tokens - self.tokens - prompt_tokens
+        record_route(self.plan.route, self.model_spec, time.perf_counter() - self.started, prompt_tokens, output_tokens, outcome)
+
+
+def _route_info(plan, model_spec, escalated_from):
+    return {"route": plan.route, "reason": plan.reason, "model": model_spec, "escalated_from": escalated_from}
+
+
+def _next_step(plan, index, attempt, response, error, escalated_from):
+    """
+    Decides what to do after one model attempt: returns the response to hand back,
+    or None to escalate to the next model of the plan (re-raising errors when none is left).
+    """
+    model_spec = plan.models[index]
+    has_next = index + 1 < len(plan.models)
+    if error is not None:
+        attempt.finish(getattr(error, "reason", "error"))
+        # Model ถูกล่ม/ไม่มี (เช่น Ollama ไม่ได้รัน) หรือหยุดเพราะวนเกินรอบ ส่งต่อได้
+        # ส่วน Budget รวมของ Task หมดแล้วส่งต่อไม่ได้
+        if not has_next or (isinstance(error, BudgetExceeded) and error.reason != "iterations"):
+            raise error
+        print(f"Model {model_spec} failed for route {plan.route}: {error}")
+    elif (response.get("output") or "").strip() or not has_next:
+        attempt.finish("ok" if (response.get("output") or "").strip() else "empty")
+        response["route"] = _route_info(plan, model_spec, escalated_from)
+        return response
+    else:
+        attempt.finish("empty")
+    metrics.increment("route_escalations", route=plan.route, model=model_spec)
+    print(f"Escalating route {plan.route} from {model_spec} to {plan.models[index + 1]}.")
+    escalated_from.append(model_spec)
+    return None
+
+
+def invoke_routed_agent(plan, budget, inputs, agent_factory):
+    """
+    Runs the agent built by agent_factory(model_spec) for each model of the plan until one answers.
+    Returns the executor response (with a "route" entry), or None when no agent could be created.
+    Errors of the last model (and task budget exhaustion) propagate to the caller's retry handling.
+    """
+    escalated_from = []
+    for index, model_spec in enumerate(plan.models):
+        agent_executor = agent_factory(model_spec)
+        if not agent_executor:
+            print(f"Could not create an agent with {model_spec} for route {plan.route}.")
+            escalated_from.append(model_spec)
+            continue
+        attempt = _Attempt(plan, model_spec, budget)
+        response = error = None
+        try:
+            response = budget.invoke(agent_executor, inputs)
+        except Exception as e:
+            error = e
+        result = _next_step(plan, index, attempt, response, error, escalated_from)
+        if result is not None:
+            return result
+    return None
+
+
+async def ainvoke_routed_agent(plan, budget, inputs, agent_factory):
+    """Async variant of invoke_routed_agent (agent_factory is blocking and runs in a thread)."""
+    escalated_from = []
+    for index, model_spec in enumerate(plan.models):
+        agent_executor = await asyncio.to_thread(agent_factory, model_spec)
+        if not agent_executor:
+            print(f"Could not create an agent with {model_spec} for route {plan.route}.")
+            escalated_from.append(model_spec)
+            continue
+        attempt = _Attempt(plan, model_spec, budget)
+        response = error = None
+        try:
+            response = await budget.ainvoke(agent_executor, inputs)
+        except Exception as e:
+            error = e
+        result = _next_step(plan, index, attempt, response, error, escalated_from)
+        if result is not None:
+            return result
+    return None
+
+
+def template_response(plan):
+    """Executor-shaped response for a route answered from a template (no model call)."""
+    record_route(plan.route, TEMPLATE_MODEL, 0.0)
+    return {"output": plan.template, "intermediate_steps": [], "route": _route_info(plan, TEMPLATE_MODEL, [])}
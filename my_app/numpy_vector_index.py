@@ -0,0 +1,159 @@
+# numpy_vector_index.py
+
+import json
+import os
+import threading
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import PrivateAttr
+
+from database import DB_FILE_NAME
+from knowledge_index import documents_fingerprint, get_knowledge_index
+
+# =========================================================================
+# 🟢 Vector Index แบบ NumPy (RAG_BACKEND=numpy)
+# Knowledge Base ของแต่ละร้านมีแค่หลักสิบแถว การเปิด Chroma Persistent Client จึงหนักเกินจำเป็น
+# ที่นี่เก็บ Embedding ของแต่ละร้านเป็นไฟล์ float32 (แถวถูก Normalize แล้ว) ข้าง store_database.db
+# โหลดแบบ memmap เมื่อร้านถูกค้นครั้งแรก และหา Top-k ด้วย Cosine Similarity (Matrix x Vector) ใน NumPy
+# เอกสารที่คืนมี page_content / metadata เหมือนกับที่ Index ใน Chroma
+# =========================================================================
+
+KB_VECTOR_DIRECTORY = os.getenv(
+    "KB_VECTOR_DIRECTORY",
+    os.path.join(os.path.dirname(os.path.abspath(DB_FILE_NAME)), "kb_vectors"),
+)
+
+_lock = threading.Lock()
+_indexes = {}
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class NumpyVectorIndex:
+    """Normalized float32 embedding matrix of one store, memory-mapped from disk."""
+
+    def __init__(self, store_id, documents, matrix, fingerprint):
+        self.store_id = store_id
+        self.documents = documents
+        self.matrix = matrix
+        self.fingerprint = fingerprint
+
+    @staticmethod
+    def paths(store_id):
+        base = os.path.join(KB_VECTOR_DIRECTORY, f"store_{store_id}")
+        return base + ".f32", base + ".json"
+
+    @classmethod
+    def write(cls, store_id, matrix, fingerprint):
+        """Writes a store's embedding matrix (rows in kb_id order) and its manifest atomically."""
+        matrix = normalize_rows(np.asarray(matrix, dtype=np.float32))
+        matrix_path, manifest_path = cls.paths(store_id)
+        os.makedirs(KB_VECTOR_DIRECTORY, exist_ok=True)
+        # เขียนไฟล์ชั่วคราวแล้ว os.replace เพื่อไม่ให้ Process อื่นเห็นไฟล์ที่เขียนไม่ครบ
+        with open(matrix_path + ".tmp", "wb") as matrix_file:
+            matrix_file.write(matrix.tobytes())
+        with open(manifest_path + ".tmp", "w", encoding="utf-8") as manifest_file:
+            json.dump({"rows": matrix.shape[0], "dim": matrix.shape[1], "fingerprint": fingerprint}, manifest_file)
+        os.replace(matrix_path + ".tmp", matrix_path)
+        os.replace(manifest_path + ".tmp", manifest_path)
+        print(f"NumPy vector index written for store {store_id}: {matrix.shape[0]} x {matrix.shape[1]}.")
+
+    @classmethod
+    def load(cls, store_id, documents):
+        """Memory-maps the store's matrix; returns None when missing or built from different documents."""
+        matrix_path, manifest_path = cls.paths(store_id)
+        try:
+            with open(manifest_path, encoding="utf-8") as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            return None
+        fingerprint = documents_fingerprint(documents)
+        if manifest["fingerprint"] != fingerprint or manifest["rows"] != len(documents):
+            return None
+        matrix = np.memmap(matrix_path, dtype=np.float32, mode="r", shape=(manifest["rows"], manifest["dim"]))
+        return cls(store_id, documents, matrix, fingerprint)
+
+    def search(self, query_vector, k):
+        """Returns [(document, score)] of the k most cosine-similar documents."""
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        scores = self.matrix @ query
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.documents[i], float(scores[i])) for i in top]
+
+
+def get_numpy_vector_index(store_id, embeddings):
+    """Returns the store's index, loading it lazily and (re)building it when the knowledge base changed."""
+    store_id = str(store_id)
+    documents = get_knowledge_index(store_id).documents
+    if not documents:
+        return None
+    index = _indexes.get(store_id)
+    # Index ถูกสร้างจาก List เอกสารเดียวกัน (KnowledgeIndex ยังไม่หมดอายุ) จึงไม่ต้องคำนวณ Fingerprint ใหม่
+    if index is not None and (index.documents is documents or index.fingerprint == documents_fingerprint(documents)):
+        if index.documents is not documents:
+            index.documents = documents
+        return index
+    with _lock:
+        index = _indexes.get(store_id)
+        if index is None or index.fingerprint != documents_fingerprint(documents):
+            index = NumpyVectorIndex.load(store_id, documents)
+            if index is None:
+                # ยังไม่มีไฟล์หรือ Knowledge Base เปลี่ยน: Index แบบแบ่ง Batch (ทำต่อจาก Checkpoint ได้)
+                from kb_indexer import index_store
+                index_store(store_id, backend="numpy", embeddings=embeddings)
+                index = NumpyVectorIndex.load(store_id, documents)
+            if index is None:
+                return None
+            _indexes[store_id] = index
+    return index
+
+
+def remove_numpy_store_vectors(store_id):
+    """Deletes a store's matrix files so the next search rebuilds them."""
+    store_id = str(store_id)
+    with _lock:
+        _indexes.pop(store_id, None)
+        for path in NumpyVectorIndex.paths(store_id):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class NumpyStoreRetriever(BaseRetriever):
+    """Retriever over one store's NumPy vector index (same Document contract as the Chroma retriever)."""
+
+    store_id: str
+    k: int = 3
+
+    _embeddings: object = PrivateAttr(default=None)
+
+    def __init__(self, embeddings, **kwargs):
+        super().__init__(**kwargs)
+        self._embeddings = embeddings
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        index = get_numpy_vector_index(self.store_id, self._embeddings)
+        if index is None:
+            return []
+        query_vector = self._embeddings.embed_query(query)
+        return [
+            Document(page_content=document.page_content, metadata=dict(document.metadata))
+            for document, _ in index.search(query_vector, self.k)
+        ]
+
+
+def get_numpy_store_retriever(store_id, k, embeddings):
+    """NumpyStoreRetriever for a store, or None when the store has no knowledge."""
+    if not get_knowledge_index(store_id).documents:
+        return None
+    return NumpyStoreRetriever(embeddings, store_id=str(store_id), k=k)
@@ -0,0 +1,140 @@
+# parallel_tools.py
+
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from langchain.agents import AgentExecutor
+from langchain_core.agents import AgentAction, AgentStep
+from pydantic import Field
+
+import metrics
+
+# =========================================================================
+# 🟢 Parallel Tool Execution ภายใน Agent Turn เดียว
+# Gemini มักขอเรียกหลาย Tool ในคำตอบเดียว (เช่น sql_db_query หาเมนู + knowledge_base_search หาที่จอดรถ)
+# AgentExecutor เดิม (โหมด Sync) รันทีละ Tool ต่อกัน ทำให้เวลารวม = ผลรวมของทุก Tool
+# ParallelToolAgentExecutor รันทุก Tool Call ของ Turn เดียวกันพร้อมกัน และจำกัดเวลาแต่ละ Tool
+# Tool ที่เกินเวลาจะได้ Observation แจ้งว่าหมดเวลา เพื่อให้ LLM ตอบด้วยข้อมูลที่มีอยู่แทนการค้างทั้งข้อความ
+# ข้อจำกัด: Tool แบบ Sync ที่เริ่มรันแล้วหยุดกลางคันไม่ได้ Future ถูก cancel() ได้เฉพาะตอนยังรอคิว
+# Tool ที่หมดเวลาแต่ยังรันอยู่จะครอง Thread ของ Pool จนกว่าจะจบเอง (ดู Gauge tool_timed_out_running)
+# จึงควรตั้ง Timeout ภายในตัว Tool เองด้วย (เช่น Timeout ของ HTTP Client / DB)
+# =========================================================================
+
+TOOL_TIMEOUT_SECONDS = float(os.getenv("TOOL_TIMEOUT_SECONDS", "20"))
+TOOL_EXECUTION_WORKERS = int(os.getenv("TOOL_EXECUTION_WORKERS", "16"))
+
+_tool_pool = ThreadPoolExecutor(max_workers=TOOL_EXECUTION_WORKERS, thread_name_prefix="agent-tool")
+# Tool Call ที่ Agent ประกาศใน Turn ปัจจุบัน แยกตาม Thread และ Executor
+_turn_state = threading.local()
+_timed_out_running = 0
+_timed_out_lock = threading.Lock()
+
+
+def _abandon(future, tool_name):
+    """Cancels a timed-out tool future; one that already started keeps its pool thread until it returns."""
+    global _timed_out_running
+    if future.cancel():
+        return
+    with _timed_out_lock:
+        _timed_out_running += 1
+        metrics.set_gauge("tool_timed_out_running", _timed_out_running)
+    print(f"Tool '{tool_name}' is still running after its timeout and keeps a tool thread until it returns.")
+    future.add_done_callback(_release_abandoned)
+
+
+def _release_abandoned(_future):
+    global _timed_out_running
+    with _timed_out_lock:
+        _timed_out_running -= 1
+        metrics.set_gauge("tool_timed_out_running", _timed_out_running)
+
+
+def _timeout_observation(tool_name, timeout):
+    return f"Tool '{tool_name}' ใช้เวลาเกิน {timeout:g} วินาที จึงถูกยกเลิก ให้ตอบลูกค้าด้วยข้อมูลที่มีอยู่"
+
+
+class ParallelToolAgentExecutor(AgentExecutor):
+    """AgentExecutor that runs all tool calls of one model response concurrently, each with a timeout."""
+
+    tool_timeouts: dict = Field(default_factory=dict)
+    """Per-tool timeout in seconds, keyed by tool name. Tools not listed use default_tool_timeout."""
+    default_tool_timeout: float = TOOL_TIMEOUT_SECONDS
+
+    def timeout_for(self, tool_name):
+        return self.tool_timeouts.get(tool_name, self.default_tool_timeout)
+
+    def _turn(self):
+        turns = getattr(_turn_state, "turns", None)
+        if turns is None:
+            turns = _turn_state.turns = {}
+        return turns.setdefault(id(self), {"actions": [], "results": {}})
+
+    def _iter_next_step(self, name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager=None):
+        # AgentExecutor ส่ง AgentAction ของ Turn นี้ออกมาครบทุกตัวก่อน แล้วจึงเรียก _perform_agent_action ทีละตัว
+        # จึงจดรายการ Action ไว้ เพื่อให้ _perform_agent_action ครั้งแรกรันทั้งหมดพร้อมกัน
+        turn = self._turn()
+        try:
+            for item in super()._iter_next_step(name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager):
+                if isinstance(item, AgentAction):
+                    turn["actions"].append(item)
+                yield item
+        finally:
+            _turn_state.turns.pop(id(self), None)
+
+    def _run_one(self, name_to_tool_map, color_mapping, agent_action, run_manager):
+        started = time.perf_counter()
+        try:
+            return super()._perform_agent_action(name_to_tool_map, color_mapping, agent_action, run_manager)
+        finally:
+            metrics.observe("tool_seconds", time.perf_counter() - started, tool=agent_action.tool)
+
+    def _perform_agent_action(self, name_to_tool_map, color_mapping, agent_action, run_manager=None):
+        turn = self._turn()
+        if id(agent_action) in turn["results"]:
+            return turn["results"].pop(id(agent_action))
+
+        actions = [action for action in turn["actions"] if action is not agent_action]
+        actions.insert(0, agent_action)
+        if len(actions) > 1:
+            metrics.increment("parallel_tool_batches")
+            metrics.observe("parallel_tool_batch_size", len(actions))
+
+        # ส่ง Context (Callback/Tracing ของ LangChain) ไปยัง Thread ที่รัน Tool ด้วย
+        futures = [
+            (action, _tool_pool.submit(contextvars.copy_context().run, self._run_one, name_to_tool_map, color_mapping, action, run_manager))
+            for action in actions
+        ]
+        deadline_base = time.monotonic()
+        for action, future in futures:
+            timeout = self.timeout_for(action.tool)
+            remaining = max(0.0, deadline_base + timeout - time.monotonic())
+            try:
+                step = future.result(timeout=remaining)
+            except FutureTimeoutError:
+                print(f"Tool '{action.tool}' timed out after {timeout:g}s.")
+                metrics.increment("tool_timeouts", tool=action.tool)
+                _abandon(future, action.tool)
+                step = AgentStep(action=action, observation=_timeout_observation(action.tool, timeout))
+            turn["results"][id(action)] = step
+        turn["actions"] = []
+        return turn["results"].pop(id(agent_action))
+
+    async def _aperform_agent_action(self, name_to_tool_map, color_mapping, agent_action, run_manager=None):
+        # เส้นทาง Async ของ AgentExecutor รัน Tool พร้อมกันด้วย asyncio.gather อยู่แล้ว ที่นี่เพิ่มแค่ Timeout
+        timeout = self.timeout_for(agent_action.tool)
+        started = time.perf_counter()
+        try:
+            return await asyncio.wait_for(
+                super()._aperform_agent_action(name_to_tool_map, color_mapping, agent_action, run_manager),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            print(f"Tool '{agent_action.tool}' timed out after {timeout:g}s.")
+            metrics.increment("tool_timeouts", tool=agent_action.tool)
+            return AgentStep(action=agent_action, observation=_timeout_observation(agent_action.tool, timeout))
+        finally:
+            metrics.observe("tool_seconds", time.perf_counter() - started, tool=agent_action.tool)
@@ -0,0 +1,112 @@
+# prompt_compiler.py
+
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+
+from langchain_core.messages import SystemMessage
+
+from memory_store import estimate_tokens
+import metrics
+
+# =========================================================================
+# 🟢 Prompt Compiler (System Prefix ต่อร้าน)
+# เดิม System Instruction ยาว ~4 KB ถูกสร้างด้วย f-string ใหม่ทุกข้อความ ทั้งที่ต่างกันแค่ store_id / store_name
+# Compiler นี้สร้าง Prefix ครั้งเดียวต่อร้าน ตัดส่วนที่ไม่มีผลต่อความหมายออก (ช่องว่างซ้ำ, บรรทัดว่างซ้ำ, ตัวหนา Markdown)
+# แล้วเก็บไว้พร้อมจำนวน Token และ Fingerprint
+# Prefix ที่ได้จะเหมือนเดิมทุกไบต์และอยู่หน้าสุดของทุกคำขอ จึงเข้า Implicit Context Caching ของ Gemini
+# (และ Prompt Cache ของ Ollama) ได้ทุก LLM Hop ใน Agent Loop
+# =========================================================================
+
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "1000"))
+PROMPT_STRIP_EMPHASIS = os.getenv("PROMPT_STRIP_EMPHASIS", "1") == "1"
+
+_CODE_SPAN = re.compile(r"(`[^`\n]*`)")
+_INLINE_SPACES = re.compile(r"(?<=\S)[ \t]{2,}")
+_BLANK_LINES = re.compile(r"\n{3,}")
+
+
+class CompiledPrompt(NamedTuple):
+    text: str
+    tokens: int
+    raw_tokens: int
+    fingerprint: str
+
+    def as_system_message(self):
+        """SystemMessage with the compiled text, so braces in it are not parsed as template variables."""
+        return SystemMessage(content=self.text)
+
+
+_lock = threading.Lock()
+_compiled = OrderedDict()
+
+
+def _lean_line(line, strip_emphasis):
+    indent = len(line) - len(line.lstrip(" "))
+    # ย่อการย่อหน้าเหลือ 1 ช่องต่อระดับ (4 ช่อง -> 2) ยังคงโครงสร้างลิสต์ย่อยไว้
+    parts = _CODE_SPAN.split(line.strip())
+    for i in range(0, len(parts), 2):  # ไม่แตะข้อความใน `code`
+        part = _INLINE_SPACES.sub(" ", parts[i])
+        if strip_emphasis:
+            part = part.replace("**", "")
+        parts[i] = part
+    return " " * (indent // 2) + "".join(parts)
+
+
+def compile_prompt(text, strip_emphasis=PROMPT_STRIP_EMPHASIS):
+    """Returns a token-lean version of a prompt: same wording, without redundant whitespace and (optionally) Markdown bold markers."""
+    lines = [_lean_line(line, strip_emphasis) for line in text.strip().splitlines()]
+    return _BLANK_LINES.sub("\n\n", "\n".join(lines))
+
+
+def get_store_prompt(builder, store_id, store_name, user_id, strip_emphasis=PROMPT_STRIP_EMPHASIS):
+    """Renders builder(store_id, store_name, user_id) once per store and returns the cached CompiledPrompt."""
+    key = (builder.__module__, builder.__qualname__, str(store_id), store_name, user_id, strip_emphasis)
+    with _lock:
+        compiled = _compiled.get(key)
+        if compiled is not None:
+            _compiled.move_to_end(key)
+    if compiled is not None:
+        metrics.increment("prompt_cache_hits", builder=builder.__name__)
+        return compiled
+
+    raw_text = builder(store_id, store_name, user_id)
+    text = compile_prompt(raw_text, strip_emphasis)
+    compiled = CompiledPrompt(
+        text=text,
+        tokens=estimate_tokens(text),
+        raw_tokens=estimate_tokens(raw_text),
+        fingerprint=hashlib.sha256(text.encode("utf-8")).hexdigest()[:12],
+    )
+    with _lock:
+        _compiled[key] = compiled
+        while len(_compiled) > PROMPT_CACHE_SIZE:
+            _compiled.popitem(last=False)
+    metrics.increment("prompt_cache_misses", builder=builder.__name__)
+    metrics.set_gauge("system_prompt_tokens", compiled.tokens, store=user_id)
+    metrics.set_gauge("system_prompt_raw_tokens", compiled.raw_tokens, store=user_id)
+    print(f"Compiled system prompt for store {store_id} ({builder.__name__}): {compiled.raw_tokens} -> {compiled.tokens} tokens [{compiled.fingerprint}]")
+    return compiled
+
+
+def invalidate_store_prompt(user_id=None):
+    """Drops compiled prompts of one store (e.g. after its name changes), or all of them."""
+    with _lock:
+        for key in [key for key in _compiled if user_id is None or key[4] == user_id]:
+            del _compiled[key]
+
+
+def prompt_cache_stats():
+    with _lock:
+        entries = list(_compiled.values())
+    return {
+        "entries": len(entries),
+        "raw_tokens": sum(entry.raw_tokens for entry in entries),
+        "compiled_tokens": sum(entry.tokens for entry in entries),
+    }
+
+
+metrics.register_collector("prompt_cache", prompt_cache_stats)
@@ -0,0 +1,260 @@
+# quick_replies.py
+
+import asyncio
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+import metrics
+from database import execute_write, get_connection
+from model_router import GREETING_TEMPLATE, POLITE_PARTICLES, THANKS_TEMPLATE
+from write_buffer import commit_task_response, stage_task_status
+
+# =========================================================================
+# 🟢 ตอบกลับทันทีด้วยกฎ (ไม่เรียก LLM) สำหรับคำทักทาย/ขอบคุณ สติกเกอร์ และรูปภาพ
+# เดิมข้อความอย่าง "สวัสดี" ผ่าน Dispatcher/คิว และสร้าง Agent เต็มรูปแบบเพื่อให้ได้ข้อความต้อนรับตายตัว
+# ส่วนสติกเกอร์/รูปภาพตอบด้วยข้อความในโค้ดและไม่ถูกบันทึกใน tasks
+# - กฎของแต่ละร้านอยู่ในตาราง quick_replies (name, kind, pattern, reply, priority, enabled)
+#   กฎที่ name ตรงกับ DEFAULT_RULES ใช้แทนกฎเริ่มต้นนั้น (enabled=0 = ปิดกฎเริ่มต้น)
+# - กฎทั้งหมดของร้านต่อชนิดข้อความถูก Compile เป็น Regex เดียว: \A(?:(?P<q0>...)|(?P<q1>...)|...)(คำลงท้าย)*\Z
+#   เรียงตาม priority (น้อย = ก่อน) Regex ลอง Alternative ตามลำดับ กฎแรกที่ตรงทั้งข้อความจึงชนะ
+#   Pattern ต้องตรงทั้งข้อความ (ไม่นับคำลงท้าย ครับ/ค่ะ/นะ เครื่องหมาย และ Emoji)
+#   สติกเกอร์ถูกจับคู่กับ "package_id/sticker_id" รูปภาพกับข้อความว่าง Pattern ว่าง = ตรงทุกข้อความ
+# - Webhook (api_app.py, asgi_app.py) ตรวจก่อนส่งงานเข้า Dispatcher/คิว เมื่อตรง: Commit คำตอบลง tasks
+#   (สถานะ Responded, using_sql = "Rule: <name>") แล้วตอบด้วย reply_token ทันที
+# - ทำงานเฉพาะเมื่อเปิด Auto-reply ไม่เช่นนั้นข้อความ (รวมถึงสติกเกอร์/รูปภาพ) รอแอดมินเป็น Pending ตามเดิม
+# =========================================================================
+
+TEXT = "text"
+STICKER = "sticker"
+IMAGE = "image"
+MESSAGE_KINDS = (TEXT, STICKER, IMAGE)
+
+# ข้อความที่บันทึกเป็น user_message ของ Task สำหรับข้อความที่ไม่ใช่ตัวอักษร
+STICKER_MESSAGE = "[สติกเกอร์]"
+IMAGE_MESSAGE = "[รูปภาพ]"
+
+QUICK_REPLIES_ENABLED = os.getenv("QUICK_REPLIES_ENABLED", "1") == "1"
+# ข้อความที่ยาวกว่านี้ส่งให้ Agent เสมอ (กฎมีไว้สำหรับข้อความสั้นเท่านั้น)
+QUICK_REPLY_MAX_CHARS = int(os.getenv("QUICK_REPLY_MAX_CHARS", "80"))
+QUICK_REPLIES_CACHE_SECONDS = float(os.getenv("QUICK_REPLIES_CACHE_SECONDS", "30"))
+# ข้อความ LINE หนึ่งข้อความยาวได้ไม่เกิน 5000 ตัวอักษร
+_MAX_REPLY_CHARS = 5000
+_DEFAULT_PRIORITY = 100
+
+QuickReplyRule = namedtuple("QuickReplyRule", ["name", "kind", "pattern", "reply", "priority", "enabled", "custom"])
+QuickReplyMatch = namedtuple("QuickReplyMatch", ["name", "kind", "reply"])
+
+DEFAULT_RULES = (
+    QuickReplyRule("greeting", TEXT, r"สวัสดี|หวัดดี|ดีจ้า|hello|hi|hey", GREETING_TEMPLATE, 900, True, False),
+    QuickReplyRule("thanks", TEXT, r"ขอบคุณ|ขอบใจ|thank\s?you|thanks|thx", THANKS_TEMPLATE, 900, True, False),
+    QuickReplyRule("sticker", STICKER, "", "สวัสดีค่ะมีอะไรสอบถามแจ้งได้เลยนะคะ", 900, True, False),
+    QuickReplyRule("image", IMAGE, "", "ขอบคุณสำหรับรูปภาพค่ะ รบกวนพิมพ์คำถาม หรือมีอะไรสอบถามแจ้งได้เลยนะคะ", 900, True, False),
+)
+_DEFAULTS_BY_NAME = {rule.name: rule for rule in DEFAULT_RULES}
+
+# ส่วนท้ายที่ไม่นับ: ช่องว่าง คำลงท้าย ไม้ยมก เครื่องหมาย และ Emoji
+_SUFFIX = "(?:\\s|ๆ|[^\\w\\s]|{})*".format("|".join(re.escape(word) for word in sorted(POLITE_PARTICLES, key=len, reverse=True)))
+# Group ที่มีชื่อและ Backreference ใช้ไม่ได้เมื่อรวมหลาย Pattern เป็น Regex เดียว
+_UNSUPPORTED_SYNTAX = re.compile(r"\(\?P[<=]|\(\?<[^=!]|\\[1-9]|\\g<|\\k<")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _validate_pattern(pattern):
+    if _UNSUPPORTED_SYNTAX.search(pattern):
+        raise ValueError("Patterns cannot use named groups or backreferences.")
+    try:
+        re.compile(pattern)
+    except re.error as e:
+        raise ValueError(f"Invalid pattern {pattern!r}: {e}") from e
+
+
+def compile_matcher(rules):
+    """
+    Compiles the enabled rules (already in priority order) into one regex.
+    Returns (regex, {group name: rule}) or (None, {}) when no rule is enabled.
+    """
+    groups, by_group = [], {}
+    for index, rule in enumerate(rule for rule in rules if rule.enabled):
+        group = f"q{index}"
+        groups.append(f"(?P<{group}>{rule.pattern or '(?s:.*)'})")
+        by_group[group] = rule
+    if not groups:
+        return None, {}
+    # Group ของกฎเป็น Group ที่ปิดหลังสุดเสมอ (ส่วนท้ายไม่มี Capturing Group) จึงอ่านกฎที่ตรงจาก lastgroup ได้
+    return re.compile(f"\\A(?:{'|'.join(groups)}){_SUFFIX}\\Z", re.IGNORECASE), by_group
+
+
+def normalize_message(text):
+    return _WHITESPACE.sub(" ", (text or "").strip().lower())
+
+
+# -------------------------------------------------------------------------
+# กฎต่อร้าน Cache (พร้อม Regex ที่ Compile แล้ว) ใน Process ไม่เกิน QUICK_REPLIES_CACHE_SECONDS
+# -------------------------------------------------------------------------
+_matchers_cache = {}
+_matchers_lock = threading.Lock()
+
+
+def get_store_rules(user_id):
+    """Returns {name: QuickReplyRule} of one store's own rows (overrides and additions)."""
+    conn = get_connection()
+    try:
+        rows = conn.execute(
+            "SELECT name, kind, pattern, reply, priority, enabled FROM quick_replies WHERE user_id = ?", (str(user_id),)
+        ).fetchall()
+    except sqlite3.Error as e:
+        print(f"Database error reading quick replies: {e}")
+        rows = []
+    finally:
+        conn.close()
+    return {name: QuickReplyRule(name, kind, pattern, reply, priority, bool(enabled), True)
+            for name, kind, pattern, reply, priority, enabled in rows}
+
+
+def effective_rules(user_id):
+    """All rules of a store (defaults merged with its own rows), in matching order."""
+    rules = dict(_DEFAULTS_BY_NAME)
+    rules.update(get_store_rules(user_id))
+    return sorted(rules.values(), key=lambda rule: (rule.priority, rule.name))
+
+
+def _store_matchers(user_id):
+    user_id = str(user_id)
+    with _matchers_lock:
+        cached = _matchers_cache.get(user_id)
+        if cached and time.monotonic() - cached[0] < QUICK_REPLIES_CACHE_SECONDS:
+            return cached[1]
+    rules = effective_rules(user_id)
+    matchers = {}
+    for kind in MESSAGE_KINDS:
+        try:
+            matchers[kind] = compile_matcher([rule for rule in rules if rule.kind == kind])
+        except re.error as e:
+            # แถวที่เขียนเข้า DB โดยตรงโดยไม่ผ่าน set_quick_reply: ปิดกฎของชนิดนี้ดีกว่าทำให้ Webhook ล้ม
+            print(f"Invalid quick reply rules for store {user_id} ({kind}): {e}")
+            matchers[kind] = (None, {})
+    with _matchers_lock:
+        _matchers_cache[user_id] = (time.monotonic(), matchers)
+    return matchers
+
+
+def match_quick_reply(user_id, kind, text=""):
+    """Returns the QuickReplyMatch of the first rule that matches the whole message, or None."""
+    if not QUICK_REPLIES_ENABLED:
+        return None
+    text = normalize_message(text)
+    if kind == TEXT and (not text or len(text) > QUICK_REPLY_MAX_CHARS):
+        return None
+    regex, by_group = _store_matchers(user_id).get(kind, (None, {}))
+    match = regex.fullmatch(text) if regex is not None else None
+    if match is None:
+        metrics.increment("quick_reply_misses", kind=kind)
+        return None
+    rule = by_group[match.lastgroup]
+    metrics.increment("quick_reply_hits", kind=kind, rule=rule.name)
+    return QuickReplyMatch(rule.name, kind, rule.reply)
+
+
+def set_quick_reply(user_id, name, rule):
+    """
+    Creates or replaces a rule of a store from a dict (kind, pattern, reply, priority, enabled).
+    Fields left out keep the value of the default rule with the same name. None deletes the store's row
+    (a default rule then applies again).
+    """
+    if not isinstance(name, str) or not name.strip() or len(name) > 64:
+        raise ValueError("Rule name must be a non-empty string of at most 64 characters.")
+    if rule is None:
+        execute_write("DELETE FROM quick_replies WHERE user_id = ? AND name = ?", (str(user_id), name))
+    else:
+        if not isinstance(rule, dict):
+            raise ValueError(f"Rule {name!r} must be an object or null.")
+        base = _DEFAULTS_BY_NAME.get(name) or QuickReplyRule(name, TEXT, "", "", _DEFAULT_PRIORITY, True, True)
+        kind = rule.get("kind", base.kind)
+        pattern = rule.get("pattern", base.pattern)
+        reply = rule.get("reply", base.reply)
+        priority = rule.get("priority", base.priority)
+        enabled = rule.get("enabled", base.enabled)
+        if kind not in MESSAGE_KINDS:
+            raise ValueError(f"Unknown message kind: {kind!r}")
+        if not isinstance(pattern, str) or (kind == TEXT and not pattern.strip()):
+            raise ValueError("Text rules need a pattern.")
+        _validate_pattern(pattern)
+        if not isinstance(reply, str) or len(reply) > _MAX_REPLY_CHARS or (enabled and not reply.strip()):
+            raise ValueError(f"Reply must be non-empty text of at most {_MAX_REPLY_CHARS} characters.")
+        if not isinstance(priority, int) or isinstance(priority, bool):
+            raise ValueError("Priority must be an integer.")
+        # Pattern ที่ Compile ได้ตัวเดียวอาจใช้ไม่ได้ใน Regex รวม (เช่น Flag แบบ (?i) ที่ไม่อยู่ต้น Expression)
+        # ซึ่งจะทำให้กฎชนิดนี้ของร้านถูกปิดทั้งหมด จึงต้องลอง Compile Regex รวมของร้านพร้อมกฎใหม่ก่อนบันทึก
+        candidate = QuickReplyRule(name, kind, pattern, reply, priority, bool(enabled), True)
+        rules = {existing.name: existing for existing in effective_rules(user_id)}
+        rules[name] = candidate
+        try:
+            compile_matcher(sorted((r for r in rules.values() if r.kind == kind), key=lambda r: (r.priority, r.name)))
+        except re.error as e:
+            raise ValueError(f"Pattern {pattern!r} cannot be combined with the store's other rules: {e}") from e
+        execute_write("""
+            INSERT INTO quick_replies (user_id, name, kind, pattern, reply, priority, enabled) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, name) DO UPDATE SET
+                kind = excluded.kind, pattern = excluded.pattern, reply = excluded.reply,
+                priority = excluded.priority, enabled = excluded.enabled
+        """, (str(user_id), name, kind, pattern, reply, priority, 1 if enabled else 0))
+    with _matchers_lock:
+        _matchers_cache.pop(str(user_id), None)
+
+
+# -------------------------------------------------------------------------
+# ตอบและบันทึก (เรียกจาก Webhook หลัง add_new_task)
+# -------------------------------------------------------------------------
+def record_quick_reply(task_id, match):
+    """Commits the rule's answer to the task. Send it to the customer only if this returns True."""
+    if commit_task_response(task_id, match.reply, f"Rule: {match.name}"):
+        return True
+    print(f"Quick reply for task {task_id} was not committed. Setting status to Awaiting_Approval.")
+    stage_task_status(task_id, "Awaiting_Approval")
+    return False
+
+
+def answer_quick_reply(user_id, task_id, kind, text, send_reply):
+    """
+    Answers a message from the store's rules when one matches: records the answer, then calls
+    send_reply(text) (a LINE reply_message with the event's reply token).
+    Returns True when the message was handled here and must not go to the agent.
+    """
+    if task_id is None:
+        return False
+    started = time.perf_counter()
+    match = match_quick_reply(user_id, kind, text)
+    if match is None:
+        return False
+    if record_quick_reply(task_id, match):
+        try:
+            send_reply(match.reply)
+            print(f"Task {task_id} answered by quick reply rule {match.name!r}.")
+        except Exception as e:
+            print(f"Failed to send quick reply for task {task_id}: {e}. Setting status to Awaiting_Approval.")
+            stage_task_status(task_id, "Awaiting_Approval")
+    metrics.observe("quick_reply_seconds", time.perf_counter() - started)
+    return True
+
+
+async def aanswer_quick_reply(user_id, task_id, kind, text, send_reply):
+    """Async variant of answer_quick_reply: send_reply is a coroutine function, DB work runs in threads."""
+    if task_id is None:
+        return False
+    started = time.perf_counter()
+    match = await asyncio.to_thread(match_quick_reply, user_id, kind, text)
+    if match is None:
+        return False
+    if await asyncio.to_thread(record_quick_reply, task_id, match):
+        try:
+            await send_reply(match.reply)
+            print(f"Task {task_id} answered by quick reply rule {match.name!r}.")
+        except Exception as e:
+            print(f"Failed to send quick reply for task {task_id}: {e}. Setting status to Awaiting_Approval.")
+            await asyncio.to_thread(stage_task_status, task_id, "Awaiting_Approval")
+    metrics.observe("quick_reply_seconds", time.perf_counter() - started)
+    return True
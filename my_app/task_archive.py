@@ -0,0 +1,209 @@
+# task_archive.py
+#
+# ย้าย Task เก่าที่จบแล้วออกจากตาราง tasks และดูแลขนาดไฟล์ฐานข้อมูล
+#
+#   python task_archive.py                      # Archive + incremental vacuum + optimize หนึ่งรอบ
+#   python task_archive.py --retention-days 90
+#   python task_archive.py --enable-incremental-vacuum   # ครั้งเดียวสำหรับไฟล์ DB ที่สร้างก่อนมี auto_vacuum (ใช้ VACUUM เต็ม ควรหยุดระบบก่อน)
+#
+# - Task ที่มีสถานะจบแล้ว (task_status.ARCHIVABLE_STATUSES) และเก่ากว่า TASK_RETENTION_DAYS ถูกย้ายไปตาราง
+#   tasks_archive_YYYY_MM ตามเดือนของ timestamp โดยเนื้อหาถูกบีบอัด (zlib) เหลือประมาณ 1/3
+# - Task ล่าสุดของแต่ละแชทไม่ถูกย้ายเสมอ รายการแชทของ Dashboard (get_chat_threads_by_status) จึงไม่เปลี่ยน
+# - ย้ายทีละ TASK_ARCHIVE_BATCH_SIZE แถว (INSERT + DELETE ใน Transaction เดียว) Writer จึงไม่ถูกกั้นนาน
+# - History API ใน database.py (get_chat_history, get_chat_history_for_memory, get_recent_turns_after) อ่าน Archive ด้วย
+# - Trace ของ Agent ที่เก่ากว่า TASK_TRACE_RETENTION_DAYS ถูกลบ (task_traces.py)
+# - หลังย้าย: PRAGMA incremental_vacuum คืนหน้าว่างให้ระบบ และ PRAGMA optimize อัปเดตสถิติของ Query Planner (ANALYZE แบบจำกัด)
+# - ai_worker.py รันรอบนี้อัตโนมัติทุก TASK_MAINTENANCE_INTERVAL วินาที
+
+import argparse
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+import metrics
+from database import ARCHIVE_PAYLOAD_COLUMNS, ARCHIVE_TABLE_PREFIX, execute_write_many, get_connection, initialize_database
+from task_status import ARCHIVABLE_STATUSES
+from task_traces import TASK_TRACE_RETENTION_DAYS, prune_traces
+
+TASK_RETENTION_DAYS = float(os.getenv("TASK_RETENTION_DAYS", "30"))
+TASK_ARCHIVE_BATCH_SIZE = int(os.getenv("TASK_ARCHIVE_BATCH_SIZE", "1000"))
+# จำนวนหน้าสูงสุดที่คืนต่อรอบ (หน้าละ 4 KB โดยปกติ)
+TASK_VACUUM_PAGES = int(os.getenv("TASK_VACUUM_PAGES", "5000"))
+# 0 = ไม่รันอัตโนมัติใน ai_worker.py
+TASK_MAINTENANCE_INTERVAL = float(os.getenv("TASK_MAINTENANCE_INTERVAL", "3600"))
+
+_ANALYSIS_LIMIT = 1000
+_STATUS_PLACEHOLDERS = ", ".join("?" for _ in ARCHIVABLE_STATUSES)
+
+_CANDIDATE_QUERY = f"""
+    SELECT * FROM tasks t
+    WHERE t.status IN ({_STATUS_PLACEHOLDERS}) AND t.timestamp < ?
+      AND t.task_id < (SELECT MAX(l.task_id) FROM tasks l WHERE l.user_id = t.user_id AND l.line_id = t.line_id)
+    ORDER BY t.task_id
+    LIMIT ?
+"""
+
+
+def archive_table_name(timestamp):
+    """tasks_archive_YYYY_MM for a task timestamp ('YYYY-MM-DD...' in both the ISO and SQLite formats)."""
+    text = str(timestamp or "")
+    year, month = text[:4], text[5:7]
+    if not (year.isdigit() and month.isdigit()):
+        year, month = "0000", "00"
+    return f"{ARCHIVE_TABLE_PREFIX}{year}_{month}"
+
+
+def _archive_table_statements(table):
+    return [
+        (f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                task_id INTEGER PRIMARY KEY,
+                user_id TEXT,
+                line_id TEXT,
+                status TEXT,
+                timestamp DATETIME,
+                payload BLOB NOT NULL
+            )
+        """, ()),
+        (f"CREATE INDEX IF NOT EXISTS idx_{table}_conversation ON {table} (user_id, line_id, task_id)", ()),
+    ]
+
+
+def encode_payload(task):
+    """Compresses the columns not needed for lookups (database.decode_archived_task reverses it)."""
+    return zlib.compress(json.dumps([task[column] for column in ARCHIVE_PAYLOAD_COLUMNS], ensure_ascii=False).encode("utf-8"), 6)
+
+
+def archive_batch(cutoff, batch_size=TASK_ARCHIVE_BATCH_SIZE):
+    """Moves up to batch_size archivable tasks older than cutoff into the monthly tables. Returns rows moved."""
+    conn = get_connection()
+    conn.row_factory = sqlite3.Row
+    try:
+        tasks = [dict(row) for row in conn.execute(_CANDIDATE_QUERY, (*ARCHIVABLE_STATUSES, cutoff, batch_size)).fetchall()]
+    finally:
+        conn.close()
+    if not tasks:
+        return 0
+
+    by_table = {}
+    for task in tasks:
+        by_table.setdefault(archive_table_name(task["timestamp"]), []).append(
+            (task["task_id"], task["user_id"], task["line_id"], task["status"], task["timestamp"], encode_payload(task))
+        )
+    statements = []
+    for table, rows in by_table.items():
+        statements.extend(_archive_table_statements(table))
+        statements.append((f"INSERT OR REPLACE INTO {table} (task_id, user_id, line_id, status, timestamp, payload) VALUES (?, ?, ?, ?, ?, ?)", rows))
+    # ลบเฉพาะแถวที่ไม่ถูกแก้ไขหลังจากอ่าน: แถวที่ถูกเขียนระหว่างนั้นจะถูกย้ายใหม่ในรอบถัดไป (INSERT OR REPLACE)
+    statements.append((
+        "DELETE FROM tasks WHERE task_id = ? AND status = ? AND response_timestamp IS ? AND admin_response IS ?",
+        [(task["task_id"], task["status"], task["response_timestamp"], task["admin_response"]) for task in tasks],
+    ))
+    results = execute_write_many(statements)
+    moved = results[-1]["rowcount"]
+    metrics.increment("tasks_archived", moved)
+    return moved
+
+
+def archive_old_tasks(retention_days=TASK_RETENTION_DAYS, batch_size=TASK_ARCHIVE_BATCH_SIZE, max_batches=None):
+    """Archives every eligible task older than retention_days, one batch per transaction. Returns rows moved."""
+    cutoff = (datetime.datetime.now() - datetime.timedelta(days=retention_days)).isoformat()
+    moved = batches = 0
+    while max_batches is None or batches < max_batches:
+        count = archive_batch(cutoff, batch_size)
+        moved += count
+        batches += 1
+        if count < batch_size:
+            break
+    return moved
+
+
+def compact_database(max_pages=TASK_VACUUM_PAGES):
+    """Returns free pages to the filesystem (auto_vacuum=INCREMENTAL) and refreshes planner statistics."""
+    conn = get_connection()
+    try:
+        free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        incremental = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        if incremental and free_before:
+            # incremental_vacuum คืนหนึ่งหน้าต่อหนึ่ง Step แต่ execute() Step ครั้งเดียว: executescript รันจนจบ
+            conn.executescript(f"PRAGMA incremental_vacuum({int(max_pages)});")
+            # ไฟล์หลักหดลงเมื่อ Checkpoint หน้าที่ถูกย้ายกลับจาก WAL
+            conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+        conn.execute(f"PRAGMA analysis_limit={_ANALYSIS_LIMIT}")
+        conn.execute("PRAGMA optimize")
+        conn.commit()
+        free_after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    finally:
+        conn.close()
+    freed = free_before - free_after
+    metrics.increment("db_pages_vacuumed", max(freed, 0))
+    if free_before and not incremental:
+        print(f"Database has {free_before} free pages but auto_vacuum is not INCREMENTAL "
+              f"(run python task_archive.py --enable-incremental-vacuum once).")
+    return {"incremental_vacuum": incremental, "free_pages_before": free_before, "pages_freed": freed}
+
+
+def enable_incremental_vacuum():
+    """One-off full VACUUM that switches an existing database file to auto_vacuum=INCREMENTAL."""
+    conn = get_connection()
+    try:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        return conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    finally:
+        conn.close()
+
+
+def run_maintenance(retention_days=TASK_RETENTION_DAYS, batch_size=TASK_ARCHIVE_BATCH_SIZE, vacuum_pages=TASK_VACUUM_PAGES):
+    """One maintenance pass: archive, then compact. Returns a report dict."""
+    started = time.perf_counter()
+    report = {"archived": 0}
+    try:
+        report["archived"] = archive_old_tasks(retention_days, batch_size)
+        report["traces_pruned"] = prune_traces(TASK_TRACE_RETENTION_DAYS)
+        report.update(compact_database(vacuum_pages))
+    except sqlite3.Error as e:
+        report["error"] = str(e)
+        print(f"Database error during task maintenance: {e}")
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    metrics.observe("task_maintenance_seconds", report["seconds"])
+    if report["archived"]:
+        print(f"Archived {report['archived']} tasks older than {retention_days:g} days in {report['seconds']}s.")
+    return report
+
+
+def start_maintenance_thread(interval=TASK_MAINTENANCE_INTERVAL, stop_event=None):
+    """Runs run_maintenance every interval seconds in a daemon thread (first pass right away)."""
+    stop_event = stop_event or threading.Event()
+
+    def loop():
+        while not stop_event.is_set():
+            run_maintenance()
+            stop_event.wait(interval)
+
+    thread = threading.Thread(target=loop, name="task-maintenance", daemon=True)
+    thread.start()
+    return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive old finished tasks and compact the database.")
+    parser.add_argument("--retention-days", type=float, default=TASK_RETENTION_DAYS)
+    parser.add_argument("--batch-size", type=int, default=TASK_ARCHIVE_BATCH_SIZE)
+    parser.add_argument("--vacuum-pages", type=int, default=TASK_VACUUM_PAGES)
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help="run a one-off full VACUUM that turns on auto_vacuum=INCREMENTAL for an existing database")
+    args = parser.parse_args()
+
+    initialize_database()
+    if args.enable_incremental_vacuum:
+        print(f"auto_vacuum=INCREMENTAL enabled: {enable_incremental_vacuum()}")
+    print(json.dumps(run_maintenance(args.retention_days, args.batch_size, args.vacuum_pages)))
+
+
+if __name__ == "__main__":
+    main()
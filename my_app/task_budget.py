@@ -0,0 +1,164 @@
+# task_budget.py
+
+import os
+import time
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+import metrics
+
+# =========================================================================
+# 🟢 Budget ต่อ Task (LLM Calls / Tokens / Seconds)
+# เดิม AgentExecutor ไม่มี max_execution_time และ Model ที่สับสนอาจวนเรียก sql_db_schema/sql_db_query ไม่รู้จบ
+# แล้วยังถูกคูณด้วย Retry อีก 5 รอบ TaskBudget ถูกสร้างครั้งเดียวต่อ Task และใช้ร่วมกันทุก Retry:
+#   - BudgetCallbackHandler นับทุกการเรียก LLM และ Token จริงจาก usage_metadata แล้วหยุดทันทีที่เกิน
+#   - max_iterations / max_execution_time ของ AgentExecutor ถูกตั้งตามเวลาที่เหลือของ Budget
+# เมื่อ Budget หมด Task จะถูกส่งให้แอดมิน (Awaiting_Approval) แทนการตอบผิดหรือค้าง
+# =========================================================================
+
+TASK_MAX_LLM_CALLS = int(os.getenv("TASK_MAX_LLM_CALLS", "10"))
+TASK_MAX_TOKENS = int(os.getenv("TASK_MAX_TOKENS", "30000"))
+TASK_MAX_SECONDS = float(os.getenv("TASK_MAX_SECONDS", "120"))
+AGENT_MAX_ITERATIONS = int(os.getenv("AGENT_MAX_ITERATIONS", "6"))
+
+# ข้อความที่ AgentExecutor คืนเมื่อหยุดเพราะ max_iterations / max_execution_time (early_stopping_method="force")
+# ข้อความต่างกันระหว่าง Agent แบบ Single-action และ Multi-action (Tool Calling)
+AGENT_STOPPED_OUTPUTS = (
+    "Agent stopped due to iteration limit or time limit.",
+    "Agent stopped due to max iterations.",
+)
+
+
+class BudgetExceeded(Exception):
+    """Raised when a task has used up one of its limits. `reason` is 'llm_calls', 'tokens', 'seconds' or 'iterations'."""
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+class TaskBudget:
+    """Limits shared by every attempt of one task."""
+
+    def __init__(self, user_id, max_llm_calls=TASK_MAX_LLM_CALLS, max_tokens=TASK_MAX_TOKENS, max_seconds=TASK_MAX_SECONDS, max_iterations=AGENT_MAX_ITERATIONS):
+        self.user_id = user_id
+        self.max_llm_calls = max_llm_calls
+        self.max_tokens = max_tokens
+        self.max_seconds = max_seconds
+        self.max_iterations = max_iterations
+        self.started_at = time.monotonic()
+        self.llm_calls = 0
+        self.tokens = 0
+        # Token ขาเข้า (Prompt) รวมทุก LLM Hop และส่วนที่ Provider อ่านจาก Context Cache
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+
+    def elapsed_seconds(self):
+        return time.monotonic() - self.started_at
+
+    def remaining_seconds(self):
+        return max(0.0, self.max_seconds - self.elapsed_seconds())
+
+    def can_wait(self, seconds):
+        """True if sleeping for `seconds` (e.g. a retry backoff) still leaves time in the budget."""
+        return seconds < self.remaining_seconds()
+
+    def check(self):
+        if self.llm_calls > self.max_llm_calls:
+            raise BudgetExceeded("llm_calls", f"LLM call budget exceeded ({self.llm_calls}/{self.max_llm_calls})")
+        if self.tokens > self.max_tokens:
+            raise BudgetExceeded("tokens", f"Token budget exceeded ({self.tokens}/{self.max_tokens})")
+        if self.remaining_seconds() <= 0:
+            raise BudgetExceeded("seconds", f"Time budget exceeded ({self.elapsed_seconds():.1f}s/{self.max_seconds:g}s)")
+
+    def charge_llm_call(self):
+        self.llm_calls += 1
+        self.check()
+
+    def charge_tokens(self, tokens, prompt_tokens=0, cached_prompt_tokens=0):
+        self.tokens += tokens
+        self.prompt_tokens += prompt_tokens
+        self.cached_prompt_tokens += cached_prompt_tokens
+        self.check()
+
+    def apply_limits(self, agent_executor):
+        """Caps the executor's iterations and wall time by what is left of this budget."""
+        agent_executor.max_iterations = self.max_iterations
+        agent_executor.max_execution_time = self.remaining_seconds()
+        agent_executor.early_stopping_method = "force"
+
+    def _config(self):
+        return {"callbacks": [BudgetCallbackHandler(self)]}
+
+    def _check_output(self, response):
+        if response.get("output") in AGENT_STOPPED_OUTPUTS:
+            raise BudgetExceeded("iterations", f"Agent stopped by iteration/time limit after {self.llm_calls} LLM calls")
+        return response
+
+    def invoke(self, agent_executor, inputs):
+        """Runs agent_executor.invoke under this budget. Raises BudgetExceeded when a limit is hit."""
+        self.check()
+        self.apply_limits(agent_executor)
+        response = self._check_output(agent_executor.invoke(inputs, config=self._config()))
+        self.record_usage()
+        return response
+
+    async def ainvoke(self, agent_executor, inputs):
+        """Async variant of invoke()."""
+        self.check()
+        self.apply_limits(agent_executor)
+        response = self._check_output(await agent_executor.ainvoke(inputs, config=self._config()))
+        self.record_usage()
+        return response
+
+    def record_usage(self):
+        metrics.observe("task_llm_calls", self.llm_calls, store=self.user_id)
+        metrics.observe("task_tokens", self.tokens, store=self.user_id)
+        metrics.observe("task_seconds", self.elapsed_seconds(), store=self.user_id)
+        # Prompt Token ก่อน/หลัง Context Cache: ส่วนที่ไม่ได้มาจาก Cache คือส่วนที่คิดราคาเต็ม
+        metrics.observe("task_prompt_tokens", self.prompt_tokens, store=self.user_id)
+        metrics.observe("task_cached_prompt_tokens", self.cached_prompt_tokens, store=self.user_id)
+        metrics.observe("task_uncached_prompt_tokens", self.prompt_tokens - self.cached_prompt_tokens, store=self.user_id)
+
+    def record_exhausted(self, reason):
+        """Counts a budget exhaustion for this store (task_budget_exhausted{store, reason})."""
+        metrics.increment("task_budget_exhausted", store=self.user_id, reason=reason)
+        self.record_usage()
+
+
+def _usage_tokens(response):
+    """(total, prompt, cached prompt) tokens of an LLMResult, from message usage_metadata or the provider's llm_output."""
+    tokens = prompt_tokens = cached_tokens = 0
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                tokens += usage.get("total_tokens", 0)
+                prompt_tokens += usage.get("input_tokens", 0)
+                cached_tokens += (usage.get("input_token_details") or {}).get("cache_read", 0) or 0
+    if not tokens and response.llm_output:
+        usage = response.llm_output.get("token_usage") or response.llm_output.get("usage_metadata") or {}
+        tokens = usage.get("total_tokens", 0)
+        prompt_tokens = usage.get("prompt_tokens", usage.get("input_tokens", 0))
+    return tokens, prompt_tokens, cached_tokens
+
+
+class BudgetCallbackHandler(BaseCallbackHandler):
+    """Charges LLM calls and tokens to a TaskBudget and aborts the run as soon as a limit is exceeded."""
+
+    raise_error = True
+
+    def __init__(self, budget):
+        self.budget = budget
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self.budget.charge_llm_call()
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.budget.charge_llm_call()
+
+    def on_llm_end(self, response, **kwargs):
+        self.budget.charge_tokens(*_usage_tokens(response))
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        self.budget.check()
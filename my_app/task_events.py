@@ -0,0 +1,291 @@
+# task_events.py
+
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import metrics
+from database import add_task_listener, execute_write, get_connection
+
+# =========================================================================
+# 🟢 Live Update ของ Dashboard (Server-Sent Events)
+# เดิมทุกแท็บของแอดมินเรียก /api/tasks/... (Query หา Thread ล่าสุดของทุกลูกค้า) ซ้ำทุกครั้งที่ Refresh
+# ตอนนี้ Trigger บนตาราง tasks เขียน Event ลง task_events (ทุก Process รวมถึง AI Worker)
+# และ Process ของ Web มี Broker หนึ่ง Thread ที่:
+#   - ตรวจ PRAGMA data_version ทุก TASK_EVENTS_POLL_INTERVAL (ไม่แตะตารางถ้าไม่มีใคร Commit)
+#     และถูกปลุกทันทีเมื่อ Task ถูกเขียนใน Process เดียวกัน (database.add_task_listener)
+#   - อ่าน Event ใหม่ครั้งเดียวแล้วกระจายให้ทุกแท็บของร้านนั้น
+# แท็บที่เปิดค้างไว้ N แท็บจึงไม่สร้าง Query เลยระหว่างที่ไม่มี Event
+# =========================================================================
+
+TASK_EVENTS_POLL_INTERVAL = float(os.getenv("TASK_EVENTS_POLL_INTERVAL", "0.5"))
+TASK_EVENTS_RETENTION_SECONDS = float(os.getenv("TASK_EVENTS_RETENTION_SECONDS", "3600"))
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+# ปิด Stream เป็นระยะให้ Browser ต่อใหม่ (พร้อม Last-Event-ID) เพื่อคืน Thread ของ Web Worker
+SSE_MAX_STREAM_SECONDS = float(os.getenv("SSE_MAX_STREAM_SECONDS", "300"))
+SSE_SUBSCRIBER_QUEUE_SIZE = int(os.getenv("SSE_SUBSCRIBER_QUEUE_SIZE", "500"))
+# จำนวน Stream พร้อมกันต่อ Process: แต่ละ Stream ถือหนึ่ง Thread ของ gthread Worker ตลอดอายุ (แท็บต่อใหม่ภายใน 3 วินาที)
+# จึงต้องน้อยกว่า WEB_THREADS มากเพื่อให้เหลือ Thread รับ /webhook เสมอ Stream ที่เกินได้ 503 และ Dashboard ใช้ Polling แทน
+SSE_MAX_STREAMS = int(os.getenv("SSE_MAX_STREAMS", str(max(1, int(os.getenv("WEB_THREADS", "4")) // 4))))
+
+_EVENT_BATCH_LIMIT = 1000
+_PRUNE_INTERVAL_SECONDS = 60
+
+_EVENT_QUERY = """
+    SELECT e.event_id, e.kind, t.task_id, t.user_id, t.line_id, t.user_message,
+           t.ai_response, t.admin_response, t.status, t.timestamp
+    FROM task_events e
+    JOIN tasks t ON t.task_id = e.task_id
+    WHERE e.event_id > ? {user_filter}
+    ORDER BY e.event_id
+    LIMIT ?
+"""
+
+
+def _event_rows(conn, after_event_id, user_id=None, limit=_EVENT_BATCH_LIMIT):
+    conn.row_factory = sqlite3.Row
+    if user_id is None:
+        rows = conn.execute(_EVENT_QUERY.format(user_filter=""), (after_event_id, limit)).fetchall()
+    else:
+        rows = conn.execute(_EVENT_QUERY.format(user_filter="AND e.user_id = ?"), (after_event_id, user_id, limit)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def coalesce_events(events):
+    """Keeps only the newest event of each task (rows already carry the task's current state), in event order."""
+    latest = {}
+    for event in events:
+        latest.pop(event["task_id"], None)
+        latest[event["task_id"]] = event
+    return list(latest.values())
+
+
+def latest_event_id(conn=None):
+    own_connection = conn is None
+    conn = conn or get_connection()
+    try:
+        return conn.execute("SELECT COALESCE(MAX(event_id), 0) FROM task_events").fetchone()[0]
+    finally:
+        if own_connection:
+            conn.close()
+
+
+def prune_task_events(retention_seconds=TASK_EVENTS_RETENTION_SECONDS):
+    """Deletes events older than the retention window. Returns the number of rows removed."""
+    try:
+        return execute_write("DELETE FROM task_events WHERE created_at < ?", (time.time() - retention_seconds,))["rowcount"]
+    except sqlite3.Error as e:
+        print(f"Database error pruning task events: {e}")
+        return 0
+
+
+class Subscription:
+    """Queue of task events for one dashboard stream of one store."""
+
+    def __init__(self, user_id):
+        self.user_id = str(user_id)
+        self.queue = queue.Queue(maxsize=SSE_SUBSCRIBER_QUEUE_SIZE)
+        # Client ช้าจนคิวเต็ม: ทิ้งคิวแล้วให้ Client โหลดรายการใหม่ทั้งหมดแทน
+        self.lagged = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.lagged = True
+
+
+class TaskEventBroker:
+    """Polls task_events once per process and fans new events out to the subscribed streams."""
+
+    def __init__(self, poll_interval=TASK_EVENTS_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._last_event_id = None
+        self.polls = 0
+        self.reads = 0
+
+    def subscribe(self, user_id):
+        subscription = Subscription(user_id)
+        with self._lock:
+            self._subscribers.setdefault(subscription.user_id, set()).add(subscription)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="task-event-broker", daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.user_id]
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def current_event_id(self):
+        """The last event already fanned out (a new stream starts after it)."""
+        if self._last_event_id is None:
+            return latest_event_id()
+        return self._last_event_id
+
+    def notify(self, event=None):
+        """Task listener: wakes the poller right after a task write committed in this process."""
+        self._wake.set()
+
+    def _run(self):
+        conn = get_connection()
+        data_version = None
+        last_prune = 0.0
+        try:
+            self._last_event_id = latest_event_id(conn)
+            while True:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                if not self.subscriber_count():
+                    continue
+                self.polls += 1
+                # data_version เปลี่ยนเมื่อ Connection อื่น (ทุก Process) Commit: ถ้าไม่เปลี่ยนก็ไม่ต้อง Query
+                version = conn.execute("PRAGMA data_version").fetchone()[0]
+                if version == data_version:
+                    continue
+                data_version = version
+                self._dispatch(conn)
+                if time.monotonic() - last_prune > _PRUNE_INTERVAL_SECONDS:
+                    last_prune = time.monotonic()
+                    prune_task_events()
+        except Exception as e:
+            print(f"Task event broker stopped: {e}")
+        finally:
+            conn.close()
+            with self._lock:
+                self._thread = None
+
+    def _dispatch(self, conn):
+        while True:
+            try:
+                events = _event_rows(conn, self._last_event_id)
+            except sqlite3.Error as e:
+                print(f"Database error reading task events: {e}")
+                return
+            # ปิด Read Transaction เพื่อไม่ให้ WAL Checkpoint ถูกกั้นไว้
+            conn.commit()
+            if not events:
+                return
+            self.reads += 1
+            self._last_event_id = events[-1]["event_id"]
+            with self._lock:
+                subscribers = {user_id: list(subs) for user_id, subs in self._subscribers.items()}
+            for event in coalesce_events(events):
+                for subscription in subscribers.get(event["user_id"], ()):
+                    subscription.put(event)
+            metrics.increment("task_events_dispatched", len(events))
+            if len(events) < _EVENT_BATCH_LIMIT:
+                return
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_task_event_broker():
+    """Returns the process-wide broker, registering it as a task listener on first use."""
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = TaskEventBroker()
+            add_task_listener(_broker.notify)
+            metrics.register_collector("task_events", lambda: {
+                "sse_subscribers": _broker.subscriber_count(),
+                "polls": _broker.polls,
+                "reads": _broker.reads,
+            })
+        return _broker
+
+
+def _sse(event_name, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event_name}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+
+_stream_slots = threading.BoundedSemaphore(max(1, SSE_MAX_STREAMS))
+
+
+def acquire_stream_slot():
+    """Reserves one of the process's SSE_MAX_STREAMS stream slots; False when all are in use."""
+    if _stream_slots.acquire(blocking=False):
+        return True
+    metrics.increment("sse_streams_rejected")
+    return False
+
+
+def release_stream_slot():
+    _stream_slots.release()
+
+
+def sse_stream(user_id, last_event_id=None, max_seconds=SSE_MAX_STREAM_SECONDS, heartbeat_seconds=SSE_HEARTBEAT_SECONDS):
+    """
+    Yields Server-Sent Events of one store's task changes.
+    With last_event_id (a reconnecting browser) missed events are replayed first; when they were
+    already pruned a 'resync' event tells the client to reload its list.
+    """
+    user_id = str(user_id)
+    broker = get_task_event_broker()
+    subscription = broker.subscribe(user_id)
+    metrics.increment("sse_streams_opened")
+    started = time.monotonic()
+    try:
+        cursor = broker.current_event_id()
+        yield "retry: 3000\n\n"
+        if last_event_id is not None:
+            conn = get_connection()
+            try:
+                oldest = conn.execute("SELECT MIN(event_id) FROM task_events").fetchone()[0]
+                if oldest is not None and last_event_id < oldest - 1:
+                    yield _sse("resync", {"reason": "events expired"}, cursor)
+                else:
+                    missed = _event_rows(conn, last_event_id, user_id)
+                    for event in coalesce_events(missed):
+                        yield _sse("task", event, event["event_id"])
+                    if missed:
+                        cursor = max(cursor, missed[-1]["event_id"])
+                    if len(missed) == _EVENT_BATCH_LIMIT:
+                        yield _sse("resync", {"reason": "too many missed events"}, cursor)
+            finally:
+                conn.close()
+        else:
+            yield _sse("ready", {"event_id": cursor}, cursor)
+
+        while time.monotonic() - started < max_seconds:
+            try:
+                event = subscription.queue.get(timeout=heartbeat_seconds)
+            except queue.Empty:
+                yield ": ping\n\n"
+                continue
+            if subscription.lagged:
+                while not subscription.queue.empty():
+                    subscription.queue.get_nowait()
+                subscription.lagged = False
+                yield _sse("resync", {"reason": "stream fell behind"}, broker.current_event_id())
+                continue
+            # Event ที่ Replay ไปแล้วตอนเชื่อมต่อใหม่
+            if event["event_id"] <= cursor:
+                continue
+            cursor = event["event_id"]
+            metrics.increment("sse_events_sent")
+            yield _sse("task", event, cursor)
+    finally:
+        broker.unsubscribe(subscription)
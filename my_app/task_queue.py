@@ -0,0 +1,136 @@
+# task_queue.py
+
+import datetime
+import sqlite3
+
+from database import get_connection, execute_write
+
+# =========================================================================
+# 🟢 Job Queue (ตาราง job_queue ใน store_database.db)
+# Web Worker (gunicorn) ใส่งานด้วย enqueue_job แล้วตอบ LINE ทันที
+# AI Worker (ai_worker.py) ดึงงานทั้งบทสนทนาด้วย claim_next_conversation_batch แบบ Atomic เพื่อไม่ให้สอง Worker ได้งานเดียวกัน
+# =========================================================================
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+def enqueue_job(task_id, user_id, line_id, user_message):
+    """Adds a task to the shared job queue. Returns the job_id or None on error."""
+    try:
+        result = execute_write("""
+            INSERT INTO job_queue (task_id, user_id, line_id, user_message, status, created_at)
+            VALUES (?, ?, ?, ?, 'queued', ?)
+        """, (task_id, user_id, line_id, user_message, _now()))
+        return result["lastrowid"]
+    except sqlite3.Error as e:
+        print(f"Database error enqueueing task {task_id}: {e}")
+        return None
+
+def claim_next_conversation_batch(worker_id, debounce_seconds=0.0, max_wait_seconds=5.0, max_per_store=None):
+    """
+    Atomically claims every queued job of one conversation (user_id, line_id) and returns them oldest first.
+    A conversation is eligible only when none of its jobs is running (strict per-conversation order) and
+    its newest job is older than debounce_seconds, or its oldest job is older than max_wait_seconds.
+    Stores with fewer running conversations go first, and a store already running max_per_store
+    conversations (across all workers) is skipped while another store under the cap has queued jobs,
+    so one busy store cannot take every worker but still uses them all when it is the only one waiting.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    quiet_cutoff = (now - datetime.timedelta(seconds=debounce_seconds)).isoformat()
+    max_wait_cutoff = (now - datetime.timedelta(seconds=max_wait_seconds)).isoformat()
+    try:
+        result = execute_write("""
+            WITH store_load AS (
+                SELECT user_id, COUNT(DISTINCT line_id) AS running
+                FROM job_queue
+                WHERE status = 'running'
+                GROUP BY user_id
+            ),
+            target AS (
+                SELECT q.user_id, q.line_id
+                FROM job_queue q
+                LEFT JOIN store_load s ON s.user_id = q.user_id
+                WHERE q.status = 'queued'
+                  AND (? IS NULL OR COALESCE(s.running, 0) < ? OR NOT EXISTS (
+                      SELECT 1 FROM job_queue o
+                      LEFT JOIN store_load so ON so.user_id = o.user_id
+                      WHERE o.status = 'queued' AND o.user_id != q.user_id AND COALESCE(so.running, 0) < ?
+                  ))
+                  AND NOT EXISTS (
+                      SELECT 1 FROM job_queue r
+                      WHERE r.status = 'running' AND r.user_id = q.user_id AND r.line_id = q.line_id
+                  )
+                GROUP BY q.user_id, q.line_id
+                HAVING MAX(q.created_at) <= ? OR MIN(q.created_at) <= ?
+                ORDER BY COALESCE(MAX(s.running), 0), MIN(q.job_id)
+                LIMIT 1
+            )
+            UPDATE job_queue
+            SET status = 'running', worker_id = ?, claimed_at = ?, attempts = attempts + 1
+            WHERE status = 'queued' AND (user_id, line_id) = (SELECT user_id, line_id FROM target)
+            RETURNING job_id, task_id, user_id, line_id, user_message, attempts
+        """, (max_per_store, max_per_store, max_per_store, quiet_cutoff, max_wait_cutoff, worker_id, now.isoformat()))
+    except sqlite3.Error as e:
+        print(f"Database error claiming conversation batch for {worker_id}: {e}")
+        return []
+
+    jobs = [
+        {"job_id": job_id, "task_id": task_id, "user_id": user_id, "line_id": line_id, "user_message": user_message, "attempts": attempts}
+        for job_id, task_id, user_id, line_id, user_message, attempts in result["rows"]
+    ]
+    return sorted(jobs, key=lambda job: job["job_id"])
+
+def complete_job(job_id, status="done", error=None):
+    """Marks a claimed job as finished ('done' or 'failed')."""
+    try:
+        execute_write(
+            "UPDATE job_queue SET status = ?, error = ?, finished_at = ? WHERE job_id = ?",
+            (status, error, _now(), job_id),
+        )
+    except sqlite3.Error as e:
+        print(f"Database error completing job {job_id}: {e}")
+
+def requeue_stale_jobs(max_running_seconds=600, max_attempts=3):
+    """
+    Puts jobs whose worker died while running back into the queue.
+    Jobs that already used max_attempts are marked 'failed' instead.
+    """
+    cutoff = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=max_running_seconds)).isoformat()
+    try:
+        result = execute_write("""
+            UPDATE job_queue
+            SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, worker_id = NULL
+            WHERE status = 'running' AND claimed_at < ?
+        """, (max_attempts, cutoff))
+        return result["rowcount"]
+    except sqlite3.Error as e:
+        print(f"Database error requeueing stale jobs: {e}")
+        return 0
+
+def get_queue_depth():
+    """Returns the number of jobs still waiting to be claimed."""
+    conn = get_connection()
+    try:
+        row = conn.execute("SELECT COUNT(*) FROM job_queue WHERE status = 'queued'").fetchone()
+        return row[0]
+    except sqlite3.Error as e:
+        print(f"Database error reading queue depth: {e}")
+        return 0
+    finally:
+        conn.close()
+
+def get_queue_backlog_by_store():
+    """Returns {user_id: conversations with queued jobs} (the load shedder's view of the queue)."""
+    conn = get_connection()
+    try:
+        rows = conn.execute("""
+            SELECT user_id, COUNT(DISTINCT line_id) FROM job_queue
+            WHERE status = 'queued'
+            GROUP BY user_id
+        """).fetchall()
+        return dict(rows)
+    except sqlite3.Error as e:
+        print(f"Database error reading queue backlog: {e}")
+        return {}
+    finally:
+        conn.close()
@@ -0,0 +1,64 @@
+# task_status.py
+
+# =========================================================================
+# 🟢 State Machine ของสถานะ Task
+# เดิมสถานะเป็น String อิสระ (/api/update_task_status รับค่าอะไรก็ได้) ที่นี่กำหนดสถานะที่มีได้และการเปลี่ยนที่อนุญาต
+# ทุก UPDATE ของคอลัมน์ status ใช้ status_assignment(): ถ้าสถานะปัจจุบันเปลี่ยนไปเป็นค่าใหม่ไม่ได้
+# แถวนั้นคงสถานะเดิมไว้ (คอลัมน์อื่นใน UPDATE เดียวกันยังถูกเขียน) การตรวจจึงเป็น Atomic โดยไม่ต้องอ่านก่อนเขียน
+# =========================================================================
+
+PENDING = "Pending"
+RESPONDED = "Responded"
+AWAITING_APPROVAL = "Awaiting_Approval"
+ERROR = "Error"
+FATAL_ERROR = "FatalError"
+MERGED = "Merged"
+SENT = "Sent"
+REJECTED = "Rejected"
+RESOLVED = "Resolved"
+
+# สถานะปัจจุบัน -> สถานะที่เปลี่ยนไปได้ (การตั้งค่าเดิมซ้ำอนุญาตเสมอ)
+TRANSITIONS = {
+    PENDING: {RESPONDED, AWAITING_APPROVAL, ERROR, FATAL_ERROR, MERGED, REJECTED, RESOLVED},
+    # ส่งหาลูกค้าไม่สำเร็จหลังบันทึกคำตอบแล้ว -> Awaiting_Approval
+    RESPONDED: {AWAITING_APPROVAL, ERROR, FATAL_ERROR, SENT, RESOLVED},
+    AWAITING_APPROVAL: {RESPONDED, SENT, REJECTED, RESOLVED, ERROR, FATAL_ERROR},
+    # งานที่ผิดพลาดถูกส่งกลับเข้าคิว (Pending) หรือให้แอดมินจัดการ
+    ERROR: {PENDING, RESPONDED, AWAITING_APPROVAL, FATAL_ERROR, MERGED, SENT, REJECTED, RESOLVED},
+    FATAL_ERROR: {PENDING, RESPONDED, AWAITING_APPROVAL, SENT, REJECTED, RESOLVED},
+    MERGED: set(),
+    # แอดมินตอบแชทที่ปิดไปแล้ว -> Responded
+    SENT: {RESPONDED, RESOLVED},
+    REJECTED: {RESPONDED, RESOLVED},
+    RESOLVED: {RESPONDED, AWAITING_APPROVAL},
+}
+
+TASK_STATUSES = tuple(TRANSITIONS)
+
+# สถานะที่งานจบแล้ว ย้ายไป Archive ได้เมื่อเก่าพอ (task_archive.py)
+ARCHIVABLE_STATUSES = (RESPONDED, RESOLVED, SENT, REJECTED, MERGED)
+
+
+def is_valid_status(status):
+    return status in TRANSITIONS
+
+
+def can_transition(old_status, new_status):
+    return old_status == new_status or new_status in TRANSITIONS.get(old_status, ())
+
+
+def allowed_sources(new_status):
+    """Statuses a task may currently have to move to new_status (including new_status itself)."""
+    if not is_valid_status(new_status):
+        raise ValueError(f"Unknown task status: {new_status!r}")
+    return sorted({old for old, targets in TRANSITIONS.items() if new_status in targets} | {new_status})
+
+
+def status_assignment(new_status, column="status"):
+    """
+    SET fragment that writes the bound new status only when the row's current status allows it,
+    e.g. status = CASE WHEN status IN ('Pending', ...) THEN ? ELSE status END. Binds one parameter.
+    """
+    # สถานะมาจาก TRANSITIONS เท่านั้น จึงใส่เป็น Literal ใน SQL ได้ปลอดภัย
+    sources = ", ".join(f"'{status}'" for status in allowed_sources(new_status))
+    return f"{column} = CASE WHEN {column} IN ({sources}) THEN ? ELSE {column} END"
@@ -0,0 +1,153 @@
+# task_traces.py
+
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+import metrics
+from database import execute_write, get_connection
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# =========================================================================
+# 🟢 Trace ของ Agent (ตาราง task_traces)
+# เดิม tasks.using_sql เก็บเพียงข้อความ SQL/Tool ที่ตัดมาจากคำตอบ และอยู่ในแถวเดียวกับที่ทุก Inbox Query สแกน
+# ตอนนี้ intermediate_steps ทั้งหมดที่ AgentExecutor คืนมา (return_intermediate_steps=True) ถูกเก็บแยก
+# บีบอัดด้วย zstd (ถ้าไม่มี zstandard ใช้ zlib) หนึ่งแถวต่อ task_id และอ่านเฉพาะตอนแอดมินเปิดดู Task
+# tasks.using_sql เหลือเพียงสรุปสั้น ๆ (ไม่เกิน TASK_USING_SQL_MAX_CHARS)
+# =========================================================================
+
+# Observation ของ Tool หนึ่งครั้ง (เช่นผล SQL หลายพันแถว) ถูกตัดที่ความยาวนี้
+TASK_TRACE_MAX_OBSERVATION_CHARS = int(os.getenv("TASK_TRACE_MAX_OBSERVATION_CHARS", "20000"))
+TASK_TRACE_RETENTION_DAYS = float(os.getenv("TASK_TRACE_RETENTION_DAYS", "90"))
+TASK_USING_SQL_MAX_CHARS = int(os.getenv("TASK_USING_SQL_MAX_CHARS", "200"))
+
+_ZSTD_LEVEL = 3
+_ZLIB_LEVEL = 6
+
+
+def _truncate(text, max_chars):
+    return text if len(text) <= max_chars else text[:max_chars] + f"… [{len(text) - max_chars} chars truncated]"
+
+
+def _jsonable(value):
+    """Tool inputs/observations as JSON values (anything else becomes its str())."""
+    try:
+        json.dumps(value, ensure_ascii=False)
+        return value
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def serialize_steps(intermediate_steps):
+    """Turns [(AgentAction, observation), ...] into a list of plain dicts."""
+    steps = []
+    for step in intermediate_steps or ():
+        action, observation = step if isinstance(step, (tuple, list)) and len(step) == 2 else (step, None)
+        observation = observation if isinstance(observation, str) else json.dumps(_jsonable(observation), ensure_ascii=False)
+        steps.append({
+            "tool": getattr(action, "tool", None),
+            "tool_input": _jsonable(getattr(action, "tool_input", None)),
+            "tool_call_id": getattr(action, "tool_call_id", None),
+            "log": getattr(action, "log", str(action)),
+            "observation": _truncate(observation, TASK_TRACE_MAX_OBSERVATION_CHARS),
+        })
+    return steps
+
+
+def encode_trace(trace):
+    """Returns (codec, raw_bytes, payload) for a trace dict."""
+    raw = json.dumps(trace, ensure_ascii=False).encode("utf-8")
+    if zstandard is not None:
+        return "zstd", len(raw), zstandard.ZstdCompressor(level=_ZSTD_LEVEL).compress(raw)
+    return "zlib", len(raw), zlib.compress(raw, _ZLIB_LEVEL)
+
+
+def decode_trace(codec, payload):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("this trace is zstd-compressed but the zstandard package is not installed")
+        raw = zstandard.ZstdDecompressor().decompress(payload)
+    elif codec == "zlib":
+        raw = zlib.decompress(payload)
+    else:
+        raise ValueError(f"Unknown trace codec: {codec!r}")
+    return json.loads(raw)
+
+
+def using_sql_summary(command, max_chars=TASK_USING_SQL_MAX_CHARS):
+    """The short form of a SQL/Tool command kept in tasks.using_sql (the full text lives in the trace)."""
+    if not command or len(command) <= max_chars:
+        return command
+    return command[:max_chars - 1] + "…"
+
+
+def save_trace(task_id, user_id, response, command=None, budget=None):
+    """
+    Stores the agent's intermediate steps for a task (replacing an earlier attempt's trace).
+    Never raises: a trace that cannot be written must not fail the task. Returns True when stored.
+    """
+    try:
+        trace = {
+            "output": response.get("output"),
+            "command": command,
+            "steps": serialize_steps(response.get("intermediate_steps")),
+        }
+        if response.get("route"):
+            trace["route"] = response["route"]
+        if budget is not None:
+            trace["usage"] = {
+                "llm_calls": budget.llm_calls,
+                "tokens": budget.tokens,
+                "prompt_tokens": budget.prompt_tokens,
+                "cached_prompt_tokens": budget.cached_prompt_tokens,
+                "seconds": round(budget.elapsed_seconds(), 3),
+            }
+        codec, raw_bytes, payload = encode_trace(trace)
+        execute_write("""
+            INSERT OR REPLACE INTO task_traces (task_id, user_id, codec, raw_bytes, payload, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (task_id, str(user_id), codec, raw_bytes, payload, time.time()))
+    except Exception as e:
+        print(f"Could not store agent trace for task {task_id}: {e}")
+        return False
+    metrics.increment("task_traces_saved")
+    metrics.observe("task_trace_bytes", len(payload))
+    return True
+
+
+def load_trace(task_id, user_id=None):
+    """Returns the decoded trace of a task (only if it belongs to user_id when given), or None."""
+    conn = get_connection()
+    try:
+        sql = "SELECT codec, raw_bytes, payload, created_at FROM task_traces WHERE task_id = ?"
+        params = (task_id,)
+        if user_id is not None:
+            sql += " AND user_id = ?"
+            params += (str(user_id),)
+        row = conn.execute(sql, params).fetchone()
+    except sqlite3.Error as e:
+        print(f"Database error loading agent trace: {e}")
+        return None
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    codec, raw_bytes, payload, created_at = row
+    trace = decode_trace(codec, payload)
+    trace.update({"task_id": task_id, "created_at": created_at, "raw_bytes": raw_bytes, "stored_bytes": len(payload)})
+    return trace
+
+
+def prune_traces(retention_days=TASK_TRACE_RETENTION_DAYS):
+    """Deletes traces older than the retention window. Returns the number of rows removed."""
+    try:
+        return execute_write("DELETE FROM task_traces WHERE created_at < ?", (time.time() - retention_days * 86400,))["rowcount"]
+    except sqlite3.Error as e:
+        print(f"Database error pruning agent traces: {e}")
+        return 0
@@ -0,0 +1,143 @@
+# vector_index.py
+
+import os
+import re
+import threading
+
+from langchain_community.vectorstores import Chroma
+from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+from async_runtime import ensure_event_loop
+
+# =========================================================================
+# 🟢 Vector Index กลางสำหรับทุกร้าน (Multi-tenant Chroma Collection)
+# เดิมทุกข้อความสร้าง Chroma Client และ Embedding Client ใหม่ และแต่ละร้านมี Collection ของตัวเอง (store_<id>_knowledge)
+# ร้านนับพันจึงเท่ากับ Collection นับพันบนดิสก์/ใน Memory
+# ที่นี่มี Client, Embedding และ Collection เดียวตลอดอายุ Process แยกข้อมูลร้านด้วย Metadata store_id
+# และค้นด้วย filter={"store_id": ...} แทนการเปิด Collection ของร้าน
+# =========================================================================
+
+CHROMA_PERSIST_DIRECTORY = os.getenv("CHROMA_PERSIST_DIRECTORY", "./chroma_vector_db/")
+KNOWLEDGE_COLLECTION = os.getenv("KNOWLEDGE_COLLECTION", "knowledge_base")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-004")
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "3"))
+# "chroma" (Collection กลาง) หรือ "numpy" (ไฟล์ float32 ต่อร้าน ดู numpy_vector_index.py)
+RAG_BACKEND = os.getenv("RAG_BACKEND", "chroma")
+
+_LEGACY_COLLECTION = re.compile(r"^store_(?P<store_id>.+)_knowledge$")
+
+_lock = threading.Lock()
+_client = None
+_embeddings = None
+_vector_store = None
+# ร้านที่ตรวจแล้วว่ามีเอกสารใน Collection กลาง (ต่อ Process)
+_indexed_stores = set()
+
+
+def get_chroma_client():
+    """Returns the process-wide persistent Chroma client."""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                import chromadb
+                _client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIRECTORY)
+    return _client
+
+
+def get_embeddings():
+    """Returns the process-wide embedding client."""
+    global _embeddings
+    if _embeddings is None:
+        with _lock:
+            if _embeddings is None:
+                # Client ของ Embedding ต้องมี Event Loop ใน Thread ที่สร้าง
+                ensure_event_loop()
+                _embeddings = GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL)
+    return _embeddings
+
+
+def get_knowledge_vector_store(embedding_function=None):
+    """Returns the shared LangChain Chroma wrapper over the single knowledge collection."""
+    global _vector_store
+    if _vector_store is None:
+        client = get_chroma_client()
+        embedding_function = embedding_function or get_embeddings()
+        with _lock:
+            if _vector_store is None:
+                _vector_store = Chroma(
+                    client=client,
+                    collection_name=KNOWLEDGE_COLLECTION,
+                    embedding_function=embedding_function,
+                )
+    return _vector_store
+
+
+def ensure_store_indexed(store_id):
+    """Indexes the store's knowledge_base rows on first use (in batches, see kb_indexer.py). Returns False when the store has no knowledge."""
+    from kb_indexer import get_checkpoint, index_store
+    store_id = str(store_id)
+    if store_id in _indexed_stores:
+        return True
+    # Vector ที่ย้ายมาจาก Collection เดิม (ไม่มี Checkpoint) ใช้ได้เลย
+    collection = get_knowledge_vector_store()._collection
+    if get_checkpoint(store_id, "chroma") is None and collection.get(where={"store_id": store_id}, limit=1, include=[])["ids"]:
+        _indexed_stores.add(store_id)
+        return True
+
+    if not index_store(store_id, backend="chroma")["rows"]:
+        return False
+    _indexed_stores.add(store_id)
+    return True
+
+
+def remove_store_vectors(store_id):
+    """Deletes every vector of a store (e.g. before re-indexing its knowledge base)."""
+    store_id = str(store_id)
+    if RAG_BACKEND == "numpy":
+        from numpy_vector_index import remove_numpy_store_vectors
+        return remove_numpy_store_vectors(store_id)
+    get_knowledge_vector_store()._collection.delete(where={"store_id": store_id})
+    _indexed_stores.discard(store_id)
+
+
+def get_store_retriever(store_id, k=RAG_TOP_K):
+    """Retriever over the shared collection restricted to one store, or None when the store has no knowledge."""
+    if RAG_BACKEND == "numpy":
+        from numpy_vector_index import get_numpy_store_retriever
+        return get_numpy_store_retriever(store_id, k, get_embeddings())
+    if not ensure_store_indexed(store_id):
+        return None
+    return get_knowledge_vector_store().as_retriever(search_kwargs={"k": k, "filter": {"store_id": str(store_id)}})
+
+
+def migrate_legacy_collections(delete_after=False):
+    """
+    Copies vectors from the old per-store collections (store_<id>_knowledge) into the shared collection,
+    reusing the stored embeddings so nothing is re-embedded. Returns the number of vectors copied.
+    """
+    client = get_chroma_client()
+    target = get_knowledge_vector_store()._collection
+    copied = 0
+    for collection in client.list_collections():
+        name = getattr(collection, "name", collection)
+        match = _LEGACY_COLLECTION.match(name)
+        if not match:
+            continue
+        store_id = match.group("store_id")
+        data = client.get_collection(name).get(include=["embeddings", "documents", "metadatas"])
+        if not data["ids"]:
+            continue
+        metadatas = [dict(metadata or {}, store_id=store_id) for metadata in data["metadatas"]]
+        ids = [f"{store_id}:legacy:{legacy_id}" for legacy_id in data["ids"]]
+        target.upsert(ids=ids, embeddings=data["embeddings"], documents=data["documents"], metadatas=metadatas)
+        copied += len(ids)
+        _indexed_stores.add(store_id)
+        print(f"Migrated {len(ids)} vectors of store {store_id} from '{name}'.")
+        if delete_after:
+            client.delete_collection(name)
+    return copied
+
+
+if __name__ == "__main__":
+    print(f"{migrate_legacy_collections(delete_after=os.getenv('DELETE_LEGACY_COLLECTIONS') == '1')} vectors migrated into '{KNOWLEDGE_COLLECTION}'.")
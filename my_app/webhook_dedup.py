@@ -0,0 +1,151 @@
+# webhook_dedup.py
+
+import collections
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+from database import execute_write
+
+# =========================================================================
+# 🟢 Idempotent Webhook (กัน Event ซ้ำจาก LINE)
+# เมื่อ callback ตอบช้าเกินเวลาที่ LINE รอ LINE จะส่ง Event เดิมซ้ำ (deliveryContext.isRedelivery = true)
+# เดิมทำให้ add_new_task บันทึกแถวซ้ำ และ Agent ตอบลูกค้าซ้ำอีกครั้ง
+#   - webhookEventId ทุกตัวที่รับแล้วถูกบันทึกในตาราง webhook_events (INSERT OR IGNORE เป็นจุดตัดสินแบบ Atomic
+#     จึงใช้ได้แม้มีหลาย Web Worker)
+#   - LRU ใน Memory ตอบ Event ซ้ำที่เพิ่งเห็นได้ทันทีโดยไม่ต้องเขียน DB
+#   - แถวที่เก่ากว่า WEBHOOK_DEDUP_TTL จะถูกลบเป็นระยะ ตารางจึงมีขนาดจำกัด
+# =========================================================================
+
+WEBHOOK_DEDUP_TTL = float(os.getenv("WEBHOOK_DEDUP_TTL", str(24 * 3600)))
+WEBHOOK_DEDUP_MEMORY_SIZE = int(os.getenv("WEBHOOK_DEDUP_MEMORY_SIZE", "10000"))
+WEBHOOK_DEDUP_PRUNE_INTERVAL = float(os.getenv("WEBHOOK_DEDUP_PRUNE_INTERVAL", "600"))
+
+_recent_ids = collections.OrderedDict()
+_lock = threading.Lock()
+_last_pruned_at = 0.0
+
+
+def _remember(webhook_event_id):
+    with _lock:
+        _recent_ids[webhook_event_id] = True
+        _recent_ids.move_to_end(webhook_event_id)
+        while len(_recent_ids) > WEBHOOK_DEDUP_MEMORY_SIZE:
+            _recent_ids.popitem(last=False)
+
+
+def _seen_recently(webhook_event_id):
+    with _lock:
+        return webhook_event_id in _recent_ids
+
+
+def prune_webhook_events(max_age_seconds=WEBHOOK_DEDUP_TTL):
+    """Deletes dedup records older than max_age_seconds. Returns the number of rows removed."""
+    try:
+        result = execute_write(
+            "DELETE FROM webhook_events WHERE received_at < ?",
+            (time.time() - max_age_seconds,),
+        )
+        return result["rowcount"]
+    except sqlite3.Error as e:
+        print(f"Database error pruning webhook events: {e}")
+        return 0
+
+
+def _maybe_prune():
+    global _last_pruned_at
+    now = time.monotonic()
+    with _lock:
+        if now - _last_pruned_at < WEBHOOK_DEDUP_PRUNE_INTERVAL:
+            return
+        _last_pruned_at = now
+    removed = prune_webhook_events()
+    if removed:
+        print(f"Pruned {removed} expired webhook dedup records.")
+
+
+def claim_webhook_event(user_id, event):
+    """
+    Returns True if this event has not been processed before and the caller should handle it.
+    Returns False for a duplicate (already claimed by this or another process).
+    Events without a webhookEventId are always processed.
+    """
+    webhook_event_id = getattr(event, "webhook_event_id", None)
+    delivery_context = getattr(event, "delivery_context", None)
+    is_redelivery = bool(getattr(delivery_context, "is_redelivery", False))
+
+    metrics.increment("webhook_events", store=user_id)
+    if is_redelivery:
+        metrics.increment("webhook_redeliveries", store=user_id)
+    if not webhook_event_id:
+        return True
+
+    if _seen_recently(webhook_event_id):
+        metrics.increment("webhook_duplicates", store=user_id)
+        return False
+
+    try:
+        result = execute_write("""
+            INSERT OR IGNORE INTO webhook_events (webhook_event_id, user_id, is_redelivery, received_at)
+            VALUES (?, ?, ?, ?)
+            RETURNING webhook_event_id
+        """, (webhook_event_id, user_id, int(is_redelivery), time.time()))
+    except sqlite3.Error as e:
+        # ถ้าบันทึกไม่ได้ ให้ประมวลผลต่อ (ตอบซ้ำดีกว่าไม่ตอบเลย)
+        print(f"Database error recording webhook event {webhook_event_id}: {e}")
+        return True
+
+    _remember(webhook_event_id)
+    _maybe_prune()
+    if not result["rows"]:
+        metrics.increment("webhook_duplicates", store=user_id)
+        print(f"Skipping duplicate webhook event {webhook_event_id} (redelivery={is_redelivery}).")
+        return False
+    return True
+
+
+def release_webhook_event(event):
+    """Forgets a claimed event after its processing failed, so LINE's redelivery is handled again."""
+    webhook_event_id = getattr(event, "webhook_event_id", None)
+    if not webhook_event_id:
+        return
+    with _lock:
+        _recent_ids.pop(webhook_event_id, None)
+    try:
+        execute_write("DELETE FROM webhook_events WHERE webhook_event_id = ?", (webhook_event_id,))
+    except sqlite3.Error as e:
+        print(f"Database error releasing webhook event {webhook_event_id}: {e}")
+
+
+def idempotent_handler(user_id):
+    """Decorator for LINE event handlers: skips duplicate events and releases the claim if the handler fails."""
+    def decorator(handler_function):
+        # รับเฉพาะ event เพราะ WebhookHandler เลือกส่ง destination ตามจำนวน Argument ของ Handler
+        def wrapper(event):
+            if not claim_webhook_event(user_id, event):
+                return None
+            try:
+                return handler_function(event)
+            except Exception:
+                release_webhook_event(event)
+                raise
+        wrapper.__name__ = handler_function.__name__
+        wrapper.__doc__ = handler_function.__doc__
+        return wrapper
+    return decorator
+
+
+def dedup_stats():
+    """Collector for /api/metrics: total events, duplicates and the dedup rate."""
+    total = sum(metrics.get_counter_series("webhook_events").values())
+    duplicates = sum(metrics.get_counter_series("webhook_duplicates").values())
+    return {
+        "events": total,
+        "duplicates": duplicates,
+        "dedup_rate": duplicates / total if total else 0.0,
+    }
+
+
+metrics.register_collector("webhook_dedup", dedup_stats)
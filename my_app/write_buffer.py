@@ -0,0 +1,167 @@
+# write_buffer.py
+
+import datetime
+import os
+import sqlite3
+import threading
+
+import metrics
+from database import execute_write_many, notify_task_changes, TASK_RETURNING_CLAUSE
+from task_status import is_valid_status, status_assignment
+
+# =========================================================================
+# 🟢 Write-behind Buffer สำหรับการอัปเดตตาราง tasks
+# แต่ละข้อความเคยเขียน DB แยกกัน 3 ครั้ง (response, status, status อีกรอบ) แต่ละครั้งเป็น Transaction ของตัวเอง
+# Buffer นี้รวมการอัปเดตของ task_id เดียวกันเป็น UPDATE เดียว และรวมทุก task ที่ค้างอยู่เป็น Transaction เดียว
+#
+# สัญญาความคงทน (Durability Contract):
+#   commit_task_response() จะคืนค่าก็ต่อเมื่อคำตอบถูก Commit ลง DB แล้วเท่านั้น
+#   จึงต้องเรียกก่อนส่งข้อความหาลูกค้าเสมอ ส่วน stage_task_status() เป็นแบบ Fire-and-forget
+# =========================================================================
+
+FLUSH_INTERVAL = float(os.getenv("TASK_WRITE_FLUSH_INTERVAL", "0.05"))
+MAX_PENDING = int(os.getenv("TASK_WRITE_MAX_PENDING", "100"))
+
+# คอลัมน์ของ tasks ที่อนุญาตให้เขียนผ่าน Buffer
+_WRITABLE_COLUMNS = ("ai_response", "using_sql", "admin_response", "status", "response_timestamp")
+
+
+class TaskWriteBuffer:
+    """Coalesces per-task column updates and flushes them in one transaction on a timer or when full."""
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._staged_generation = 0
+        self._flushed_generation = 0
+        self._failed_generation = 0
+        self._thread = threading.Thread(target=self._run, name="task-write-buffer", daemon=True)
+        self._thread.start()
+
+    def stage(self, task_id, **fields):
+        """Merges column updates for task_id into the buffer and returns the generation that contains them."""
+        unknown = set(fields) - set(_WRITABLE_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unsupported task columns: {sorted(unknown)}")
+        if "status" in fields and not is_valid_status(fields["status"]):
+            raise ValueError(f"Unknown task status: {fields['status']!r}")
+
+        with self._cond:
+            entry = self._pending.setdefault(task_id, {})
+            if entry:
+                metrics.increment("task_writes_coalesced")
+            entry.update(fields)
+            self._staged_generation += 1
+            generation = self._staged_generation
+            # ปลุก Thread ที่ Flush เสมอ: Update ที่ไม่มีใครรอ commit() (เช่น stage_task_status) ต้องถูกเขียนในรอบเวลาเช่นกัน
+            self._cond.notify_all()
+        return generation
+
+    def commit(self, generation=None, timeout=10):
+        """
+        Blocks until everything staged up to generation (default: now) is committed.
+        Concurrent callers share the same flush, so N responses cost one transaction.
+        Returns True when committed, False if the flush failed or timed out.
+        """
+        with self._cond:
+            if generation is None:
+                generation = self._staged_generation
+            self._cond.notify_all()
+            committed = self._cond.wait_for(
+                lambda: self._flushed_generation >= generation or self._failed_generation >= generation,
+                timeout=timeout,
+            )
+            return bool(committed) and self._flushed_generation >= generation
+
+    def flush(self):
+        """Writes every pending update in a single transaction."""
+        with self._flush_lock:
+            with self._cond:
+                if not self._pending:
+                    return
+                batch = self._pending
+                generation = self._staged_generation
+                self._pending = {}
+
+            statements = []
+            for task_id, fields in batch.items():
+                columns = [column for column in _WRITABLE_COLUMNS if column in fields]
+                # status ถูกเขียนเฉพาะเมื่อ State Machine อนุญาต (task_status.py)
+                assignments = ", ".join(status_assignment(fields[column]) if column == "status" else f"{column} = ?" for column in columns)
+                params = tuple(fields[column] for column in columns) + (task_id,)
+                statements.append((f"UPDATE tasks SET {assignments} WHERE task_id = ? {TASK_RETURNING_CLAUSE}", params))
+
+            try:
+                results = execute_write_many(statements)
+            except sqlite3.Error as e:
+                print(f"Database error flushing task updates: {e}")
+                with self._cond:
+                    # คืนค่าที่ยังไม่ถูกเขียนกลับเข้า Buffer (ค่าที่ Stage ใหม่กว่าจะทับค่าเก่า)
+                    for task_id, fields in batch.items():
+                        merged = dict(fields)
+                        merged.update(self._pending.get(task_id, {}))
+                        self._pending[task_id] = merged
+                    self._failed_generation = max(self._failed_generation, generation)
+                    self._cond.notify_all()
+                return
+
+            metrics.increment("task_write_flushes")
+            metrics.increment("task_write_rows", len(statements))
+            # แจ้ง Listener ก่อนปล่อยผู้รอ เพื่อให้ข้อความถัดไปของบทสนทนาเห็นคำตอบนี้แน่นอน
+            notify_task_changes(results)
+            with self._cond:
+                self._flushed_generation = max(self._flushed_generation, generation)
+                self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._pending and self._staged_generation > self._flushed_generation,
+                )
+                # รอให้ครบรอบเวลา เพื่อรวม Update ของงานอื่นเข้ามาใน Transaction เดียวกัน (Group Commit)
+                self._cond.wait_for(lambda: len(self._pending) >= self.max_pending, timeout=self.flush_interval)
+            self.flush()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_task_write_buffer():
+    """Returns the process-wide TaskWriteBuffer (created on first use)."""
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = TaskWriteBuffer()
+        return _buffer
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def stage_task_status(task_id, new_status):
+    """Buffers a status change; it is committed with the next flush."""
+    return get_task_write_buffer().stage(task_id, status=new_status)
+
+
+def stage_task_response(task_id, response, sql_text, status="Responded"):
+    """Buffers the AI response together with its final status as one coalesced row update."""
+    return get_task_write_buffer().stage(
+        task_id,
+        ai_response=response,
+        using_sql=sql_text,
+        status=status,
+        response_timestamp=_now(),
+    )
+
+
+def commit_task_response(task_id, response, sql_text, status="Responded"):
+    """Stages the AI response and waits until it is durable. Send to the customer only if this returns True."""
+    buffer = get_task_write_buffer()
+    generation = stage_task_response(task_id, response, sql_text, status)
+    return buffer.commit(generation)